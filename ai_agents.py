@@ -1,31 +1,117 @@
 # ai_agent.py
 
-import re
-import os
-from questionnaire_data import QUESTIONNAIRE_STRUCTURE, GOOGLE_SHEET_HEADERS, GOOGLE_SHEET_ID, SERVICE_ACCOUNT_FILE
-from google_sheets_service import get_google_sheet_client, append_row_to_sheet
-from ai_nlu_layer import AINLULayer
-import time # 用於模擬思考時間
+from questionnaire_data import SUBMISSION_ID_HEADER
+from questionnaire_model import DEFAULT_QUESTIONNAIRE
+from google_sheets_service import get_default_sheet_client
+from answer_analytics import ANALYTICS
+from result_stores import get_result_store_for
+from ai_nlu_layer import AINLULayer, current_turn_usage
+from chat_memory import ChatMemory
+from session_store import SessionState
+from metrics import METRICS
+from rule_extractor import END_COMMANDS, get_rule_extractor
+import asyncio
+import time
+import uuid
+from collections import deque
+
+class TurnPipelineStats:
+    """
+    回合管線統計：預先生成的下一步提示命中率、澄清提示的 LLM 呼叫次數，以及回合的首段輸出延遲 (TTFT)。
+    """
+    def __init__(self, max_samples=1000):
+        self.speculations = 0
+        self.speculation_hits = 0
+        self.clarification_failures = 0
+        self.clarification_calls = 0
+        self.ttft_samples = deque(maxlen=max_samples)
+
+    def record_ttft(self, seconds):
+        self.ttft_samples.append(seconds)
+
+    def _ttft_percentile(self, p):
+        if not self.ttft_samples:
+            return 0.0
+        ordered = sorted(self.ttft_samples)
+        return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1000, 2)
+
+    def summary(self):
+        return {
+            "turn_ttft_p50_ms": self._ttft_percentile(50),
+            "turn_ttft_p95_ms": self._ttft_percentile(95),
+            "speculations": self.speculations,
+            "speculation_hits": self.speculation_hits,
+            "speculation_hit_rate": round(self.speculation_hits / self.speculations, 4) if self.speculations else 0.0,
+            "clarification_failures": self.clarification_failures,
+            "clarification_calls": self.clarification_calls,
+        }
+
+TURN_PIPELINE_STATS = TurnPipelineStats()
 
 class QuestionnaireAgent:
-    def __init__(self):
-        self.question_structure = QUESTIONNAIRE_STRUCTURE
-        self.collected_answers = {q["id"]: None for q in QUESTIONNAIRE_STRUCTURE}
+    END_COMMANDS = END_COMMANDS
+
+    def __init__(self, nlu_agent=None, rule_extractor=None, clarification_mode="merged", speculative_next_prompt=True, questionnaire=None,
+                 result_store=None, history_size=32, summarize_history=True, summary_batch=16, submission_id=None):
+        """
+        clarification_mode: "merged" 將多個驗證失敗合併為一次 LLM 呼叫；"concurrent" 每個失敗一次呼叫但同時發出；
+                            "sequential" 為逐一呼叫的舊行為。
+        speculative_next_prompt: 在等待 LLM 提取答案的同時，預先生成「使用者回答了上一輪提及問題」情況下的下一步提示。
+        questionnaire: questionnaire_model.CompiledQuestionnaire，預設為 DEFAULT_QUESTIONNAIRE。
+        result_store: result_stores.ResultStore，預設依 questionnaire_data.RESULT_STORE 設定建立 (每份問卷各自的後端)。
+        history_size: 對話歷史環形緩衝區保存的最近訊息數。
+        summarize_history: 為 True 時，被擠出的訊息每累積 summary_batch 則就在背景併入滾動摘要。
+        submission_id: 寫入結果時的提交識別碼，同一個 id 只會寫入一次；None 時每次 astart() (每一次作答) 產生新的 id，
+                       並隨會話快照保存，從快照恢復後重送「結束」仍對應同一份提交。
+        """
+        self.questionnaire = questionnaire if questionnaire is not None else DEFAULT_QUESTIONNAIRE
+        self.question_structure = self.questionnaire.questions
+        self.collected_answers = {q_id: None for q_id in self.questionnaire.headers}
         
-        self.unanswered_questions_ids = set(q["id"] for q in QUESTIONNAIRE_STRUCTURE)
-        self.unanswered_questions_ids.discard("detailed_dissatisfaction_reason") 
+        # 條件 (show_if / required_if) 的初始結果在問卷編譯時已算好；之後只在答案變動時重新評估其下游問題
+        self._hidden = set(self.questionnaire.initial_hidden)
+        self._required = set(self.questionnaire.initial_required)
+        self.condition_evaluations = 0
+        # 被隱藏的問題不算未回答
+        self.unanswered_questions_ids = set(self.questionnaire.headers) - self._hidden
+        # 以下兩個集合隨答案變化增量維護，不必每回合重新掃描整份問卷
+        self._answered_ids = set()
+        self._pending_required = self.unanswered_questions_ids & self._required
 
         self.gs_client = None
-        self.nlu_agent = None
-        self.chat_history = []
-        self.total_questions_count = len(QUESTIONNAIRE_STRUCTURE)
+        self.result_store = result_store # 第一次儲存時才建立預設後端
+        self._fixed_submission_id = submission_id
+        self.submission_id = submission_id
+        self.nlu_agent = nlu_agent # 多會話時可共用同一個 AINLULayer
+        # 簡單回答 (數字、是/否、email、年齡) 先以本地規則提取，命中時不呼叫 LLM
+        if rule_extractor is None:
+            rule_extractor = get_rule_extractor(self.questionnaire)
+        self.rule_extractor = rule_extractor
+        self.chat_history = ChatMemory(history_size, self._summarize_history if summarize_history else None, summary_batch)
+        self.total_questions_count = len(self.questionnaire)
+
+        self.finished = False
+        self.awaiting_exit_confirmation = False
+        self._pending_farewell = None
+        self._turn_output = []
+        self._on_chunk = None # 串流模式下的輸出回呼 (每回合設定)
+        self._turn_started_at = None
+        self._first_output_at = None
+
+        self.clarification_mode = clarification_mode
+        self.speculative_next_prompt = speculative_next_prompt
+        self._last_prompted_ids = set() # 上一輪提示語中具體詢問的問題
+        self._speculation = None # (預測的未回答問題集合, asyncio.Task)
+
+        # 每回合與整個會話的 token 用量
+        self.last_turn_token_usage = None
+        self.session_token_usage = self._new_usage_counter()
+        # 最近一回合各階段的耗時 (毫秒)，指標停用時為 None
+        self.last_turn_trace = None
 
     def _initialize_gs_client(self):
         if not self.gs_client:
-            if not os.path.exists(SERVICE_ACCOUNT_FILE):
-                print(f"錯誤：服務帳戶文件 '{SERVICE_ACCOUNT_FILE}' 不存在。無法連接 Google Sheets。")
-                return None
-            self.gs_client = get_google_sheet_client(SERVICE_ACCOUNT_FILE)
+            self.gs_client = get_default_sheet_client() # 程序內共用同一個客戶端
         return self.gs_client
     
     def _initialize_nlu_agent(self):
@@ -40,26 +126,15 @@ class QuestionnaireAgent:
         return self.nlu_agent
 
     def _get_question_obj_by_id(self, q_id):
-        for q in self.question_structure:
-            if q["id"] == q_id:
-                return q
-        return None
+        return self.questionnaire.by_id.get(q_id)
 
     def _validate_extracted_answer(self, question_obj, extracted_answer):
         q_id = question_obj["id"]
-        q_type = question_obj.get("type")
-        validation_rule = question_obj.get("validation_rule")
-        options = question_obj.get("options", [])
-
-        is_required = False
-        if validation_rule == "required":
-            is_required = True
-        elif validation_rule == "required_if_triggered" and q_id == "detailed_dissatisfaction_reason":
-            product_satisfaction = self.collected_answers.get("product_satisfaction")
-            if product_satisfaction is not None and product_satisfaction in [1, 2]:
-                is_required = True
-            if not is_required:
-                return True, None, None 
+
+        # 目前被隱藏的問題不接受答案
+        if q_id in self._hidden:
+            return True, None, None 
+        is_required = q_id in self._required
 
         # 如果提取的答案是 None 或空字串
         if extracted_answer is None or (isinstance(extracted_answer, str) and not extracted_answer.strip()):
@@ -68,48 +143,19 @@ class QuestionnaireAgent:
             else: # 非必填，且答案為空，視為有效，但答案為 None
                 return True, None, None 
 
-        # 類型和規則驗證 (對於非空答案)
-        if q_type == "number":
-            try:
-                num_input = int(extracted_answer)
-                if validation_rule == "range_1_5" and not (1 <= num_input <= 5):
-                    return False, None, "您提供的數字不在有效範圍 (1-5) 內。"
-                return True, num_input, None 
-            except ValueError:
-                return False, None, "無法將您的回答轉換為有效的數字。請確保您的回答包含數字。"
-        elif q_type == "select":
-            matched_option = None
-            for opt in options:
-                if isinstance(extracted_answer, str) and extracted_answer.lower() == opt.lower():
-                    matched_option = opt
-                    break
-            if matched_option:
-                return True, matched_option, None
-            else:
-                # 嘗試更寬鬆的匹配：如果 extracted_answer 只是數字，且選項也是數字
-                if isinstance(extracted_answer, (int, str)) and str(extracted_answer).isdigit():
-                    for opt in options: # e.g. age_group 37 -> "35-44"
-                        if '-' in opt:
-                            try:
-                                low, high = map(int, opt.split('-'))
-                                if low <= int(extracted_answer) <= high:
-                                    return True, opt, None
-                            except ValueError:
-                                pass
-                return False, None, f"您選擇的選項不在有效列表中。請從以下選項中選擇一個：{', '.join(options)}。"
-        elif q_type == "boolean":
-            if isinstance(extracted_answer, str):
-                if extracted_answer.lower() in ["是", "yes"]:
-                    return True, "是", None
-                elif extracted_answer.lower() in ["否", "no"]:
-                    return True, "否", None
-            return False, None, "無法將您的回答解析為 '是' 或 '否'。請嘗試更直接的回答。"
-        elif q_type == "text":
-            if validation_rule == "email":
-                if not re.match(r"[^@]+@[^@]+\.[^@]+", str(extracted_answer)):
-                    return False, None, "您提供的電子郵件格式無效。請輸入一個有效的電子郵件地址。"
-        
-        return True, extracted_answer, None
+        # 類型和規則驗證 (對於非空答案)，驗證函式在問卷編譯時已預先建立
+        return self.questionnaire.validators[q_id](extracted_answer)
+
+    def _extraction_failures(self, extracted_answers):
+        """
+        供 NLU 層判斷是否升級模型：返回未通過 _validate_extracted_answer 的 [(question_id, value)]，不存在的問題 id 也算在內。
+        """
+        failures = []
+        for q_id, value in extracted_answers.items():
+            question_obj = self._get_question_obj_by_id(q_id)
+            if question_obj is None or not self._validate_extracted_answer(question_obj, value)[0]:
+                failures.append((q_id, value))
+        return failures
 
     def _update_answers_and_unanswered_status(self, q_id, validated_answer):
         is_actually_updated = False 
@@ -117,14 +163,14 @@ class QuestionnaireAgent:
 
         # 只有當有實際的、非 None 的答案被提供，並且與舊答案不同時，才算「更新」
         if validated_answer is not None and old_answer != validated_answer:
-            self.collected_answers[q_id] = validated_answer
+            self._set_answer(q_id, validated_answer)
             is_actually_updated = True
             
             if q_id in self.unanswered_questions_ids: # 如果之前是未回答
-                self.unanswered_questions_ids.discard(q_id)
-                print(f"✅ 已成功獲取 '{self._get_question_obj_by_id(q_id)['question']}' 的答案。")
+                self._remove_from_unanswered(q_id)
+                self._notify(f"✅ 已成功獲取 '{self._get_question_obj_by_id(q_id)['question']}' 的答案。")
             else: # 更新已回答的答案
-                print(f"🔄 已更新 '{self._get_question_obj_by_id(q_id)['question']}' 的答案。")
+                self._notify(f"🔄 已更新 '{self._get_question_obj_by_id(q_id)['question']}' 的答案。")
         elif validated_answer is None and old_answer is not None and q_id not in self.unanswered_questions_ids:
             # 如果之前有答案，現在變成 None (例如被修改為空，或因條件變化而不再需要)
             # 但問題本身並非「未回答」狀態（除非它是必填）
@@ -135,122 +181,411 @@ class QuestionnaireAgent:
             pass # 保持原樣，如果 validated_answer 是 None，不應觸發 "已成功獲取"
 
 
-        # 處理 'product_satisfaction' 的條件邏輯
-        if q_id == "product_satisfaction":
-            detailed_reason_q_id = "detailed_dissatisfaction_reason"
-            detailed_reason_q_obj = self._get_question_obj_by_id(detailed_reason_q_id)
-            
-            current_ps_answer = self.collected_answers.get("product_satisfaction") # 以最新的為準
-
-            if current_ps_answer is not None and current_ps_answer in [1, 2]:
-                if detailed_reason_q_id not in self.unanswered_questions_ids and self.collected_answers.get(detailed_reason_q_id) is None:
-                    self.unanswered_questions_ids.add(detailed_reason_q_id) 
-                    print(f"👉 您的產品滿意度較低，問題 '{detailed_reason_q_obj['question']}' 現為必填。")
-            else: 
-                if detailed_reason_q_id in self.unanswered_questions_ids:
-                    self.unanswered_questions_ids.discard(detailed_reason_q_id) 
-                    if self.collected_answers.get(detailed_reason_q_id) is not None: # 只有當之前有答案才提示跳過
-                        print(f"👉 您的產品滿意度良好，問題 '{detailed_reason_q_obj['question']}' 已被跳過。")
-                if self.collected_answers.get(detailed_reason_q_id) is not None:
-                    self.collected_answers[detailed_reason_q_id] = None
-                    # print(f"👉 先前提供的關於不滿意原因的回答已被清除。") # 這個提示可能太頻繁
+        if is_actually_updated:
+            self._reevaluate_conditions(q_id)
         
         return is_actually_updated
 
-    def start_questionnaire(self):
-        print("--- 正在啟動智能問卷助手... ---")
-        if not self._initialize_nlu_agent():
-            print("初始化失敗，問卷無法啟動。")
+    def _reevaluate_conditions(self, changed_q_id):
+        """
+        只重新評估條件中 (直接或間接) 引用了 changed_q_id 的問題，依拓撲順序處理，
+        因此上游問題被隱藏而清除答案時，下游問題會在同一輪中看到最新狀態。
+        """
+        questionnaire = self.questionnaire
+        for q_id in questionnaire.downstream.get(changed_q_id, ()):
+            self.condition_evaluations += 1
+            visible = questionnaire.is_visible(q_id, self.collected_answers)
+            required = visible and questionnaire.is_required(q_id, self.collected_answers)
+            question_text = questionnaire.by_id[q_id]["question"]
+
+            if required:
+                self._required.add(q_id)
+            else:
+                self._required.discard(q_id)
+
+            if not visible:
+                if q_id not in self._hidden:
+                    self._hidden.add(q_id)
+                    self._remove_from_unanswered(q_id)
+                    if self.collected_answers.get(q_id) is not None: # 只有當之前有答案才提示跳過
+                        self._notify(f"👉 根據您的回答，問題 '{question_text}' 已被跳過。")
+                        self._set_answer(q_id, None)
+                continue
+
+            if q_id in self._hidden:
+                self._hidden.discard(q_id)
+                if self.collected_answers.get(q_id) is None:
+                    self._add_to_unanswered(q_id)
+                    if required:
+                        self._notify(f"👉 根據您的回答，問題 '{question_text}' 現為必填。")
+            elif q_id in self.unanswered_questions_ids:
+                # 仍顯示但必填狀態可能改變 (required_if)
+                self._add_to_unanswered(q_id)
+                if not required:
+                    self._pending_required.discard(q_id)
+
+    def _set_answer(self, q_id, value):
+        self.collected_answers[q_id] = value
+        if value is None:
+            self._answered_ids.discard(q_id)
+        else:
+            self._answered_ids.add(q_id)
+
+    def _remove_from_unanswered(self, q_id):
+        self.unanswered_questions_ids.discard(q_id)
+        self._pending_required.discard(q_id)
+
+    def _add_to_unanswered(self, q_id):
+        self.unanswered_questions_ids.add(q_id)
+        if q_id in self._required:
+            self._pending_required.add(q_id)
+
+    # ---- 對話狀態機 (與終端 I/O 分離，由 session_engine / CLI 等前端呼叫) ----
+
+    def _say(self, text, record=True):
+        self._emit_segment_start()
+        self._emit(text)
+        self._turn_output.append(text)
+        if record:
+            self.chat_history.append({"role": "assistant", "content": text})
+
+    def _notify(self, text):
+        # 狀態提示 (例如已獲取答案) 只顯示給使用者，不寫入對話歷史
+        self._emit_segment_start()
+        self._emit(text)
+        self._turn_output.append(text)
+
+    def _emit_segment_start(self):
+        # 串流輸出的區段分隔與 _flush_output 的 "\n".join 一致，確保串接結果等於完整回覆
+        if self._on_chunk is not None and self._turn_output:
+            self._on_chunk("\n")
+
+    def _emit(self, piece):
+        if not piece:
+            return
+        if self._first_output_at is None:
+            self._first_output_at = time.perf_counter()
+        if self._on_chunk is not None:
+            self._on_chunk(piece)
+
+    async def _say_streamed(self, pieces):
+        """
+        逐塊輸出 LLM 生成的文字，結束後與 _say 一樣記錄到回覆與對話歷史。
+        """
+        self._emit_segment_start()
+        parts = []
+        async for piece in pieces:
+            parts.append(piece)
+            self._emit(piece)
+        text = "".join(parts)
+        self._turn_output.append(text)
+        self.chat_history.append({"role": "assistant", "content": text})
+
+    def _begin_output(self, on_chunk):
+        self._on_chunk = on_chunk
+        self._turn_started_at = time.perf_counter()
+        self._first_output_at = None
+
+    def _end_output(self):
+        if self._first_output_at is not None:
+            TURN_PIPELINE_STATS.record_ttft(self._first_output_at - self._turn_started_at)
+        self._on_chunk = None
+
+    def _flush_output(self):
+        reply = "\n".join(self._turn_output)
+        self._turn_output = []
+        return reply
+
+    def _pending_required_ids(self):
+        return list(self._pending_required)
+
+    def _count_answered(self):
+        # 被隱藏問題的答案會被清除，因此非空答案數即為有效答案數
+        return len(self._answered_ids)
+
+    def _current_unanswered_question_objs(self):
+        by_id = self.questionnaire.by_id
+        return [by_id[q_id] for q_id in self.unanswered_questions_ids if q_id in by_id]
+
+    async def _prompt_next_questions(self):
+        unanswered_objs = self._current_unanswered_question_objs()
+        _, mentioned = self.nlu_agent.select_questions_to_mention(unanswered_objs, self.collected_answers)
+        speculation, self._speculation = self._speculation, None
+        if speculation is not None and speculation[0] == frozenset(self.unanswered_questions_ids):
+            TURN_PIPELINE_STATS.speculation_hits += 1
+            next_prompt = await speculation[1]
+        else:
+            if speculation is not None:
+                speculation[1].cancel()
+            if self._on_chunk is not None:
+                self._last_prompted_ids = {q["id"] for q in mentioned}
+                await self._say_streamed(self.nlu_agent.astream_next_questions_prompt(
+                    unanswered_objs, self.chat_history, self.collected_answers))
+                return
+            next_prompt = await self.nlu_agent.agenerate_next_questions_prompt(unanswered_objs, self.chat_history, self.collected_answers)
+        self._last_prompted_ids = {q["id"] for q in mentioned}
+        self._say(next_prompt)
+
+    def _start_speculative_next_prompt(self):
+        # 預測使用者回答了上一輪提及的問題，提前生成對應的下一步提示，與答案提取同時進行
+        predicted_ids = self.unanswered_questions_ids - self._last_prompted_ids
+        if not predicted_ids or predicted_ids == self.unanswered_questions_ids:
             return
+        predicted_objs = [self._get_question_obj_by_id(q_id) for q_id in predicted_ids]
+        task = asyncio.ensure_future(self.nlu_agent.agenerate_next_questions_prompt(
+            predicted_objs, self.chat_history.copy(), dict(self.collected_answers)))
+        self._speculation = (frozenset(predicted_ids), task)
+        TURN_PIPELINE_STATS.speculations += 1
+
+    def _cancel_speculation(self):
+        if self._speculation is not None:
+            self._speculation[1].cancel()
+            self._speculation = None
+
+    async def _clarify(self, validation_failures):
+        problems = [
+            (failure['question_id'],
+             f"關於「{failure['question_text']}」，您說了「{failure['user_input_segment']}」，但它{failure['reason']}。可以請您再說清楚一點嗎？")
+            for failure in validation_failures
+        ]
+        TURN_PIPELINE_STATS.clarification_failures += len(problems)
+        # 下一輪的回答針對的是要求澄清的問題
+        self._last_prompted_ids = {failure['question_id'] for failure in validation_failures}
+        streaming = self._on_chunk is not None
+        if self.clarification_mode == "merged":
+            TURN_PIPELINE_STATS.clarification_calls += 1
+            if streaming:
+                await self._say_streamed(self.nlu_agent.astream_combined_clarification_prompt(problems, self.chat_history))
+                return
+            prompts = [await self.nlu_agent.agenerate_combined_clarification_prompt(problems, self.chat_history)]
+        elif self.clarification_mode == "concurrent":
+            TURN_PIPELINE_STATS.clarification_calls += len(problems)
+            prompts = await asyncio.gather(*[
+                self.nlu_agent.agenerate_clarification_prompt(q_id, description, self.chat_history)
+                for q_id, description in problems
+            ])
+        else:
+            prompts = []
+            for q_id, description in problems:
+                TURN_PIPELINE_STATS.clarification_calls += 1
+                if streaming:
+                    await self._say_streamed(self.nlu_agent.astream_clarification_prompt(q_id, description, self.chat_history))
+                    continue
+                prompts.append(await self.nlu_agent.agenerate_clarification_prompt(q_id, description, self.chat_history))
+        for clarification_prompt in prompts:
+            self._say(clarification_prompt)
+
+    @staticmethod
+    def _new_usage_counter():
+        return {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_prompt_tokens": 0}
+
+    def _begin_usage_tracking(self):
+        self.last_turn_token_usage = self._new_usage_counter()
+        return current_turn_usage.set(self.last_turn_token_usage)
+
+    def _end_usage_tracking(self, token):
+        current_turn_usage.reset(token)
+        for key, value in self.last_turn_token_usage.items():
+            self.session_token_usage[key] += value
+
+    async def _summarize_history(self, previous_summary, messages):
+        # 摘要在回合結束後的背景執行，用量另外計入會話總用量
+        usage = self._new_usage_counter()
+        token = current_turn_usage.set(usage)
+        try:
+            return await self.nlu_agent.asummarize_history(previous_summary, messages)
+        finally:
+            current_turn_usage.reset(token)
+            for key, value in usage.items():
+                self.session_token_usage[key] += value
+
+    # ---- 會話快照 (session_store) ----
 
-        initial_greeting = self.nlu_agent.generate_initial_greeting_and_guidance()
-        print(f"\nAI: {initial_greeting}")
-        self.chat_history.append({"role": "assistant", "content": initial_greeting})
-        print("-" * 30)
+    def snapshot(self, session_id, turn):
+        """
+        返回可序列化的 SessionState，供每回合結束後寫入 session_store。
+        """
+        messages, summary, pending = self.chat_history.export_state()
+        return SessionState(
+            session_id, self.questionnaire.version, turn, dict(self.collected_answers),
+            sorted(self.unanswered_questions_ids), sorted(self._hidden), sorted(self._required),
+            sorted(self._last_prompted_ids), self.finished, self.awaiting_exit_confirmation, self._pending_farewell,
+            messages, summary, pending, dict(self.session_token_usage), questionnaire_id=self.questionnaire.name,
+            submission_id=self.submission_id)
 
-        user_raw_input = input("您: ")
+    def restore(self, state):
+        """
+        由 SessionState 恢復會話。問卷定義已變更時拋出 ValueError (答案與條件狀態可能不再一致)。
+        """
+        if state.questionnaire_version != self.questionnaire.version or state.questionnaire_id != self.questionnaire.name:
+            raise ValueError(f"會話 '{state.session_id}' 的問卷版本 {state.questionnaire_id}@{state.questionnaire_version} 與目前版本 "
+                             f"{self.questionnaire.name}@{self.questionnaire.version} 不同，無法恢復。")
+        self.collected_answers = {q_id: state.collected_answers.get(q_id) for q_id in self.questionnaire.headers}
+        self.submission_id = state.submission_id or state.session_id # 舊快照沒有 submission_id
+        self._hidden = set(state.hidden_ids)
+        self._required = set(state.required_ids)
+        self.unanswered_questions_ids = set(state.unanswered_ids)
+        self._answered_ids = {q_id for q_id, value in self.collected_answers.items() if value is not None}
+        self._pending_required = self.unanswered_questions_ids & self._required
+        self._last_prompted_ids = set(state.last_prompted_ids)
+        self.finished = state.finished
+        self.awaiting_exit_confirmation = state.awaiting_exit_confirmation
+        self._pending_farewell = state.pending_farewell
+        self.chat_history.restore_state(state.chat_messages, state.chat_summary, state.chat_pending)
+        self.session_token_usage = {**self._new_usage_counter(), **state.token_usage}
+        return self
+
+    def close(self):
+        """
+        會話被移除時呼叫，取消尚未完成的背景摘要。
+        """
+        self.chat_history.close()
+
+    def memory_stats(self):
+        """
+        此會話對話歷史的記憶體與摘要統計。
+        """
+        return self.chat_history.stats()
+
+    async def _request_finish(self, farewell):
+        # 在真正結束前，檢查是否有必填問題未完成
+        pending_required = self._pending_required_ids()
+        if pending_required:
+            self._say(f"您還有 {len(pending_required)} 個重要問題尚未回答，確定要現在結束嗎？ (是/否)")
+            self.awaiting_exit_confirmation = True
+            return self._flush_output()
+        return self._finish(farewell)
+
+    def _finish(self, farewell):
+        self._say(farewell)
+        self.finished = True
+        status = self._save_answers_to_sheet()
+        if status == "saved":
+            self._notify("您的問卷答案已送出，感謝您的參與！")
+        elif status == "already_saved":
+            self._notify("您的問卷答案先前已經送出，不會重複記錄，感謝您的參與！")
+        elif status == "conflict":
+            self._notify("這份問卷先前已經以相同的提交識別碼送出過，本次的答案沒有寫入。如需修改答案請聯繫管理員。")
+        else:
+            self._notify("儲存問卷答案時發生錯誤。請稍後再試或聯繫管理員。")
+        return self._flush_output()
+
+    async def astart(self, on_chunk=None):
+        """
+        開始一個新的問卷會話，返回歡迎語。
+        on_chunk: 串流回呼，回覆文字會逐塊傳入 (串接後等於返回值)；None 時不串流。
+        """
+        if not self._initialize_nlu_agent():
+            raise RuntimeError("初始化失敗，問卷無法啟動。")
+        # 每次作答各自的提交識別碼；session ID 可能被重複使用 (例如 CLI)，不能作為去重的依據
+        self.submission_id = self._fixed_submission_id or uuid.uuid4().hex
+        # 歡迎語會引導使用者從第一個必填問題開始
+        first_required = next((q for q in self.question_structure if q.get("validation_rule") == "required"), None)
+        self._last_prompted_ids = {first_required["id"]} if first_required else set()
+        self._turn_output = []
+        self._begin_output(on_chunk)
+        usage_token = self._begin_usage_tracking()
+        try:
+            if on_chunk is not None:
+                await self._say_streamed(self.nlu_agent.astream_initial_greeting_and_guidance())
+            else:
+                self._say(await self.nlu_agent.agenerate_initial_greeting_and_guidance())
+        finally:
+            self._end_usage_tracking(usage_token)
+            self._end_output()
+        return self._flush_output()
+
+    async def aturn(self, user_raw_input, on_chunk=None):
+        """
+        處理使用者的一次輸入，返回 AI 的回覆文字。問卷結束後 self.finished 為 True。
+        on_chunk: 串流回呼，回覆文字會逐塊傳入 (串接後等於返回值)；None 時不串流。
+        """
+        if self.finished:
+            reply = "問卷已結束，感謝您的參與。"
+            if on_chunk is not None:
+                on_chunk(reply)
+            return reply
+        if not self._initialize_nlu_agent():
+            raise RuntimeError("初始化失敗，問卷無法繼續。")
+        self._turn_output = []
+        self._begin_output(on_chunk)
+        usage_token = self._begin_usage_tracking()
+        trace_token = METRICS.begin_turn()
+        try:
+            return await self._handle_turn(user_raw_input)
+        finally:
+            self.last_turn_trace = METRICS.end_turn(trace_token)
+            self._end_usage_tracking(usage_token)
+            self._end_output()
+            if self.finished:
+                self.close()
+            else:
+                self.chat_history.schedule_summary()
+
+    async def _handle_turn(self, user_raw_input):
+
+        self._turn_output = []
         self.chat_history.append({"role": "user", "content": user_raw_input})
 
-        while True: 
-            # 檢查是否為明確的結束指令
-            if user_raw_input.lower() in ["結束問卷", "完成問卷", "結束", "完成", "我想結束", "不用了", "quit", "exit", "done"]:
-                # 在真正結束前，檢查是否有必填問題未完成
-                pending_required = [
-                    q_id for q_id in self.unanswered_questions_ids 
-                    if self._get_question_obj_by_id(q_id).get("validation_rule") == "required" or 
-                       (self._get_question_obj_by_id(q_id).get("validation_rule") == "required_if_triggered" and 
-                        self.collected_answers.get("product_satisfaction") in [1,2] and 
-                        self.collected_answers.get(q_id) is None)
-                ]
-                if pending_required:
-                    confirm_exit = input(f"AI: 您還有 {len(pending_required)} 個重要問題尚未回答，確定要現在結束嗎？ (是/否) ")
-                    self.chat_history.append({"role": "assistant", "content": f"您還有 {len(pending_required)} 個重要問題尚未回答，確定要現在結束嗎？"})
-                    self.chat_history.append({"role": "user", "content": confirm_exit})
-                    if confirm_exit.lower() not in ["是", "yes"]:
-                        print("AI: 好的，我們繼續。")
-                        # 需要重新生成提問
-                        current_unanswered_questions_objs = [self._get_question_obj_by_id(q_id) for q_id in self.unanswered_questions_ids if self._get_question_obj_by_id(q_id) is not None]
-                        next_prompt = self.nlu_agent.generate_next_questions_prompt(current_unanswered_questions_objs, self.chat_history, self.collected_answers)
-                        print(f"\nAI: {next_prompt}")
-                        self.chat_history.append({"role": "assistant", "content": next_prompt})
-                        user_raw_input = input("您: ")
-                        self.chat_history.append({"role": "user", "content": user_raw_input})
-                        continue 
-                print("AI: 好的，感謝您的參與。問卷已結束。")
-                break
-
-            print("AI: 正在分析您的回答... (請稍候)")
-            time.sleep(0.5) # 減少等待時間
-
-            nlu_result = self.nlu_agent.parse_chat_response_to_answers(
-                user_raw_input, 
-                self.question_structure, 
-                self.collected_answers, 
-                self.chat_history
-            )
-
-            action_request = nlu_result.get("action_request")
-            extracted_answers_map = nlu_result.get("extracted_answers", {})
-            reasoning = nlu_result.get("reasoning", "")
-
-            if action_request == "error":
-                error_msg = f"抱歉，我在處理您的回答時遇到問題: {reasoning} 請您再試一次。"
-                print(f"AI: {error_msg}")
-                self.chat_history.append({"role": "assistant", "content": error_msg})
-                user_raw_input = input("您: ")
-                self.chat_history.append({"role": "user", "content": user_raw_input})
-                continue 
-            
-            if action_request == "finish_questionnaire": 
-                # 這裡的邏輯與上面的結束指令檢查重複了，可以合併
-                # 暫時先保留，確保 LLM 的結束意圖也被處理
-                # 在真正結束前，檢查是否有必填問題未完成
-                pending_required = [
-                    q_id for q_id in self.unanswered_questions_ids 
-                    if self._get_question_obj_by_id(q_id).get("validation_rule") == "required" or 
-                       (self._get_question_obj_by_id(q_id).get("validation_rule") == "required_if_triggered" and 
-                        self.collected_answers.get("product_satisfaction") in [1,2] and 
-                        self.collected_answers.get(q_id) is None)
-                ]
-                if pending_required:
-                    confirm_exit = input(f"AI: 您還有 {len(pending_required)} 個重要問題尚未回答，確定要現在結束嗎？ (是/否) ")
-                    self.chat_history.append({"role": "assistant", "content": f"您還有 {len(pending_required)} 個重要問題尚未回答，確定要現在結束嗎？"})
-                    self.chat_history.append({"role": "user", "content": confirm_exit})
-                    if confirm_exit.lower() not in ["是", "yes"]:
-                        print("AI: 好的，我們繼續。")
-                        current_unanswered_questions_objs = [self._get_question_obj_by_id(q_id) for q_id in self.unanswered_questions_ids if self._get_question_obj_by_id(q_id) is not None]
-                        next_prompt = self.nlu_agent.generate_next_questions_prompt(current_unanswered_questions_objs, self.chat_history, self.collected_answers)
-                        print(f"\nAI: {next_prompt}")
-                        self.chat_history.append({"role": "assistant", "content": next_prompt})
-                        user_raw_input = input("您: ")
-                        self.chat_history.append({"role": "user", "content": user_raw_input})
-                        continue
-                print("AI: 好的，您已選擇結束問卷。")
-                break 
+        # 上一輪詢問了「確定要現在結束嗎？」
+        if self.awaiting_exit_confirmation:
+            self.awaiting_exit_confirmation = False
+            if user_raw_input.lower() in ["是", "yes"]:
+                return self._finish(self._pending_farewell)
+            self._notify("好的，我們繼續。")
+            with METRICS.span("prompt_generation"):
+                await self._prompt_next_questions()
+            return self._flush_output()
+
+        # 檢查是否為明確的結束指令
+        if user_raw_input.lower() in self.END_COMMANDS:
+            self._pending_farewell = "好的，感謝您的參與。問卷已結束。"
+            return await self._request_finish(self._pending_farewell)
+
+        nlu_result = None
+        if self.rule_extractor:
+            with METRICS.span("rule_extraction"):
+                nlu_result = self.rule_extractor.extract(user_raw_input, self.unanswered_questions_ids, self._last_prompted_ids)
+        try:
+            return await self._process_user_input(user_raw_input, nlu_result)
+        finally:
+            # 未被採用的預先生成提示直接取消
+            self._cancel_speculation()
+
+    async def _process_user_input(self, user_raw_input, nlu_result):
+        if nlu_result is None:
+            if self.speculative_next_prompt:
+                self._start_speculative_next_prompt()
+            llm_start = time.perf_counter()
+            with METRICS.span("llm_extraction"):
+                nlu_result = await self.nlu_agent.aparse_chat_response_to_answers(
+                    user_raw_input, 
+                    self.question_structure, 
+                    self.collected_answers, 
+                    self.chat_history,
+                    validate=self._extraction_failures,
+                    prompted_ids=self._last_prompted_ids
+                )
+            if self.rule_extractor:
+                self.rule_extractor.stats.record_llm_call(time.perf_counter() - llm_start)
+
+        action_request = nlu_result.get("action_request")
+        extracted_answers_map = nlu_result.get("extracted_answers", {})
+        reasoning = nlu_result.get("reasoning", "")
+
+        if action_request == "error":
+            self._say(f"抱歉，我在處理您的回答時遇到問題: {reasoning} 請您再試一次。")
+            return self._flush_output()
 
-            newly_updated_count = 0
-            validation_failures = [] 
+        if action_request == "finish_questionnaire": 
+            # LLM 判斷使用者想結束問卷
+            self._pending_farewell = "好的，您已選擇結束問卷。"
+            return await self._request_finish(self._pending_farewell)
 
+        newly_updated_count = 0
+        validation_failures = [] 
+
+        with METRICS.span("validation"):
             if extracted_answers_map: # 只有當LLM提取到東西時才處理
                 for q_id, llm_extracted_value in extracted_answers_map.items():
                     question_obj = self._get_question_obj_by_id(q_id)
@@ -268,86 +603,51 @@ class QuestionnaireAgent:
                                 "user_input_segment": llm_extracted_value,
                                 "reason": error_msg
                             })
-            
-            if validation_failures:
-                for failure in validation_failures:
-                    clarification_prompt = self.nlu_agent.generate_clarification_prompt(
-                        failure['question_id'],
-                        f"關於「{failure['question_text']}」，您說了「{failure['user_input_segment']}」，但它{failure['reason']}。可以請您再說清楚一點嗎？",
-                        self.chat_history
-                    )
-                    print(f"\nAI: {clarification_prompt}")
-                    self.chat_history.append({"role": "assistant", "content": clarification_prompt})
-            elif len(self.unanswered_questions_ids) == 0:
-                print("\nAI: 感謝您的配合！所有問題都已完成。您可以說「結束」來提交問卷。")
-                self.chat_history.append({"role": "assistant", "content": "所有問題都已完成。"})
-            elif newly_updated_count == 0 and action_request == "no_change" and not extracted_answers_map:
-                # 只有當LLM明確說no_change且沒有提取到任何答案時，才提示這個
-                no_change_msg = "AI: 您的回答似乎沒有提供新的問卷資訊，或者我還未能完全理解。如果您想修改答案，請直接說明要修改哪個問題。"
-                print(no_change_msg)
-                self.chat_history.append({"role": "assistant", "content": no_change_msg})
-            else: 
-                current_unanswered_questions_objs = [self._get_question_obj_by_id(q_id) for q_id in self.unanswered_questions_ids if self._get_question_obj_by_id(q_id) is not None]
-                if not current_unanswered_questions_objs and len(self.unanswered_questions_ids) > 0:
-                     # 這種情況可能是 unanswered_questions_ids 中有ID，但 get_question_obj_by_id 返回None
-                     # 理論上不應發生，但作為防禦
-                    print(f"警告: unanswered_questions_ids 中包含無效ID: {self.unanswered_questions_ids}")
-                    print("\nAI: 感謝您的配合！所有問題都已完成。您可以說「結束」來提交問卷。")
-                elif current_unanswered_questions_objs:
-                    next_prompt = self.nlu_agent.generate_next_questions_prompt(current_unanswered_questions_objs, self.chat_history, self.collected_answers)
-                    print(f"\nAI: {next_prompt}")
-                    self.chat_history.append({"role": "assistant", "content": next_prompt})
-                else: # 所有問題都回答完了
-                     print("\nAI: 感謝您的配合！所有問題都已完成。您可以說「結束」來提交問卷。")
-
-
-            # 更新計數顯示
-            actually_answered_count = 0
-            for q_id_check in self.question_structure:
-                if self.collected_answers.get(q_id_check["id"]) is not None: # 只要答案不是None就算回答了
-                    # 對於 detailed_dissatisfaction_reason，如果它不該被問，即使答案是None也不算未回答
-                    if q_id_check["id"] == "detailed_dissatisfaction_reason":
-                        product_satisfaction = self.collected_answers.get("product_satisfaction")
-                        if product_satisfaction is not None and product_satisfaction not in [1, 2]:
-                            # 這種情況下，detailed_dissatisfaction_reason 不應被計算為未回答
-                            pass # 不增加 actually_answered_count，也不將其視為未回答
-                        elif self.collected_answers.get(q_id_check["id"]) is not None:
-                             actually_answered_count +=1
-                    else:
-                        actually_answered_count +=1
-            
-            # 計算真正未回答的問題數量
-            true_unanswered_count = self.total_questions_count - actually_answered_count
-            # 確保 detailed_dissatisfaction_reason 在不需要時不被計入未回答
-            if self.collected_answers.get("product_satisfaction") is not None and \
-               self.collected_answers.get("product_satisfaction") not in [1, 2] and \
-               "detailed_dissatisfaction_reason" in self.unanswered_questions_ids:
-                # 如果產品滿意度高，但 detailed_dissatisfaction_reason 仍在未回答列表，則不應計入
-                # （這通常在 _update_answers_and_unanswered_status 中處理，但這裡再確認）
-                pass
-
-
-            print(f"目前已收集到 {actually_answered_count} / {self.total_questions_count} 個問題的有效答案。")
-            print("-" * 30) 
-            
-            user_raw_input = input("您: ")
-            self.chat_history.append({"role": "user", "content": user_raw_input})
 
-        print("\n--- 問卷已完成或提前結束 ---")
-        print("我們正在將您的回答儲存到資料庫中...")
-        self._save_answers_to_sheet()
-        print("問卷結束。")
+        if validation_failures:
+            with METRICS.span("prompt_generation"):
+                await self._clarify(validation_failures)
+        elif len(self.unanswered_questions_ids) == 0:
+            self._notify("感謝您的配合！所有問題都已完成。您可以說「結束」來提交問卷。")
+            self.chat_history.append({"role": "assistant", "content": "所有問題都已完成。"})
+        elif newly_updated_count == 0 and action_request == "no_change" and not extracted_answers_map:
+            # 只有當LLM明確說no_change且沒有提取到任何答案時，才提示這個
+            self._say("您的回答似乎沒有提供新的問卷資訊，或者我還未能完全理解。如果您想修改答案，請直接說明要修改哪個問題。")
+        else: 
+            current_unanswered_questions_objs = self._current_unanswered_question_objs()
+            if not current_unanswered_questions_objs:
+                # 理論上 unanswered_questions_ids 不應包含無效ID，但作為防禦
+                print(f"警告: unanswered_questions_ids 中包含無效ID: {self.unanswered_questions_ids}")
+                self._notify("感謝您的配合！所有問題都已完成。您可以說「結束」來提交問卷。")
+            else:
+                with METRICS.span("prompt_generation"):
+                    await self._prompt_next_questions()
+
+        # 更新計數顯示
+        self._notify(f"目前已收集到 {self._count_answered()} / {self.total_questions_count} 個問題的有效答案。")
+        return self._flush_output()
 
     def _save_answers_to_sheet(self):
-        if not self._initialize_gs_client():
-            print("無法連接 Google Sheets，答案未能儲存。")
-            return
-        data_row = []
-        for header_id in GOOGLE_SHEET_HEADERS:
-            val = self.collected_answers.get(header_id)
-            data_row.append(val if val is not None else "")
-        success = append_row_to_sheet(self.gs_client, GOOGLE_SHEET_ID, "工作表1", data_row, GOOGLE_SHEET_HEADERS)
-        if success:
-            print("您的問卷答案已成功儲存！")
-        else:
-            print("儲存問卷答案到 Google Sheet 時發生錯誤。請稍後再試或聯繫管理員。")
\ No newline at end of file
+        """
+        寫入設定的儲存後端：預設為 Google Sheets 背景佇列，本地後端則由定時匯出批次送往 Google Sheets。
+        返回 "saved"；"already_saved" (同一個 submission_id 先前已送出同樣的答案，例如從快照恢復後重送「結束」)；
+        "conflict" (這個 submission_id 先前已送出，但無法確認是這份答案，本次沒有寫入)；或 "error"。
+        """
+        try:
+            with METRICS.span("persistence"):
+                if self.result_store is None:
+                    self.result_store = get_result_store_for(self.questionnaire)
+                if self.submission_id is None: # 未經 astart() 直接提交
+                    self.submission_id = uuid.uuid4().hex
+                answers = {**self.collected_answers, SUBMISSION_ID_HEADER: self.submission_id}
+                if not self.result_store.append(answers):
+                    return "already_saved" if self.result_store.is_stored(answers) else "conflict"
+        except Exception as e:
+            print(f"儲存問卷答案時發生錯誤: {e}")
+            return "error"
+        # 只統計新的提交；重複提交已在先前計入
+        try:
+            ANALYTICS.record(self.collected_answers, self.questionnaire)
+        except Exception as e:
+            print(f"更新答案統計時發生錯誤: {e}")
+        return "saved"
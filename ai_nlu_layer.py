@@ -1,20 +1,249 @@
 # ai_nlu_layer.py
 
-import openai
+import asyncio
+import contextvars
+import hashlib
 import json
 import os
-from questionnaire_data import QUESTIONNAIRE_STRUCTURE
+import threading
+import time
+from collections import deque
+from metrics import METRICS
+from openai_client_manager import KIND_PRIORITIES, get_client_manager
+from questionnaire_data import ESCALATION_MODEL, MODEL_ROUTING, STRUCTURED_OUTPUT
+from questionnaire_model import DEFAULT_QUESTIONNAIRE, build_answer_schema
+from response_cache import PromptVariantCache
+
+# 目前回合的 token 累計器 (dict)。由 QuestionnaireAgent 在每回合開始時設定，
+# 以 contextvars 傳遞，因此多個會話同時進行、或回合內另開的 asyncio task 都能正確歸屬。
+current_turn_usage = contextvars.ContextVar("current_turn_usage", default=None)
+
+class StreamingStats:
+    """
+    串流生成的首個 token 延遲 (time-to-first-token) 與完整生成時間，依呼叫類型統計最近的樣本。
+    """
+    def __init__(self, max_samples=1000):
+        self._lock = threading.Lock()
+        self._samples = {} # kind -> deque[(ttft, total)]
+        self.max_samples = max_samples
+
+    def record(self, kind, ttft, total):
+        with self._lock:
+            self._samples.setdefault(kind, deque(maxlen=self.max_samples)).append((ttft, total))
+
+    @classmethod
+    def combined(cls, stats_list):
+        """
+        合併多個 AINLULayer 的樣本；只有一個時直接返回它。
+        """
+        if len(stats_list) == 1:
+            return stats_list[0]
+        combined = cls(max_samples=sum(s.max_samples for s in stats_list))
+        for stats in stats_list:
+            with stats._lock:
+                for kind, values in stats._samples.items():
+                    combined._samples.setdefault(kind, deque(maxlen=combined.max_samples)).extend(values)
+        return combined
+
+    def summary(self):
+        def pct(values, p):
+            ordered = sorted(values)
+            return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1000, 2)
+
+        with self._lock:
+            samples = {kind: list(values) for kind, values in self._samples.items()}
+        return {
+            kind: {
+                "streams": len(values),
+                "ttft_p50_ms": pct([v[0] for v in values], 50),
+                "ttft_p95_ms": pct([v[0] for v in values], 95),
+                "total_p50_ms": pct([v[1] for v in values], 50),
+            }
+            for kind, values in samples.items() if values
+        }
+
+
+class ModelRoutingStats:
+    """
+    提取的分層路由統計：各層 (primary 為小模型，escalated 為升級後的強模型) 的呼叫數、失敗數與延遲，
+    以及依原因統計的升級次數。
+    """
+    TIERS = ("primary", "escalated")
+
+    def __init__(self, max_samples=1000):
+        self._lock = threading.Lock()
+        self._latencies = {tier: deque(maxlen=max_samples) for tier in self.TIERS}
+        self.calls = {tier: 0 for tier in self.TIERS}
+        self.errors = {tier: 0 for tier in self.TIERS}
+        self.escalations = {}
+
+    def record_call(self, tier, seconds, failed):
+        with self._lock:
+            self.calls[tier] += 1
+            self._latencies[tier].append(seconds)
+            if failed:
+                self.errors[tier] += 1
+
+    def record_escalation(self, reason):
+        with self._lock:
+            self.escalations[reason] = self.escalations.get(reason, 0) + 1
+
+    def summary(self):
+        def pct(values, p):
+            if not values:
+                return 0.0
+            ordered = sorted(values)
+            return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1000, 2)
+
+        with self._lock:
+            tiers = {
+                tier: {
+                    "calls": self.calls[tier],
+                    "errors": self.errors[tier],
+                    "p50_ms": pct(self._latencies[tier], 50),
+                    "p95_ms": pct(self._latencies[tier], 95),
+                }
+                for tier in self.TIERS
+            }
+            escalations = dict(self.escalations)
+        primary_calls = tiers["primary"]["calls"]
+        return {
+            "tiers": tiers,
+            "escalations": escalations,
+            "escalation_rate": round(sum(escalations.values()) / primary_calls, 4) if primary_calls else 0.0,
+        }
+
+
+class _StrippedStream:
+    """
+    逐塊去除前後空白：所有輸出區塊串接後等於完整文字的 .strip()，與非串流路徑的返回值一致。
+    結尾的空白會暫時保留，直到後面出現非空白字元才輸出。
+    """
+    def __init__(self):
+        self.started = False
+        self.pending = ""
+        self.parts = []
+
+    def feed(self, piece):
+        if not self.started:
+            piece = piece.lstrip()
+            if not piece:
+                return ""
+            self.started = True
+        text = self.pending + piece
+        stripped = text.rstrip()
+        self.pending = text[len(stripped):]
+        if stripped:
+            self.parts.append(stripped)
+        return stripped
+
+    @property
+    def text(self):
+        return "".join(self.parts)
+
 
 class AINLULayer:
-    def __init__(self, model="gpt-3.5-turbo", api_key=None):
-        if api_key is None:
-            api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            raise ValueError("OpenAI API Key not found. Please set OPENAI_API_KEY environment variable.")
-        
-        self.client = openai.OpenAI(api_key=api_key)
+    GREETING_FALLBACK = "--- 歡迎來到我們的智能問卷調查！ --- 請開始提供您的資訊。"
+    NEXT_QUESTIONS_FALLBACK = "我們還有一些問題需要您的協助。請問您是否願意繼續？您也可以隨時說出想修改的答案。"
+    CLARIFICATION_FALLBACK = "您剛才的回答我有點不確定，可以請您再說清楚一點嗎？"
+    ALL_ANSWERED_TEXT = "所有問題都已回答。謝謝！"
+    CORRECTION_KEYWORDS = ["改", "更正", "修正", "不對", "錯了", "其實", "更新"]
+
+    def __init__(self, model="gpt-3.5-turbo", api_key=None, compact_schema=False,
+                 response_cache=None, greeting_variants=5, next_prompt_variants=3, questionnaire=None,
+                 client_manager=None, model_routing=None, escalation_model=None, escalation_confidence=0.5,
+                 structured_output=None, extraction_cache=None):
+        """
+        compact_schema: 為 True 時只送出未回答的問題 (以及使用者可能正在修改的問題)，問題列表改放在最後的狀態訊息中。
+        response_cache: response_cache.ResponseCache；提供時歡迎語與下一步提示會依變化策略快取。
+        greeting_variants / next_prompt_variants: 每個快取鍵保存的變體數 (1 為固定回覆，0 為不快取)。
+        questionnaire: questionnaire_model.CompiledQuestionnaire，預設為 DEFAULT_QUESTIONNAIRE。
+        client_manager: openai_client_manager.OpenAIClientManager；預設取得程序共用的管理器 (共用連線池與限流額度)。
+        model_routing: {呼叫類型: 模型}，例如 {"extraction": "gpt-4o-mini", "greeting": "gpt-4o-mini"}；
+                       未列出的類型使用 model。None 時使用 questionnaire_data.MODEL_ROUTING。
+        escalation_model: 提取結果 JSON 無效、驗證失敗或信心低於 escalation_confidence 時，改用這個模型重新提取一次；
+                          None 時使用 questionnaire_data.ESCALATION_MODEL (仍為 None 表示不升級)。
+        structured_output: 為 True 時提取請求改用由問卷定義產生的嚴格 JSON schema (Structured Outputs)，
+                           選項、範圍與是/否由 schema 約束，系統提示只保留提取規則；需要支援的模型 (例如 gpt-4o-mini)。
+                           None 時使用 questionnaire_data.STRUCTURED_OUTPUT。
+        extraction_cache: extraction_cache.ExtractionCache；提供時相同情境下的簡短回答直接使用先前的提取結果。
+        """
+        if client_manager is None:
+            if api_key is None:
+                api_key = os.getenv("OPENAI_API_KEY")
+            if not api_key:
+                raise ValueError("OpenAI API Key not found. Please set OPENAI_API_KEY environment variable.")
+            client_manager = get_client_manager(api_key)
+        self.client_manager = client_manager
+        # 建立其他問卷的 AINLULayer (for_questionnaire) 時沿用相同設定
+        self._settings = dict(model=model, compact_schema=compact_schema, greeting_variants=greeting_variants,
+                              next_prompt_variants=next_prompt_variants, model_routing=model_routing,
+                              escalation_model=escalation_model, escalation_confidence=escalation_confidence,
+                              structured_output=structured_output)
+        self.response_cache = response_cache
         self.model = model
-        self.question_structure = QUESTIONNAIRE_STRUCTURE
+        self.model_routing = dict(MODEL_ROUTING if model_routing is None else model_routing)
+        self.escalation_model = escalation_model if escalation_model is not None else ESCALATION_MODEL
+        if self.escalation_model == self.model_for("extraction"):
+            self.escalation_model = None # 與第一層相同的模型不需要升級
+        self.escalation_confidence = escalation_confidence
+        self.routing_stats = ModelRoutingStats()
+        self.questionnaire = questionnaire if questionnaire is not None else DEFAULT_QUESTIONNAIRE
+        self.question_structure = self.questionnaire.questions
+        self.compact_schema = compact_schema
+        self.structured_output = STRUCTURED_OUTPUT if structured_output is None else structured_output
+        self._response_formats = {} # 問題 id 組合 -> response_format，精簡模式下依未回答問題變化
+
+        # 問卷定義只編譯一次，之後每回合重複使用相同的靜態系統提示
+        self._compiled_schema = self._get_question_schema_for_llm(self.question_structure)
+        self._static_parse_prompt = self._compile_parse_system_prompt(self._compiled_schema)
+        self._static_parse_prompt_without_schema = self._compile_parse_system_prompt()
+        self._structured_parse_prompt = self._compile_structured_parse_prompt()
+        # 影響提取結果的設定；任一項改變時提取快取的鍵也跟著改變
+        self.extraction_cache = extraction_cache
+        self._pending_extractions = {} # 快取鍵 -> 正在進行的提取 (asyncio.Future)
+        self._extraction_signature = hashlib.sha1(json.dumps([
+            self.model_for("extraction"), self.escalation_model, self.escalation_confidence, self.structured_output,
+            self.compact_schema, self._static_parse_prompt, self._structured_parse_prompt,
+        ], ensure_ascii=False).encode("utf-8")).hexdigest()[:12]
+
+        # 歡迎語只取決於問卷定義；下一步提示主要取決於未回答問題的集合
+        self.questionnaire_signature = self.questionnaire.version
+        self.greeting_cache = None
+        self.next_prompt_cache = None
+        if response_cache is not None:
+            self.greeting_cache = PromptVariantCache(response_cache, greeting_variants, namespace=f"greeting:{self.questionnaire_signature}")
+            self.next_prompt_cache = PromptVariantCache(response_cache, next_prompt_variants, namespace=f"next:{self.questionnaire_signature}")
+
+        # 依呼叫類型累計 token 用量 (來自 OpenAI 回應的 usage 欄位)
+        self.token_usage = {}
+        self.last_usage = None
+        self.streaming_stats = StreamingStats()
+
+    @property
+    def client(self):
+        return self.client_manager.client
+
+    def for_questionnaire(self, questionnaire):
+        """
+        返回使用另一份問卷、其餘設定相同的 AINLULayer：共用 OpenAI 客戶端、回應快取、提取快取與統計，
+        提示語與 schema 依該問卷預先編譯。同一版本問卷的所有會話應共用返回的物件 (SessionEngine 會這麼做)。
+        """
+        if questionnaire is self.questionnaire:
+            return self
+        nlu = AINLULayer(questionnaire=questionnaire, client_manager=self.client_manager, response_cache=self.response_cache,
+                         extraction_cache=self.extraction_cache, **self._settings)
+        nlu.routing_stats = self.routing_stats
+        nlu.streaming_stats = self.streaming_stats
+        nlu.token_usage = self.token_usage
+        return nlu
+
+    def model_for(self, kind: str) -> str:
+        return self.model_routing.get(kind, self.model)
+
+    @property
+    def async_client(self):
+        return self.client_manager.async_client # 供非同步多會話伺服器使用
 
     def _get_question_schema_for_llm(self, questions_to_consider: list) -> str:
         schema_parts = []
@@ -27,8 +256,17 @@ class AINLULayer:
             - {q_id} (類型: {q_type}): {q_mapping_context} {f"可選值: [{q_options}]" if q_options else ""}""")
         return "\n".join(schema_parts)
 
-    def parse_chat_response_to_answers(self, user_input: str, all_questions: list, current_answers: dict, chat_history: list = None) -> dict:
-        questions_schema = self._get_question_schema_for_llm(all_questions)
+    def _compile_parse_system_prompt(self, questions_schema: str = None) -> str:
+        # 靜態前綴：不含任何每回合會變動的內容，供應商端的 prompt caching 才能命中
+        schema_section = f"""
+        問卷問題列表 (及其映射上下文):
+        {questions_schema}
+        """ if questions_schema is not None else """
+        問卷問題列表會在對話最後的系統訊息中提供。
+        """
+        # 設定了升級模型時才要求模型自評信心，未使用時不多佔 token
+        confidence_section = """
+        - "confidence": 0 到 1 之間的數字，表示你對這次提取結果的整體信心。""" if self.escalation_model else ""
         system_prompt = f"""
         你是一個智能問卷調查AI助理，專門從使用者的自然語言回答中，盡可能地提取出問卷中所有相關的答案。
         你的目標是精確地識別使用者提供的資訊，並將其映射到問卷問題的 'id' 上。
@@ -44,45 +282,437 @@ class AINLULayer:
                             - "continue_questionnaire": 意味著你提取了部分或所有答案，且對話應繼續。
                             - "finish_questionnaire": 只有當使用者明確說出例如「結束問卷」、「完成問卷」、「結束」、「完成」、「不想填了」等明確的結束指令時，才設為此值。避免將簡短回答或抱怨誤判為結束。
                             - "no_change": 意味著使用者輸入與問卷問題無關，或沒有新的可提取信息。
-        - "reasoning": 字符串，簡要說明你的提取結果和下一步的建議。
+        - "reasoning": 字符串，簡要說明你的提取結果和下一步的建議。{confidence_section}
 
         請注意：
         - 只有在使用者明確提及或回答相關問題時才提取答案。避免產生幻覺或推斷。
         - 如果使用者一次提供了多個問題的答案，請盡可能全部提取。
         - 如果使用者明確表示要修改之前給出的答案，請在 `extracted_answers` 中提供該問題的新答案。
+        - 目前已收集的答案會在對話最後的系統訊息中提供，如果使用者提及修改，請參考這些舊答案。
         - 你的回答必須僅包含 JSON。
+        {schema_section}"""
+        # 去除縮排空白以節省 token
+        return "\n".join(line.strip() for line in system_prompt.strip().splitlines())
 
-        問卷問題列表 (及其映射上下文):
-        {questions_schema}
+    def _compile_structured_parse_prompt(self) -> str:
+        # 問題說明、選項與範圍都在 JSON schema 中，這裡只保留 schema 表達不了的提取規則
+        confidence_rule = "\n- confidence 為 0 到 1 之間的數字，表示你對這次提取結果的整體信心。" if self.escalation_model else ""
+        return f"""你是問卷調查助理，從使用者的回答中提取問卷答案，鍵為問題 id。
+- 只提取使用者明確提及的答案，未提及的問題填 null，避免推斷。
+- 使用者修改先前的答案時填入新答案；目前已收集的答案在最後的系統訊息中。
+- action_request：有提取到答案為 continue_questionnaire；與問卷無關或沒有新資訊為 no_change；只有使用者明確要求結束 (例如「結束問卷」、「不想填了」) 時才是 finish_questionnaire。
+- reasoning 請簡短說明。{confidence_rule}"""
+
+    def _parse_response_format(self, schema_questions: list) -> dict:
+        if not self.structured_output:
+            return {"type": "json_object"}
+        key = tuple(q["id"] for q in schema_questions)
+        response_format = self._response_formats.get(key)
+        if response_format is None:
+            properties = {
+                "extracted_answers": {
+                    "type": "object",
+                    "properties": {q["id"]: build_answer_schema(q) for q in schema_questions},
+                    "required": list(key),
+                    "additionalProperties": False,
+                },
+                "action_request": {"type": "string", "enum": ["continue_questionnaire", "finish_questionnaire", "no_change"]},
+                "reasoning": {"type": "string"},
+            }
+            if self.escalation_model:
+                properties["confidence"] = {"type": "number"}
+            response_format = {"type": "json_schema", "json_schema": {
+                "name": "questionnaire_extraction",
+                "strict": True,
+                "schema": {"type": "object", "properties": properties, "required": list(properties), "additionalProperties": False},
+            }}
+            if len(self._response_formats) >= 256:
+                self._response_formats.clear()
+            self._response_formats[key] = response_format
+        return response_format
+
+    def _schema_questions(self, user_input: str, all_questions: list, current_answers: dict) -> list:
+        return self._questions_for_compact_schema(user_input, all_questions, current_answers) if self.compact_schema else all_questions
+
+    def _questions_for_compact_schema(self, user_input: str, all_questions: list, current_answers: dict) -> list:
+        # 只送出未回答的問題；若使用者可能在修改答案，則一併送出已回答的問題
+        if any(keyword in user_input for keyword in self.CORRECTION_KEYWORDS):
+            return all_questions
+        return [q for q in all_questions if current_answers.get(q["id"]) is None]
+
+    def _build_parse_messages(self, user_input: str, all_questions: list, current_answers: dict, chat_history: list = None) -> list:
+        if self.structured_output:
+            # 問題列表在 response_format 的 JSON schema 中 (精簡模式下只含未回答的問題)
+            system_prompt = self._structured_parse_prompt
+            schema_text = None
+        elif self.compact_schema:
+            system_prompt = self._static_parse_prompt_without_schema
+            schema_questions = self._questions_for_compact_schema(user_input, all_questions, current_answers)
+            schema_text = "\n".join(line.strip() for line in self._get_question_schema_for_llm(schema_questions).splitlines() if line.strip())
+        elif all_questions is self.question_structure:
+            system_prompt = self._static_parse_prompt
+            schema_text = None
+        else:
+            system_prompt = self._compile_parse_system_prompt(self._get_question_schema_for_llm(all_questions))
+            schema_text = None
+
+        # 每回合變動的狀態放在最後一則小訊息中，前面的前綴保持不變
+        answered = {k: v for k, v in current_answers.items() if v is not None}
+        turn_state = f"目前已收集的答案: {json.dumps(answered, ensure_ascii=False, separators=(',', ':'))}"
+        if schema_text is not None:
+            turn_state = f"問卷問題列表 (及其映射上下文):\n{schema_text}\n{turn_state}"
 
-        目前已收集的答案 (如果使用者提及修改，請參考這些舊答案):
-        {json.dumps(current_answers, ensure_ascii=False)}
-        """
         messages = [{"role": "system", "content": system_prompt}]
-        if chat_history:
-            messages.extend(chat_history[-8:])
+        messages.extend(self._history_messages(chat_history, 8))
+        messages.append({"role": "system", "content": turn_state})
         messages.append({"role": "user", "content": f"這是我的回答：{user_input}"})
+        return messages
+
+    @staticmethod
+    def _history_messages(chat_history, window: int, with_summary: bool = True) -> list:
+        """
+        返回最近 window 則對話；chat_history 為 chat_memory.ChatMemory 且已有滾動摘要時，摘要放在最前面。
+        """
+        if not chat_history:
+            return []
+        summary = chat_history.summary_message() if with_summary and hasattr(chat_history, "summary_message") else None
+        recent = chat_history.recent(window) if hasattr(chat_history, "recent") else list(chat_history[-window:])
+        return [summary] + recent if summary else recent
+
+    def _record_usage(self, response, kind: str):
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", 0) or 0
+        self.last_usage = {
+            "kind": kind,
+            "prompt_tokens": usage.prompt_tokens,
+            "completion_tokens": usage.completion_tokens,
+            "cached_prompt_tokens": cached_tokens,
+        }
+        totals = self.token_usage.setdefault(kind, {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_prompt_tokens": 0})
+        totals["calls"] += 1
+        totals["prompt_tokens"] += usage.prompt_tokens
+        totals["completion_tokens"] += usage.completion_tokens
+        totals["cached_prompt_tokens"] += cached_tokens
+        METRICS.record_llm_usage(getattr(response, "model", None) or self.model, kind, usage.prompt_tokens,
+                                 usage.completion_tokens, cached_tokens)
+        turn_usage = current_turn_usage.get()
+        if turn_usage is not None:
+            turn_usage["calls"] += 1
+            turn_usage["prompt_tokens"] += usage.prompt_tokens
+            turn_usage["completion_tokens"] += usage.completion_tokens
+            turn_usage["cached_prompt_tokens"] += cached_tokens
+
+    def _parse_llm_output(self, response_content: str) -> dict:
+        parsed_output = json.loads(response_content)
+        if not all(k in parsed_output for k in ["extracted_answers", "action_request"]):
+            raise ValueError("LLM response missing required keys.")
+        # 嚴格 schema 下每一題都會出現，未提及的為 null；去掉它們，與「不包含該鍵」的意義相同
+        parsed_output["extracted_answers"] = {k: v for k, v in (parsed_output["extracted_answers"] or {}).items() if v is not None}
+        return parsed_output
 
+    def _parse_request_kwargs(self, messages: list, response_format: dict, model: str) -> dict:
+        return {
+            "model": model,
+            "messages": messages,
+            "response_format": response_format,
+            "temperature": 0.0
+        }
+
+    def _parse_response(self, response) -> dict:
+        self._record_usage(response, "extraction")
+        message = response.choices[0].message
+        if message.content is None and getattr(message, "refusal", None):
+            raise ValueError(f"LLM refused: {message.refusal}")
+        return self._parse_llm_output(message.content)
+
+    def _parse_error(self, e: Exception, model: str, response=None) -> tuple:
+        """
+        返回 (錯誤結果, 升級原因)。
+        """
+        if isinstance(e, json.JSONDecodeError):
+            METRICS.inc("llm_errors_total", kind="extraction", error="invalid_json")
+            response_content = response.choices[0].message.content if response is not None else None
+            print(f"錯誤：LLM ({model}) 返回的內容不是有效的 JSON: {e}\n原始響應內容: {response_content}")
+            return {"extracted_answers": {}, "action_request": "error", "reasoning": f"Invalid JSON from LLM: {e}"}, "invalid_json"
+        METRICS.inc("llm_errors_total", kind="extraction", error=type(e).__name__)
+        print(f"與 OpenAI 互動時發生錯誤: {e}")
+        # ValueError 來自 _parse_llm_output (JSON 缺少必要的鍵)，其餘為 API 錯誤
+        reason = "invalid_output" if isinstance(e, ValueError) else "api_error"
+        return {"extracted_answers": {}, "action_request": "error", "reasoning": f"OpenAI API error: {e}"}, reason
+
+    def _parse_once(self, messages: list, response_format: dict, tier: str) -> tuple:
+        """
+        以指定層的模型提取一次，返回 (結果, 失敗時的升級原因或 None)。
+        """
+        model = self.model_for("extraction") if tier == "primary" else self.escalation_model
+        response = None
+        start = time.perf_counter()
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                response_format={"type": "json_object"},
-                temperature=0.0
-            )
-            response_content = response.choices[0].message.content
-            parsed_output = json.loads(response_content)
-            if not all(k in parsed_output for k in ["extracted_answers", "action_request"]):
-                raise ValueError("LLM response missing required keys.")
-            return parsed_output
-        except json.JSONDecodeError as e:
-            print(f"錯誤：LLM 返回的內容不是有效的 JSON: {e}\n原始響應內容: {response_content}")
-            return {"extracted_answers": {}, "action_request": "error", "reasoning": f"Invalid JSON from LLM: {e}"}
+            with METRICS.timer("llm_request_seconds", kind="extraction", model=model):
+                response = self.client_manager.create(priority=KIND_PRIORITIES["extraction"], **self._parse_request_kwargs(messages, response_format, model))
+            result, reason = self._parse_response(response), None
         except Exception as e:
-            print(f"與 OpenAI 互動時發生錯誤: {e}")
-            return {"extracted_answers": {}, "action_request": "error", "reasoning": f"OpenAI API error: {e}"}
+            result, reason = self._parse_error(e, model, response)
+        self.routing_stats.record_call(tier, time.perf_counter() - start, reason is not None)
+        return result, reason
 
-    def generate_initial_greeting_and_guidance(self) -> str:
+    async def _aparse_once(self, messages: list, response_format: dict, tier: str) -> tuple:
+        model = self.model_for("extraction") if tier == "primary" else self.escalation_model
+        response = None
+        start = time.perf_counter()
+        try:
+            with METRICS.timer("llm_request_seconds", kind="extraction", model=model):
+                response = await self.client_manager.acreate(priority=KIND_PRIORITIES["extraction"], **self._parse_request_kwargs(messages, response_format, model))
+            result, reason = self._parse_response(response), None
+        except Exception as e:
+            result, reason = self._parse_error(e, model, response)
+        self.routing_stats.record_call(tier, time.perf_counter() - start, reason is not None)
+        return result, reason
+
+    def _schema_failures(self, extracted_answers: dict) -> list:
+        """
+        預設的提取結果檢查：不存在的問題 id，或未通過該題驗證函式的非空值。返回 [(question_id, value)]。
+        """
+        failures = []
+        for q_id, value in extracted_answers.items():
+            validator = self.questionnaire.validators.get(q_id)
+            if validator is None:
+                failures.append((q_id, value))
+            elif value is not None and not (isinstance(value, str) and not value.strip()) and not validator(value)[0]:
+                failures.append((q_id, value))
+        return failures
+
+    def _escalation_reason(self, result: dict, error_reason: str, user_input: str, validate) -> str:
+        """
+        判斷第一層的提取結果是否需要升級到強模型，返回原因或 None。
+        驗證失敗若是使用者的答案本身無效 (例如格式錯誤的 email、超出範圍的分數)，而非模型提取錯誤，則不升級；
+        之後照常由澄清提示處理。
+        """
+        if self.escalation_model is None:
+            return None
+        if error_reason is not None:
+            return error_reason
+        confidence = result.get("confidence")
+        if isinstance(confidence, (int, float)) and confidence < self.escalation_confidence:
+            return "low_confidence"
+        extracted_answers = result.get("extracted_answers") or {}
+        failures = validate(extracted_answers) if validate is not None else self._schema_failures(extracted_answers)
+        for q_id, value in failures:
+            if not self._is_user_error(self.questionnaire.by_id.get(q_id), value, user_input):
+                return "validation_failed"
+        return None
+
+    @staticmethod
+    def _is_user_error(question, value, user_input: str) -> bool:
+        # 選項題與是/否題需要模型正規化，原樣照抄使用者的字仍算模型的問題；
+        # 數字題提取出了數字 (例如超出範圍的滿意度) 或文字題原樣出現在輸入中，則是使用者給的答案本身無效
+        if question is None or question["type"] in ("select", "boolean"):
+            return False
+        if question["type"] == "number":
+            try:
+                float(value)
+                return True
+            except (TypeError, ValueError):
+                return False
+        return isinstance(value, str) and bool(value.strip()) and value.strip() in user_input
+
+    def _choose_escalated(self, result: dict, escalated: dict) -> dict:
+        # 強模型也失敗 (例如 API 錯誤) 時保留第一層的結果
+        if escalated.get("action_request") == "error" and result.get("action_request") != "error":
+            return result
+        return escalated
+
+    def _extraction_cache_key(self, user_input: str, all_questions: list, current_answers: dict, prompted_ids) -> str:
+        if self.extraction_cache is None or all_questions is not self.question_structure:
+            return None
+        # 每回合的提示都附上已收集的答案 (精簡模式下也決定送出的問題列表)，已回答的問題集合不同時不共用結果
+        answered_ids = [q["id"] for q in all_questions if current_answers.get(q["id"]) is not None]
+        correcting = any(keyword in user_input for keyword in self.CORRECTION_KEYWORDS)
+        return self.extraction_cache.key(user_input, self.questionnaire.version, self._extraction_signature,
+                                         prompted_ids or (), answered_ids, bypass=correcting,
+                                         questionnaire_id=self.questionnaire.name)
+
+    def parse_chat_response_to_answers(self, user_input: str, all_questions: list, current_answers: dict, chat_history: list = None,
+                                       validate=None, prompted_ids=None) -> dict:
+        """
+        validate: 可選的檢查函式 (extracted_answers) -> [(question_id, value)]，列出驗證失敗的答案；
+                  None 時以問卷的驗證函式檢查。只在設定了 escalation_model 時用於決定是否升級。
+        prompted_ids: 上一輪詢問或要求澄清的問題 id，作為提取快取鍵的情境。
+        """
+        cache_key = self._extraction_cache_key(user_input, all_questions, current_answers, prompted_ids)
+        if cache_key is not None:
+            cached = self.extraction_cache.get(cache_key)
+            if cached is not None:
+                return cached
+        start = time.perf_counter()
+        result = self._parse_uncached(user_input, all_questions, current_answers, chat_history, validate)
+        if cache_key is not None:
+            self.extraction_cache.set(cache_key, result, time.perf_counter() - start)
+        return result
+
+    async def aparse_chat_response_to_answers(self, user_input: str, all_questions: list, current_answers: dict, chat_history: list = None,
+                                              validate=None, prompted_ids=None) -> dict:
+        cache_key = self._extraction_cache_key(user_input, all_questions, current_answers, prompted_ids)
+        if cache_key is None:
+            return await self._aparse_uncached(user_input, all_questions, current_answers, chat_history, validate)
+        # 同一個鍵已有提取正在進行 (多位填答者同時輸入相同的回答) 時等待其結果，不重複呼叫 LLM
+        pending = self._pending_extractions.get(cache_key)
+        if pending is not None:
+            await asyncio.wait([pending])
+            if not pending.cancelled() and pending.exception() is None:
+                return self.extraction_cache.coalesce(pending.result())
+        cached = self.extraction_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        pending = asyncio.get_running_loop().create_future()
+        self._pending_extractions[cache_key] = pending
+        start = time.perf_counter()
+        try:
+            result = await self._aparse_uncached(user_input, all_questions, current_answers, chat_history, validate)
+            pending.set_result(result)
+            # 寫入磁碟層 (SQLite commit) 時不阻塞事件迴圈；寫入期間到達的相同請求直接取用 pending 的結果
+            await asyncio.to_thread(self.extraction_cache.set, cache_key, result, time.perf_counter() - start)
+            return result
+        finally:
+            if not pending.done():
+                pending.cancel()
+            self._pending_extractions.pop(cache_key, None)
+
+    def _parse_uncached(self, user_input: str, all_questions: list, current_answers: dict, chat_history, validate) -> dict:
+        messages = self._build_parse_messages(user_input, all_questions, current_answers, chat_history)
+        response_format = self._parse_response_format(self._schema_questions(user_input, all_questions, current_answers))
+        result, error_reason = self._parse_once(messages, response_format, "primary")
+        reason = self._escalation_reason(result, error_reason, user_input, validate)
+        if reason is None:
+            return result
+        self.routing_stats.record_escalation(reason)
+        METRICS.inc("llm_escalations_total", reason=reason)
+        escalated, _ = self._parse_once(messages, response_format, "escalated")
+        return self._choose_escalated(result, escalated)
+
+    async def _aparse_uncached(self, user_input: str, all_questions: list, current_answers: dict, chat_history, validate) -> dict:
+        messages = self._build_parse_messages(user_input, all_questions, current_answers, chat_history)
+        response_format = self._parse_response_format(self._schema_questions(user_input, all_questions, current_answers))
+        result, error_reason = await self._aparse_once(messages, response_format, "primary")
+        reason = self._escalation_reason(result, error_reason, user_input, validate)
+        if reason is None:
+            return result
+        self.routing_stats.record_escalation(reason)
+        METRICS.inc("llm_escalations_total", reason=reason)
+        escalated, _ = await self._aparse_once(messages, response_format, "escalated")
+        return self._choose_escalated(result, escalated)
+
+    def _complete_text(self, messages: list, fallback: str, error_label: str, kind: str, temperature: float = 0.7) -> str:
+        try:
+            model = self.model_for(kind)
+            with METRICS.timer("llm_request_seconds", kind=kind, model=model):
+                response = self.client_manager.create(priority=KIND_PRIORITIES.get(kind, 0), model=model, messages=messages, temperature=temperature)
+            self._record_usage(response, kind)
+            return response.choices[0].message.content.strip()
+        except Exception as e:
+            METRICS.inc("llm_errors_total", kind=kind, error=type(e).__name__)
+            print(f"{error_label}時發生錯誤: {e}")
+            return fallback
+
+    async def _acomplete_text(self, messages: list, fallback: str, error_label: str, kind: str, temperature: float = 0.7) -> str:
+        try:
+            model = self.model_for(kind)
+            with METRICS.timer("llm_request_seconds", kind=kind, model=model):
+                response = await self.client_manager.acreate(priority=KIND_PRIORITIES.get(kind, 0), model=model, messages=messages, temperature=temperature)
+            self._record_usage(response, kind)
+            return response.choices[0].message.content.strip()
+        except Exception as e:
+            METRICS.inc("llm_errors_total", kind=kind, error=type(e).__name__)
+            print(f"{error_label}時發生錯誤: {e}")
+            return fallback
+
+    def _stream_request_kwargs(self, kind: str, messages: list, temperature: float) -> dict:
+        return {
+            "priority": KIND_PRIORITIES.get(kind, 0),
+            "model": self.model_for(kind),
+            "messages": messages,
+            "temperature": temperature,
+            "stream_options": {"include_usage": True},
+        }
+
+    def _on_stream_chunk(self, chunk, kind: str, stripped: _StrippedStream) -> str:
+        if getattr(chunk, "usage", None) is not None:
+            self._record_usage(chunk, kind)
+        if not chunk.choices:
+            return ""
+        return stripped.feed(chunk.choices[0].delta.content or "")
+
+    def _stream_text(self, messages: list, fallback: str, error_label: str, kind: str, temperature: float = 0.7):
+        """
+        _complete_text 的串流版本，逐塊 yield。串接結果與 _complete_text 的返回值相同；
+        串流中途出錯時停在已輸出的內容，尚未輸出任何內容時改為輸出 fallback。
+        """
+        stripped = _StrippedStream()
+        start = time.perf_counter()
+        ttft = None
+        try:
+            for chunk in self.client_manager.stream(**self._stream_request_kwargs(kind, messages, temperature)):
+                piece = self._on_stream_chunk(chunk, kind, stripped)
+                if piece:
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+                    yield piece
+        except Exception as e:
+            METRICS.inc("llm_errors_total", kind=kind, error=type(e).__name__)
+            print(f"{error_label}時發生錯誤: {e}")
+            if not stripped.text:
+                yield fallback
+            return
+        total = time.perf_counter() - start
+        self.streaming_stats.record(kind, ttft if ttft is not None else total, total)
+        METRICS.observe("llm_request_seconds", total, kind=kind, model=self.model_for(kind))
+
+    async def _astream_text(self, messages: list, fallback: str, error_label: str, kind: str, temperature: float = 0.7):
+        stripped = _StrippedStream()
+        start = time.perf_counter()
+        ttft = None
+        try:
+            async for chunk in self.client_manager.astream(**self._stream_request_kwargs(kind, messages, temperature)):
+                piece = self._on_stream_chunk(chunk, kind, stripped)
+                if piece:
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+                    yield piece
+        except Exception as e:
+            METRICS.inc("llm_errors_total", kind=kind, error=type(e).__name__)
+            print(f"{error_label}時發生錯誤: {e}")
+            if not stripped.text:
+                yield fallback
+            return
+        total = time.perf_counter() - start
+        self.streaming_stats.record(kind, ttft if ttft is not None else total, total)
+        METRICS.observe("llm_request_seconds", total, kind=kind, model=self.model_for(kind))
+
+    def _cached_stream(self, cache, key, pieces, fallback):
+        """
+        串流輸出並在完成後將完整文字加入變化快取 (fallback 不快取)。
+        """
+        parts = []
+        for piece in pieces:
+            parts.append(piece)
+            yield piece
+        text = "".join(parts)
+        if cache and text != fallback:
+            cache.add(key, text)
+
+    async def _acached_stream(self, cache, key, pieces, fallback):
+        parts = []
+        async for piece in pieces:
+            parts.append(piece)
+            yield piece
+        text = "".join(parts)
+        if cache and text != fallback:
+            cache.add(key, text)
+
+    def _build_greeting_messages(self) -> list:
         first_required_question = next((q for q in self.question_structure if q.get("validation_rule") == "required"), None)
         initial_prompt_part = ""
         if first_required_question:
@@ -97,17 +727,72 @@ class AINLULayer:
         """
         messages = [{"role": "system", "content": system_prompt}]
         messages.append({"role": "user", "content": f"生成初始歡迎語和指南，並引導開始。引導語應包含：「{initial_prompt_part}」"})
-        try:
-            response = self.client.chat.completions.create(model=self.model, messages=messages, temperature=0.7)
-            return response.choices[0].message.content.strip()
-        except Exception as e:
-            print(f"生成歡迎語時發生錯誤: {e}")
-            return "--- 歡迎來到我們的智能問卷調查！ --- 請開始提供您的資訊。"
+        return messages
 
-    def generate_next_questions_prompt(self, unanswered_questions: list, chat_history: list = None, current_answers: dict = None) -> str:
-        if not unanswered_questions:
-            return "所有問題都已回答。謝謝！"
-        
+    def generate_initial_greeting_and_guidance(self) -> str:
+        cached = self.greeting_cache.get("default") if self.greeting_cache else None
+        if cached is not None:
+            return cached
+        greeting = self._complete_text(self._build_greeting_messages(), self.GREETING_FALLBACK, "生成歡迎語", "greeting")
+        if self.greeting_cache and greeting != self.GREETING_FALLBACK:
+            self.greeting_cache.add("default", greeting)
+        return greeting
+
+    async def agenerate_initial_greeting_and_guidance(self) -> str:
+        cached = self.greeting_cache.get("default") if self.greeting_cache else None
+        if cached is not None:
+            return cached
+        greeting = await self._acomplete_text(self._build_greeting_messages(), self.GREETING_FALLBACK, "生成歡迎語", "greeting")
+        if self.greeting_cache and greeting != self.GREETING_FALLBACK:
+            self.greeting_cache.add("default", greeting)
+        return greeting
+
+    def stream_initial_greeting_and_guidance(self):
+        """
+        串流版本：逐塊 yield 歡迎語，串接結果與 generate_initial_greeting_and_guidance 相同。
+        """
+        cached = self.greeting_cache.get("default") if self.greeting_cache else None
+        if cached is not None:
+            yield cached
+            return
+        yield from self._cached_stream(self.greeting_cache, "default", self._stream_text(
+            self._build_greeting_messages(), self.GREETING_FALLBACK, "生成歡迎語", "greeting"), self.GREETING_FALLBACK)
+
+    async def astream_initial_greeting_and_guidance(self):
+        cached = self.greeting_cache.get("default") if self.greeting_cache else None
+        if cached is not None:
+            yield cached
+            return
+        async for piece in self._acached_stream(self.greeting_cache, "default", self._astream_text(
+                self._build_greeting_messages(), self.GREETING_FALLBACK, "生成歡迎語", "greeting"), self.GREETING_FALLBACK):
+            yield piece
+
+    async def aprewarm_greeting_pool(self) -> int:
+        """
+        啟動時預先生成整個歡迎語變體池，之後的新會話可零延遲取得歡迎語。返回池中的變體數。
+        """
+        if not self.greeting_cache:
+            return 0
+        missing = self.greeting_cache.variants_per_key - len(self.greeting_cache.variants("default"))
+        if missing > 0:
+            greetings = await asyncio.gather(*[
+                self._acomplete_text(self._build_greeting_messages(), self.GREETING_FALLBACK, "生成歡迎語", "greeting")
+                for _ in range(missing)
+            ])
+            for greeting in greetings:
+                if greeting != self.GREETING_FALLBACK:
+                    self.greeting_cache.add("default", greeting)
+        return len(self.greeting_cache.variants("default"))
+
+    @staticmethod
+    def _unanswered_signature(unanswered_questions: list) -> str:
+        return ",".join(sorted(q["id"] for q in unanswered_questions))
+
+    def select_questions_to_mention(self, unanswered_questions: list, current_answers: dict = None) -> tuple:
+        """
+        返回 (依優先級排序的未回答問題, 提示語中要具體提及的問題)。
+        """
+        current_answers = current_answers or {}
         sorted_unanswered = sorted(unanswered_questions, key=lambda x: (x.get("validation_rule") == "required", x.get("priority", 99)))
         
         questions_to_mention_candidates = []
@@ -117,7 +802,10 @@ class AINLULayer:
                  questions_to_mention_candidates.append(q_obj)
         
         questions_to_mention = questions_to_mention_candidates[:2] if questions_to_mention_candidates else sorted_unanswered[:1]
+        return sorted_unanswered, questions_to_mention
 
+    def _build_next_questions_messages(self, unanswered_questions: list, chat_history: list = None, current_answers: dict = None) -> list:
+        sorted_unanswered, questions_to_mention = self.select_questions_to_mention(unanswered_questions, current_answers)
 
         questions_list_text = ""
         if questions_to_mention:
@@ -136,18 +824,68 @@ class AINLULayer:
         你可以嘗試引導他們回答其中一個或幾個，例如：{questions_list_text}
         """
         messages = [{"role": "system", "content": system_prompt}]
-        if chat_history:
-            messages.extend(chat_history[-4:])
+        messages.extend(self._history_messages(chat_history, 4))
         messages.append({"role": "user", "content": "請生成一個引導使用者繼續回答問題的提示語。"})
-        try:
-            response = self.client.chat.completions.create(model=self.model, messages=messages, temperature=0.7)
-            return response.choices[0].message.content.strip()
-        except Exception as e:
-            print(f"生成下一步提示時發生錯誤: {e}")
-            return "我們還有一些問題需要您的協助。請問您是否願意繼續？您也可以隨時說出想修改的答案。"
+        return messages
 
-    def generate_clarification_prompt(self, question_id: str, problem_description: str, chat_history: list = None) -> str:
-        question_obj = next((q for q in self.question_structure if q["id"] == question_id), None)
+    def generate_next_questions_prompt(self, unanswered_questions: list, chat_history: list = None, current_answers: dict = None) -> str:
+        if not unanswered_questions:
+            return self.ALL_ANSWERED_TEXT
+        signature = self._unanswered_signature(unanswered_questions)
+        cached = self.next_prompt_cache.get(signature) if self.next_prompt_cache else None
+        if cached is not None:
+            return cached
+        messages = self._build_next_questions_messages(unanswered_questions, chat_history, current_answers)
+        next_prompt = self._complete_text(messages, self.NEXT_QUESTIONS_FALLBACK, "生成下一步提示", "next_prompt")
+        if self.next_prompt_cache and next_prompt != self.NEXT_QUESTIONS_FALLBACK:
+            self.next_prompt_cache.add(signature, next_prompt)
+        return next_prompt
+
+    async def agenerate_next_questions_prompt(self, unanswered_questions: list, chat_history: list = None, current_answers: dict = None) -> str:
+        if not unanswered_questions:
+            return self.ALL_ANSWERED_TEXT
+        signature = self._unanswered_signature(unanswered_questions)
+        cached = self.next_prompt_cache.get(signature) if self.next_prompt_cache else None
+        if cached is not None:
+            return cached
+        messages = self._build_next_questions_messages(unanswered_questions, chat_history, current_answers)
+        next_prompt = await self._acomplete_text(messages, self.NEXT_QUESTIONS_FALLBACK, "生成下一步提示", "next_prompt")
+        if self.next_prompt_cache and next_prompt != self.NEXT_QUESTIONS_FALLBACK:
+            self.next_prompt_cache.add(signature, next_prompt)
+        return next_prompt
+
+    def stream_next_questions_prompt(self, unanswered_questions: list, chat_history: list = None, current_answers: dict = None):
+        """
+        串流版本：逐塊 yield 下一步提示，串接結果與 generate_next_questions_prompt 相同。
+        """
+        if not unanswered_questions:
+            yield self.ALL_ANSWERED_TEXT
+            return
+        signature = self._unanswered_signature(unanswered_questions)
+        cached = self.next_prompt_cache.get(signature) if self.next_prompt_cache else None
+        if cached is not None:
+            yield cached
+            return
+        messages = self._build_next_questions_messages(unanswered_questions, chat_history, current_answers)
+        yield from self._cached_stream(self.next_prompt_cache, signature, self._stream_text(
+            messages, self.NEXT_QUESTIONS_FALLBACK, "生成下一步提示", "next_prompt"), self.NEXT_QUESTIONS_FALLBACK)
+
+    async def astream_next_questions_prompt(self, unanswered_questions: list, chat_history: list = None, current_answers: dict = None):
+        if not unanswered_questions:
+            yield self.ALL_ANSWERED_TEXT
+            return
+        signature = self._unanswered_signature(unanswered_questions)
+        cached = self.next_prompt_cache.get(signature) if self.next_prompt_cache else None
+        if cached is not None:
+            yield cached
+            return
+        messages = self._build_next_questions_messages(unanswered_questions, chat_history, current_answers)
+        async for piece in self._acached_stream(self.next_prompt_cache, signature, self._astream_text(
+                messages, self.NEXT_QUESTIONS_FALLBACK, "生成下一步提示", "next_prompt"), self.NEXT_QUESTIONS_FALLBACK):
+            yield piece
+
+    def _build_clarification_messages(self, question_id: str, problem_description: str, chat_history: list = None) -> list:
+        question_obj = self.questionnaire.get(question_id)
         question_text = question_obj["question"] if question_obj else question_id
         system_prompt = f"""
         你是一個友善的問卷AI助理。我們在處理使用者最近的回答時遇到一些不明確的地方，需要澄清。
@@ -159,12 +897,80 @@ class AINLULayer:
         請用中文回答。
         """
         messages = [{"role": "system", "content": system_prompt}]
-        if chat_history:
-            messages.extend(chat_history[-2:])
+        messages.extend(self._history_messages(chat_history, 2, with_summary=False))
         messages.append({"role": "user", "content": "請生成澄清提示。"})
-        try:
-            response = self.client.chat.completions.create(model=self.model, messages=messages, temperature=0.7)
-            return response.choices[0].message.content.strip()
-        except Exception as e:
-            print(f"生成澄清提示時發生錯誤: {e}")
-            return "您剛才的回答我有點不確定，可以請您再說清楚一點嗎？"
\ No newline at end of file
+        return messages
+
+    def generate_clarification_prompt(self, question_id: str, problem_description: str, chat_history: list = None) -> str:
+        messages = self._build_clarification_messages(question_id, problem_description, chat_history)
+        return self._complete_text(messages, self.CLARIFICATION_FALLBACK, "生成澄清提示", "clarification")
+
+    async def agenerate_clarification_prompt(self, question_id: str, problem_description: str, chat_history: list = None) -> str:
+        messages = self._build_clarification_messages(question_id, problem_description, chat_history)
+        return await self._acomplete_text(messages, self.CLARIFICATION_FALLBACK, "生成澄清提示", "clarification")
+
+    def stream_clarification_prompt(self, question_id: str, problem_description: str, chat_history: list = None):
+        messages = self._build_clarification_messages(question_id, problem_description, chat_history)
+        yield from self._stream_text(messages, self.CLARIFICATION_FALLBACK, "生成澄清提示", "clarification")
+
+    async def astream_clarification_prompt(self, question_id: str, problem_description: str, chat_history: list = None):
+        messages = self._build_clarification_messages(question_id, problem_description, chat_history)
+        async for piece in self._astream_text(messages, self.CLARIFICATION_FALLBACK, "生成澄清提示", "clarification"):
+            yield piece
+
+    def _build_combined_clarification_messages(self, problems: list, chat_history: list = None) -> list:
+        problem_lines = []
+        for question_id, problem_description in problems:
+            question_obj = self.questionnaire.get(question_id)
+            question_text = question_obj["question"] if question_obj else question_id
+            problem_lines.append(f"- 相關問題: {question_text}\n          問題描述: {problem_description}")
+        system_prompt = f"""
+        你是一個友善的問卷AI助理。我們在處理使用者最近的回答時，有幾個地方不明確，需要澄清。
+        請將以下所有問題整合成一段禮貌、清晰的澄清提問語，逐一提及是關於哪個問題，引導使用者提供更準確的資訊。
+
+        {chr(10).join(problem_lines)}
+        請用中文回答。
+        """
+        messages = [{"role": "system", "content": system_prompt}]
+        messages.extend(self._history_messages(chat_history, 2, with_summary=False))
+        messages.append({"role": "user", "content": "請生成澄清提示。"})
+        return messages
+
+    async def agenerate_combined_clarification_prompt(self, problems: list, chat_history: list = None) -> str:
+        """
+        problems: [(question_id, problem_description)]，以單次呼叫生成涵蓋所有問題的澄清提示。
+        """
+        if len(problems) == 1:
+            return await self.agenerate_clarification_prompt(problems[0][0], problems[0][1], chat_history)
+        messages = self._build_combined_clarification_messages(problems, chat_history)
+        return await self._acomplete_text(messages, self.CLARIFICATION_FALLBACK, "生成澄清提示", "clarification")
+
+    async def astream_combined_clarification_prompt(self, problems: list, chat_history: list = None):
+        if len(problems) == 1:
+            pieces = self.astream_clarification_prompt(problems[0][0], problems[0][1], chat_history)
+        else:
+            messages = self._build_combined_clarification_messages(problems, chat_history)
+            pieces = self._astream_text(messages, self.CLARIFICATION_FALLBACK, "生成澄清提示", "clarification")
+        async for piece in pieces:
+            yield piece
+
+    def _build_summary_messages(self, previous_summary: str, messages: list) -> list:
+        transcript = "\n".join(f"{'使用者' if m.role == 'user' else '助理'}: {m.content}" for m in messages)
+        system_prompt = f"""
+        你負責維護一份問卷對話的摘要。請將「既有摘要」與「新的對話片段」合併成一份新的摘要，
+        保留使用者提供過的事實、偏好、修改過的答案與尚未釐清的地方，省略寒暄與重複內容。
+        摘要請用中文條列，總長度不超過 200 字。
+
+        既有摘要: {previous_summary or "(無)"}
+        """
+        return [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": f"新的對話片段:\n{transcript}\n請更新對話摘要。"},
+        ]
+
+    async def asummarize_history(self, previous_summary: str, messages: list) -> str:
+        """
+        chat_memory.ChatMemory 的 summarizer：將被擠出環形緩衝區的訊息併入滾動摘要。失敗時返回 None。
+        """
+        return await self._acomplete_text(self._build_summary_messages(previous_summary, messages), None,
+                                          "更新對話摘要", "summary", temperature=0.2)
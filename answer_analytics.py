@@ -0,0 +1,337 @@
+# answer_analytics.py
+
+"""
+已提交答案的增量統計。
+
+QuestionnaireAgent 每寫入一份新的提交 (_save_answers_to_sheet)，就依問題的 type / options 更新彙總：
+- select / boolean：各選項的次數 (不在選項中的值計入 other)
+- number：串流平均數與變異數 (Welford)、最小/最大值；有範圍規則 (例如 range_1_5) 時另計各分數的次數
+- text：作答數與平均長度
+- 每一題：顯示次數 (show_if 成立)、作答數、完成率，以及在這一題中斷的比例 (drop-off：
+  之後顯示的問題都沒有回答，且這一題也沒有回答)
+
+查詢時直接返回快取的快照 (只在有新提交後重建一次，成本與資料筆數無關)，儀表板不必下載整張工作表重新計算。
+歷史資料以 backfill() 一次掃描匯入；export_state() / merge_state() 用於保存狀態與彙總多個 worker 程序。
+
+用法：
+    python answer_analytics.py --backfill sqlite --path questionnaire_results.db --state analytics_state.json
+"""
+
+import json
+import math
+import os
+import threading
+
+from questionnaire_model import DEFAULT_QUESTIONNAIRE, RANGE_RULES
+
+STATE_FORMAT = 1
+
+
+class _QuestionStats:
+    __slots__ = ("kind", "options", "shown", "answered", "dropped", "counts", "other",
+                 "n", "mean", "m2", "min", "max", "chars")
+
+    def __init__(self, kind, options=()):
+        self.kind = kind
+        self.options = tuple(options)
+        self.shown = 0
+        self.answered = 0
+        self.dropped = 0
+        self.counts = {option: 0 for option in self.options}
+        self.other = 0
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.chars = 0
+
+    def add(self, value):
+        self.answered += 1
+        if self.kind == "number":
+            self._add_number(value)
+        elif self.kind == "text":
+            self.chars += len(str(value))
+        if self.kind in ("select", "boolean") or (self.kind == "number" and self.options):
+            key = str(value) if self.kind == "number" else value
+            if key in self.counts:
+                self.counts[key] += 1
+            else:
+                self.other += 1
+
+    def _add_number(self, value):
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            return
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (value - self.mean)
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, state):
+        self.shown += state["shown"]
+        self.answered += state["answered"]
+        self.dropped += state["dropped"]
+        for key, count in state["counts"].items():
+            self.counts[key] = self.counts.get(key, 0) + count
+        self.other += state["other"]
+        self.chars += state["chars"]
+        if state["n"]:
+            # 合併兩組的平均數與平方差和 (Chan 等人的平行演算法)
+            n = self.n + state["n"]
+            delta = state["mean"] - self.mean
+            self.m2 += state["m2"] + delta * delta * self.n * state["n"] / n
+            self.mean += delta * state["n"] / n
+            self.n = n
+            self.min = state["min"] if self.min is None else min(self.min, state["min"])
+            self.max = state["max"] if self.max is None else max(self.max, state["max"])
+
+    def export(self):
+        state = {name: getattr(self, name) for name in self.__slots__}
+        state["options"] = list(self.options)
+        state["counts"] = dict(self.counts)
+        return state
+
+    def summary(self, submissions):
+        result = {
+            "type": self.kind,
+            "shown": self.shown,
+            "answered": self.answered,
+            "completion_rate": round(self.answered / self.shown, 4) if self.shown else 0.0,
+            "drop_offs": self.dropped,
+            "drop_off_rate": round(self.dropped / submissions, 4) if submissions else 0.0,
+        }
+        if self.kind == "number":
+            variance = self.m2 / self.n if self.n else 0.0
+            result.update(mean=round(self.mean, 4) if self.n else None, variance=round(variance, 4),
+                          stddev=round(math.sqrt(variance), 4), min=self.min, max=self.max)
+        elif self.kind == "text":
+            result["avg_length"] = round(self.chars / self.answered, 1) if self.answered else 0.0
+        if self.counts or self.kind in ("select", "boolean"):
+            total = sum(self.counts.values())
+            result["counts"] = dict(self.counts)
+            result["distribution"] = {key: round(count / total, 4) for key, count in self.counts.items()} if total else {}
+            result["other"] = self.other
+        return result
+
+
+def _question_kind(question):
+    q_type = question.get("type")
+    if q_type == "select" and question.get("options"):
+        return "select", question["options"]
+    if q_type == "boolean":
+        return "boolean", ("是", "否")
+    if q_type == "number":
+        bounds = RANGE_RULES.get(question.get("validation_rule"))
+        return "number", tuple(str(v) for v in range(bounds[0], bounds[1] + 1)) if bounds else ()
+    return "text", ()
+
+
+class QuestionnaireAnalytics:
+    """
+    一個問卷版本的彙總。questionnaire 為 None 時 (由保存的狀態建立) 只能合併與查詢，第一次 record() 時補上。
+    """
+    def __init__(self, questionnaire=None, name=None, version=None):
+        self.questionnaire = questionnaire
+        self.name = questionnaire.name if questionnaire is not None else name
+        self.version = questionnaire.version if questionnaire is not None else version
+        self.submissions = 0
+        self.completed = 0
+        self.questions = {}
+        if questionnaire is not None:
+            for q in questionnaire.questions:
+                self.questions[q["id"]] = _QuestionStats(*_question_kind(q))
+        self._lock = threading.Lock()
+        self._snapshot = None
+
+    def _normalize(self, q_id, value):
+        # 儲存後端讀回的資料行是字串 ("4"、"")；與即時提交一樣經過驗證函式轉為標準值
+        if value is None or value == "":
+            return None
+        is_valid, validated, _ = self.questionnaire.validators[q_id](value)
+        return validated if is_valid else value
+
+    def record(self, answers):
+        """
+        加入一份提交 (問題 id -> 答案，未回答為 None)。
+        """
+        questionnaire = self.questionnaire
+        values = {q_id: self._normalize(q_id, answers.get(q_id)) for q_id in questionnaire.headers}
+        shown = [q_id for q_id in questionnaire.headers if questionnaire.is_visible(q_id, values)]
+        # 中斷點：最後一個有回答的顯示問題之後的第一個顯示問題
+        drop_off = None
+        for position in range(len(shown) - 1, -1, -1):
+            if values[shown[position]] is not None:
+                if position + 1 < len(shown):
+                    drop_off = shown[position + 1]
+                break
+        else:
+            drop_off = shown[0] if shown else None
+        with self._lock:
+            self.submissions += 1
+            self.completed += drop_off is None
+            for q_id in shown:
+                stats = self.questions[q_id]
+                stats.shown += 1
+                if values[q_id] is not None:
+                    stats.add(values[q_id])
+            if drop_off is not None:
+                self.questions[drop_off].dropped += 1
+            self._snapshot = None
+
+    def backfill(self, rows, headers=None):
+        """
+        一次掃描匯入歷史資料，返回筆數。rows 為答案 dict，或依 headers (預設為問卷的 result_headers) 排列的資料行。
+        """
+        headers = list(headers if headers is not None else self.questionnaire.result_headers)
+        count = 0
+        for row in rows:
+            self.record(row if isinstance(row, dict) else dict(zip(headers, row)))
+            count += 1
+        return count
+
+    def snapshot(self):
+        """
+        返回目前的彙總；沒有新提交時直接返回上次建立的結果 (呼叫端不應修改)。
+        """
+        snapshot = self._snapshot
+        if snapshot is not None:
+            return snapshot
+        with self._lock:
+            submissions = self.submissions
+            snapshot = {
+                "questionnaire": self.name,
+                "version": self.version,
+                "submissions": submissions,
+                "completed": self.completed,
+                "completion_rate": round(self.completed / submissions, 4) if submissions else 0.0,
+                "questions": {q_id: stats.summary(submissions) for q_id, stats in self.questions.items()},
+            }
+            self._snapshot = snapshot
+        return snapshot
+
+    def export_state(self):
+        with self._lock:
+            return {
+                "name": self.name, "version": self.version, "submissions": self.submissions, "completed": self.completed,
+                "questions": {q_id: stats.export() for q_id, stats in self.questions.items()},
+            }
+
+    def merge_state(self, state):
+        with self._lock:
+            self.submissions += state["submissions"]
+            self.completed += state["completed"]
+            for q_id, q_state in state["questions"].items():
+                stats = self.questions.get(q_id)
+                if stats is None:
+                    stats = self.questions[q_id] = _QuestionStats(q_state["kind"], q_state["options"])
+                stats.merge(q_state)
+            self._snapshot = None
+
+
+class AnswerAnalytics:
+    """
+    依 (問卷 id, 版本) 分開的彙總；題目變更後的新版本另外統計，不與舊版本的選項混在一起。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._questionnaires = {} # (問卷 id, version) -> QuestionnaireAnalytics
+
+    def for_questionnaire(self, questionnaire):
+        key = (questionnaire.name, questionnaire.version)
+        analytics = self._questionnaires.get(key)
+        if analytics is None or analytics.questionnaire is None:
+            with self._lock:
+                analytics = self._questionnaires.get(key)
+                if analytics is None:
+                    analytics = self._questionnaires[key] = QuestionnaireAnalytics(questionnaire)
+                elif analytics.questionnaire is None:
+                    analytics.questionnaire = questionnaire
+        return analytics
+
+    def record(self, answers, questionnaire=None):
+        self.for_questionnaire(questionnaire or DEFAULT_QUESTIONNAIRE).record(answers)
+
+    def backfill(self, rows, questionnaire=None, headers=None):
+        return self.for_questionnaire(questionnaire or DEFAULT_QUESTIONNAIRE).backfill(rows, headers)
+
+    def snapshot(self, questionnaire_id=None):
+        """
+        返回 {"<問卷 id>@<版本>": 彙總}；questionnaire_id 提供時只包含該問卷的各版本。
+        """
+        return {f"{name}@{version}": analytics.snapshot() for (name, version), analytics in list(self._questionnaires.items())
+                if questionnaire_id is None or name == questionnaire_id}
+
+    def export_state(self):
+        """
+        返回可 JSON 序列化 (也可 pickle) 的狀態，供 merge_state() 還原或彙總其他程序 (worker_pool) 的統計。
+        """
+        return [analytics.export_state() for analytics in list(self._questionnaires.values())]
+
+    def merge_state(self, states):
+        for state in states:
+            key = (state["name"], state["version"])
+            with self._lock:
+                analytics = self._questionnaires.get(key)
+                if analytics is None:
+                    analytics = self._questionnaires[key] = QuestionnaireAnalytics(name=state["name"], version=state["version"])
+            analytics.merge_state(state)
+
+    def save(self, path):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump([STATE_FORMAT, self.export_state()], f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def load(self, path):
+        """
+        合併 save() 保存的狀態；檔案不存在時不做任何事。返回載入的問卷版本數。
+        """
+        if not os.path.exists(path):
+            return 0
+        with open(path, "r", encoding="utf-8") as f:
+            state_format, states = json.load(f)
+        if state_format != STATE_FORMAT:
+            raise ValueError(f"不支援的統計狀態格式版本: {state_format}")
+        self.merge_state(states)
+        return len(states)
+
+
+# 程序共用的統計，由 QuestionnaireAgent 在寫入新提交後更新
+ANALYTICS = AnswerAnalytics()
+
+
+def _read_store_rows(store, batch_size=5000):
+    position = 0
+    while True:
+        rows, position = store.read_since(position, batch_size)
+        if not rows:
+            return
+        yield from rows
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="由儲存後端的歷史資料一次重建答案統計")
+    parser.add_argument("--backfill", required=True, choices=["sqlite", "csv", "jsonl", "sheets"])
+    parser.add_argument("--path", default=None, help="本地儲存後端的檔案路徑")
+    parser.add_argument("--worksheet", default="工作表1", help="Google Sheets 的工作表名稱")
+    parser.add_argument("--state", default="analytics_state.json", help="輸出的統計狀態檔 (會被覆寫)")
+    args = parser.parse_args()
+
+    analytics = AnswerAnalytics()
+    if args.backfill == "sheets":
+        from google_sheets_service import get_default_sheet_client
+        from questionnaire_data import GOOGLE_SHEET_ID
+        values = get_default_sheet_client().open_by_key(GOOGLE_SHEET_ID).worksheet(args.worksheet).get_all_values()
+        count = analytics.backfill(values[1:], headers=values[0]) if values else 0
+    else:
+        from result_stores import create_result_store
+        store = create_result_store(args.backfill, args.path)
+        count = analytics.backfill(_read_store_rows(store), headers=store.headers)
+        store.close()
+    analytics.save(args.state)
+    print(f"已匯入 {count} 筆提交，統計狀態寫入 {args.state}。")
+    print(json.dumps(analytics.snapshot(), ensure_ascii=False, indent=2))
@@ -0,0 +1,317 @@
+# batch_nlu.py
+
+"""
+離線批次 NLU：將 email、表單等來源收集到的自由文字回覆，以與互動問卷相同的提取與驗證流程
+轉成問卷答案，批次寫入結果儲存後端。
+
+輸入為 JSONL，每行一筆：{"id": ..., "text": ...}；也接受 request_id / body (+ title) 或
+transcript 欄位。提取以有上限的非同步併發執行 (共用 OpenAIClientManager 的限流與重試)，
+依輸入順序每累積 write_batch 筆就批次寫入並更新檢查點，程序中斷後重新執行會從檢查點繼續。
+
+用法：
+    python batch_nlu.py transcripts.jsonl --store sqlite --store-path results.db --concurrency 32
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from questionnaire_data import SUBMISSION_ID_HEADER
+
+ID_FIELDS = ("id", "request_id", "response_id")
+TEXT_FIELDS = ("text", "transcript", "body")
+
+
+def parse_transcript(line, line_no):
+    """
+    返回 (record_id, text)；找不到文字欄位時 text 為 None。
+    """
+    record = json.loads(line)
+    if isinstance(record, str):
+        return str(line_no), record
+    record_id = next((str(record[f]) for f in ID_FIELDS if record.get(f) is not None), str(line_no))
+    text = next((record[f] for f in TEXT_FIELDS if isinstance(record.get(f), str) and record[f].strip()), None)
+    if text is not None and isinstance(record.get("title"), str) and record["title"].strip():
+        text = f"{record['title'].strip()}\n{text}"
+    return record_id, text
+
+
+class BatchStats:
+    def __init__(self, processed=0, rows_written=0, failed=0, empty=0, invalid_fields=0, duplicates_skipped=0):
+        # 累計值 (含先前中斷前的執行)；吞吐量只以本次執行計算
+        self.processed = processed
+        self.rows_written = rows_written
+        self.duplicates_skipped = duplicates_skipped # 提交索引判定已寫入過而略過的行 (例如恢復後重送的最後一批，或重跑同一個檔案)
+        self.failed = failed
+        self.empty = empty
+        self.invalid_fields = invalid_fields
+        self.resumed_from = processed
+        self.started_at = time.perf_counter()
+
+    def to_dict(self):
+        return {
+            "processed": self.processed,
+            "rows_written": self.rows_written,
+            "duplicates_skipped": self.duplicates_skipped,
+            "failed": self.failed,
+            "empty": self.empty,
+            "invalid_fields": self.invalid_fields,
+        }
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started_at
+        this_run = self.processed - self.resumed_from
+        return {
+            **self.to_dict(),
+            "processed_this_run": this_run,
+            "elapsed_s": round(elapsed, 2),
+            "records_per_s": round(this_run / elapsed, 1) if elapsed > 0 else 0.0,
+        }
+
+
+class BatchCheckpoint:
+    """
+    檢查點檔案：已提交的輸入行數與位元組位移 (恢復時直接 seek)，以及累計統計。以暫存檔原子替換。
+    """
+    def __init__(self, path, input_path):
+        self.path = path
+        self.input_path = os.path.abspath(input_path)
+        self.line = 0
+        self.offset = 0
+        self.stats = {}
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return self
+        with open(self.path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("input") != self.input_path:
+            raise ValueError(f"檢查點 '{self.path}' 屬於另一個輸入檔案 ({data.get('input')})。")
+        self.line = data["line"]
+        self.offset = data["offset"]
+        self.stats = data.get("stats", {})
+        return self
+
+    def save(self, line, offset, stats):
+        self.line, self.offset, self.stats = line, offset, stats
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"input": self.input_path, "line": line, "offset": offset, "stats": stats}, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
+class BatchNLURunner:
+    def __init__(self, nlu_agent=None, result_store=None, questionnaire=None, concurrency=16, write_batch=100,
+                 progress_interval=5.0):
+        """
+        nlu_agent: AINLULayer，預設建立新的 (共用程序的 OpenAIClientManager)。
+        result_store: result_stores.ResultStore，預設依 questionnaire_data.RESULT_STORE 設定。
+        concurrency: 同時進行的提取請求數上限。
+        write_batch: 每累積多少筆 (依輸入順序) 批次寫入一次並更新檢查點。
+        """
+        from questionnaire_model import DEFAULT_QUESTIONNAIRE
+        self.questionnaire = questionnaire if questionnaire is not None else DEFAULT_QUESTIONNAIRE
+        if nlu_agent is None:
+            from ai_nlu_layer import AINLULayer
+            nlu_agent = AINLULayer(questionnaire=self.questionnaire)
+        self.nlu_agent = nlu_agent
+        if result_store is None:
+            from result_stores import get_default_result_store
+            result_store = get_default_result_store()
+        self.result_store = result_store
+        self.concurrency = concurrency
+        self.write_batch = write_batch
+        self.progress_interval = progress_interval
+
+    def _new_agent(self):
+        from ai_agents import QuestionnaireAgent
+        return QuestionnaireAgent(nlu_agent=self.nlu_agent, rule_extractor=False, speculative_next_prompt=False,
+                                  questionnaire=self.questionnaire, result_store=self.result_store,
+                                  summarize_history=False)
+
+    async def extract(self, text):
+        """
+        對一筆文字執行提取與驗證，返回 (answers 或 None, 無效欄位數, 錯誤原因)。
+        驗證與條件 (show_if / required_if) 的處理與互動問卷相同，被隱藏問題的答案會被忽略。
+        """
+        agent = self._new_agent()
+        result = await self.nlu_agent.aparse_chat_response_to_answers(text, agent.question_structure, agent.collected_answers,
+                                                                      validate=agent._extraction_failures)
+        if result.get("action_request") == "error":
+            return None, 0, result.get("reasoning", "error")
+        invalid = 0
+        for q_id, value in (result.get("extracted_answers") or {}).items():
+            question_obj = agent._get_question_obj_by_id(q_id)
+            if not question_obj:
+                continue
+            is_valid, validated_value, _ = agent._validate_extracted_answer(question_obj, value)
+            if is_valid:
+                agent._update_answers_and_unanswered_status(q_id, validated_value)
+            elif value is not None and not (isinstance(value, str) and not value.strip()):
+                invalid += 1
+        return agent.collected_answers, invalid, None
+
+    async def arun(self, input_path, checkpoint_path=None, failures_path=None, limit=None):
+        """
+        處理 input_path，返回統計。checkpoint_path 預設為 <input>.checkpoint.json；
+        提取失敗的記錄 (可重試) 寫入 failures_path，預設為 <input>.failed.jsonl。
+        limit: 本次最多處理的筆數 (用於分段執行)。
+        """
+        checkpoint = BatchCheckpoint(checkpoint_path or input_path + ".checkpoint.json", input_path).load()
+        failures_path = failures_path or input_path + ".failed.jsonl"
+        input_name = os.path.basename(input_path) # 與記錄 id 組成 submission_id，重跑同一個檔案不會重複寫入
+        stats = BatchStats(**checkpoint.stats)
+        if checkpoint.line:
+            print(f"從檢查點繼續：略過前 {checkpoint.line} 行。")
+
+        # 已完成、但前面還有未完成記錄而尚未提交的結果：line_no -> (行尾位移, record_id, answers, 無效欄位數, 錯誤)
+        # record_id 為 None 表示空行
+        done = {}
+        committed = [checkpoint.line, checkpoint.offset]
+        pending_rows = []
+        pending_failures = []
+        window = max(self.concurrency * 4, self.write_batch) # 允許超前提交點的行數上限，限制記憶體
+        window_open = asyncio.Condition()
+        last_report = [time.perf_counter()]
+
+        def flush():
+            # 先寫結果再更新檢查點：兩者之間崩潰時，恢復後會重送最後一批，設定了提交索引的儲存後端會略過已寫入的記錄
+            if pending_rows:
+                written = self.result_store.append_many(pending_rows)
+                stats.rows_written += written
+                stats.duplicates_skipped += len(pending_rows) - written
+            if pending_failures:
+                with open(failures_path, "a", encoding="utf-8") as f:
+                    f.writelines(json.dumps(r, ensure_ascii=False) + "\n" for r in pending_failures)
+            pending_rows.clear()
+            pending_failures.clear()
+            checkpoint.save(committed[0], committed[1], stats.to_dict())
+
+        def commit():
+            # 依輸入順序推進提交點，累積 write_batch 筆就批次寫入
+            advanced = False
+            while committed[0] in done:
+                end_offset, record_id, answers, invalid, error = done.pop(committed[0])
+                if record_id is not None:
+                    stats.processed += 1
+                    stats.invalid_fields += invalid
+                    if error is not None:
+                        stats.failed += 1
+                        pending_failures.append({"id": record_id, "line": committed[0] + 1, "error": error})
+                    elif all(v is None for v in answers.values()):
+                        stats.empty += 1
+                    else:
+                        pending_rows.append({**answers, SUBMISSION_ID_HEADER: f"{input_name}:{record_id}"})
+                committed[0] += 1
+                committed[1] = end_offset
+                advanced = True
+            if len(pending_rows) + len(pending_failures) >= self.write_batch:
+                flush()
+            return advanced
+
+        def report_progress():
+            if self.progress_interval and time.perf_counter() - last_report[0] >= self.progress_interval:
+                last_report[0] = time.perf_counter()
+                summary = stats.summary()
+                print(f"已處理 {summary['processed']} 筆 ({summary['records_per_s']} 筆/秒)，失敗 {summary['failed']} 筆。")
+
+        async def process(line_no, end_offset, raw):
+            answers, invalid = None, 0
+            try:
+                record_id, text = parse_transcript(raw, line_no + 1)
+                error = None if text is not None else "找不到文字欄位"
+            except (ValueError, TypeError, AttributeError) as e:
+                record_id, text, error = str(line_no + 1), None, f"無法解析的輸入行: {e}"
+            if text is not None:
+                try:
+                    answers, invalid, error = await self.extract(text)
+                except Exception as e:
+                    error = f"提取時發生錯誤: {e}"
+            done[line_no] = (end_offset, record_id, answers, invalid, error)
+            if commit():
+                async with window_open:
+                    window_open.notify_all()
+            report_progress()
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+        fatal = [] # 寫入結果或檢查點失敗時停止整個批次，已提交的檢查點保持不變
+
+        async def bounded(line_no, end_offset, raw):
+            try:
+                await process(line_no, end_offset, raw)
+            except Exception as e:
+                fatal.append(e)
+                async with window_open:
+                    window_open.notify_all()
+            finally:
+                semaphore.release()
+
+        started = 0
+        with open(input_path, "rb") as f:
+            f.seek(checkpoint.offset)
+            line_no, offset = checkpoint.line, checkpoint.offset
+            for raw in iter(f.readline, b""):
+                if fatal or (raw.strip() and limit is not None and started >= limit):
+                    break
+                offset += len(raw)
+                if not raw.strip():
+                    done[line_no] = (offset, None, None, 0, None)
+                    commit()
+                else:
+                    started += 1
+                    async with window_open:
+                        await window_open.wait_for(lambda: fatal or line_no - committed[0] < window)
+                    await semaphore.acquire()
+                    if fatal:
+                        semaphore.release()
+                        break
+                    task = asyncio.ensure_future(bounded(line_no, offset, raw))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                line_no += 1
+            if tasks:
+                await asyncio.gather(*tasks)
+        if fatal:
+            print(f"批次處理中止，已提交到第 {checkpoint.line} 行，重新執行會從檢查點繼續: {fatal[0]}")
+            raise fatal[0]
+        flush()
+        summary = stats.summary()
+        print(f"批次處理完成：本次 {summary['processed_this_run']} 筆，累計寫入 {summary['rows_written']} 筆 "
+              f"(略過重複 {summary['duplicates_skipped']} 筆)，"
+              f"失敗 {summary['failed']} 筆，無資訊 {summary['empty']} 筆，無效欄位 {summary['invalid_fields']} 個，"
+              f"{summary['records_per_s']} 筆/秒。")
+        return summary
+
+    def run(self, input_path, checkpoint_path=None, failures_path=None, limit=None):
+        return asyncio.run(self.arun(input_path, checkpoint_path, failures_path, limit))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="離線批次提取自由文字回覆中的問卷答案")
+    parser.add_argument("input", help="JSONL 檔案，每行一筆 {\"id\": ..., \"text\": ...}")
+    parser.add_argument("--store", default=None, help="結果儲存後端 (sqlite/csv/jsonl/sheets)，預設依 questionnaire_data.RESULT_STORE")
+    parser.add_argument("--store-path", default=None, help="本地後端的檔案路徑")
+    parser.add_argument("--concurrency", type=int, default=16, help="同時進行的提取請求數")
+    parser.add_argument("--write-batch", type=int, default=100, help="每批寫入與更新檢查點的筆數")
+    parser.add_argument("--checkpoint", default=None, help="檢查點檔案，預設 <input>.checkpoint.json")
+    parser.add_argument("--limit", type=int, default=None, help="本次最多處理的筆數")
+    args = parser.parse_args()
+
+    store = None
+    if args.store:
+        from result_stores import create_result_store
+        store = create_result_store(args.store, args.store_path)
+    runner = BatchNLURunner(result_store=store, concurrency=args.concurrency, write_batch=args.write_batch)
+    try:
+        runner.run(args.input, args.checkpoint, limit=args.limit)
+    finally:
+        runner.result_store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1663 @@
+# benchmarks.py
+
+"""
+效能基準測試，全部使用 fake_backends 中的假後端，不需要網路或 API 金鑰。
+
+用法：
+    python benchmarks.py sheet_save
+    python benchmarks.py turn_pipeline
+    python benchmarks.py prompt_tokens
+    python benchmarks.py response_cache
+    python benchmarks.py questionnaire_model
+    python benchmarks.py conditions
+    python benchmarks.py result_stores
+    python benchmarks.py client_manager
+    python benchmarks.py streaming
+    python benchmarks.py chat_memory
+    python benchmarks.py session_store
+    python benchmarks.py batch_nlu
+    python benchmarks.py load_test
+    python benchmarks.py metrics
+    python benchmarks.py model_routing
+    python benchmarks.py structured_output
+    python benchmarks.py submission_dedup
+    python benchmarks.py startup
+    python benchmarks.py extraction_cache
+    python benchmarks.py worker_pool
+    python benchmarks.py questionnaire_registry
+    python benchmarks.py answer_analytics
+    python benchmarks.py all
+"""
+
+import argparse
+import statistics
+import time
+
+from fake_backends import FakeGspreadClient, make_fake_nlu
+from load_test import percentile
+
+
+def bench_sheet_save(sizes=(100, 10000, 50000), saves_per_size=20, latency=0.002, per_row_latency=0.00002):
+    """
+    比較在不同資料量的工作表上儲存一筆答案的耗時。
+    標題行檢查已快取，因此每次儲存只剩一次 append 請求，耗時不隨資料量增加。
+    """
+    import google_sheets_service
+    from questionnaire_data import GOOGLE_SHEET_HEADERS
+
+    results = []
+    for size in sizes:
+        google_sheets_service.invalidate_worksheet_cache()
+        client = FakeGspreadClient(latency=latency, per_row_latency=per_row_latency)
+        worksheet = client.open_by_key("bench-sheet").worksheet("工作表1")
+        worksheet.rows = [list(GOOGLE_SHEET_HEADERS)] + [["x"] * len(GOOGLE_SHEET_HEADERS) for _ in range(size)]
+
+        # 舊做法：每次儲存都先下載整張工作表確認標題
+        start = time.perf_counter()
+        worksheet.get_all_values()
+        full_scan_ms = (time.perf_counter() - start) * 1000
+
+        timings = []
+        for _ in range(saves_per_size):
+            start = time.perf_counter()
+            google_sheets_service.append_rows_to_sheet(client, "bench-sheet", "工作表1", [["y"] * len(GOOGLE_SHEET_HEADERS)], GOOGLE_SHEET_HEADERS)
+            timings.append((time.perf_counter() - start) * 1000)
+
+        results.append({
+            "rows": size,
+            "legacy_full_scan_ms": round(full_scan_ms, 2),
+            "first_save_ms": round(timings[0], 2),
+            "median_save_ms": round(statistics.median(timings), 2),
+            "get_all_values_calls": worksheet.call_counts.get("get_all_values", 0) - 1,
+            "row_values_calls": worksheet.call_counts.get("row_values", 0),
+        })
+    for r in results:
+        print(f"{r['rows']:>7} 行 | 舊做法整表掃描 {r['legacy_full_scan_ms']:>8} ms | 首次儲存 {r['first_save_ms']:>6} ms | "
+              f"儲存中位數 {r['median_save_ms']:>6} ms | get_all_values {r['get_all_values_calls']} 次 | row_values {r['row_values_calls']} 次")
+    return results
+
+
+# 模擬「依提示語回答」的填答者：第二回合同時給出兩個無效答案，觸發兩個澄清
+PIPELINE_SCRIPT = {
+    "我叫王小明": {"name": "王小明"},
+    "信箱是 wang-at-example，滿意度九分": {"email": "wang-at-example", "product_satisfaction": "9"},
+    "信箱 wang@example.com，滿意度四分": {"email": "wang@example.com", "product_satisfaction": 4},
+    "沒什麼意見，可以聯絡我": {"feedback_comments": "沒什麼意見", "allow_follow_up": "是"},
+    "我三十歲": {"age_group": "25-34"},
+}
+
+
+def bench_turn_pipeline(sessions=20, latency=0.05, jitter=0.01):
+    """
+    比較逐一呼叫 (舊行為) 與回合管線 (合併澄清 + 預先生成下一步提示) 的每回合延遲。
+    """
+    import asyncio
+    from ai_agents import QuestionnaireAgent, TURN_PIPELINE_STATS
+    from rule_extractor import RuleBasedExtractor
+
+    turns = list(PIPELINE_SCRIPT)
+    configs = {
+        "sequential": {"clarification_mode": "sequential", "speculative_next_prompt": False},
+        "pipeline": {"clarification_mode": "merged", "speculative_next_prompt": True},
+    }
+    results = {}
+    for name, config in configs.items():
+        nlu = make_fake_nlu(PIPELINE_SCRIPT, latency=latency, jitter=jitter)
+        TURN_PIPELINE_STATS.__init__()
+        timings = []
+
+        async def run_session():
+            agent = QuestionnaireAgent(nlu_agent=nlu, rule_extractor=RuleBasedExtractor(), **config)
+            await agent.astart()
+            for text in turns:
+                start = time.perf_counter()
+                await agent.aturn(text)
+                timings.append((time.perf_counter() - start) * 1000)
+
+        async def run_all():
+            await asyncio.gather(*[run_session() for _ in range(sessions)])
+
+        asyncio.run(run_all())
+        results[name] = {
+            "p50_ms": round(percentile(timings, 50), 1),
+            "p95_ms": round(percentile(timings, 95), 1),
+            "llm_calls_per_session": round(nlu.async_client.calls / sessions, 2),
+            **TURN_PIPELINE_STATS.summary(),
+        }
+    print(f"單次模型延遲約 {latency * 1000:.0f} ms")
+    for name, r in results.items():
+        print(f"{name:>10} | p50 {r['p50_ms']:>6} ms | p95 {r['p95_ms']:>6} ms | 每會話 LLM 呼叫 {r['llm_calls_per_session']} | "
+              f"預先生成命中 {r['speculation_hits']}/{r['speculations']} | 澄清呼叫 {r['clarification_calls']}")
+    return results
+
+
+def bench_prompt_tokens():
+    """
+    比較完整問卷結構 (靜態前綴) 與精簡結構 (只送未回答問題) 的每回合提取 prompt token 數，
+    並檢查系統提示前綴是否在各回合間保持不變 (供應商端 prompt caching 的前提)。
+    """
+    import asyncio
+    from ai_agents import QuestionnaireAgent
+    from fake_backends import estimate_request_tokens, estimate_tokens
+    from rule_extractor import RuleBasedExtractor
+
+    results = {}
+    for name, compact in (("full_schema", False), ("compact_schema", True)):
+        nlu = make_fake_nlu(PIPELINE_SCRIPT, compact_schema=compact)
+        agent = QuestionnaireAgent(nlu_agent=nlu, rule_extractor=RuleBasedExtractor(), speculative_next_prompt=False)
+        per_turn = []
+
+        async def run():
+            await agent.astart()
+            for text in PIPELINE_SCRIPT:
+                await agent.aturn(text)
+                per_turn.append(agent.last_turn_token_usage["prompt_tokens"])
+
+        asyncio.run(run())
+        extraction_requests = [r for r in nlu.async_client.requests if r.get("response_format")]
+        prefixes = {r["messages"][0]["content"] for r in extraction_requests}
+        results[name] = {
+            "extraction_prompt_tokens": [estimate_request_tokens(r) for r in extraction_requests],
+            "static_prefix_tokens": estimate_tokens(extraction_requests[0]["messages"][0]["content"]),
+            "prefix_stable": len(prefixes) == 1,
+            "turn_prompt_tokens": per_turn,
+            "session_prompt_tokens": agent.session_token_usage["prompt_tokens"],
+        }
+    for name, r in results.items():
+        print(f"{name:>15} | 靜態前綴 {r['static_prefix_tokens']} tokens (各回合一致: {r['prefix_stable']}) | "
+              f"每次提取 {r['extraction_prompt_tokens']} | 每回合 {r['turn_prompt_tokens']} | 整個會話 {r['session_prompt_tokens']}")
+    return results
+
+
+def bench_response_cache(sessions=50, latency=0.05):
+    """
+    比較有無回應快取時，新會話的開始延遲與每會話的提示語生成呼叫次數。
+    """
+    import asyncio
+    from ai_agents import QuestionnaireAgent
+    from response_cache import ResponseCache
+    from rule_extractor import RuleBasedExtractor
+
+    results = {}
+    for name, use_cache in (("no_cache", False), ("cache", True)):
+        nlu = make_fake_nlu(PIPELINE_SCRIPT, latency=latency, response_cache=ResponseCache() if use_cache else None)
+        start_timings = []
+
+        async def run():
+            if use_cache:
+                await nlu.aprewarm_greeting_pool()
+            warm_calls = nlu.async_client.calls
+            for _ in range(sessions):
+                agent = QuestionnaireAgent(nlu_agent=nlu, rule_extractor=RuleBasedExtractor(), speculative_next_prompt=False)
+                start = time.perf_counter()
+                await agent.astart()
+                start_timings.append((time.perf_counter() - start) * 1000)
+                for text in PIPELINE_SCRIPT:
+                    await agent.aturn(text)
+            return warm_calls
+
+        warm_calls = asyncio.run(run())
+        prompt_calls = sum(v["calls"] for k, v in nlu.token_usage.items() if k in ("greeting", "next_prompt"))
+        results[name] = {
+            "session_start_p50_ms": round(percentile(start_timings, 50), 2),
+            "prewarm_calls": warm_calls,
+            "prompt_calls_per_session": round((prompt_calls - warm_calls) / sessions, 2),
+        }
+    for name, r in results.items():
+        print(f"{name:>9} | 會話開始 p50 {r['session_start_p50_ms']:>6} ms | 預先生成呼叫 {r['prewarm_calls']} | "
+              f"每會話歡迎語/提示語呼叫 {r['prompt_calls_per_session']}")
+    return results
+
+
+def make_synthetic_questionnaire(size):
+    """
+    產生 size 題的合成問卷：每 5 題一組，包含必填文字、email、選項、1-5 分數題，以及分數為 1 或 2 時才顯示的必填題。
+    """
+    structure = []
+    for i in range(size // 5):
+        structure += [
+            {"id": f"name_{i}", "question": f"姓名 {i}？", "type": "text", "validation_rule": "required", "priority": 5 * i + 1},
+            {"id": f"email_{i}", "question": f"電子郵件 {i}？", "type": "text", "validation_rule": "email", "priority": 5 * i + 2},
+            {"id": f"age_{i}", "question": f"年齡區間 {i}？", "type": "select", "options": ["18-24", "25-34", "35-44", "45-54", "55+"],
+             "validation_rule": "required", "priority": 5 * i + 3},
+            {"id": f"score_{i}", "question": f"滿意度 {i}？", "type": "number", "validation_rule": "range_1_5", "priority": 5 * i + 4},
+            {"id": f"reason_{i}", "question": f"不滿意原因 {i}？", "type": "text", "validation_rule": "required",
+             "show_if": f"score_{i} in [1, 2]", "priority": 5 * i + 5},
+        ]
+    return structure
+
+
+def bench_questionnaire_model(sizes=(10, 100, 500)):
+    """
+    比較每回合狀態維護的耗時：舊做法以線性掃描查詢問題、每回合重新計算待答必填題與進度；
+    新做法使用編譯後的索引模型與增量維護的計數。每回合回答一題 (分數題給 2 分以觸發條件題)。
+    """
+    from ai_agents import QuestionnaireAgent
+    from questionnaire_model import compile_questionnaire
+
+    class LegacyLookupAgent(QuestionnaireAgent):
+        def _get_question_obj_by_id(self, q_id):
+            for q in self.question_structure:
+                if q["id"] == q_id:
+                    return q
+            return None
+
+        def _pending_required_ids(self):
+            return [q_id for q_id in self.unanswered_questions_ids
+                    if self._get_question_obj_by_id(q_id).get("validation_rule") == "required"]
+
+        def _count_answered(self):
+            return sum(1 for q in self.question_structure if self.collected_answers.get(q["id"]) is not None)
+
+        def _current_unanswered_question_objs(self):
+            return [self._get_question_obj_by_id(q_id) for q_id in self.unanswered_questions_ids if self._get_question_obj_by_id(q_id) is not None]
+
+    answers = {"name": "王小明", "email": "wang@example.com", "age": "37", "score": 2, "reason": "太慢"}
+
+    def run_session(agent_cls, questionnaire):
+        agent = agent_cls(nlu_agent=object(), rule_extractor=False, questionnaire=questionnaire)
+        start = time.perf_counter()
+        for q in questionnaire.questions:
+            question_obj = agent._get_question_obj_by_id(q["id"])
+            is_valid, value, _ = agent._validate_extracted_answer(question_obj, answers[q["id"].rsplit("_", 1)[0]])
+            if is_valid:
+                agent._update_answers_and_unanswered_status(q["id"], value)
+            agent._pending_required_ids()
+            agent._count_answered()
+            agent._current_unanswered_question_objs()
+            agent._turn_output = []
+        elapsed = time.perf_counter() - start
+        return elapsed / len(questionnaire) * 1e6, agent._count_answered()
+
+    results = []
+    for size in sizes:
+        compile_start = time.perf_counter()
+        questionnaire = compile_questionnaire(make_synthetic_questionnaire(size))
+        compile_ms = (time.perf_counter() - compile_start) * 1000
+        legacy_us, legacy_answered = run_session(LegacyLookupAgent, questionnaire)
+        indexed_us, indexed_answered = run_session(QuestionnaireAgent, questionnaire)
+        assert legacy_answered == indexed_answered == len(questionnaire)
+        results.append({
+            "questions": len(questionnaire),
+            "compile_ms": round(compile_ms, 2),
+            "legacy_turn_us": round(legacy_us, 1),
+            "indexed_turn_us": round(indexed_us, 1),
+        })
+    for r in results:
+        print(f"{r['questions']:>4} 題 | 編譯 {r['compile_ms']:>7} ms | 舊做法每回合 {r['legacy_turn_us']:>9} µs | "
+              f"索引模型每回合 {r['indexed_turn_us']:>7} µs")
+    return results
+
+
+def make_branching_questionnaire(blocks):
+    """
+    每組 4 題：分數題、分數低時顯示的原因題、填了原因才顯示的追問題，以及分數高時才必填的推薦題。
+    """
+    structure = []
+    for i in range(blocks):
+        structure += [
+            {"id": f"score_{i}", "question": f"滿意度 {i}？", "type": "number", "validation_rule": "range_1_5"},
+            {"id": f"reason_{i}", "question": f"原因 {i}？", "type": "text", "validation_rule": "required", "show_if": f"score_{i} <= 2"},
+            {"id": f"detail_{i}", "question": f"追問 {i}？", "type": "text", "show_if": f"reason_{i} is not None and score_{i} == 1"},
+            {"id": f"referral_{i}", "question": f"推薦 {i}？", "type": "boolean", "required_if": f"score_{i} >= 4"},
+        ]
+    return structure
+
+
+def bench_conditions(block_counts=(10, 100, 500)):
+    """
+    測量不同問卷大小下每回合的條件評估次數與耗時 (正確性由 tests/test_conditions.py 檢查)。
+    每回合回答一題 (分數先給 1 觸發分支，再改成 5 收回分支)，統計每回合的條件評估次數。
+    """
+    from ai_agents import QuestionnaireAgent
+    from questionnaire_model import compile_questionnaire
+
+    results = []
+    for blocks in block_counts:
+        questionnaire = compile_questionnaire(make_branching_questionnaire(blocks))
+        agent = QuestionnaireAgent(nlu_agent=object(), rule_extractor=False, questionnaire=questionnaire)
+        turns = 0
+        max_per_turn = 0
+        start = time.perf_counter()
+        for i in range(blocks):
+            for q_id, value in ((f"score_{i}", 1), (f"reason_{i}", "太慢"), (f"detail_{i}", "常當機"), (f"score_{i}", 5), (f"referral_{i}", "是")):
+                before = agent.condition_evaluations
+                is_valid, validated, _ = agent._validate_extracted_answer(questionnaire.by_id[q_id], value)
+                if is_valid:
+                    agent._update_answers_and_unanswered_status(q_id, validated)
+                agent._turn_output = []
+                turns += 1
+                max_per_turn = max(max_per_turn, agent.condition_evaluations - before)
+        elapsed_us = (time.perf_counter() - start) / turns * 1e6
+
+        results.append({
+            "questions": len(questionnaire),
+            "condition_rules": len(questionnaire.conditional_ids),
+            "evaluations_per_turn": round(agent.condition_evaluations / turns, 2),
+            "max_evaluations_per_turn": max_per_turn,
+            "turn_us": round(elapsed_us, 1),
+        })
+    for r in results:
+        print(f"{r['questions']:>5} 題 / {r['condition_rules']:>4} 條規則 | 每回合條件評估 {r['evaluations_per_turn']} 次 "
+              f"(最多 {r['max_evaluations_per_turn']}) | 每回合 {r['turn_us']} µs")
+    return results
+
+
+def bench_result_stores(rows=5000, sheets_latency=0.2):
+    """
+    比較各儲存後端的寫入吞吐量 (rows/s)：逐筆寫入 (每份問卷結束時一筆) 與批次寫入。
+    Sheets 以假客戶端模擬每次 API 呼叫約 sheets_latency 秒，計算到資料全部寫入工作表為止。
+    """
+    import os
+    import tempfile
+    from result_stores import SQLiteResultStore, CSVResultStore, JSONLResultStore, SheetsResultStore, SheetsBulkExporter
+    from sheet_submission_queue import SheetSubmissionQueue
+    from questionnaire_data import GOOGLE_SHEET_HEADERS
+
+    sample = {"name": "王小明", "email": "wang@example.com", "age_group": "25-34", "product_satisfaction": 4,
+              "feedback_comments": "希望加入更多功能", "allow_follow_up": "是"}
+    tmp_dir = tempfile.mkdtemp()
+    results = []
+
+    def measure(fn, count):
+        start = time.perf_counter()
+        fn()
+        return round(count / (time.perf_counter() - start))
+
+    for cls, filename in ((SQLiteResultStore, "r.db"), (CSVResultStore, "r.csv"), (JSONLResultStore, "r.jsonl")):
+        single = cls(os.path.join(tmp_dir, "single-" + filename))
+        bulk = cls(os.path.join(tmp_dir, "bulk-" + filename))
+        single_rps = measure(lambda: [single.append(sample) for _ in range(rows)], rows)
+        bulk_rps = measure(lambda: bulk.append_many([sample] * rows), rows)
+        assert single.count() == bulk.count() == rows
+
+        fake_client = FakeGspreadClient(latency=sheets_latency)
+        exporter = SheetsBulkExporter(single, lambda: fake_client, "bench-sheet",
+                                      state_path=os.path.join(tmp_dir, f"{cls.name}.state"), batch_size=1000)
+        export_rps = measure(exporter.export_once, rows)
+        assert exporter.stats["exported_rows"] == rows
+        results.append({"backend": cls.name, "single_rows_per_s": single_rps, "bulk_rows_per_s": bulk_rps,
+                        "export_to_sheets_rows_per_s": export_rps})
+        single.close()
+        bulk.close()
+
+    sheet_rows = min(rows, 1000)
+    fake_client = FakeGspreadClient(latency=sheets_latency)
+    queue = SheetSubmissionQueue(lambda: fake_client, "bench-sheet", "工作表1", GOOGLE_SHEET_HEADERS,
+                                 spool_path=os.path.join(tmp_dir, "spool.jsonl"), max_batch_size=50, max_batch_age=0.05)
+    store = SheetsResultStore(queue)
+
+    def write_to_sheets():
+        for _ in range(sheet_rows):
+            store.append(sample)
+        queue.flush()
+    sheets_rps = measure(write_to_sheets, sheet_rows)
+    queue.close()
+    results.append({"backend": "sheets", "single_rows_per_s": sheets_rps, "bulk_rows_per_s": None, "export_to_sheets_rows_per_s": None})
+
+    for r in results:
+        print(f"{r['backend']:>6} | 逐筆 {r['single_rows_per_s']:>8} rows/s | 批次 {str(r['bulk_rows_per_s']):>8} rows/s | "
+              f"匯出到 Sheets {str(r['export_to_sheets_rows_per_s']):>6} rows/s")
+    return results
+
+
+def bench_client_manager(requests=300, server_limit=(50, 1.0), latency=0.02):
+    """
+    假的 OpenAI 端每 server_limit[1] 秒最多接受 server_limit[0] 個請求，超過即回 429。
+    比較直接併發呼叫 (不限流、不重試) 與經由 OpenAIClientManager (令牌桶限流 + 退避重試 + 優先級) 的結果。
+    一半請求是答案提取 (高優先級)，一半是歡迎語生成 (低優先級)。
+    """
+    import asyncio
+    from fake_backends import FakeOpenAIClient
+    from openai_client_manager import OpenAIClientManager, PRIORITY_EXTRACTION, PRIORITY_GREETING
+
+    max_requests, window = server_limit
+    kinds = [PRIORITY_GREETING if i % 2 else PRIORITY_EXTRACTION for i in range(requests)]
+    request = {"model": "fake", "messages": [{"role": "user", "content": "生成歡迎語"}]}
+
+    async def run(use_manager):
+        client = FakeOpenAIClient(latency=latency, is_async=True, rate_limit=server_limit)
+        # 限流設為供應商限制的 80%，瞬間額度設為窗口的 1/4，確保任何時間窗口內都不超過限制
+        manager = OpenAIClientManager(client=object(), async_client=client,
+                                      requests_per_minute=max_requests / window * 60 * 0.8, tokens_per_minute=None,
+                                      burst_seconds=window / 4, max_concurrency=32, base_backoff=0.2)
+        latencies = {PRIORITY_EXTRACTION: [], PRIORITY_GREETING: []}
+        errors = 0
+
+        async def call(priority):
+            nonlocal errors
+            start = time.perf_counter()
+            try:
+                if use_manager:
+                    await manager.acreate(priority=priority, **request)
+                else:
+                    await client.chat.completions.create(**request)
+                latencies[priority].append((time.perf_counter() - start) * 1000)
+            except Exception:
+                errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*[call(priority) for priority in kinds])
+        return {
+            "total_s": round(time.perf_counter() - start, 2),
+            "failed_requests": errors,
+            "server_429s": client.rate_limited,
+            "extraction_p50_ms": round(percentile(latencies[PRIORITY_EXTRACTION], 50), 1),
+            "greeting_p50_ms": round(percentile(latencies[PRIORITY_GREETING], 50), 1),
+            "manager": manager.summary() if use_manager else None,
+        }
+
+    results = {"direct": asyncio.run(run(False)), "managed": asyncio.run(run(True))}
+    for name, r in results.items():
+        print(f"{name:>8} | 失敗 {r['failed_requests']:>3} / {requests} | 伺服器 429 {r['server_429s']:>3} 次 | 總時間 {r['total_s']:>5} s | "
+              f"提取 p50 {r['extraction_p50_ms']:>7} ms | 歡迎語 p50 {r['greeting_p50_ms']:>7} ms")
+    return results
+
+
+def bench_streaming(sessions=20, latency=0.4):
+    """
+    比較一般回合與串流回合的首段輸出延遲 (TTFT)：假模型的首個 token 在延遲的 1/4 時送出，其餘逐塊送達。
+    答案提取 (JSON) 無法串流，命中預先生成的下一步提示也會整段輸出，因此串流主要縮短歡迎語與
+    「提取後才生成提示」的回合 (p95)。同時確認串流區塊串接後與回覆文字完全一致，且與非串流模式的回覆相同。
+    """
+    import asyncio
+    from ai_agents import TURN_PIPELINE_STATS
+    from rule_extractor import RuleBasedExtractor
+    from session_engine import SessionEngine
+
+    turns = list(PIPELINE_SCRIPT)
+
+    def run(stream):
+        nlu = make_fake_nlu(PIPELINE_SCRIPT, latency=latency)
+        engine = SessionEngine(nlu_agent=nlu, agent_factory=lambda nlu_agent: _agent_with_rules(nlu_agent, RuleBasedExtractor()))
+        TURN_PIPELINE_STATS.__init__()
+        replies = []
+        totals = []
+        greeting_ttfts = []
+
+        async def run_session(index):
+            chunks = []
+            first_chunk_at = []
+
+            def on_greeting_chunk(piece):
+                first_chunk_at.append(time.perf_counter())
+
+            start = time.perf_counter()
+            session_id, greeting = await engine.start_session(f"s{index}", on_chunk=on_greeting_chunk if stream else None)
+            greeting_ttfts.append(((first_chunk_at[0] if first_chunk_at else time.perf_counter()) - start) * 1000)
+            transcript = [greeting]
+            for text in turns:
+                chunks.clear()
+                start = time.perf_counter()
+                reply = await engine.turn(session_id, text, on_chunk=chunks.append if stream else None)
+                totals.append((time.perf_counter() - start) * 1000)
+                if stream:
+                    assert "".join(chunks) == reply, (chunks, reply)
+                transcript.append(reply)
+            replies.append(transcript)
+
+        async def run_all():
+            await asyncio.gather(*[run_session(i) for i in range(sessions)])
+
+        asyncio.run(run_all())
+        return {
+            "greeting_ttft_p50_ms": round(percentile(greeting_ttfts, 50), 1),
+            "ttft_p50_ms": TURN_PIPELINE_STATS.summary()["turn_ttft_p50_ms"],
+            "ttft_p95_ms": TURN_PIPELINE_STATS.summary()["turn_ttft_p95_ms"],
+            "total_p50_ms": round(percentile(totals, 50), 1),
+            "replies": replies,
+            "llm_streams": nlu.streaming_stats.summary(),
+        }
+
+    results = {"blocking": run(False), "streaming": run(True)}
+    assert sorted(results["blocking"]["replies"]) == sorted(results["streaming"]["replies"]), "串流與非串流的回覆不一致"
+    print(f"單次模型延遲約 {latency * 1000:.0f} ms，串流與非串流回覆文字一致")
+    for name, r in results.items():
+        print(f"{name:>9} | 歡迎語首段 p50 {r['greeting_ttft_p50_ms']:>7} ms | 回合首段輸出 p50 {r['ttft_p50_ms']:>7} ms | p95 {r['ttft_p95_ms']:>7} ms | 回合完成 p50 {r['total_p50_ms']:>7} ms")
+    return results
+
+
+def bench_chat_memory(turns=400, sessions=10, history_size=32):
+    """
+    長時間會話：第一回合提供姓名，之後是大量沒有新資訊的閒聊。比較不設上限的 list (舊行為) 與
+    ChatMemory (環形緩衝區 + 滾動摘要) 的每會話記憶體、每回合送出的歷史 token 數，以及最早的事實
+    在最後一回合是否仍出現在答案提取的提示中。
+    """
+    import asyncio
+    from ai_agents import QuestionnaireAgent
+    from chat_memory import ChatMemory, estimate_tokens
+
+    class UnboundedMemory(ChatMemory):
+        # 舊行為：保留全部訊息，但提示只取最近的幾則
+        def __init__(self):
+            super().__init__(max_messages=10 ** 9)
+
+    script = {"我叫王小明": {"name": "王小明"}}
+    chatter = [f"今天天氣不錯，第 {i} 次閒聊" for i in range(turns)]
+
+    def run(bounded):
+        nlu = make_fake_nlu(script)
+        agents = []
+
+        async def run_session():
+            agent = QuestionnaireAgent(nlu_agent=nlu, rule_extractor=False, speculative_next_prompt=False,
+                                       history_size=history_size)
+            if not bounded:
+                agent.chat_history = UnboundedMemory()
+            agents.append(agent)
+            await agent.astart()
+            await agent.aturn("我叫王小明")
+            for text in chatter:
+                await agent.aturn(text)
+                await agent.chat_history.wait_for_summary()
+
+        async def run_all():
+            await asyncio.gather(*[run_session() for _ in range(sessions)])
+
+        start = time.perf_counter()
+        asyncio.run(run_all())
+        elapsed = time.perf_counter() - start
+        agent = agents[0]
+        prompt = nlu._build_parse_messages("最後一個問題", agent.question_structure, agent.collected_answers, agent.chat_history)
+        history_tokens = sum(estimate_tokens(m["content"]) for m in prompt[1:-2])
+        return {
+            "bytes_per_session": round(sum(a.chat_history.memory_bytes() for a in agents) / sessions),
+            "messages_kept": len(agent.chat_history),
+            "history_tokens_last_turn": history_tokens,
+            "early_fact_in_prompt": any("王小明" in m["content"] for m in prompt[1:-2]),
+            "summaries": agent.chat_history.summaries,
+            "summary_tokens": nlu.token_usage.get("summary", {}).get("prompt_tokens", 0) // sessions,
+            "elapsed_s": round(elapsed, 2),
+        }
+
+    results = {"unbounded": run(False), "bounded": run(True)}
+    assert results["bounded"]["early_fact_in_prompt"], "滾動摘要遺失了最早的事實"
+    print(f"每會話 {turns} 回合閒聊，{sessions} 個會話的平均")
+    for name, r in results.items():
+        print(f"{name:>9} | 每會話 {r['bytes_per_session'] / 1024:>8.1f} KiB | 保留 {r['messages_kept']:>4} 則 | "
+              f"最後一回合歷史 {r['history_tokens_last_turn']:>4} tokens | 早期事實在提示中 {r['early_fact_in_prompt']} | "
+              f"摘要 {r['summaries']:>3} 次 (每會話 {r['summary_tokens']} prompt tokens)")
+    return results
+
+
+def bench_session_store(sessions=200, stored_sizes=(1000, 20000), snapshots=2000):
+    """
+    會話快照：(1) 每回合快照 (序列化 + 寫入) 的耗時，需低於 1 ms；(2) 程序在問卷中途「崩潰」後，
+    新的引擎從快照恢復並完成剩下的回合，結果需與不中斷的執行相同且不重新生成歡迎語；
+    (3) 依 session_id 恢復的耗時不隨已保存的會話數增加 (O(1))。
+    """
+    import asyncio
+    import os
+    import random
+    import tempfile
+    from ai_agents import QuestionnaireAgent
+    from rule_extractor import RuleBasedExtractor
+    from session_engine import SessionEngine
+    from session_store import STORE_TYPES
+
+    turns = list(PIPELINE_SCRIPT)
+    crash_after = len(turns) // 2
+
+    def factory(nlu_agent):
+        return QuestionnaireAgent(nlu_agent=nlu_agent, rule_extractor=RuleBasedExtractor())
+
+    def run_turns(engine, ids, texts, start=False):
+        async def run_session(session_id):
+            if start:
+                await engine.start_session(session_id)
+            for text in texts:
+                await engine.turn(session_id, text)
+
+        async def run_all():
+            await asyncio.gather(*[run_session(sid) for sid in ids])
+        asyncio.run(run_all())
+
+    ids = [f"session-{i}" for i in range(sessions)]
+    reference = SessionEngine(nlu_agent=make_fake_nlu(PIPELINE_SCRIPT), agent_factory=factory)
+    run_turns(reference, ids, turns, start=True)
+    expected = {sid: dict(reference._sessions[sid].agent.collected_answers) for sid in ids}
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for kind, store_cls in STORE_TYPES.items():
+            path = os.path.join(tmp, f"sessions.{kind}")
+            # (2) 崩潰前後由兩個不同的引擎 (與儲存實例) 處理，模擬程序重啟或換 worker
+            nlu_before = make_fake_nlu(PIPELINE_SCRIPT)
+            before = SessionEngine(nlu_agent=nlu_before, agent_factory=factory, session_store=store_cls(path))
+            run_turns(before, ids, turns[:crash_after], start=True)
+            save_stats = before.session_store.stats()
+            nlu_after = make_fake_nlu(PIPELINE_SCRIPT)
+            after = SessionEngine(nlu_agent=nlu_after, agent_factory=factory, session_store=store_cls(path))
+            run_turns(after, ids, turns[crash_after:])
+            resumed_ok = all(after._sessions[sid].agent.collected_answers == expected[sid] for sid in ids)
+            assert resumed_ok, f"{kind}: 恢復後的答案與不中斷的執行不同"
+            assert "greeting" not in nlu_after.token_usage, f"{kind}: 恢復時不應重新生成歡迎語"
+
+            # (1) 直接量測快照的序列化 + 寫入 (使用已有完整對話歷史的會話狀態)
+            agent = after._sessions[ids[0]].agent
+            store = store_cls(os.path.join(tmp, f"overhead.{kind}"))
+            timings = []
+            for i in range(snapshots):
+                start = time.perf_counter()
+                store.save(agent.snapshot(ids[i % sessions], i))
+                timings.append((time.perf_counter() - start) * 1000)
+            snapshot_bytes = len(agent.snapshot(ids[0], 0).to_bytes())
+
+            # (3) 已保存 N 個會話時，依 session_id 載入的耗時
+            load_ms = {}
+            for size in stored_sizes:
+                big = store_cls(os.path.join(tmp, f"big-{size}.{kind}"))
+                for i in range(size):
+                    big.save(agent.snapshot(f"big-{i}", 1))
+                lookups = random.Random(0).sample(range(size), 200)
+                start = time.perf_counter()
+                for i in lookups:
+                    big.load(f"big-{i}")
+                load_ms[size] = round((time.perf_counter() - start) / len(lookups) * 1000, 4)
+                big.close()
+
+            results[kind] = {
+                "engine_save_p50_ms": save_stats.get("save_p50_ms"),
+                "snapshot_p50_ms": round(percentile(timings, 50), 4),
+                "snapshot_p95_ms": round(percentile(timings, 95), 4),
+                "snapshot_bytes": snapshot_bytes,
+                "resumed_sessions": after.resumed_sessions,
+                "load_ms": load_ms,
+            }
+            assert results[kind]["snapshot_p95_ms"] < 1.0, f"{kind}: 每回合快照超過 1 ms"
+            for engine in (before, after):
+                engine.session_store.close()
+            store.close()
+
+    print(f"{sessions} 個會話在第 {crash_after} 回合後崩潰並由新引擎恢復，結果與不中斷的執行一致")
+    for kind, r in results.items():
+        loads = " | ".join(f"{size} 個會話時載入 {ms} ms" for size, ms in r["load_ms"].items())
+        print(f"{kind:>6} | 每回合快照 p50 {r['snapshot_p50_ms']} ms / p95 {r['snapshot_p95_ms']} ms | "
+              f"快照 {r['snapshot_bytes']} bytes | 恢復 {r['resumed_sessions']} 個會話 | {loads}")
+    return results
+
+
+def bench_batch_nlu(records=2000, latency=0.05, concurrencies=(1, 8, 32), serial_sample=100):
+    """
+    離線批次 NLU：比較不同併發數的吞吐量 (併發 1 只取 serial_sample 筆估算)，統計失敗與無效欄位數，
+    並模擬寫入結果時程序崩潰，確認從檢查點恢復後每筆記錄剛好寫入一次。
+    """
+    import json
+    import os
+    import tempfile
+    from batch_nlu import BatchNLURunner
+    from result_stores import SQLiteResultStore
+
+    texts = list(PIPELINE_SCRIPT)
+    lines = []
+    for i in range(records):
+        if i % 100 == 99:
+            lines.append(json.dumps({"id": f"r{i}", "subject": "沒有文字欄位"}, ensure_ascii=False))
+        else:
+            lines.append(json.dumps({"id": f"r{i}", "text": texts[i % len(texts)]}, ensure_ascii=False))
+
+    class CrashingStore(SQLiteResultStore):
+        # 第 crash_at 次批次寫入時拋出例外，模擬程序在寫入途中崩潰
+        def __init__(self, path, crash_at):
+            super().__init__(path)
+            self.crash_at = crash_at
+            self.writes = 0
+
+        def append_rows(self, rows):
+            self.writes += 1
+            if self.writes == self.crash_at:
+                raise RuntimeError("模擬崩潰")
+            super().append_rows(rows)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        def write_input(name, count):
+            path = os.path.join(tmp, name)
+            with open(path, "w", encoding="utf-8") as f:
+                f.write("\n".join(lines[:count]) + "\n")
+            return path
+
+        for concurrency in concurrencies:
+            count = serial_sample if concurrency == 1 else records
+            path = write_input(f"input-{concurrency}.jsonl", count)
+            store = SQLiteResultStore(os.path.join(tmp, f"results-{concurrency}.db"))
+            runner = BatchNLURunner(make_fake_nlu(PIPELINE_SCRIPT, latency=latency), store, concurrency=concurrency,
+                                    progress_interval=0)
+            summary = runner.run(path)
+            results[f"concurrency_{concurrency}"] = {**summary, "stored_rows": store.count()}
+            store.close()
+
+        path = write_input("input-crash.jsonl", records)
+        db_path = os.path.join(tmp, "results-crash.db")
+        crashing = CrashingStore(db_path, crash_at=5)
+        try:
+            BatchNLURunner(make_fake_nlu(PIPELINE_SCRIPT, latency=latency), crashing, concurrency=32, progress_interval=0).run(path)
+        except RuntimeError:
+            pass
+        crashed_rows = crashing.count()
+        crashing.close()
+        store = SQLiteResultStore(db_path)
+        resumed = BatchNLURunner(make_fake_nlu(PIPELINE_SCRIPT, latency=latency), store, concurrency=32, progress_interval=0).run(path)
+        expected_rows = results[f"concurrency_{max(concurrencies)}"]["rows_written"]
+        results["crash_resume"] = {"rows_before_crash": crashed_rows, "processed_after_resume": resumed["processed_this_run"],
+                                   "stored_rows": store.count(), "expected_rows": expected_rows}
+        store.close()
+        assert results["crash_resume"]["stored_rows"] == expected_rows, "恢復後的寫入筆數與預期不同"
+
+    print(f"單次模型延遲約 {latency * 1000:.0f} ms")
+    for name, r in results.items():
+        if name == "crash_resume":
+            print(f"崩潰恢復 | 崩潰前已寫入 {r['rows_before_crash']} 筆 | 恢復後處理 {r['processed_after_resume']} 筆 | "
+                  f"最終 {r['stored_rows']} 筆 (預期 {r['expected_rows']})")
+        else:
+            print(f"{name:>14} | {r['records_per_s']:>7} 筆/秒 | 處理 {r['processed']} 筆 | 寫入 {r['stored_rows']} 筆 | "
+                  f"失敗 {r['failed']} | 無資訊 {r['empty']} | 無效欄位 {r['invalid_fields']}")
+    return results
+
+
+def bench_load_test(respondents=100, concurrencies=(1, 10, 50), llm_latency=0.05, error_rate=0.05):
+    """
+    以 load_test 在不同併發數下完成整份問卷 (本地 HTTP stub + 真實 openai 客戶端)，
+    並在最高併發下注入隨機 500/429 錯誤，觀察重試對尾端延遲與完成率的影響。
+    """
+    from load_test import run_load_test
+
+    results = {}
+    for concurrency in concurrencies:
+        count = min(respondents, 10) if concurrency == 1 else respondents
+        results[f"concurrency_{concurrency}"] = run_load_test(count, concurrency, llm_latency=llm_latency)
+    results["error_injection"] = run_load_test(respondents, max(concurrencies), llm_latency=llm_latency,
+                                               llm_error_rate=error_rate)
+
+    print(f"單次模型延遲約 {llm_latency * 1000:.0f} ms，錯誤注入率 {error_rate:.0%}")
+    for name, r in results.items():
+        lat = r["turn_latency_ms"]
+        print(f"{name:>16} | 完成 {r['sessions']['completed']}/{r['sessions']['started']} | {r['turns_per_s']:>6} 回合/秒 | "
+              f"p50 {lat['p50']:>7} ms | p95 {lat['p95']:>7} ms | p99 {lat['p99']:>7} ms | "
+              f"LLM {r['llm_calls_per_completed']} 次/份 | 重試 {r['llm_retries']} | {r['tokens_per_session']['total']} tokens/會話")
+    return results
+
+
+def bench_metrics(sessions=200, span_iterations=200000):
+    """
+    比較指標開啟與停用時單一 span 的成本，以及零延遲假模型下整個回合的耗時 (只剩 CPU 成本，最能凸顯額外負擔)。
+    """
+    import asyncio
+    from ai_agents import QuestionnaireAgent
+    from metrics import METRICS
+    from result_stores import SQLiteResultStore
+    from rule_extractor import RuleBasedExtractor
+
+    results = {}
+    previous = METRICS.enabled
+    try:
+        for name, enabled in (("disabled", False), ("enabled", True)):
+            METRICS.enabled = enabled
+            METRICS.reset()
+            start = time.perf_counter()
+            for _ in range(span_iterations):
+                with METRICS.span("bench"):
+                    pass
+            span_ns = (time.perf_counter() - start) / span_iterations * 1e9
+
+            nlu = make_fake_nlu(PIPELINE_SCRIPT)
+            store = SQLiteResultStore(":memory:")
+            timings = []
+
+            async def run_session():
+                agent = QuestionnaireAgent(nlu_agent=nlu, rule_extractor=RuleBasedExtractor(), result_store=store)
+                await agent.astart()
+                for text in list(PIPELINE_SCRIPT) + ["結束"]:
+                    start = time.perf_counter()
+                    await agent.aturn(text)
+                    timings.append((time.perf_counter() - start) * 1000)
+
+            async def run_all():
+                for _ in range(sessions):
+                    await run_session()
+
+            asyncio.run(run_all())
+            results[name] = {
+                "span_ns": round(span_ns, 1),
+                "turn_p50_ms": round(percentile(timings, 50), 4),
+                "turn_mean_ms": round(statistics.fmean(timings), 4),
+                "recorded_turns": METRICS.to_dict()["counters"].get("turns_total", 0),
+            }
+    finally:
+        METRICS.enabled = previous
+
+    overhead = results["enabled"]["turn_mean_ms"] - results["disabled"]["turn_mean_ms"]
+    results["overhead_per_turn_ms"] = round(overhead, 4)
+    for name in ("disabled", "enabled"):
+        r = results[name]
+        print(f"{name:>9} | 每個 span {r['span_ns']:>7} ns | 回合 p50 {r['turn_p50_ms']} ms | 平均 {r['turn_mean_ms']} ms | "
+              f"記錄回合數 {r['recorded_turns']}")
+    print(f"開啟指標後每回合增加約 {overhead * 1000:.1f} µs")
+    return results
+
+
+def bench_model_routing(sessions=30, small_latency=0.04, strong_latency=0.15, small="gpt-4o-mini", strong="gpt-4o"):
+    """
+    比較全部使用強模型、全部使用小模型，以及小模型優先、必要時升級的分層路由：
+    每回合延遲、估算費用與最終答案的正確率 (以強模型的結果為準)。
+    模擬的小模型在五個回合中有一個會出錯 (年齡未對應到選項)；分層路由的歡迎語與提示語也使用小模型。
+    """
+    import asyncio
+    import json
+    from ai_agents import QuestionnaireAgent
+    from ai_nlu_layer import AINLULayer
+    from fake_backends import FakeOpenAIClient, ScriptedResponder
+    from metrics import METRICS
+    from openai_client_manager import OpenAIClientManager
+    from result_stores import SQLiteResultStore
+
+    def extraction(answers, **extra):
+        return json.dumps({"extracted_answers": answers, "action_request": "continue_questionnaire", "reasoning": "fake", **extra},
+                          ensure_ascii=False)
+
+    weak_outputs = {
+        "我三十歲": extraction({"age_group": "三十歲"}), # 未對應到選項
+    }
+
+    class TieredResponder(ScriptedResponder):
+        def __call__(self, request):
+            if request.get("response_format") and request.get("model") == small:
+                user_input = request["messages"][-1]["content"].replace("這是我的回答：", "", 1).strip()
+                if user_input in weak_outputs:
+                    return weak_outputs[user_input]
+            return super().__call__(request)
+
+    configs = {
+        "strong_only": {"model": strong},
+        "small_only": {"model": small},
+        "tiered": {"model": strong, "escalation_model": strong,
+                   "model_routing": {"extraction": small, "greeting": small, "next_prompt": small, "clarification": small}},
+    }
+    turns = list(PIPELINE_SCRIPT) + ["結束"]
+    results = {}
+    reference = None
+    for name, config in configs.items():
+        responder = TieredResponder(PIPELINE_SCRIPT)
+        latencies = {small: small_latency, strong: strong_latency}
+        manager = OpenAIClientManager(
+            client=FakeOpenAIClient(responder, model_latency=latencies),
+            async_client=FakeOpenAIClient(responder, model_latency=latencies, is_async=True),
+            requests_per_minute=None, tokens_per_minute=None, max_concurrency=10000, max_retries=0)
+        nlu = AINLULayer(client_manager=manager, **{"model_routing": {}, **config})
+        store = SQLiteResultStore(":memory:")
+        METRICS.reset()
+        timings = []
+        finals = []
+
+        async def run_session():
+            agent = QuestionnaireAgent(nlu_agent=nlu, rule_extractor=False, result_store=store)
+            await agent.astart()
+            for text in turns:
+                start = time.perf_counter()
+                await agent.aturn(text)
+                timings.append((time.perf_counter() - start) * 1000)
+                if agent.awaiting_exit_confirmation:
+                    await agent.aturn("是")
+            finals.append(dict(agent.collected_answers))
+
+        async def run_all():
+            await asyncio.gather(*[run_session() for _ in range(sessions)])
+
+        asyncio.run(run_all())
+        if reference is None:
+            reference = finals[0]
+        expected = {k: v for k, v in reference.items() if v is not None}
+        correct = sum(sum(1 for k, v in expected.items() if final.get(k) == v) for final in finals)
+        counters = METRICS.to_dict()["counters"]
+        routing = nlu.routing_stats.summary()
+        results[name] = {
+            "p50_ms": round(percentile(timings, 50), 1),
+            "p95_ms": round(percentile(timings, 95), 1),
+            "cost_usd_per_session": round(sum(v for k, v in counters.items() if k.startswith("llm_cost_usd_total")) / sessions, 6),
+            "accuracy": round(correct / (len(expected) * sessions), 4),
+            "primary_calls": routing["tiers"]["primary"]["calls"],
+            "escalated_calls": routing["tiers"]["escalated"]["calls"],
+            "escalations": routing["escalations"],
+            "escalation_rate": routing["escalation_rate"],
+        }
+    print(f"小模型 {small} 約 {small_latency * 1000:.0f} ms，強模型 {strong} 約 {strong_latency * 1000:.0f} ms")
+    for name, r in results.items():
+        print(f"{name:>12} | p50 {r['p50_ms']:>6} ms | p95 {r['p95_ms']:>6} ms | 每會話 ${r['cost_usd_per_session']:.5f} | "
+              f"正確率 {r['accuracy']:.0%} | 第一層 {r['primary_calls']} 次 | 升級 {r['escalated_calls']} 次 {r['escalations']}")
+    return results
+
+
+# 自然作答的填答者：(輸入, 問題 id, 未約束時模型照抄的值, 受 schema 約束時的值, 被要求澄清後的重新作答)
+NATURAL_SCRIPT = [
+    ("我叫王小明", "name", "王小明", "王小明", None),
+    ("信箱是 wang@example.com", "email", "wang@example.com", "wang@example.com", None),
+    ("我三十歲", "age_group", "三十歲", "25-34", "25-34"),
+    ("滿意度大概四分吧", "product_satisfaction", "四分", 4, "4"),
+    ("沒什麼其他意見", "feedback_comments", "沒什麼其他意見", "沒什麼其他意見", None),
+    ("可以聯絡我", "allow_follow_up", "可以", "是", "是"),
+]
+
+
+def bench_structured_output(sessions=30, latency=0.05, model="gpt-4o-mini"):
+    """
+    比較 json_object + 文字說明 (舊行為) 與由問卷定義產生的嚴格 JSON schema：
+    每次提取的 prompt token (含 schema)、每會話的澄清次數、回合數、LLM 呼叫數與 token 數。
+    模擬的模型在未受約束時會照抄使用者的說法 (「三十歲」、「四分」、「可以」)，觸發澄清與重新作答；
+    受 schema 約束時只能輸出選項、範圍內的整數或 '是'/'否'。
+    """
+    import asyncio
+    from ai_agents import QuestionnaireAgent, TURN_PIPELINE_STATS
+    from fake_backends import ScriptedResponder, estimate_request_tokens
+
+    freeform = {text: {q_id: value} for text, q_id, value, _, _ in NATURAL_SCRIPT}
+    constrained = {text: {q_id: value} for text, q_id, _, value, _ in NATURAL_SCRIPT}
+    retries = {retry: {q_id: retry} for _, q_id, _, _, retry in NATURAL_SCRIPT if retry}
+
+    class SchemaAwareResponder(ScriptedResponder):
+        def __call__(self, request):
+            response_format = request.get("response_format") or {}
+            if response_format.get("type") == "json_schema":
+                self.script = {**retries, **constrained}
+            elif response_format:
+                self.script = {**retries, **freeform}
+            return super().__call__(request)
+
+    results = {}
+    for name, structured in (("json_object", False), ("json_schema", True)):
+        nlu = make_fake_nlu(latency=latency, model=model, structured_output=structured, model_routing={})
+        nlu.async_client.responder = SchemaAwareResponder()
+        TURN_PIPELINE_STATS.__init__()
+        turns = []
+        session_tokens = []
+        durations = []
+
+        async def run_session():
+            agent = QuestionnaireAgent(nlu_agent=nlu, rule_extractor=False, speculative_next_prompt=False)
+            start = time.perf_counter()
+            await agent.astart()
+            count = 0
+            for text, q_id, _, _, retry in NATURAL_SCRIPT:
+                await agent.aturn(text)
+                count += 1
+                if agent.collected_answers.get(q_id) is None and retry:
+                    await agent.aturn(retry) # 被要求澄清後重新作答
+                    count += 1
+            durations.append((time.perf_counter() - start) * 1000)
+            turns.append(count)
+            session_tokens.append(agent.session_token_usage["prompt_tokens"])
+
+        async def run_all():
+            await asyncio.gather(*[run_session() for _ in range(sessions)])
+
+        asyncio.run(run_all())
+        extraction_requests = [r for r in nlu.async_client.requests if r.get("response_format")]
+        results[name] = {
+            "extraction_prompt_tokens": round(statistics.mean(estimate_request_tokens(r) for r in extraction_requests), 1),
+            "system_prompt_tokens": estimate_request_tokens({"messages": extraction_requests[0]["messages"][:1]}),
+            "clarifications_per_session": round(TURN_PIPELINE_STATS.summary()["clarification_calls"] / sessions, 2),
+            "turns_per_session": round(statistics.mean(turns), 2),
+            "llm_calls_per_session": round(nlu.async_client.calls / sessions, 2),
+            "prompt_tokens_per_session": round(statistics.mean(session_tokens), 1),
+            "session_p50_ms": round(percentile(durations, 50), 1),
+        }
+    print(f"單次模型延遲約 {latency * 1000:.0f} ms")
+    for name, r in results.items():
+        print(f"{name:>12} | 每次提取 {r['extraction_prompt_tokens']} tokens (系統提示 {r['system_prompt_tokens']}) | "
+              f"每會話澄清 {r['clarifications_per_session']} 次 | 回合 {r['turns_per_session']} | LLM 呼叫 {r['llm_calls_per_session']} | "
+              f"prompt tokens {r['prompt_tokens_per_session']} | 完成時間 p50 {r['session_p50_ms']} ms")
+    return results
+
+
+def bench_submission_dedup(submissions=5000, retry_rate=0.2, existing_rows=20000, per_row_latency=0.000002, scan_sample=20):
+    """
+    模擬 retry_rate 比例的提交被重送 (逾時重試、重複「結束」)：
+    比較不去重、每次下載整張工作表比對 (原本唯一的去重方式) 與本地提交索引 (Bloom filter + SQLite) 的
+    每次檢查延遲與最終寫入行數，以及以一次單欄範圍讀取對帳的耗時。
+    """
+    import os
+    import random
+    import tempfile
+    from questionnaire_data import GOOGLE_SHEET_HEADERS, SUBMISSION_ID_HEADER
+    from result_stores import SQLiteResultStore, SheetsBulkExporter
+    from submission_index import SubmissionIndex, reconcile_with_sheet
+
+    rng = random.Random(0)
+    sample = {"name": "王小明", "email": "wang@example.com", "age_group": "25-34", "product_satisfaction": 4, "allow_follow_up": "是"}
+    attempts = []
+    for i in range(submissions):
+        attempts.append({**sample, SUBMISSION_ID_HEADER: f"session-{i}"})
+        if rng.random() < retry_rate:
+            attempts.append({**sample, SUBMISSION_ID_HEADER: f"session-{i}"})
+
+    tmp_dir = tempfile.mkdtemp()
+    results = {}
+    for name, with_index in (("no_dedup", False), ("bloom_index", True)):
+        index = SubmissionIndex(os.path.join(tmp_dir, f"{name}.idx")) if with_index else None
+        store = SQLiteResultStore(os.path.join(tmp_dir, f"{name}.db"), index=index)
+        start = time.perf_counter()
+        for answers in attempts:
+            store.append(answers)
+        elapsed = time.perf_counter() - start
+        results[name] = {"attempts": len(attempts), "rows_written": store.count(),
+                         "per_submission_ms": round(elapsed / len(attempts) * 1000, 4)}
+        if index is not None:
+            results[name]["exact_lookups"] = index.stats["exact_lookups"]
+            results[name]["bloom_negatives"] = index.stats["bloom_negatives"]
+
+            client = FakeGspreadClient(per_row_latency=per_row_latency)
+            worksheet = client.open_by_key("bench-sheet").worksheet("工作表1")
+            worksheet.rows = [list(GOOGLE_SHEET_HEADERS)] + [
+                store.to_row({**sample, SUBMISSION_ID_HEADER: f"old-{i}"}) for i in range(existing_rows)]
+            exporter = SheetsBulkExporter(store, lambda: client, "bench-sheet", state_path=os.path.join(tmp_dir, "export.json"))
+            exporter.export_once()
+
+            # 原本的去重方式：每次提交前下載整張工作表找 id
+            start = time.perf_counter()
+            for answers in attempts[:scan_sample]:
+                any(row[-1] == answers[SUBMISSION_ID_HEADER] for row in worksheet.get_all_values())
+            results["sheet_scan"] = {"attempts": len(attempts), "rows_written": submissions,
+                                     "per_submission_ms": round((time.perf_counter() - start) / scan_sample * 1000, 4)}
+
+            start = time.perf_counter()
+            report = reconcile_with_sheet(index, client, "bench-sheet", "工作表1", GOOGLE_SHEET_HEADERS)
+            results[name]["reconcile_ms"] = round((time.perf_counter() - start) * 1000, 1)
+            start = time.perf_counter()
+            reconcile_with_sheet(index, client, "bench-sheet", "工作表1", GOOGLE_SHEET_HEADERS) # 既有的 id 已在索引中
+            results[name]["reconcile_again_ms"] = round((time.perf_counter() - start) * 1000, 1)
+            results[name]["sheet_duplicates"] = len(report["duplicates"])
+        store.close()
+    print(f"{submissions} 份提交，{retry_rate:.0%} 被重送；工作表既有 {existing_rows} 行")
+    for name, r in results.items():
+        extra = ""
+        if "reconcile_ms" in r:
+            extra = (f" | 精確查詢 {r['exact_lookups']} 次 (Bloom 排除 {r['bloom_negatives']} 次) | "
+                     f"首次對帳 {r['reconcile_ms']} ms (含匯入既有 id) / 再次 {r['reconcile_again_ms']} ms，每次 1 次單欄讀取，重複 {r['sheet_duplicates']}")
+        print(f"{name:>12} | 嘗試 {r['attempts']} | 寫入 {r['rows_written']} 行 | 每次提交 {r['per_submission_ms']} ms{extra}")
+    return results
+
+
+HEAVY_SDK_MODULES = ("openai", "httpx", "gspread", "google.oauth2", "google.auth", "requests")
+
+
+def _importtime_ms(code, module):
+    """
+    以 python -X importtime 在新的直譯器中執行 code，返回 (module 的累計匯入毫秒數, 整個程序的牆鐘毫秒數)。
+    """
+    import os
+    import subprocess
+    import sys
+
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True,
+                               cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+    wall_ms = (time.perf_counter() - start) * 1000
+    cumulative_us = 0
+    for line in completed.stderr.splitlines():
+        parts = line.split("|")
+        if line.startswith("import time:") and len(parts) == 3 and parts[2].strip() == module:
+            cumulative_us = max(cumulative_us, int(parts[1]))
+    return cumulative_us / 1000, wall_ms
+
+
+def bench_startup(targets=("main", "server", "batch_nlu", "session_engine"), runs=5, budget_ms=150.0):
+    """
+    冷啟動成本：以 python -X importtime 量測各入口模組的匯入時間 (取 runs 次的中位數)，
+    確認 openai / gspread / google-auth 等 SDK 沒有在匯入時載入，且匯入時間在 budget_ms 之內。
+    """
+    import subprocess
+    import sys
+
+    sdk_ms = statistics.median(_importtime_ms("import gspread, google.oauth2.service_account", "gspread")[0] for _ in range(runs))
+    interpreter_ms = statistics.median(_importtime_ms("pass", "")[1] for _ in range(runs))
+    results = {"deferred_sheets_sdk_ms": round(sdk_ms, 1), "interpreter_wall_ms": round(interpreter_ms, 1), "targets": {}}
+    for target in targets:
+        samples = [_importtime_ms(f"import {target}", target) for _ in range(runs)]
+        loaded = subprocess.run([sys.executable, "-c", f"import sys, {target}; print(','.join(m for m in {HEAVY_SDK_MODULES!r} if m in sys.modules))"],
+                                capture_output=True, text=True, check=True).stdout.strip()
+        import_ms = statistics.median(ms for ms, _ in samples)
+        results["targets"][target] = {
+            "import_ms": round(import_ms, 1),
+            "wall_ms": round(statistics.median(wall for _, wall in samples), 1),
+            "heavy_modules_loaded": loaded.split(",") if loaded else [],
+            "within_budget": import_ms <= budget_ms and not loaded,
+        }
+    print(f"直譯器本身約 {results['interpreter_wall_ms']} ms；延後載入的 gspread + google-auth 約 {results['deferred_sheets_sdk_ms']} ms；預算 {budget_ms:.0f} ms")
+    for target, r in results["targets"].items():
+        status = "OK" if r["within_budget"] else "超出預算"
+        print(f"{target:>15} | 匯入 {r['import_ms']:>6} ms | 程序總計 {r['wall_ms']:>6} ms | 已載入的 SDK {r['heavy_modules_loaded'] or '無'} | {status}")
+    return results
+
+
+# 常見的簡短回答：(問題 id, [(輸入, 提取值)])；填答者從中隨機挑選，姓名與信箱則每人不同
+COMMON_ANSWERS = [
+    ("age_group", [("25歲", "25-34"), ("三十歲", "25-34"), ("二十出頭", "18-24"), ("40歲", "35-44")]),
+    ("product_satisfaction", [("滿意度4分", 4), ("5分", 5), ("5分！", 5), ("不滿意，1分", 1)]),
+    ("detailed_dissatisfaction_reason", [("太貴了", "太貴了"), ("太貴了。", "太貴了"), ("品質不好", "品質不好")]),
+    ("feedback_comments", [("沒有意見", "沒有意見"), ("沒有意見！", "沒有意見"), ("沒有 意見", "沒有意見"), ("沒有", "沒有意見")]),
+    ("allow_follow_up", [("可以", "是"), ("好", "是"), ("沒有", "否")]),
+]
+
+
+def bench_extraction_cache(sessions=200, latency=0.05, arrival_interval=0.01, seed=7):
+    """
+    比較有無提取快取時，填答者 (每 arrival_interval 秒開始一位) 以常見的簡短回答作答的 LLM 提取呼叫數、命中率與每回合延遲，
+    並示範重啟後由磁碟層取回，以及問卷定義變更 (版本改變) 後舊的快取項目被清除、不會再命中。
+    同一句「沒有」在意見題與聯絡意願題之後的提取結果不同，由快取鍵中的上一輪詢問問題區分。
+    """
+    import asyncio
+    import os
+    import random
+    import tempfile
+    from ai_agents import QuestionnaireAgent
+    from extraction_cache import ExtractionCache
+    from fake_backends import ScriptedResponder
+    from questionnaire_data import QUESTIONNAIRE_STRUCTURE
+    from questionnaire_model import compile_questionnaire
+    from result_stores import SQLiteResultStore
+
+    class ContextResponder(ScriptedResponder):
+        # 依最後的狀態訊息判斷使用者在回答哪一題 (「沒有」在不同問題之後意義不同)
+        def __call__(self, request):
+            if request.get("response_format"):
+                user_input = request["messages"][-1]["content"].replace("這是我的回答：", "", 1).strip()
+                if user_input == "沒有":
+                    answered = request["messages"][-2]["content"]
+                    self.script["沒有"] = {"allow_follow_up": "否"} if "feedback_comments" in answered \
+                        else {"feedback_comments": "沒有意見"}
+            return super().__call__(request)
+
+    def respondent_turns(rng, index):
+        turns = [(f"我叫填答者{index}", {"name": f"填答者{index}"}), (f"user{index}@example.com", {"email": f"user{index}@example.com"})]
+        satisfaction = None
+        for q_id, choices in COMMON_ANSWERS:
+            if q_id == "detailed_dissatisfaction_reason" and satisfaction != 1:
+                continue
+            text, value = rng.choice(choices)
+            if q_id == "product_satisfaction":
+                satisfaction = value
+            turns.append((text, {q_id: value}))
+        return turns
+
+    script = {}
+    for i in range(sessions * 3):
+        for text, answers in respondent_turns(random.Random(seed + i), i):
+            script.setdefault(text, answers)
+
+    tmpdir = tempfile.mkdtemp()
+    cache_path = os.path.join(tmpdir, "extraction_cache.db")
+
+    def run(questionnaire, cache, first=0):
+        nlu = make_fake_nlu(latency=latency, questionnaire=questionnaire, extraction_cache=cache)
+        nlu.async_client.responder = ContextResponder(script)
+        store = SQLiteResultStore(":memory:")
+        timings = []
+        mismatches = []
+
+        async def run_session(i):
+            await asyncio.sleep((i - first) * arrival_interval)
+            agent = QuestionnaireAgent(nlu_agent=nlu, rule_extractor=False, speculative_next_prompt=False,
+                                       questionnaire=questionnaire, result_store=store)
+            await agent.astart()
+            expected = {}
+            for text, answers in respondent_turns(random.Random(seed + i), i):
+                start = time.perf_counter()
+                await agent.aturn(text)
+                timings.append((time.perf_counter() - start) * 1000)
+                expected.update(answers)
+            mismatches.extend(k for k, v in expected.items() if agent.collected_answers.get(k) != v)
+
+        async def run_all():
+            await asyncio.gather(*[run_session(i) for i in range(first, first + sessions)])
+
+        asyncio.run(run_all())
+        extraction_calls = sum(1 for r in nlu.async_client.requests if r.get("response_format"))
+        return {
+            "extraction_calls_per_session": round(extraction_calls / sessions, 2),
+            "p50_ms": round(percentile(timings, 50), 1),
+            "p95_ms": round(percentile(timings, 95), 1),
+            "wrong_answers": len(mismatches),
+            "cache": cache.stats() if cache is not None else None,
+        }
+
+    questionnaire = compile_questionnaire(QUESTIONNAIRE_STRUCTURE)
+    changed = [dict(q) for q in QUESTIONNAIRE_STRUCTURE]
+    changed[0]["question"] = "請問怎麼稱呼您？"
+    cache = ExtractionCache(sqlite_path=cache_path)
+    results = {
+        "no_cache": run(questionnaire, None),
+        "cache": run(questionnaire, cache),
+        # 重啟後另一批填答者：常見回答由磁碟層取回
+        "cache_restart": run(questionnaire, ExtractionCache(sqlite_path=cache_path), first=sessions),
+        # 問卷定義變更：版本不同，舊項目在第一次查詢時清除
+        "cache_new_version": run(compile_questionnaire(changed), ExtractionCache(sqlite_path=cache_path), first=sessions * 2),
+    }
+    print(f"{sessions} 位填答者，單次模型延遲約 {latency * 1000:.0f} ms")
+    for name, r in results.items():
+        stats = r["cache"] or {}
+        print(f"{name:>17} | 每會話提取呼叫 {r['extraction_calls_per_session']} | p50 {r['p50_ms']:>6} ms | p95 {r['p95_ms']:>6} ms | "
+              f"答案錯誤 {r['wrong_answers']} | 命中率 {stats.get('hit_ratio', '-')} (等待進行中 {stats.get('coalesced', '-')}) | "
+              f"省下 {stats.get('saved_seconds', '-')} s")
+    return results
+
+
+def _pool_engine(latency):
+    # 在 worker 程序中執行：假 LLM 後端 + 記憶體內的 SQLite 結果儲存
+    from ai_agents import QuestionnaireAgent
+    from result_stores import SQLiteResultStore
+    from session_engine import SessionEngine
+
+    store = SQLiteResultStore(":memory:")
+    return SessionEngine(nlu_agent=make_fake_nlu(PIPELINE_SCRIPT, latency=latency),
+                         agent_factory=lambda nlu_agent: QuestionnaireAgent(nlu_agent=nlu_agent, result_store=store))
+
+
+def bench_worker_pool(worker_counts=(1, 2, 4), sessions=400, concurrency=64, latency=0.002):
+    """
+    以假 LLM 後端 (延遲很短，每回合的 Python 工作成為瓶頸) 比較不同 worker 程序數的每秒回合數，
+    並在問卷進行中加入、移除 worker，確認會話被搬移後仍完整結束。
+    可用的核心數少於 worker 數時吞吐量不會再增加 (結果中的 cpu_count)，因此另外量測每回合在 worker 與
+    supervisor 中耗用的 CPU 時間，推算核心足夠時的吞吐量上限 (supervisor 只轉送訊息，不應成為瓶頸)。
+    """
+    import asyncio
+    import functools
+    import os
+    from worker_pool import WorkerPool
+
+    turns = list(PIPELINE_SCRIPT) + ["結束"]
+    engine_factory = functools.partial(_pool_engine, latency)
+
+    async def run_sessions(pool, count, between=None):
+        semaphore = asyncio.Semaphore(concurrency)
+        finished = []
+        timings = []
+
+        async def run_session(index):
+            async with semaphore:
+                session_id, _ = await pool.start_session()
+                for turn_index, text in enumerate(turns):
+                    if between is not None and index == count // 2 and turn_index == 2:
+                        await between()
+                    start = time.perf_counter()
+                    await pool.turn(session_id, text)
+                    timings.append((time.perf_counter() - start) * 1000)
+                finished.append(not pool.is_active(session_id))
+
+        start = time.perf_counter()
+        await asyncio.gather(*[run_session(i) for i in range(count)])
+        return time.perf_counter() - start, finished, timings
+
+    async def scaling(workers):
+        pool = await WorkerPool(workers, engine_factory=engine_factory).start()
+        try:
+            await run_sessions(pool, concurrency) # 暖機
+            before = await pool.stats()
+            supervisor_cpu = time.process_time()
+            elapsed, finished, timings = await run_sessions(pool, sessions)
+            supervisor_cpu = time.process_time() - supervisor_cpu
+            stats = await pool.stats()
+        finally:
+            await pool.close()
+        worker_cpu = sum(s["cpu_seconds"] - before["worker_stats"][w]["cpu_seconds"] for w, s in stats["worker_stats"].items())
+        worker_ms_per_turn = worker_cpu / len(timings) * 1000
+        supervisor_ms_per_turn = supervisor_cpu / len(timings) * 1000
+        return {
+            "turns_per_second": round(len(timings) / elapsed, 1),
+            "p50_ms": round(percentile(timings, 50), 1),
+            "completed": sum(finished),
+            "turns_per_worker": {w: s["turns"] - before["worker_stats"][w]["turns"] for w, s in stats["worker_stats"].items()},
+            "worker_cpu_ms_per_turn": round(worker_ms_per_turn, 3),
+            "supervisor_cpu_ms_per_turn": round(supervisor_ms_per_turn, 3),
+            # 每個 worker 各有一個核心時的上限，同時受 supervisor 單核心轉送能力限制
+            "projected_turns_per_second": round(min(workers * 1000 / worker_ms_per_turn, 1000 / supervisor_ms_per_turn), 1),
+        }
+
+    async def rebalance():
+        pool = await WorkerPool(2, engine_factory=engine_factory).start()
+        events = {}
+
+        async def add_then_remove():
+            await pool.add_worker()
+            events["removed_moved"] = await pool.remove_worker()
+
+        try:
+            _, finished, _ = await run_sessions(pool, sessions, between=add_then_remove)
+            stats = await pool.stats()
+        finally:
+            await pool.close()
+        return {"completed": sum(finished), "sessions": sessions, "migrated_sessions": stats["migrated_sessions"], **events}
+
+    results = {"cpu_count": os.cpu_count()}
+    for workers in worker_counts:
+        results[f"workers_{workers}"] = asyncio.run(scaling(workers))
+    baseline = results[f"workers_{worker_counts[0]}"]["turns_per_second"]
+    print(f"可用核心數 {os.cpu_count()}，{sessions} 個會話，同時進行 {concurrency} 個，單次模型延遲 {latency * 1000:.0f} ms")
+    for workers in worker_counts:
+        r = results[f"workers_{workers}"]
+        speedup = r["turns_per_second"] / baseline
+        print(f"{workers:>2} 個 worker | {r['turns_per_second']:>7} 回合/秒 (x{speedup:.2f}，效率 {speedup / workers * worker_counts[0]:.0%}) | "
+              f"p50 {r['p50_ms']} ms | 完成 {r['completed']}/{sessions} | 每回合 CPU worker {r['worker_cpu_ms_per_turn']} ms + "
+              f"supervisor {r['supervisor_cpu_ms_per_turn']} ms | 核心足夠時約 {r['projected_turns_per_second']} 回合/秒")
+        print(f"             各 worker 回合數 {r['turns_per_worker']}")
+    results["rebalance"] = asyncio.run(rebalance())
+    r = results["rebalance"]
+    print(f"問卷進行中加入再移除 worker | 完成 {r['completed']}/{r['sessions']} | "
+          f"共搬移 {r['migrated_sessions']} 個會話 (移除時 {r['removed_moved']} 個)")
+    return results
+
+
+def bench_questionnaire_registry(surveys=30, sessions_per_survey=20, extra_questions=6):
+    """
+    同時服務多份問卷：比較每個會話各自編譯問卷並建立 AINLULayer / 規則提取器 (不共用) 與經由問卷註冊表
+    共用同一版本編譯結果時的開始會話耗時、編譯次數與每會話記憶體 (tracemalloc)。
+    接著在會話進行中修改一份問卷定義 (熱重載)：進行中的會話維持原本的版本並完成作答，新會話使用新版本；
+    重啟後 (新的引擎與註冊表) 仍能由快照恢復舊版本的會話。
+    """
+    import asyncio
+    import gc
+    import json
+    import os
+    import tempfile
+    import tracemalloc
+    from ai_agents import QuestionnaireAgent
+    from questionnaire_data import QUESTIONNAIRE_STRUCTURE
+    from questionnaire_model import compile_questionnaire
+    from questionnaire_registry import QuestionnaireRegistry
+    from result_stores import SQLiteResultStore
+    from rule_extractor import RuleBasedExtractor
+    from session_engine import SessionEngine
+    from session_store import SQLiteSessionStore
+
+    tmpdir = tempfile.mkdtemp()
+    definitions_dir = os.path.join(tmpdir, "surveys")
+    os.makedirs(definitions_dir)
+
+    def definition(index, revision=0):
+        questions = [dict(q, question=f"[問卷{index}] {q['question']}") for q in QUESTIONNAIRE_STRUCTURE]
+        questions += [{"id": f"extra_{k}", "question": f"問卷{index} 的附加問題 {k}{'？' * (revision + 1)}", "type": "text"}
+                      for k in range(extra_questions)]
+        return questions
+
+    def write_definition(index, revision=0):
+        path = os.path.join(definitions_dir, f"survey_{index}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"questions": definition(index, revision)}, f, ensure_ascii=False)
+        # 確保修改時間改變 (部分檔案系統的時間解析度較粗)
+        os.utime(path, ns=(time.time_ns(), time.time_ns() + revision * 1_000_000))
+
+    for i in range(surveys):
+        write_definition(i)
+
+    store = SQLiteResultStore(":memory:")
+    script = dict(PIPELINE_SCRIPT)
+    turns = ["我叫王小明", "信箱 wang@example.com，滿意度四分", "我三十歲", "沒什麼意見，可以聯絡我", "結束"]
+
+    def agent_factory(nlu_agent, questionnaire=None):
+        return QuestionnaireAgent(nlu_agent=nlu_agent, questionnaire=questionnaire, result_store=store)
+
+    def measure(start_all):
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        keep = asyncio.run(start_all())
+        elapsed = time.perf_counter() - start
+        gc.collect()
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        total = surveys * sessions_per_survey
+        return keep, {"start_ms_per_session": round(elapsed / total * 1000, 3), "kb_per_session": round(used / total / 1024, 1)}
+
+    results = {}
+    base_nlu = make_fake_nlu(script)
+
+    # 不共用：每個會話自己編譯問卷、建立 AINLULayer 與規則提取器
+    async def start_unshared():
+        structures = [definition(i) for i in range(surveys)]
+        agents = []
+        for i in range(surveys):
+            for _ in range(sessions_per_survey):
+                questionnaire = compile_questionnaire(structures[i], f"survey_{i}")
+                agent = QuestionnaireAgent(nlu_agent=base_nlu.for_questionnaire(questionnaire), questionnaire=questionnaire,
+                                           rule_extractor=RuleBasedExtractor(questionnaire), result_store=store)
+                await agent.astart()
+                agents.append(agent)
+        return agents
+
+    agents, results["unshared"] = measure(start_unshared)
+    results["unshared"]["compiles"] = len(agents)
+    del agents
+
+    registry = QuestionnaireRegistry(definitions_dir, check_interval=0.5)
+    session_store = SQLiteSessionStore(os.path.join(tmpdir, "sessions.db"))
+    engine = SessionEngine(nlu_agent=make_fake_nlu(script), agent_factory=agent_factory, session_store=session_store,
+                           registry=registry)
+
+    async def start_shared():
+        for i in range(surveys):
+            for j in range(sessions_per_survey):
+                await engine.start_session(f"s{i}-{j}", questionnaire_id=f"survey_{i}")
+        return None
+
+    _, results["registry"] = measure(start_shared)
+    results["registry"]["compiles"] = registry.compiles
+    results["registry"]["shared_nlu_layers"] = engine.stats()["questionnaires"]["shared_nlu_layers"]
+
+    # 熱重載：survey_0 的會話進行到一半時修改定義
+    async def hot_reload():
+        old_version = registry.get("survey_0").version
+        for j in range(sessions_per_survey):
+            await engine.turn(f"s0-{j}", turns[0])
+        write_definition(0, revision=1)
+        registry.reload()
+        new_version = registry.get("survey_0").version
+        await engine.start_session("s0-new", questionnaire_id="survey_0")
+        pinned = sum(1 for j in range(sessions_per_survey)
+                     if engine._sessions[f"s0-{j}"].agent.questionnaire.version == old_version)
+        # 一半的舊會話繼續在這個引擎完成，另一半留給「重啟」後恢復
+        half = sessions_per_survey // 2
+        completed = 0
+        for j in range(half):
+            for text in turns[1:]:
+                await engine.turn(f"s0-{j}", text)
+            completed += not engine.is_active(f"s0-{j}")
+        return old_version, new_version, pinned, completed, engine._sessions["s0-new"].agent.questionnaire.version
+
+    old_version, new_version, pinned, completed, new_session_version = asyncio.run(hot_reload())
+    engine.close()
+
+    async def after_restart():
+        restarted = SessionEngine(nlu_agent=make_fake_nlu(script), agent_factory=agent_factory, session_store=session_store,
+                                  registry=QuestionnaireRegistry(definitions_dir))
+        resumed = 0
+        for j in range(sessions_per_survey // 2, sessions_per_survey):
+            for text in turns[1:]:
+                await restarted.turn(f"s0-{j}", text)
+            resumed += not restarted.is_active(f"s0-{j}")
+        return resumed, restarted.resumed_sessions
+
+    resumed_completed, resumed = asyncio.run(after_restart())
+    rows = store._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+    results["hot_reload"] = {
+        "old_version": old_version, "new_version": new_version, "new_session_version": new_session_version,
+        "pinned_sessions": pinned, "completed_in_place": completed,
+        "resumed_after_restart": resumed, "completed_after_restart": resumed_completed, "stored_rows": rows,
+    }
+
+    total = surveys * sessions_per_survey
+    print(f"{surveys} 份問卷 x {sessions_per_survey} 個會話 (共 {total} 個)，每份 {len(definition(0))} 題")
+    for name in ("unshared", "registry"):
+        r = results[name]
+        print(f"{name:>9} | 開始會話 {r['start_ms_per_session']:>7} ms/會話 | 每會話記憶體 {r['kb_per_session']:>7} KB | "
+              f"編譯 {r['compiles']} 次")
+    r = results["hot_reload"]
+    print(f"熱重載 survey_0: {r['old_version']} -> {r['new_version']}；進行中會話仍使用舊版本 {r['pinned_sessions']}/{sessions_per_survey}，"
+          f"新會話版本 {r['new_session_version']}；原地完成 {r['completed_in_place']}，重啟後恢復 {r['resumed_after_restart']} 個並完成 "
+          f"{r['completed_after_restart']} 個 (結果共 {r['stored_rows']} 筆)")
+    return results
+
+
+def bench_answer_analytics(sizes=(1000, 10000, 100000), workers=4, seed=11):
+    """
+    比較儀表板查詢一次彙總的耗時：每次讀出全部資料重新計算 (舊做法) 與增量統計的快照。
+    另外量測每份提交更新統計的成本、由儲存後端一次掃描 backfill 的速度，並確認增量、backfill、
+    多個 worker 合併 (merge_state) 與直接重新計算的結果一致。
+    """
+    import random
+    from answer_analytics import AnswerAnalytics
+    from questionnaire_data import QUESTIONNAIRE_STRUCTURE, SUBMISSION_ID_HEADER
+    from questionnaire_model import DEFAULT_QUESTIONNAIRE
+    from result_stores import SQLiteResultStore
+
+    by_id = {q["id"]: q for q in QUESTIONNAIRE_STRUCTURE}
+
+    def submission(rng, index):
+        answers = {
+            "name": f"填答者{index}",
+            "email": f"user{index}@example.com" if rng.random() < 0.9 else None,
+            "age_group": rng.choice(by_id["age_group"]["options"]),
+            "product_satisfaction": rng.choices([1, 2, 3, 4, 5], weights=[1, 2, 3, 5, 4])[0],
+            "detailed_dissatisfaction_reason": None,
+            "feedback_comments": rng.choice(["沒什麼意見", "希望價格再便宜一點", None]),
+            "allow_follow_up": rng.choice(["是", "否"]),
+        }
+        if answers["product_satisfaction"] == 1:
+            answers["detailed_dissatisfaction_reason"] = "品質不穩定" if rng.random() < 0.7 else None
+        if rng.random() < 0.15:
+            # 中途結束：之後的問題都沒有回答
+            cut = rng.randrange(1, len(DEFAULT_QUESTIONNAIRE))
+            for q_id in DEFAULT_QUESTIONNAIRE.headers[cut:]:
+                answers[q_id] = None
+        answers[SUBMISSION_ID_HEADER] = f"s{index}"
+        return answers
+
+    def recompute(rows):
+        # 舊做法：每次查詢都掃描全部資料
+        headers = DEFAULT_QUESTIONNAIRE.result_headers
+        scores = []
+        age_counts = {}
+        follow_up = {"是": 0, "否": 0}
+        answered = dict.fromkeys(DEFAULT_QUESTIONNAIRE.headers, 0)
+        for row in rows:
+            record = dict(zip(headers, row))
+            for q_id in answered:
+                if record[q_id] not in (None, ""):
+                    answered[q_id] += 1
+            if record["product_satisfaction"] not in (None, ""):
+                scores.append(int(record["product_satisfaction"]))
+            if record["age_group"]:
+                age_counts[record["age_group"]] = age_counts.get(record["age_group"], 0) + 1
+            if record["allow_follow_up"] in follow_up:
+                follow_up[record["allow_follow_up"]] += 1
+        return {"mean": statistics.fmean(scores), "variance": statistics.pvariance(scores), "age_counts": age_counts,
+                "follow_up": follow_up, "answered": answered}
+
+    results = {}
+    for size in sizes:
+        rng = random.Random(seed)
+        submissions = [submission(rng, i) for i in range(size)]
+        store = SQLiteResultStore(":memory:")
+        store.append_many(submissions)
+
+        analytics = AnswerAnalytics()
+        start = time.perf_counter()
+        for answers in submissions:
+            analytics.record(answers)
+        record_us = (time.perf_counter() - start) / size * 1e6
+
+        start = time.perf_counter()
+        snapshot = analytics.snapshot()["default@" + DEFAULT_QUESTIONNAIRE.version]
+        rebuild_ms = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        for _ in range(1000):
+            analytics.snapshot()
+        cached_us = (time.perf_counter() - start) / 1000 * 1e6
+
+        start = time.perf_counter()
+        expected = recompute(store.read_since(0)[0])
+        full_scan_ms = (time.perf_counter() - start) * 1000
+
+        backfilled = AnswerAnalytics()
+        start = time.perf_counter()
+        position = 0
+        while True:
+            rows, position = store.read_since(position, 5000)
+            if not rows:
+                break
+            backfilled.backfill(rows, headers=store.headers)
+        backfill_seconds = time.perf_counter() - start
+
+        # 分給多個 worker 各自統計後合併
+        merged = AnswerAnalytics()
+        for w in range(workers):
+            part = AnswerAnalytics()
+            for answers in submissions[w::workers]:
+                part.record(answers)
+            merged.merge_state(part.export_state())
+
+        questions = snapshot["questions"]
+        consistent = (
+            abs(questions["product_satisfaction"]["mean"] - round(expected["mean"], 4)) < 1e-3
+            and abs(questions["product_satisfaction"]["variance"] - round(expected["variance"], 4)) < 1e-3
+            and {k: v for k, v in questions["age_group"]["counts"].items() if v} == expected["age_counts"]
+            and questions["allow_follow_up"]["counts"] == expected["follow_up"]
+            and all(questions[q_id]["answered"] == n for q_id, n in expected["answered"].items())
+            and backfilled.snapshot() == analytics.snapshot()
+            and merged.snapshot()["default@" + DEFAULT_QUESTIONNAIRE.version]["questions"]["allow_follow_up"]
+                == questions["allow_follow_up"]
+        )
+        results[size] = {
+            "full_scan_ms": round(full_scan_ms, 2),
+            "snapshot_rebuild_ms": round(rebuild_ms, 3),
+            "snapshot_cached_us": round(cached_us, 3),
+            "record_us_per_submission": round(record_us, 2),
+            "backfill_rows_per_second": round(size / backfill_seconds),
+            "completion_rate": snapshot["completion_rate"],
+            "consistent": consistent,
+        }
+        store.close()
+
+    for size, r in results.items():
+        print(f"{size:>7} 筆 | 全部重新計算 {r['full_scan_ms']:>9} ms | 快照 (有新提交後第一次 {r['snapshot_rebuild_ms']} ms，"
+              f"之後 {r['snapshot_cached_us']} µs) | 每份提交更新 {r['record_us_per_submission']} µs | "
+              f"backfill {r['backfill_rows_per_second']} 筆/秒 | 完成率 {r['completion_rate']} | 結果一致 {r['consistent']}")
+    return results
+
+
+def _agent_with_rules(nlu_agent, rule_extractor):
+    from ai_agents import QuestionnaireAgent
+    return QuestionnaireAgent(nlu_agent=nlu_agent, rule_extractor=rule_extractor)
+
+
+BENCHMARKS = {
+    "sheet_save": bench_sheet_save,
+    "turn_pipeline": bench_turn_pipeline,
+    "prompt_tokens": bench_prompt_tokens,
+    "response_cache": bench_response_cache,
+    "questionnaire_model": bench_questionnaire_model,
+    "conditions": bench_conditions,
+    "result_stores": bench_result_stores,
+    "client_manager": bench_client_manager,
+    "streaming": bench_streaming,
+    "chat_memory": bench_chat_memory,
+    "session_store": bench_session_store,
+    "batch_nlu": bench_batch_nlu,
+    "load_test": bench_load_test,
+    "metrics": bench_metrics,
+    "model_routing": bench_model_routing,
+    "structured_output": bench_structured_output,
+    "submission_dedup": bench_submission_dedup,
+    "startup": bench_startup,
+    "extraction_cache": bench_extraction_cache,
+    "worker_pool": bench_worker_pool,
+    "questionnaire_registry": bench_questionnaire_registry,
+    "answer_analytics": bench_answer_analytics,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="問卷 AI Agent 效能基準測試")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS) + ["all"])
+    args = parser.parse_args()
+    names = sorted(BENCHMARKS) if args.benchmark == "all" else [args.benchmark]
+    for name in names:
+        print(f"=== {name} ===")
+        BENCHMARKS[name]()
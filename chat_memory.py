@@ -0,0 +1,193 @@
+# chat_memory.py
+
+"""
+有上限的對話歷史。
+
+QuestionnaireAgent 原本以 list 保存整個會話的對話歷史，長時間運作的多會話伺服器中會無限增長，
+而 NLU 呼叫只取最後 2~8 則訊息，較早的內容留在記憶體中卻不再送給模型。ChatMemory 以固定容量的
+環形緩衝區保存最近的訊息 (使用 __slots__ 的精簡記錄)，被擠出的訊息累積到一定數量後交給
+summarizer 增量更新「滾動摘要」，讓提示以固定的 token 成本帶入較早的重要資訊。
+
+ChatMemory 保留 list 的常用介面 (append、切片、迭代、len)，切片返回 OpenAI 訊息格式的 dict。
+"""
+
+import asyncio
+import sys
+from collections import deque
+
+
+def estimate_tokens(text):
+    # 粗略估算：中文約每字一個 token，英文約每 4 個字元一個 token
+    cjk = sum(1 for ch in text if ord(ch) > 0x2E80)
+    return cjk + (len(text) - cjk) // 4 + 1
+
+
+class ChatMessage:
+    __slots__ = ("role", "content")
+
+    def __init__(self, role, content):
+        self.role = role
+        self.content = content
+
+    def to_dict(self):
+        return {"role": self.role, "content": self.content}
+
+
+class ChatMemory:
+    def __init__(self, max_messages=32, summarizer=None, summary_batch=16, max_summary_chars=600):
+        """
+        max_messages: 環形緩衝區保存的最近訊息數。
+        summarizer: async callable (previous_summary, [ChatMessage]) -> str；None 時被擠出的訊息直接丟棄。
+        summary_batch: 累積多少則被擠出的訊息後才更新一次摘要。
+        max_summary_chars: 摘要長度上限，確保摘要的 token 成本固定。
+        """
+        if max_messages < 1:
+            raise ValueError("max_messages 必須大於 0")
+        self.max_messages = max_messages
+        self.summarizer = summarizer
+        self.summary_batch = max(1, summary_batch)
+        self.max_summary_chars = max_summary_chars
+        self._messages = deque(maxlen=max_messages)
+        self._evicted = [] # 已被擠出、尚未併入摘要的訊息
+        self._summary_task = None
+        self.summary = ""
+        self.total_messages = 0
+        self.evicted_messages = 0
+        self.summaries = 0
+        self.summary_failures = 0
+
+    # ---- list 相容介面 ----
+
+    def append(self, message):
+        if len(self._messages) == self.max_messages:
+            evicted = self._messages[0]
+            self.evicted_messages += 1
+            if self.summarizer is not None:
+                self._evicted.append(evicted)
+                # 摘要持續失敗時，待摘要的訊息最多保留一個緩衝區的量
+                if len(self._evicted) > self.max_messages:
+                    del self._evicted[:len(self._evicted) - self.max_messages]
+        self._messages.append(ChatMessage(message["role"], message["content"]))
+        self.total_messages += 1
+
+    def __len__(self):
+        return len(self._messages)
+
+    def __iter__(self):
+        return (m.to_dict() for m in self._messages)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [m.to_dict() for m in list(self._messages)[index]]
+        return self._messages[index].to_dict()
+
+    def recent(self, count):
+        """
+        返回最近 count 則訊息 (dict)，不複製整個緩衝區。
+        """
+        count = min(count, len(self._messages))
+        return [self._messages[i].to_dict() for i in range(len(self._messages) - count, len(self._messages))]
+
+    def copy(self):
+        """
+        返回目前狀態的快照 (不含 summarizer)，供背景任務使用，不受之後的 append 影響。
+        """
+        snapshot = ChatMemory(self.max_messages, None, self.summary_batch, self.max_summary_chars)
+        snapshot._messages.extend(self._messages)
+        snapshot.summary = self.summary
+        return snapshot
+
+    def export_state(self):
+        """
+        返回 (訊息, 摘要, 待摘要訊息)，訊息為 [role, content]，供會話快照使用。
+        """
+        return ([[m.role, m.content] for m in self._messages], self.summary,
+                [[m.role, m.content] for m in self._evicted])
+
+    def restore_state(self, messages, summary, pending):
+        self._messages.clear()
+        self._messages.extend(ChatMessage(role, content) for role, content in messages)
+        self.summary = summary
+        self._evicted = [ChatMessage(role, content) for role, content in pending] if self.summarizer is not None else []
+
+    # ---- 滾動摘要 ----
+
+    def summary_message(self):
+        """
+        以 system 訊息形式返回目前的摘要；尚無摘要時返回 None。
+        """
+        if not self.summary:
+            return None
+        return {"role": "system", "content": f"先前對話摘要 (較早的訊息已省略): {self.summary}"}
+
+    def needs_summary(self):
+        return self.summarizer is not None and len(self._evicted) >= self.summary_batch
+
+    async def asummarize(self):
+        """
+        將累積的被擠出訊息併入摘要。失敗時保留這些訊息，下次再試。
+        """
+        if not self._evicted:
+            return self.summary
+        batch, self._evicted = self._evicted, []
+        try:
+            summary = await self.summarizer(self.summary, batch)
+        except Exception as e:
+            print(f"更新對話摘要時發生錯誤: {e}")
+            summary = None
+        if not summary:
+            self.summary_failures += 1
+            self._evicted = batch + self._evicted
+            return self.summary
+        self.summary = summary.strip()[:self.max_summary_chars]
+        self.summaries += 1
+        return self.summary
+
+    def schedule_summary(self):
+        """
+        需要時在背景更新摘要 (同一時間最多一個任務)，不佔用回合的回應時間。需在事件迴圈中呼叫。
+        """
+        if not self.needs_summary() or (self._summary_task is not None and not self._summary_task.done()):
+            return None
+        self._summary_task = asyncio.ensure_future(self.asummarize())
+        return self._summary_task
+
+    async def wait_for_summary(self):
+        if self._summary_task is not None:
+            await self._summary_task
+
+    def close(self):
+        if self._summary_task is not None and not self._summary_task.done():
+            self._summary_task.cancel()
+
+    # ---- 統計 ----
+
+    def memory_bytes(self):
+        """
+        估算此對話歷史佔用的記憶體 (訊息記錄、字串與摘要)。
+        """
+        total = sys.getsizeof(self._messages) + sys.getsizeof(self.summary)
+        for message in self._messages:
+            total += sys.getsizeof(message) + sys.getsizeof(message.content)
+        for message in self._evicted:
+            total += sys.getsizeof(message) + sys.getsizeof(message.content)
+        return total
+
+    def prompt_tokens(self, window):
+        """
+        估算送出最近 window 則訊息加上摘要時，歷史部分的 token 數。
+        """
+        tokens = estimate_tokens(self.summary) if self.summary else 0
+        return tokens + sum(estimate_tokens(m["content"]) for m in self.recent(window))
+
+    def stats(self):
+        return {
+            "messages": len(self._messages),
+            "total_messages": self.total_messages,
+            "evicted_messages": self.evicted_messages,
+            "pending_summary": len(self._evicted),
+            "summaries": self.summaries,
+            "summary_failures": self.summary_failures,
+            "summary_chars": len(self.summary),
+            "memory_bytes": self.memory_bytes(),
+        }
@@ -0,0 +1,167 @@
+# extraction_cache.py
+
+"""
+答案提取結果的記憶化快取。
+
+提取請求以 temperature=0.0 執行，同樣的簡短回答 (例如「不滿意」、「25歲」、「沒有意見」) 在相同的情境下
+會得到相同的結果，不必每位填答者都呼叫一次 LLM。儲存層沿用 response_cache.ResponseCache
+(記憶體 LRU + TTL，可選 SQLite 磁碟層)。
+
+快取鍵只包含會影響結果的部分：
+- 正規化後的使用者輸入 (全形轉半形、去除空白與首尾標點、英文轉小寫)
+- 問卷 id、版本與提取設定 (模型、系統提示、JSON schema 模式)；問卷定義變更後舊的項目不會再命中，
+  同一份問卷舊版本的磁碟項目在第一次使用新版本時清除 (不影響其他問卷)
+- 上一輪詢問或要求澄清的問題 id (同樣的「不滿意」在不同問題之後意義不同)
+- 已回答的問題 id 集合 (提示中附上已收集的答案，精簡結構模式下也決定送給模型的問題列表)
+
+已收集答案的值不在鍵中；可能是在修改答案的輸入 (含「改」、「其實」等字) 或過長的輸入不使用快取。
+"""
+
+import hashlib
+import json
+import re
+import threading
+import unicodedata
+
+from metrics import METRICS
+from response_cache import ResponseCache
+
+_SPACE_RE = re.compile(r"\s+")
+_EDGE_PUNCTUATION = " .,!?~;:、。，！？～；：…「」『』()（）\"'"
+
+
+def normalize_input(text):
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    return _SPACE_RE.sub("", text).strip(_EDGE_PUNCTUATION)
+
+
+class ExtractionCache:
+    NAMESPACE = "extract"
+
+    def __init__(self, cache=None, max_entries=4096, ttl=86400.0, sqlite_path=None, max_input_chars=40):
+        """
+        cache: 共用的 ResponseCache；未提供時依 max_entries / ttl / sqlite_path 建立。
+        max_input_chars: 正規化後超過此長度的輸入 (多半是不會重複的開放式意見) 不使用快取。
+        """
+        self.cache = cache if cache is not None else ResponseCache(max_entries=max_entries, ttl=ttl, sqlite_path=sqlite_path)
+        self.max_input_chars = max_input_chars
+        self._lock = threading.Lock()
+        self._purged_versions = set()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0 # 等待同一個鍵正在進行的提取、未另外呼叫 LLM 的次數 (計入 hits)
+        self.bypassed = 0
+        self.stored = 0
+        self.llm_seconds = 0.0 # 未命中時實際呼叫 LLM 的總耗時
+        self.saved_seconds = 0.0 # 命中的項目當初呼叫 LLM 的耗時總和
+
+    def key(self, user_input, version, signature, prompted_ids=(), answered_ids=None, bypass=False,
+            questionnaire_id="default"):
+        """
+        返回快取鍵；輸入不適合快取 (或 bypass 為 True，例如使用者在修改答案) 時返回 None。
+        """
+        normalized = normalize_input(user_input)
+        if bypass or not normalized or len(normalized) > self.max_input_chars:
+            with self._lock:
+                self.bypassed += 1
+            METRICS.inc("extraction_cache_bypassed_total")
+            return None
+        self._purge_other_versions(questionnaire_id, version)
+        context = [normalized, signature, sorted(prompted_ids or ())]
+        if answered_ids is not None:
+            context.append(sorted(answered_ids))
+        digest = hashlib.sha1(json.dumps(context, ensure_ascii=False).encode("utf-8")).hexdigest()
+        return f"{self.NAMESPACE}:{questionnaire_id}:{version}:{digest}"
+
+    def _purge_other_versions(self, questionnaire_id, version):
+        # 問卷定義變更時，清除同一份問卷其他版本留下的項目 (每個版本只檢查一次)
+        if (questionnaire_id, version) in self._purged_versions:
+            return
+        with self._lock:
+            if (questionnaire_id, version) in self._purged_versions:
+                return
+            self._purged_versions.add((questionnaire_id, version))
+        prefix = f"{self.NAMESPACE}:{questionnaire_id}:"
+        removed = self.cache.discard_prefix(prefix, keep=f"{prefix}{version}:")
+        if removed:
+            print(f"問卷 '{questionnaire_id}' 的定義已變更，清除了 {removed} 筆舊版本的提取快取。")
+
+    def get(self, key):
+        """
+        返回快取的提取結果 (副本) 或 None。
+        """
+        entry = self.cache.get(key)
+        if entry is None:
+            with self._lock:
+                self.misses += 1
+            # 與歡迎語/下一步提示快取共用 prompt_cache_requests_total，命中率由 metrics 一併計算
+            METRICS.inc("prompt_cache_requests_total", cache="extraction", result="miss")
+            return None
+        return self._hit(entry["result"], entry["llm_seconds"])
+
+    def coalesce(self, result):
+        """
+        記錄一次等待同鍵提取結果的請求 (計為命中，但等待時間未省下)，返回結果副本。
+        """
+        with self._lock:
+            self.coalesced += 1
+        return self._hit(result, 0.0)
+
+    def _hit(self, result, saved):
+        with self._lock:
+            self.hits += 1
+            self.saved_seconds += saved
+        METRICS.inc("prompt_cache_requests_total", cache="extraction", result="hit")
+        METRICS.inc("extraction_cache_saved_seconds_total", saved)
+        return {**result, "extracted_answers": dict(result.get("extracted_answers") or {})}
+
+    def set(self, key, result, llm_seconds):
+        """
+        保存成功的提取結果；llm_seconds 為這次 LLM 呼叫 (含可能的升級) 的耗時。
+        """
+        if result.get("action_request") == "error":
+            return
+        self.cache.set(key, {"result": result, "llm_seconds": round(llm_seconds, 6)})
+        with self._lock:
+            self.stored += 1
+            self.llm_seconds += llm_seconds
+
+    @staticmethod
+    def combined_stats(caches):
+        """
+        合併多個提取快取的統計 (各問卷版本的 AINLULayer 預設共用同一個快取，此時只有一個)。
+        """
+        if len(caches) == 1:
+            return caches[0].stats()
+        totals = {"entries": 0, "hits": 0, "misses": 0, "coalesced": 0, "bypassed": 0}
+        stored, llm_seconds, saved_seconds = 0, 0.0, 0.0
+        for cache in caches:
+            entries = cache.cache.stats()["entries"]
+            with cache._lock:
+                for name, value in (("entries", entries), ("hits", cache.hits), ("misses", cache.misses),
+                                    ("coalesced", cache.coalesced), ("bypassed", cache.bypassed)):
+                    totals[name] += value
+                stored += cache.stored
+                llm_seconds += cache.llm_seconds
+                saved_seconds += cache.saved_seconds
+        lookups = totals["hits"] + totals["misses"]
+        return {
+            **totals,
+            "hit_ratio": round(totals["hits"] / lookups, 4) if lookups else 0.0,
+            "avg_llm_ms": round(llm_seconds / stored * 1000, 1) if stored else 0.0,
+            "saved_seconds": round(saved_seconds, 3),
+        }
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": self.cache.stats()["entries"],
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "bypassed": self.bypassed,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "avg_llm_ms": round(self.llm_seconds / self.stored * 1000, 1) if self.stored else 0.0,
+                "saved_seconds": round(self.saved_seconds, 3),
+            }
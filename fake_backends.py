@@ -0,0 +1,484 @@
+# fake_backends.py
+
+"""
+本地測試用的假後端，模擬 gspread 客戶端與 OpenAI chat.completions 的最小介面，
+讓寫入流程與對話流程可以在沒有網路、API 金鑰與服務帳戶的情況下驗證。
+"""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeAPIError(Exception):
+    """
+    模擬 gspread.exceptions.APIError，帶有 HTTP 狀態碼。
+    """
+    def __init__(self, code, message=""):
+        super().__init__(f"APIError [{code}]: {message}")
+        self.code = code
+
+
+class FakeWorksheet:
+    def __init__(self, title, latency=0.0, per_row_latency=0.0):
+        self.title = title
+        self.rows = []
+        self.latency = latency
+        self.per_row_latency = per_row_latency # 模擬下載整張工作表時與資料量成正比的傳輸時間
+        self.call_counts = {}
+        self.fail_next_with = [] # 依序拋出的錯誤碼，例如 [429, 429]
+        self._lock = threading.Lock()
+
+    def _record_call(self, name):
+        self.call_counts[name] = self.call_counts.get(name, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.fail_next_with:
+            code = self.fail_next_with.pop(0)
+            raise FakeAPIError(code, "Quota exceeded" if code == 429 else "Fake error")
+
+    def get_all_values(self):
+        with self._lock:
+            self._record_call("get_all_values")
+            if self.per_row_latency:
+                time.sleep(self.per_row_latency * len(self.rows))
+            return [list(r) for r in self.rows]
+
+    def row_values(self, row):
+        with self._lock:
+            self._record_call("row_values")
+            return list(self.rows[row - 1]) if len(self.rows) >= row else []
+
+    def col_values(self, col):
+        # 範圍讀取單一欄，傳輸量以整張工作表的 1/欄數 估算
+        with self._lock:
+            self._record_call("col_values")
+            width = max((len(r) for r in self.rows), default=1) or 1
+            if self.per_row_latency:
+                time.sleep(self.per_row_latency * len(self.rows) / width)
+            values = [r[col - 1] if len(r) >= col else "" for r in self.rows]
+            while values and values[-1] == "":
+                values.pop() # 與 gspread 相同，不返回末端的空白儲存格
+            return values
+
+    def append_row(self, values):
+        with self._lock:
+            self._record_call("append_row")
+            self.rows.append(list(values))
+
+    def append_rows(self, values):
+        with self._lock:
+            self._record_call("append_rows")
+            self.rows.extend(list(v) for v in values)
+
+
+class FakeSpreadsheet:
+    def __init__(self, sheet_id, latency=0.0, per_row_latency=0.0):
+        self.id = sheet_id
+        self.latency = latency
+        self.per_row_latency = per_row_latency
+        self.worksheets = {}
+
+    def worksheet(self, title):
+        if title not in self.worksheets:
+            self.worksheets[title] = FakeWorksheet(title, latency=self.latency, per_row_latency=self.per_row_latency)
+        return self.worksheets[title]
+
+
+class FakeGspreadClient:
+    """
+    模擬 gspread.Client：open_by_key -> worksheet -> append_rows。
+    """
+    def __init__(self, latency=0.0, per_row_latency=0.0):
+        self.latency = latency
+        self.per_row_latency = per_row_latency
+        self.spreadsheets = {}
+        self.open_by_key_calls = 0
+
+    def open_by_key(self, key):
+        self.open_by_key_calls += 1
+        if key not in self.spreadsheets:
+            self.spreadsheets[key] = FakeSpreadsheet(key, latency=self.latency, per_row_latency=self.per_row_latency)
+        return self.spreadsheets[key]
+
+
+class _FakeMessage:
+    def __init__(self, content):
+        self.content = content
+        self.role = "assistant"
+
+
+class _FakeChoice:
+    def __init__(self, content):
+        self.message = _FakeMessage(content)
+        self.finish_reason = "stop"
+        self.index = 0
+
+
+class _FakeUsage:
+    def __init__(self, prompt_tokens, completion_tokens):
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.total_tokens = prompt_tokens + completion_tokens
+
+
+class FakeChatCompletion:
+    def __init__(self, content, model, prompt_tokens, completion_tokens):
+        self.choices = [_FakeChoice(content)]
+        self.model = model
+        self.usage = _FakeUsage(prompt_tokens, completion_tokens)
+
+
+class _FakeDelta:
+    def __init__(self, content):
+        self.content = content
+        self.role = "assistant"
+
+
+class _FakeStreamChoice:
+    def __init__(self, content, finish_reason=None):
+        self.delta = _FakeDelta(content)
+        self.finish_reason = finish_reason
+        self.index = 0
+
+
+class FakeChatCompletionChunk:
+    def __init__(self, content, model, usage=None, finish_reason=None):
+        # 與 OpenAI 相同：include_usage 時最後一個區塊的 choices 為空，只帶 usage
+        self.choices = [] if usage is not None else [_FakeStreamChoice(content, finish_reason)]
+        self.model = model
+        self.usage = usage
+
+
+def estimate_tokens(text):
+    # 粗略估算：中文約每字一個 token，英文約每 4 個字元一個 token
+    cjk = sum(1 for ch in text if ord(ch) > 0x2E80)
+    return cjk + (len(text) - cjk) // 4 + 1
+
+
+def estimate_request_tokens(request):
+    # 訊息內容加上 response_format 中的 JSON schema (供應商會將 schema 計入輸入 token)
+    tokens = sum(estimate_tokens(str(m.get("content", ""))) for m in request.get("messages", []))
+    response_format = request.get("response_format") or {}
+    if response_format.get("type") == "json_schema":
+        tokens += estimate_tokens(json.dumps(response_format["json_schema"], ensure_ascii=False, separators=(",", ":")))
+    return tokens
+
+
+class ScriptedResponder:
+    """
+    依據使用者輸入返回預先設定的提取結果；其他請求 (歡迎語、提示語) 返回固定文字。
+    script: {使用者輸入: {question_id: value}}
+    """
+    def __init__(self, script=None, finish_inputs=("結束", "完成")):
+        self.script = dict(script or {})
+        self.finish_inputs = set(finish_inputs)
+
+    def __call__(self, request):
+        messages = request["messages"]
+        if request.get("response_format"):
+            user_input = messages[-1]["content"].replace("這是我的回答：", "", 1).strip()
+            if user_input in self.finish_inputs:
+                return json.dumps({"extracted_answers": {}, "action_request": "finish_questionnaire", "reasoning": "fake"}, ensure_ascii=False)
+            answers = self.script.get(user_input)
+            action = "continue_questionnaire" if answers else "no_change"
+            return json.dumps({"extracted_answers": answers or {}, "action_request": action, "reasoning": "fake"}, ensure_ascii=False)
+        if messages[-1]["content"].endswith("請更新對話摘要。"):
+            return self._summarize(messages)
+        return "好的，謝謝您！接下來想請您分享更多資訊，您也可以隨時修改之前提供的答案。"
+
+    @staticmethod
+    def _summarize(messages):
+        # 假的滾動摘要：保留既有摘要，再依序加入未出現過的使用者發言，超過長度時截斷
+        previous = messages[0]["content"].split("既有摘要:", 1)[1].strip()
+        items = [] if previous == "(無)" else previous.split("；")
+        for line in messages[-1]["content"].splitlines():
+            if line.startswith("使用者: ") and line[5:] not in items:
+                items.append(line[5:])
+        return "；".join(items)[:200]
+
+
+class _FakeCompletions:
+    def __init__(self, owner, is_async):
+        self._owner = owner
+        self._is_async = is_async
+
+    def create(self, **request):
+        if self._is_async:
+            return self._owner._acreate(request)
+        return self._owner._create(request)
+
+
+class FakeOpenAIClient:
+    """
+    模擬 openai.OpenAI / openai.AsyncOpenAI 的 chat.completions.create，可注入延遲與錯誤。
+    is_async=True 時 create() 返回 coroutine，可作為 OpenAIClientManager 的 async_client 注入。
+    rate_limit: (最多請求數, 時間窗口秒數)，模擬供應商端的速率限制，超過時拋出 429。
+    stream=True 的請求會將回覆切成 stream_chunk_size 個字元的區塊，第一個區塊在延遲的
+    first_token_fraction 時送出，其餘區塊平均分佈在剩下的時間內。
+    """
+    stream_chunk_size = 4
+    first_token_fraction = 0.25
+
+    def __init__(self, responder=None, latency=0.0, jitter=0.0, error_rate=0.0, is_async=False, seed=None, rate_limit=None,
+                 model_latency=None):
+        """
+        model_latency: {模型: 延遲秒數}，覆蓋指定模型的 latency (模擬小模型較快、強模型較慢)。
+        """
+        import random as _random
+        self.responder = responder or ScriptedResponder()
+        self.latency = latency
+        self.model_latency = dict(model_latency or {})
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.requests = []
+        self.fail_next_with = [] # 依序拋出的錯誤碼，例如 [429, 429]
+        self.rate_limit = rate_limit
+        self.rate_limited = 0
+        self._recent = [] # 時間窗口內已接受請求的時間
+        self._random = _random.Random(seed)
+        self.chat = type("FakeChat", (), {})()
+        self.chat.completions = _FakeCompletions(self, is_async)
+
+    def _delay(self, request):
+        latency = self.model_latency.get(request.get("model"), self.latency)
+        return max(0.0, latency + self._random.uniform(-self.jitter, self.jitter))
+
+    def _respond(self, request):
+        self.calls += 1
+        self.requests.append(request)
+        if self.fail_next_with:
+            code = self.fail_next_with.pop(0)
+            raise FakeAPIError(code, "Rate limit reached" if code == 429 else "Fake error")
+        if self.rate_limit:
+            max_requests, window = self.rate_limit
+            now = time.monotonic()
+            self._recent = [t for t in self._recent if now - t < window]
+            if len(self._recent) >= max_requests:
+                self.rate_limited += 1
+                raise FakeAPIError(429, "Rate limit reached")
+            self._recent.append(now)
+        if self.error_rate and self._random.random() < self.error_rate:
+            raise FakeAPIError(500, "Injected fake OpenAI error")
+        content = self.responder(request)
+        prompt_tokens = estimate_request_tokens(request)
+        completion_tokens = estimate_tokens(content)
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        return FakeChatCompletion(content, request.get("model"), prompt_tokens, completion_tokens)
+
+    def _stream_plan(self, request, delay):
+        """
+        返回 [(送出前等待秒數, 區塊)]。
+        """
+        completion = self._respond(request)
+        content = completion.choices[0].message.content
+        pieces = [content[i:i + self.stream_chunk_size] for i in range(0, len(content), self.stream_chunk_size)] or [""]
+        first_wait = delay * self.first_token_fraction
+        rest_wait = (delay - first_wait) / max(1, len(pieces) - 1) if len(pieces) > 1 else 0.0
+        plan = [(first_wait if i == 0 else rest_wait, FakeChatCompletionChunk(piece, completion.model))
+                for i, piece in enumerate(pieces)]
+        plan.append((0.0, FakeChatCompletionChunk("", completion.model, finish_reason="stop")))
+        if (request.get("stream_options") or {}).get("include_usage"):
+            plan.append((0.0, FakeChatCompletionChunk(None, completion.model, usage=completion.usage)))
+        return plan
+
+    def _create(self, request):
+        delay = self._delay(request)
+        if request.get("stream"):
+            plan = self._stream_plan(request, delay)
+
+            def chunks():
+                for wait, chunk in plan:
+                    if wait:
+                        time.sleep(wait)
+                    yield chunk
+            return chunks()
+        if delay:
+            time.sleep(delay)
+        return self._respond(request)
+
+    async def _acreate(self, request):
+        import asyncio
+        delay = self._delay(request)
+        if request.get("stream"):
+            plan = self._stream_plan(request, delay)
+
+            async def chunks():
+                for wait, chunk in plan:
+                    if wait:
+                        await asyncio.sleep(wait)
+                    yield chunk
+            return chunks()
+        if delay:
+            await asyncio.sleep(delay)
+        return self._respond(request)
+
+
+def make_fake_nlu(script=None, latency=0.0, jitter=0.0, error_rate=0.0, seed=0, **nlu_kwargs):
+    """
+    建立使用假 OpenAI 客戶端的 AINLULayer (基準測試與 tests/ 共用)；nlu_kwargs 會傳給 AINLULayer。
+    """
+    from ai_nlu_layer import AINLULayer
+    from openai_client_manager import OpenAIClientManager
+
+    responder = ScriptedResponder(script)
+    manager = OpenAIClientManager(
+        client=FakeOpenAIClient(responder, latency=latency, jitter=jitter, error_rate=error_rate, seed=seed),
+        async_client=FakeOpenAIClient(responder, latency=latency, jitter=jitter, error_rate=error_rate, seed=seed, is_async=True),
+        requests_per_minute=None, tokens_per_minute=None, max_concurrency=10000, max_retries=0)
+    return AINLULayer(client_manager=manager, **nlu_kwargs)
+
+
+class StubOpenAIServer:
+    """
+    本地的 OpenAI 相容 HTTP stub (POST /v1/chat/completions)，讓真實的 openai 客戶端也能離線測試。
+    可模擬延遲與依序回傳的錯誤碼，並統計請求數與 TCP 連線數 (驗證 keep-alive 連線重用)。
+    stream=True 的請求以 SSE 逐塊回傳，首個區塊在延遲的 first_token_fraction 時送出。
+
+        with StubOpenAIServer(latency=0.05) as server:
+            client = openai.AsyncOpenAI(api_key="sk-stub", base_url=server.base_url)
+    """
+    stream_chunk_size = FakeOpenAIClient.stream_chunk_size
+    first_token_fraction = FakeOpenAIClient.first_token_fraction
+
+    def __init__(self, responder=None, latency=0.0, fail_next_with=None, host="127.0.0.1", port=0,
+                 jitter=0.0, error_rate=0.0, error_codes=(500, 429), seed=None):
+        """
+        jitter: 延遲的隨機浮動 (秒)。error_rate: 隨機回傳錯誤的機率，錯誤碼從 error_codes 中選取。
+        """
+        self.responder = responder or ScriptedResponder()
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_codes = tuple(error_codes)
+        import random as _random
+        self._random = _random.Random(seed)
+        self.fail_next_with = list(fail_next_with or [])
+        self.request_count = 0
+        self.connection_count = 0
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" # 支援 keep-alive
+
+            def setup(self):
+                super().setup()
+                with stub._lock:
+                    stub.connection_count += 1
+
+            def log_message(self, format, *args):
+                pass
+
+            def handle(self):
+                # 客戶端取消請求 (例如被捨棄的預先生成) 時會中途斷線，不視為錯誤
+                try:
+                    super().handle()
+                except (BrokenPipeError, ConnectionResetError):
+                    self.close_connection = True
+
+            def _send_json(self, status, payload, headers=None):
+                body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _send_event_stream(self, request, content, usage, latency):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+
+                def send_event(payload):
+                    data = f"data: {payload}\n\n".encode("utf-8")
+                    self.wfile.write(f"{len(data):x}\r\n".encode("latin-1") + data + b"\r\n")
+                    self.wfile.flush()
+
+                base = {"id": f"chatcmpl-stub-{stub.request_count}", "object": "chat.completion.chunk",
+                        "created": int(time.time()), "model": request.get("model", "stub")}
+                size = stub.stream_chunk_size
+                pieces = [content[i:i + size] for i in range(0, len(content), size)] or [""]
+                first_wait = latency * stub.first_token_fraction
+                rest_wait = (latency - first_wait) / max(1, len(pieces) - 1) if len(pieces) > 1 else 0.0
+                for i, piece in enumerate(pieces):
+                    wait = first_wait if i == 0 else rest_wait
+                    if wait:
+                        time.sleep(wait)
+                    send_event(json.dumps({**base, "choices": [
+                        {"index": 0, "delta": {"role": "assistant", "content": piece} if i == 0 else {"content": piece},
+                         "finish_reason": None}]}, ensure_ascii=False))
+                send_event(json.dumps({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}))
+                if (request.get("stream_options") or {}).get("include_usage"):
+                    send_event(json.dumps({**base, "choices": [], "usage": usage}))
+                send_event("[DONE]")
+                self.wfile.write(b"0\r\n\r\n")
+                self.wfile.flush()
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                if "messages" not in request:
+                    # 客戶端在送出請求內容前取消
+                    return self._send_json(400, {"error": {"message": "Missing messages"}})
+                with stub._lock:
+                    stub.request_count += 1
+                    code = stub.fail_next_with.pop(0) if stub.fail_next_with else None
+                    if code is None and stub.error_rate and stub._random.random() < stub.error_rate:
+                        code = stub._random.choice(stub.error_codes)
+                    latency = max(0.0, stub.latency + stub._random.uniform(-stub.jitter, stub.jitter)) if stub.jitter else stub.latency
+                if latency and not (request.get("stream") and code is None):
+                    time.sleep(latency)
+                if not self.path.rstrip("/").endswith("/chat/completions"):
+                    self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+                elif code is not None:
+                    self._send_json(code, {"error": {"message": "Rate limit reached" if code == 429 else "Stub error", "code": code}},
+                                    {"retry-after": "0.05"} if code == 429 else None)
+                else:
+                    content = stub.responder(request)
+                    prompt_tokens = estimate_request_tokens(request)
+                    completion_tokens = estimate_tokens(content)
+                    usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                             "total_tokens": prompt_tokens + completion_tokens}
+                    if request.get("stream"):
+                        return self._send_event_stream(request, content, usage, latency)
+                    self._send_json(200, {
+                        "id": f"chatcmpl-stub-{stub.request_count}",
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": request.get("model", "stub"),
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                        "usage": usage,
+                    })
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="StubOpenAIServer", daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,57 +1,161 @@
 # google_sheets_service.py
 
-import gspread
-from google.oauth2.service_account import Credentials
 import os
+import threading
+import time
+
+# gspread 與 google-auth 載入需要約 0.2 秒，只在第一次真正連線 Google Sheets 時才匯入，
+# 不寫入 Sheets 的會話、使用本地儲存後端的程序與短命的 worker 不必負擔這段啟動時間
+
+# 工作表中繼資料快取：(sheet_id, worksheet_name) -> {"client", "worksheet", "checked_at"}
+# 只在第一次 (或 TTL 過期、寫入失敗後) 讀取第一行確認標題，避免每次寫入都下載整張工作表
+WORKSHEET_CACHE_TTL = 600.0
+_worksheet_cache = {}
+_worksheet_cache_lock = threading.Lock()
+
+# 服務帳戶檔案 -> 已授權的客戶端；憑證與客戶端在程序內只建立一次，寫入佇列、批次匯出與對帳共用
+_client_cache = {}
+_client_cache_lock = threading.Lock()
 
 def get_google_sheet_client(service_account_file):
     """
-    獲取 Google Sheets API 客戶端。
+    獲取 Google Sheets API 客戶端。同一個服務帳戶檔案返回同一個客戶端；連線失敗時返回 None，下次呼叫會重試。
     """
-    # 定義認證範圍
-    scope = [
-        "https://spreadsheets.google.com/feeds",
-        "https://www.googleapis.com/auth/drive"
-    ]
+    with _client_cache_lock:
+        client = _client_cache.get(service_account_file)
+        if client is not None:
+            return client
+        import gspread
+        from google.oauth2.service_account import Credentials
 
-    # 從服務帳戶文件加載憑證
-    try:
-        creds = Credentials.from_service_account_file(service_account_file, scopes=scope)
-        client = gspread.authorize(creds)
-        print(f"成功連接 Google Sheets API 客戶端.")
-        return client
-    except Exception as e:
-        print(f"連接 Google Sheets API 失敗: {e}")
-        print(f"請確保服務帳戶文件 '{service_account_file}' 存在且有效，並且已在 GCP 中啟用相關 API。")
+        # 定義認證範圍
+        scope = [
+            "https://spreadsheets.google.com/feeds",
+            "https://www.googleapis.com/auth/drive"
+        ]
+
+        # 從服務帳戶文件加載憑證
+        try:
+            creds = Credentials.from_service_account_file(service_account_file, scopes=scope)
+            client = gspread.authorize(creds)
+            print(f"成功連接 Google Sheets API 客戶端.")
+            _client_cache[service_account_file] = client
+            return client
+        except Exception as e:
+            print(f"連接 Google Sheets API 失敗: {e}")
+            print(f"請確保服務帳戶文件 '{service_account_file}' 存在且有效，並且已在 GCP 中啟用相關 API。")
+            return None
+
+def get_default_sheet_client():
+    """
+    以 questionnaire_data.SERVICE_ACCOUNT_FILE 取得共用的客戶端；檔案不存在時返回 None。
+    """
+    from questionnaire_data import SERVICE_ACCOUNT_FILE
+    if not os.path.exists(SERVICE_ACCOUNT_FILE):
+        print(f"錯誤：服務帳戶文件 '{SERVICE_ACCOUNT_FILE}' 不存在。無法連接 Google Sheets。")
         return None
+    return get_google_sheet_client(SERVICE_ACCOUNT_FILE)
+
+def invalidate_worksheet_cache(sheet_id=None, worksheet_name=None):
+    """
+    清除工作表快取；不帶參數時清除全部。寫入失敗時會呼叫以便下次重新驗證。
+    """
+    with _worksheet_cache_lock:
+        if sheet_id is None:
+            _worksheet_cache.clear()
+            return
+        for key in list(_worksheet_cache):
+            if key[0] == sheet_id and (worksheet_name is None or key[1] == worksheet_name):
+                del _worksheet_cache[key]
+
+def get_worksheet_with_headers(client, sheet_id, worksheet_name, headers):
+    """
+    取得工作表並確保標題行存在。結果依 sheet ID 快取，TTL 內不再發出任何讀取請求。
+    """
+    key = (sheet_id, worksheet_name)
+    now = time.monotonic()
+    with _worksheet_cache_lock:
+        entry = _worksheet_cache.get(key)
+        if entry and entry["client"] is client and now - entry["checked_at"] < WORKSHEET_CACHE_TTL:
+            return entry["worksheet"]
+
+    spreadsheet = client.open_by_key(sheet_id)
+    worksheet = spreadsheet.worksheet(worksheet_name)
+
+    # 只讀取第一行來判斷標題是否存在，成本與工作表的資料量無關
+    first_row = worksheet.row_values(1)
+    if not first_row:
+        worksheet.append_row(list(headers))
+        print(f"已在 '{worksheet_name}' 工作表寫入標題行。")
+    elif list(first_row[:len(headers)]) != list(headers):
+        print(f"警告：工作表 '{worksheet_name}' 的標題行與問卷定義不一致: {first_row}")
+
+    with _worksheet_cache_lock:
+        _worksheet_cache[key] = {"client": client, "worksheet": worksheet, "checked_at": now}
+    return worksheet
 
 def append_row_to_sheet(client, sheet_id, worksheet_name, data_row, headers):
     """
     將數據行寫入 Google Sheet。
     """
+    import gspread
     try:
-        spreadsheet = client.open_by_key(sheet_id)
-        worksheet = spreadsheet.worksheet(worksheet_name)
-
-        # 檢查工作表是否為空，如果是，則寫入標題行
-        if not worksheet.get_all_values():
-            worksheet.append_row(headers)
-            print(f"已在 '{worksheet_name}' 工作表寫入標題行。")
-
+        worksheet = get_worksheet_with_headers(client, sheet_id, worksheet_name, headers)
         worksheet.append_row(data_row)
         print(f"數據已成功寫入 Google Sheet '{worksheet_name}'。")
         return True
     except gspread.exceptions.SpreadsheetNotFound:
+        invalidate_worksheet_cache(sheet_id, worksheet_name)
         print(f"錯誤：Google Sheet ID '{sheet_id}' 未找到。請檢查 ID 是否正確。")
         return False
     except gspread.exceptions.WorksheetNotFound:
+        invalidate_worksheet_cache(sheet_id, worksheet_name)
         print(f"錯誤：工作表 '{worksheet_name}' 未找到。請檢查工作表名稱是否正確。")
         return False
     except Exception as e:
+        invalidate_worksheet_cache(sheet_id, worksheet_name)
         print(f"將數據寫入 Google Sheet 時發生錯誤: {e}")
         print(f"請確保服務帳戶已具有該 Google Sheet 的編輯權限。")
         return False
 
+def build_data_row(answers, headers):
+    """
+    依照標題順序將答案字典轉為一行資料，None 以空字串表示。
+    """
+    data_row = []
+    for header_id in headers:
+        val = answers.get(header_id)
+        data_row.append(val if val is not None else "")
+    return data_row
+
+def is_quota_error(error):
+    """
+    判斷錯誤是否為 Sheets API 的配額/速率限制錯誤 (HTTP 429)。
+    """
+    code = getattr(error, "code", None)
+    if code is None:
+        response = getattr(error, "response", None)
+        code = getattr(response, "status_code", None)
+    if code == 429:
+        return True
+    message = str(error).lower()
+    return "quota" in message or "rate limit" in message
+
+def append_rows_to_sheet(client, sheet_id, worksheet_name, data_rows, headers):
+    """
+    以單次 append_rows 呼叫批次寫入多行數據。
+    與 append_row_to_sheet 不同，失敗時會拋出例外，由呼叫端 (例如寫入佇列) 決定是否重試。
+    """
+    try:
+        worksheet = get_worksheet_with_headers(client, sheet_id, worksheet_name, headers)
+        if data_rows:
+            worksheet.append_rows([list(r) for r in data_rows])
+    except Exception:
+        # 工作表可能被刪除、改名或清空，下次寫入時重新驗證
+        invalidate_worksheet_cache(sheet_id, worksheet_name)
+        raise
+    return len(data_rows)
+
 if __name__ == '__main__':
     # 這是一個簡單的測試用例
     from questionnaire_data import GOOGLE_SHEET_ID, SERVICE_ACCOUNT_FILE, GOOGLE_SHEET_HEADERS
@@ -61,5 +165,16 @@ if __name__ == '__main__':
     else:
         gs_client = get_google_sheet_client(SERVICE_ACCOUNT_FILE)
         if gs_client:
-            test_data = ["測試名稱", "test@example.com", "25-34", "4", "這是一個測試意見。", "是"]
+            # 依 GOOGLE_SHEET_HEADERS 的順序組成一列，避免與標題欄位錯位
+            sample_answers = {
+                "name": "測試名稱",
+                "email": "test@example.com",
+                "age_group": "25-34",
+                "product_satisfaction": "4",
+                "detailed_dissatisfaction_reason": "",
+                "feedback_comments": "這是一個測試意見。",
+                "allow_follow_up": "是",
+                "submission_id": "self-test",
+            }
+            test_data = [sample_answers.get(header, "") for header in GOOGLE_SHEET_HEADERS]
             append_row_to_sheet(gs_client, GOOGLE_SHEET_ID, "工作表1", test_data, GOOGLE_SHEET_HEADERS)
\ No newline at end of file
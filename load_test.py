@@ -0,0 +1,313 @@
+# load_test.py
+
+"""
+負載測試：以腳本化的模擬填答者，在可設定的併發數下驅動 SessionEngine / QuestionnaireAgent 完成整份問卷。
+
+- LLM：本地 OpenAI 相容 stub 伺服器 (真實 openai 客戶端經 HTTP 呼叫) 或程序內的假客戶端，
+  可設定延遲、浮動與錯誤注入
+- Google Sheets：假 gspread 客戶端 + 原本的 SheetSubmissionQueue 背景批次寫入
+
+輸出每回合延遲 p50/p95/p99、每份完成問卷的 LLM 呼叫數、每會話 token 數與儲存吞吐量，
+可寫成 JSON 並與基準結果比較，退步超過容許範圍時以非零狀態碼結束 (適合放在 CI)。
+
+用法：
+    python load_test.py --respondents 200 --concurrency 50 --json results.json
+    python load_test.py --respondents 200 --concurrency 50 --baseline results.json --max-regression 0.2
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+# 三種填答者：順利完成、低滿意度 (觸發條件題)、需要澄清 (無效的 email 與滿意度)
+RESPONDENT_SCRIPTS = {
+    "happy": ["我叫王小明", "信箱 wang@example.com", "我三十歲", "滿意度四分", "沒什麼意見，可以聯絡我", "結束"],
+    "dissatisfied": ["我是李小華，信箱 lee@example.com", "四十八歲", "滿意度兩分", "客服回應太慢，等了三天", "不用聯絡我", "結束"],
+    "clarification": ["我叫陳大文", "信箱是 chen-at-example，滿意度九分", "信箱 chen@example.com，滿意度五分", "我二十五歲",
+                      "可以聯絡我", "結束"],
+}
+
+# 模擬 LLM 的提取結果 (依使用者輸入)
+EXTRACTION_SCRIPT = {
+    "我叫王小明": {"name": "王小明"},
+    "信箱 wang@example.com": {"email": "wang@example.com"},
+    "我三十歲": {"age_group": "25-34"},
+    "滿意度四分": {"product_satisfaction": 4},
+    "沒什麼意見，可以聯絡我": {"feedback_comments": "沒什麼意見", "allow_follow_up": "是"},
+    "我是李小華，信箱 lee@example.com": {"name": "李小華", "email": "lee@example.com"},
+    "四十八歲": {"age_group": "45-54"},
+    "滿意度兩分": {"product_satisfaction": 2},
+    "客服回應太慢，等了三天": {"detailed_dissatisfaction_reason": "客服回應太慢"},
+    "不用聯絡我": {"allow_follow_up": "否"},
+    "我叫陳大文": {"name": "陳大文"},
+    "信箱是 chen-at-example，滿意度九分": {"email": "chen-at-example", "product_satisfaction": "9"},
+    "信箱 chen@example.com，滿意度五分": {"email": "chen@example.com", "product_satisfaction": 5},
+    "我二十五歲": {"age_group": "25-34"},
+    "可以聯絡我": {"allow_follow_up": "是"},
+}
+
+# 與基準比較時的指標：(路徑, 越低越好)
+REGRESSION_METRICS = [
+    (("turn_latency_ms", "p50"), True),
+    (("turn_latency_ms", "p95"), True),
+    (("turn_latency_ms", "p99"), True),
+    (("llm_calls_per_completed",), True),
+    (("tokens_per_session", "total"), True),
+    (("completion_rate",), False),
+    (("saves", "rows_per_s"), False),
+]
+
+
+def percentile(values, pct):
+    """
+    最近秩 (nearest-rank) 百分位數；benchmarks.py 也使用這個函式，兩邊報告的 p95 一致。
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def _build_llm_backend(backend, responder, latency, jitter, error_rate, seed, max_retries):
+    """
+    返回 (OpenAIClientManager, 請求計數函式, 關閉函式)。
+    """
+    from fake_backends import FakeOpenAIClient, StubOpenAIServer
+    from openai_client_manager import OpenAIClientManager
+
+    if backend == "stub":
+        server = StubOpenAIServer(responder, latency=latency, jitter=jitter, error_rate=error_rate, seed=seed).start()
+        manager = OpenAIClientManager(api_key="sk-load-test", base_url=server.base_url, requests_per_minute=None,
+                                      tokens_per_minute=None, max_retries=max_retries, base_backoff=0.05, max_backoff=1.0)
+        return manager, lambda: server.request_count, server.close
+    if backend == "inprocess":
+        sync_client = FakeOpenAIClient(responder, latency=latency, jitter=jitter, error_rate=error_rate, seed=seed)
+        async_client = FakeOpenAIClient(responder, latency=latency, jitter=jitter, error_rate=error_rate, seed=seed, is_async=True)
+        manager = OpenAIClientManager(client=sync_client, async_client=async_client, requests_per_minute=None,
+                                      tokens_per_minute=None, max_concurrency=10000, max_retries=max_retries,
+                                      base_backoff=0.05, max_backoff=1.0)
+        return manager, lambda: sync_client.calls + async_client.calls, lambda: None
+    raise ValueError(f"未知的 LLM 後端 '{backend}'，可用: stub, inprocess")
+
+
+def run_load_test(respondents=100, concurrency=20, backend="stub", llm_latency=0.05, llm_jitter=0.01, llm_error_rate=0.0,
+                  sheets_latency=0.05, think_time=0.0, response_cache=True, max_retries=3, seed=0):
+    """
+    執行一次負載測試並返回可序列化為 JSON 的結果。
+    think_time: 填答者每回合之間的平均思考時間 (秒)。
+    """
+    from ai_agents import QuestionnaireAgent, TURN_PIPELINE_STATS
+    from ai_nlu_layer import AINLULayer
+    from fake_backends import FakeGspreadClient, ScriptedResponder
+    from metrics import METRICS
+    from questionnaire_data import GOOGLE_SHEET_HEADERS
+    from response_cache import ResponseCache
+    from result_stores import SheetsResultStore
+    from session_engine import SessionEngine
+    from sheet_submission_queue import SheetSubmissionQueue
+
+    config = {
+        "respondents": respondents, "concurrency": concurrency, "backend": backend, "llm_latency": llm_latency,
+        "llm_jitter": llm_jitter, "llm_error_rate": llm_error_rate, "sheets_latency": sheets_latency,
+        "think_time": think_time, "response_cache": response_cache, "max_retries": max_retries, "seed": seed,
+    }
+    rng = random.Random(seed)
+    personas = [rng.choice(sorted(RESPONDENT_SCRIPTS)) for _ in range(respondents)]
+    manager, llm_request_count, close_llm = _build_llm_backend(
+        backend, ScriptedResponder(EXTRACTION_SCRIPT), llm_latency, llm_jitter, llm_error_rate, seed, max_retries)
+
+    tmp_dir = tempfile.mkdtemp(prefix="load_test_")
+    sheets_client = FakeGspreadClient(latency=sheets_latency)
+    queue = SheetSubmissionQueue(lambda: sheets_client, "load-test-sheet", "工作表1", GOOGLE_SHEET_HEADERS,
+                                 spool_path=os.path.join(tmp_dir, "spool.jsonl"), max_batch_size=50, max_batch_age=0.2,
+                                 base_backoff=0.1, fsync=False)
+    store = SheetsResultStore(queue)
+    nlu = AINLULayer(client_manager=manager, response_cache=ResponseCache() if response_cache else None)
+    engine = SessionEngine(nlu_agent=nlu, agent_factory=lambda nlu_agent: QuestionnaireAgent(nlu_agent=nlu_agent, result_store=store))
+    TURN_PIPELINE_STATS.__init__()
+    METRICS.reset()
+
+    turn_latencies = []
+    start_latencies = []
+    session_tokens = []
+    completed = 0
+    failed_sessions = 0
+    errors = []
+
+    async def respondent(index, persona):
+        nonlocal completed, failed_sessions
+        session_id = f"load-{index}"
+        try:
+            start = time.perf_counter()
+            await engine.start_session(session_id)
+            start_latencies.append((time.perf_counter() - start) * 1000)
+            agent = engine._sessions[session_id].agent
+            for text in RESPONDENT_SCRIPTS[persona]:
+                if think_time:
+                    await asyncio.sleep(rng.uniform(0, 2 * think_time))
+                start = time.perf_counter()
+                await engine.turn(session_id, text)
+                turn_latencies.append((time.perf_counter() - start) * 1000)
+                if agent.finished:
+                    break
+            if agent.finished:
+                completed += 1
+            else:
+                failed_sessions += 1
+                engine.end_session(session_id)
+            usage = agent.session_token_usage
+            session_tokens.append(usage["prompt_tokens"] + usage["completion_tokens"])
+        except Exception as e:
+            failed_sessions += 1
+            errors.append(f"{type(e).__name__}: {e}")
+
+    async def run_all():
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def bounded(index, persona):
+            async with semaphore:
+                await respondent(index, persona)
+        await asyncio.gather(*[bounded(i, persona) for i, persona in enumerate(personas)])
+
+    wall_start = time.perf_counter()
+    try:
+        asyncio.run(run_all())
+        turns_done = time.perf_counter()
+        queue.flush(timeout=60.0)
+        drained = time.perf_counter()
+    finally:
+        queue.close()
+        close_llm()
+
+    worksheet = sheets_client.open_by_key("load-test-sheet").worksheet("工作表1")
+    rows_written = max(0, len(worksheet.rows) - 1) # 第一行為標題
+    llm_calls = llm_request_count()
+    manager_stats = manager.summary()
+    wall = drained - wall_start
+    histograms = METRICS.to_dict()["histograms"]
+    stage_latency = {key[len("stage_seconds{stage="):-1]: value for key, value in histograms.items()
+                     if key.startswith("stage_seconds{")}
+    result = {
+        "config": config,
+        "wall_s": round(wall, 3),
+        "sessions": {"started": respondents, "completed": completed, "failed": failed_sessions},
+        "completion_rate": round(completed / respondents, 4) if respondents else 0.0,
+        "turns": len(turn_latencies),
+        "turns_per_s": round(len(turn_latencies) / (turns_done - wall_start), 1),
+        "turn_latency_ms": {
+            "p50": round(percentile(turn_latencies, 50), 2),
+            "p95": round(percentile(turn_latencies, 95), 2),
+            "p99": round(percentile(turn_latencies, 99), 2),
+            "max": round(max(turn_latencies, default=0.0), 2),
+            "mean": round(statistics.fmean(turn_latencies), 2) if turn_latencies else 0.0,
+        },
+        "start_latency_ms": {
+            "p50": round(percentile(start_latencies, 50), 2),
+            "p95": round(percentile(start_latencies, 95), 2),
+        },
+        "llm_calls": llm_calls,
+        "llm_calls_per_completed": round(llm_calls / completed, 2) if completed else None,
+        "llm_retries": manager_stats.get("retries", 0),
+        "tokens_per_session": {
+            "total": round(statistics.fmean(session_tokens), 1) if session_tokens else 0.0,
+            "p95": percentile(session_tokens, 95),
+        },
+        "saves": {
+            "enqueued": queue.stats["enqueued"],
+            "written": rows_written,
+            "batches": queue.stats["batches"],
+            "rows_per_s": round(rows_written / wall, 1) if wall > 0 else 0.0,
+            "drain_after_last_turn_s": round(drained - turns_done, 3),
+        },
+        "stage_latency_ms": stage_latency,
+        "turn_pipeline": TURN_PIPELINE_STATS.summary(),
+        "errors": errors[:10],
+    }
+    return result
+
+
+def compare_with_baseline(result, baseline, max_regression=0.2):
+    """
+    返回退步的指標說明 (空 list 表示沒有退步)。越低越好的指標超過基準 (1 + max_regression) 倍、
+    越高越好的指標低於基準 (1 - max_regression) 倍時視為退步。
+    """
+    regressions = []
+    for path, lower_is_better in REGRESSION_METRICS:
+        current, reference = result, baseline
+        for key in path:
+            current = current.get(key) if isinstance(current, dict) else None
+            reference = reference.get(key) if isinstance(reference, dict) else None
+        if current is None or reference is None or reference == 0:
+            continue
+        name = ".".join(path)
+        if lower_is_better and current > reference * (1 + max_regression):
+            regressions.append(f"{name}: {reference} -> {current} (+{(current / reference - 1) * 100:.1f}%)")
+        elif not lower_is_better and current < reference * (1 - max_regression):
+            regressions.append(f"{name}: {reference} -> {current} ({(current / reference - 1) * 100:.1f}%)")
+    return regressions
+
+
+def print_report(result):
+    lat = result["turn_latency_ms"]
+    print(f"會話 {result['sessions']['completed']}/{result['sessions']['started']} 完成 | 回合 {result['turns']} "
+          f"({result['turns_per_s']} 回合/秒) | 總時間 {result['wall_s']} s")
+    print(f"每回合延遲 p50 {lat['p50']} ms | p95 {lat['p95']} ms | p99 {lat['p99']} ms | max {lat['max']} ms")
+    print(f"每份完成問卷 LLM 呼叫 {result['llm_calls_per_completed']} 次 (重試 {result['llm_retries']} 次) | "
+          f"每會話 {result['tokens_per_session']['total']} tokens")
+    if result["stage_latency_ms"]:
+        print("各階段 p95: " + " | ".join(f"{stage} {value['p95_ms']} ms"
+                                           for stage, value in sorted(result["stage_latency_ms"].items())))
+    saves = result["saves"]
+    print(f"儲存 {saves['written']}/{saves['enqueued']} 筆 ({saves['batches']} 批, {saves['rows_per_s']} 筆/秒) | "
+          f"最後一回合後 {saves['drain_after_last_turn_s']} s 寫完")
+    if result["errors"]:
+        print(f"錯誤: {result['errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="問卷 AI Agent 負載測試 (模擬 LLM 與 Google Sheets)")
+    parser.add_argument("--respondents", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--backend", choices=["stub", "inprocess"], default="stub",
+                        help="stub: 本地 HTTP stub + 真實 openai 客戶端；inprocess: 程序內假客戶端")
+    parser.add_argument("--llm-latency", type=float, default=0.05)
+    parser.add_argument("--llm-jitter", type=float, default=0.01)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--sheets-latency", type=float, default=0.05)
+    parser.add_argument("--think-time", type=float, default=0.0)
+    parser.add_argument("--no-response-cache", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", default=None, help="將結果寫入 JSON 檔")
+    parser.add_argument("--baseline", default=None, help="與基準 JSON 比較，退步時以狀態碼 1 結束")
+    parser.add_argument("--max-regression", type=float, default=0.2)
+    args = parser.parse_args()
+
+    result = run_load_test(args.respondents, args.concurrency, args.backend, args.llm_latency, args.llm_jitter,
+                           args.llm_error_rate, args.sheets_latency, args.think_time, not args.no_response_cache,
+                           seed=args.seed)
+    print_report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"結果已寫入 {args.json}")
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(result, baseline, args.max_regression)
+        if regressions:
+            print("⚠️ 與基準相比有退步：")
+            for line in regressions:
+                print(f"  - {line}")
+            sys.exit(1)
+        print("與基準相比沒有超過容許範圍的退步。")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,57 @@
-from ai_agents import QuestionnaireAgent
+import asyncio
+
+from session_engine import SessionEngine
+
+class _StreamPrinter:
+    """
+    將回覆逐塊印到終端機，第一塊到達時才印出 "AI: " 前綴。
+    """
+    def __init__(self):
+        self.started = False
+
+    def __call__(self, piece):
+        if not self.started:
+            print("\nAI: ", end="", flush=True)
+            self.started = True
+        print(piece, end="", flush=True)
+
+    def finish(self):
+        if self.started:
+            print()
+        print("-" * 30)
+
+async def run_cli(engine, stream=True):
+    """
+    終端機前端：只是 SessionEngine 的其中一種轉接層。stream=True 時回覆邊生成邊顯示。
+    """
+    print("--- 正在啟動智能問卷助手... ---")
+    printer = _StreamPrinter() if stream else None
+    try:
+        # 每次執行都是新的會話 (隨機 session ID)，不會與先前的作答混在一起
+        session_id, greeting = await engine.start_session(on_chunk=printer)
+    except (RuntimeError, ValueError) as e:
+        print(e)
+        return
+    if printer is not None:
+        printer.finish()
+    else:
+        print(f"\nAI: {greeting}")
+        print("-" * 30)
+
+    loop = asyncio.get_running_loop()
+    while engine.is_active(session_id):
+        user_raw_input = await loop.run_in_executor(None, input, "您: ")
+        printer = _StreamPrinter() if stream else None
+        reply = await engine.turn(session_id, user_raw_input, on_chunk=printer)
+        if printer is not None:
+            printer.finish()
+        else:
+            print(f"\nAI: {reply}")
+            print("-" * 30)
+    print("\n--- 問卷已完成或提前結束 ---")
 
 def main():
-    agent = QuestionnaireAgent()
-    agent.start_questionnaire()
+    asyncio.run(run_cli(SessionEngine()))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,346 @@
+# metrics.py
+
+"""
+每回合的階段計時 (span)、LLM token/費用計數與快取命中率，可輸出為 Prometheus 文字格式或 JSON。
+
+一個回合分為以下階段，各自記錄在 questionnaire_stage_seconds{stage=...} 直方圖中：
+    rule_extraction   本地規則提取
+    llm_extraction    等待 LLM 提取答案
+    validation        驗證提取結果並更新答案/條件
+    prompt_generation 生成下一步提示或澄清提示
+    persistence       將答案交給結果儲存後端
+QuestionnaireAgent 在每回合結束後把各階段耗時放在 last_turn_trace，超過 slow_turn_threshold 的回合會印出分解。
+
+停用時 (環境變數 QUESTIONNAIRE_METRICS=0 或 METRICS.enabled = False) span() 返回共用的空物件，
+計數函式直接返回，熱路徑上只多一次屬性檢查。
+"""
+
+import bisect
+import contextvars
+import json
+import os
+import threading
+import time
+
+PREFIX = "questionnaire_"
+
+# 秒數直方圖的上界 (與 Prometheus 客戶端的預設值相近，補上 LLM 常見的數秒區間)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# 每百萬 token 的美元價格：(輸入, 已快取的輸入, 輸出)。未列出的模型只計 token，不計費用。
+MODEL_PRICES = {
+    "gpt-3.5-turbo": (0.50, 0.50, 1.50),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4.1": (2.00, 0.50, 8.00),
+}
+
+METRIC_HELP = {
+    "stage_seconds": "每回合各階段的耗時",
+    "turn_seconds": "整個回合的耗時",
+    "turns_total": "處理的回合數",
+    "llm_request_seconds": "單次 LLM 請求的耗時 (含排隊與重試)",
+    "llm_errors_total": "LLM 請求失敗次數 (已改用預設文字或返回錯誤)",
+    "llm_tokens_total": "OpenAI usage 欄位回報的 token 數",
+    "llm_cost_usd_total": "依 MODEL_PRICES 估算的 LLM 費用 (美元)",
+    "prompt_cache_requests_total": "歡迎語/下一步提示/答案提取快取的查詢次數",
+    "prompt_cache_hit_ratio": "歡迎語/下一步提示/答案提取快取的命中率",
+    "extraction_cache_bypassed_total": "不使用提取快取的輸入數 (過長或在修改答案)",
+    "extraction_cache_saved_seconds_total": "提取快取命中省下的 LLM 耗時 (命中項目當初呼叫 LLM 的耗時)",
+    "llm_escalations_total": "答案提取由小模型升級到大模型的次數",
+    "duplicate_submissions_total": "因提交 id 重複而略過的結果筆數",
+    "sheets_write_seconds": "Google Sheets 批次寫入的耗時",
+    "sheets_rows_written_total": "寫入 Google Sheets 的筆數",
+    "sheets_write_errors_total": "Google Sheets 批次寫入失敗次數 (之後會重試)",
+    "checkpoint_seconds": "會話快照寫入的耗時",
+}
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+def price_for(model):
+    """
+    返回模型的 (輸入, 已快取的輸入, 輸出) 價格；回應中帶日期的模型名稱 (例如 gpt-4o-mini-2024-07-18) 以最長前綴比對。
+    """
+    if not model:
+        return None
+    if model in MODEL_PRICES:
+        return MODEL_PRICES[model]
+    matches = [name for name in MODEL_PRICES if model.startswith(name + "-")]
+    return MODEL_PRICES[max(matches, key=len)] if matches else None
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+class _Span:
+    __slots__ = ("metrics", "key", "stage", "start")
+
+    def __init__(self, metrics, key, stage=None):
+        self.metrics = metrics
+        self.key = key
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        self.metrics._observe(self.key, elapsed)
+        if self.stage is not None:
+            trace = _current_trace.get()
+            if trace is not None:
+                trace[self.stage] = trace.get(self.stage, 0.0) + elapsed
+        return False
+
+
+class _Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, size):
+        self.counts = [0] * (size + 1) # 最後一格為超過所有上界的樣本
+        self.sum = 0.0
+        self.count = 0
+
+
+class Metrics:
+    def __init__(self, enabled=True, buckets=DEFAULT_BUCKETS, slow_turn_threshold=None):
+        """
+        slow_turn_threshold: 回合耗時超過這個秒數時印出各階段分解；None 表示不印出。
+        """
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+        self.slow_turn_threshold = slow_turn_threshold
+        self._lock = threading.Lock()
+        self._counters = {} # (name, labels) -> value
+        self._histograms = {} # (name, labels) -> _Histogram
+        self._stage_keys = {} # stage -> 預先算好的直方圖鍵
+
+    # ---- 記錄 ----
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        self._observe(_key(name, labels), seconds)
+
+    def _observe(self, key, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = _Histogram(len(self.buckets))
+            histogram.counts[index] += 1
+            histogram.sum += seconds
+            histogram.count += 1
+
+    def span(self, stage):
+        """
+        回合階段的計時：with METRICS.span("validation"): ...
+        """
+        if not self.enabled:
+            return _NOOP_SPAN
+        key = self._stage_keys.get(stage)
+        if key is None:
+            key = self._stage_keys[stage] = _key("stage_seconds", {"stage": stage})
+        return _Span(self, key, stage)
+
+    def timer(self, name, **labels):
+        """
+        不屬於回合階段的計時 (例如單次 LLM 請求、背景的 Sheets 寫入)。
+        """
+        if not self.enabled:
+            return _NOOP_SPAN
+        return _Span(self, _key(name, labels))
+
+    def record_llm_usage(self, model, kind, prompt_tokens, completion_tokens, cached_tokens=0):
+        if not self.enabled:
+            return
+        self.inc("llm_tokens_total", prompt_tokens - cached_tokens, kind=kind, type="prompt")
+        self.inc("llm_tokens_total", cached_tokens, kind=kind, type="cached_prompt")
+        self.inc("llm_tokens_total", completion_tokens, kind=kind, type="completion")
+        prices = price_for(model)
+        if prices is not None:
+            cost = ((prompt_tokens - cached_tokens) * prices[0] + cached_tokens * prices[1]
+                    + completion_tokens * prices[2]) / 1_000_000
+            self.inc("llm_cost_usd_total", cost, model=model, kind=kind)
+
+    # ---- 每回合的追蹤 ----
+
+    def begin_turn(self):
+        """
+        開始記錄一個回合的各階段耗時，返回交給 end_turn 的 token；停用時返回 None。
+        回合內另開的 asyncio task 會繼承同一個追蹤 (contextvars)。
+        """
+        if not self.enabled:
+            return None
+        return (_current_trace.set({}), time.perf_counter())
+
+    def end_turn(self, token):
+        """
+        結束回合追蹤，返回 {階段: 毫秒, "total": 毫秒}；停用時返回 None。
+        """
+        if token is None:
+            return None
+        context_token, start = token
+        trace = _current_trace.get()
+        _current_trace.reset(context_token)
+        total = time.perf_counter() - start
+        self.observe("turn_seconds", total)
+        self.inc("turns_total")
+        result = {stage: round(seconds * 1000, 3) for stage, seconds in trace.items()}
+        result["total"] = round(total * 1000, 3)
+        if self.slow_turn_threshold is not None and total >= self.slow_turn_threshold:
+            breakdown = ", ".join(f"{stage} {ms:.0f} ms" for stage, ms in result.items() if stage != "total")
+            print(f"慢回合: {result['total']:.0f} ms | {breakdown or '無階段記錄'}")
+        return result
+
+    # ---- 輸出 ----
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def export_state(self):
+        """
+        返回可 pickle 的原始計數與直方圖，供 merge_state() 彙總其他程序 (worker_pool) 的指標。
+        """
+        return self._snapshot()
+
+    def merge_state(self, state):
+        counters, histograms = state
+        with self._lock:
+            for key, value in counters.items():
+                self._counters[key] = self._counters.get(key, 0) + value
+            for key, (counts, total, count) in histograms.items():
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = _Histogram(len(self.buckets))
+                histogram.counts = [a + b for a, b in zip(histogram.counts, counts)]
+                histogram.sum += total
+                histogram.count += count
+
+    def _snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(h.counts), h.sum, h.count) for key, h in self._histograms.items()}
+        return counters, histograms
+
+    @staticmethod
+    def _cache_ratios(counters):
+        # 由 prompt_cache_requests_total 計算各快取的命中率
+        totals = {}
+        for (name, labels), value in counters.items():
+            if name != "prompt_cache_requests_total":
+                continue
+            label_map = dict(labels)
+            hits, total = totals.get(label_map["cache"], (0, 0))
+            totals[label_map["cache"]] = (hits + (value if label_map["result"] == "hit" else 0), total + value)
+        return {cache: round(hits / total, 4) if total else 0.0 for cache, (hits, total) in totals.items()}
+
+    def _quantile(self, counts, count, q):
+        # 以直方圖估算分位數 (返回所在區間的上界)
+        target = q * count
+        seen = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            seen += bucket_count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+    def to_dict(self):
+        """
+        JSON 友善的輸出：計數器、直方圖的次數/平均/p50/p95 (毫秒)，以及快取命中率。
+        """
+        counters, histograms = self._snapshot()
+
+        def label_key(name, labels):
+            return name + ("{" + ",".join(f"{k}={v}" for k, v in labels) + "}" if labels else "")
+
+        result = {"enabled": self.enabled, "counters": {}, "histograms": {}}
+        for (name, labels), value in sorted(counters.items()):
+            result["counters"][label_key(name, labels)] = round(value, 6) if isinstance(value, float) else value
+        for (name, labels), (counts, total, count) in sorted(histograms.items()):
+            result["histograms"][label_key(name, labels)] = {
+                "count": count,
+                "avg_ms": round(total / count * 1000, 3) if count else 0.0,
+                "p50_ms": round(self._quantile(counts, count, 0.5) * 1000, 3),
+                "p95_ms": round(self._quantile(counts, count, 0.95) * 1000, 3),
+            }
+        result["prompt_cache_hit_ratio"] = self._cache_ratios(counters)
+        return result
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), ensure_ascii=False)
+
+    def render_prometheus(self):
+        """
+        Prometheus 文字格式 (text/plain; version=0.0.4)。
+        """
+        counters, histograms = self._snapshot()
+
+        def fmt_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{str(v)}"' for k, v in pairs) + "}"
+
+        lines = []
+        described = set()
+
+        def describe(name, metric_type):
+            if name in described:
+                return
+            described.add(name)
+            lines.append(f"# HELP {PREFIX}{name} {METRIC_HELP.get(name, name)}")
+            lines.append(f"# TYPE {PREFIX}{name} {metric_type}")
+
+        for (name, labels), value in sorted(counters.items()):
+            describe(name, "counter")
+            lines.append(f"{PREFIX}{name}{fmt_labels(labels)} {value:.10g}")
+        for (name, labels), (counts, total, count) in sorted(histograms.items()):
+            describe(name, "histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{PREFIX}{name}_bucket{fmt_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{PREFIX}{name}_bucket{fmt_labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{PREFIX}{name}_sum{fmt_labels(labels)} {total:.10g}")
+            lines.append(f"{PREFIX}{name}_count{fmt_labels(labels)} {count}")
+        for cache, ratio in sorted(self._cache_ratios(counters).items()):
+            describe("prompt_cache_hit_ratio", "gauge")
+            lines.append(f'{PREFIX}prompt_cache_hit_ratio{{cache="{cache}"}} {ratio}')
+        return "\n".join(lines) + "\n"
+
+
+def _slow_turn_threshold_from_env():
+    value = os.getenv("QUESTIONNAIRE_SLOW_TURN_MS")
+    return float(value) / 1000 if value else None
+
+
+# 程序共用的指標；所有模組都記錄到這裡
+METRICS = Metrics(enabled=os.getenv("QUESTIONNAIRE_METRICS", "1") not in ("0", "false", "off"),
+                  slow_turn_threshold=_slow_turn_threshold_from_env())
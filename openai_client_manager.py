@@ -0,0 +1,452 @@
+# openai_client_manager.py
+
+"""
+程序共用的 OpenAI 客戶端管理器。
+
+- 所有 AINLULayer 共用同一組 OpenAI / AsyncOpenAI 客戶端與其 HTTP keep-alive 連線池
+- 以令牌桶同時限制每分鐘請求數 (RPM) 與每分鐘 token 數 (TPM)，送出前先等待額度，而不是撞上 429
+- 可重試的錯誤 (429、5xx、連線逾時) 以帶隨機抖動的指數退避重試；收到 429 時整個管理器一起暫停
+- 非同步請求依優先級排隊：使用者正在等待的答案提取優先於歡迎語、提示語等生成
+"""
+
+import asyncio
+import heapq
+import itertools
+import random
+import threading
+import time
+import weakref
+
+# 數字越小越優先
+PRIORITY_EXTRACTION = 0
+PRIORITY_CLARIFICATION = 1
+PRIORITY_NEXT_PROMPT = 2
+PRIORITY_GREETING = 3
+PRIORITY_SUMMARY = 4
+
+KIND_PRIORITIES = {
+    "extraction": PRIORITY_EXTRACTION,
+    "clarification": PRIORITY_CLARIFICATION,
+    "next_prompt": PRIORITY_NEXT_PROMPT,
+    "greeting": PRIORITY_GREETING,
+    "summary": PRIORITY_SUMMARY,
+}
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+def _status_code(error):
+    code = getattr(error, "status_code", None)
+    if code is None:
+        code = getattr(error, "code", None)
+    return code if isinstance(code, int) else None
+
+
+def is_retryable_error(error):
+    if _status_code(error) in RETRYABLE_STATUS_CODES:
+        return True
+    try:
+        import openai
+        return isinstance(error, (openai.APIConnectionError, openai.APITimeoutError))
+    except ImportError:
+        return False
+
+
+def _retry_after(error):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def estimate_request_tokens(request):
+    """
+    粗略估算一次請求會消耗的 token 數 (輸入 + 預期輸出)，供 TPM 限流預先扣除；實際用量在回應後校正。
+    """
+    chars = sum(len(str(m.get("content", ""))) for m in request.get("messages", ()))
+    return chars // 2 + (request.get("max_tokens") or 256)
+
+
+class TokenBucket:
+    """
+    執行緒安全的令牌桶：每分鐘補充 rate_per_minute 個令牌，最多累積 capacity 個。
+    reserve() 立即扣除並返回需要等待的秒數 (餘額可以為負，之後的請求依序往後排)。
+    """
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def delay(self, amount):
+        """
+        不扣除令牌，只返回取得 amount 個令牌所需等待的秒數。
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            deficit = min(amount, self.capacity) - self._tokens
+            return max(0.0, deficit / self.rate)
+
+    def consume(self, amount):
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens -= amount
+
+    def reserve(self, amount):
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens -= amount
+            return max(0.0, -self._tokens / self.rate)
+
+    def refund(self, amount):
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + amount)
+
+
+class RateLimiter:
+    """
+    RPM 與 TPM 兩個令牌桶；pause() 在收到 429 時讓所有請求暫停一段時間。
+    burst_seconds: 最多可瞬間使用多少秒份的額度。供應商實際上以較短的時間窗口執行每分鐘限制，
+                   一次用掉整分鐘的額度仍可能觸發 429。
+    """
+    def __init__(self, requests_per_minute=500, tokens_per_minute=200000, burst_seconds=10.0):
+        self.requests = TokenBucket(requests_per_minute, requests_per_minute / 60.0 * burst_seconds) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute / 60.0 * burst_seconds) if tokens_per_minute else None
+        self._paused_until = 0.0
+
+    def delay(self, tokens):
+        delays = [self._paused_until - time.monotonic()]
+        if self.requests:
+            delays.append(self.requests.delay(1))
+        if self.tokens:
+            delays.append(self.tokens.delay(tokens))
+        return max(0.0, *delays)
+
+    def consume(self, tokens):
+        if self.requests:
+            self.requests.consume(1)
+        if self.tokens:
+            self.tokens.consume(tokens)
+
+    def reserve(self, tokens):
+        delays = [self._paused_until - time.monotonic()]
+        if self.requests:
+            delays.append(self.requests.reserve(1))
+        if self.tokens:
+            delays.append(self.tokens.reserve(tokens))
+        return max(0.0, *delays)
+
+    def adjust_tokens(self, estimated, actual):
+        # 以實際用量校正預先扣除的估計值
+        if self.tokens and actual is not None:
+            if actual > estimated:
+                self.tokens.consume(actual - estimated)
+            else:
+                self.tokens.refund(estimated - actual)
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class _PriorityScheduler:
+    """
+    單一事件迴圈內的優先級排程：同時執行的請求數不超過 max_concurrency，
+    並且只有排在最前面 (優先級最高、最早到達) 的請求可以取得限流額度。
+    """
+    def __init__(self, max_concurrency, limiter):
+        self.max_concurrency = max_concurrency
+        self.limiter = limiter
+        self._heap = []
+        self._seq = itertools.count()
+        self._active = 0
+        self._cond = asyncio.Condition()
+        self.max_queue_depth = 0
+
+    async def acquire(self, priority, tokens):
+        entry = (priority, next(self._seq))
+        async with self._cond:
+            heapq.heappush(self._heap, entry)
+            self.max_queue_depth = max(self.max_queue_depth, len(self._heap))
+            try:
+                while True:
+                    if self._heap[0] == entry and self._active < self.max_concurrency:
+                        delay = self.limiter.delay(tokens)
+                        if delay <= 0:
+                            break
+                        # 等待額度恢復；期間若有更高優先級的請求加入會被喚醒重新判斷
+                        try:
+                            await asyncio.wait_for(self._cond.wait(), delay)
+                        except asyncio.TimeoutError:
+                            pass
+                    else:
+                        await self._cond.wait()
+                heapq.heappop(self._heap)
+                self._active += 1
+                self.limiter.consume(tokens)
+            except BaseException:
+                if entry in self._heap:
+                    self._heap.remove(entry)
+                    heapq.heapify(self._heap)
+                raise
+            finally:
+                self._cond.notify_all()
+
+    async def release(self):
+        async with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+
+class OpenAIClientManager:
+    def __init__(self, api_key=None, base_url=None, client=None, async_client=None,
+                 requests_per_minute=500, tokens_per_minute=200000, burst_seconds=10.0, max_concurrency=64,
+                 max_connections=100, max_keepalive_connections=20, timeout=30.0,
+                 max_retries=4, base_backoff=0.5, max_backoff=20.0):
+        """
+        client / async_client: 直接注入客戶端 (例如 fake_backends.FakeOpenAIClient)；未提供時建立共用連線池的 OpenAI 客戶端。
+        base_url: 可指向本地 stub 伺服器 (fake_backends.StubOpenAIServer) 進行測試。
+        """
+        if client is None or async_client is None:
+            import openai
+            try:
+                import httpx
+            except ImportError: # 較新的 openai 版本改用 httpx2
+                import httpx2 as httpx
+            limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections)
+            # SDK 內建的重試關閉，改由管理器統一處理，避免重試次數相乘
+            if client is None:
+                client = openai.OpenAI(api_key=api_key, base_url=base_url, max_retries=0, timeout=timeout,
+                                       http_client=openai.DefaultHttpxClient(limits=limits, timeout=timeout))
+            if async_client is None:
+                async_client = openai.AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0, timeout=timeout,
+                                                  http_client=openai.DefaultAsyncHttpxClient(limits=limits, timeout=timeout))
+        self.client = client
+        self.async_client = async_client
+        self.limiter = RateLimiter(requests_per_minute, tokens_per_minute, burst_seconds)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self._random = random.Random()
+        self._schedulers = weakref.WeakKeyDictionary() # 每個事件迴圈各自的排程器
+        self._sync_semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._stats_lock = threading.Lock()
+        self.stats = {"requests": 0, "retries": 0, "rate_limited": 0, "failures": 0, "queue_wait_s": 0.0}
+
+    def _scheduler(self):
+        loop = asyncio.get_running_loop()
+        scheduler = self._schedulers.get(loop)
+        if scheduler is None:
+            scheduler = self._schedulers[loop] = _PriorityScheduler(self.max_concurrency, self.limiter)
+        return scheduler
+
+    def _count(self, key, amount=1):
+        with self._stats_lock:
+            self.stats[key] += amount
+
+    def _backoff(self, attempt, error):
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            return min(self.max_backoff, retry_after)
+        # full jitter：避免大量會話同時重試造成新一波 429
+        return self._random.uniform(0, min(self.max_backoff, self.base_backoff * (2 ** attempt)))
+
+    def _on_error(self, attempt, error):
+        """
+        返回重試前需要等待的秒數；不應重試時返回 None。
+        """
+        if attempt >= self.max_retries or not is_retryable_error(error):
+            self._count("failures")
+            return None
+        delay = self._backoff(attempt, error)
+        if _status_code(error) == 429:
+            self._count("rate_limited")
+            self.limiter.pause(delay)
+        self._count("retries")
+        return delay
+
+    def _on_response(self, response, estimated_tokens):
+        # 串流時只有最後一個區塊帶有 usage
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            self.limiter.adjust_tokens(estimated_tokens, getattr(usage, "total_tokens", None))
+
+    async def acreate(self, priority=PRIORITY_EXTRACTION, **request):
+        """
+        以指定優先級送出 chat.completions.create 請求，處理限流與重試。
+        """
+        scheduler = self._scheduler()
+        estimated_tokens = estimate_request_tokens(request)
+        attempt = 0
+        while True:
+            queued_at = time.monotonic()
+            await scheduler.acquire(priority, estimated_tokens)
+            self._count("queue_wait_s", time.monotonic() - queued_at)
+            self._count("requests")
+            try:
+                response = await self.async_client.chat.completions.create(**request)
+            except Exception as e:
+                delay = self._on_error(attempt, e)
+                if delay is None:
+                    raise
+            else:
+                self._on_response(response, estimated_tokens)
+                return response
+            finally:
+                await scheduler.release()
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def astream(self, priority=PRIORITY_EXTRACTION, **request):
+        """
+        串流版本的 acreate：逐一 yield 回應區塊。只有在收到第一個區塊前的錯誤會重試，
+        之後的錯誤直接拋出 (已輸出的內容無法收回)。
+        """
+        scheduler = self._scheduler()
+        estimated_tokens = estimate_request_tokens(request)
+        attempt = 0
+        while True:
+            queued_at = time.monotonic()
+            await scheduler.acquire(priority, estimated_tokens)
+            self._count("queue_wait_s", time.monotonic() - queued_at)
+            self._count("requests")
+            try:
+                stream = await self.async_client.chat.completions.create(stream=True, **request)
+            except Exception as e:
+                await scheduler.release()
+                delay = self._on_error(attempt, e)
+                if delay is None:
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            try:
+                async for chunk in stream:
+                    self._on_response(chunk, estimated_tokens)
+                    yield chunk
+            finally:
+                await scheduler.release()
+            return
+
+    def stream(self, priority=PRIORITY_EXTRACTION, **request):
+        """
+        同步串流版本，規則與 astream 相同。
+        """
+        estimated_tokens = estimate_request_tokens(request)
+        attempt = 0
+        while True:
+            queued_at = time.monotonic()
+            with self._sync_semaphore:
+                wait = self.limiter.reserve(estimated_tokens)
+                if wait > 0:
+                    time.sleep(wait)
+                self._count("queue_wait_s", time.monotonic() - queued_at)
+                self._count("requests")
+                try:
+                    stream = self.client.chat.completions.create(stream=True, **request)
+                except Exception as e:
+                    delay = self._on_error(attempt, e)
+                    if delay is None:
+                        raise
+                else:
+                    for chunk in stream:
+                        self._on_response(chunk, estimated_tokens)
+                        yield chunk
+                    return
+            attempt += 1
+            time.sleep(delay)
+
+    def create(self, priority=PRIORITY_EXTRACTION, **request):
+        """
+        同步版本：共用同一組限流額度與重試策略 (同步呼叫不參與優先級排序)。
+        """
+        estimated_tokens = estimate_request_tokens(request)
+        attempt = 0
+        while True:
+            queued_at = time.monotonic()
+            with self._sync_semaphore:
+                wait = self.limiter.reserve(estimated_tokens)
+                if wait > 0:
+                    time.sleep(wait)
+                self._count("queue_wait_s", time.monotonic() - queued_at)
+                self._count("requests")
+                try:
+                    response = self.client.chat.completions.create(**request)
+                except Exception as e:
+                    delay = self._on_error(attempt, e)
+                    if delay is None:
+                        raise
+                else:
+                    self._on_response(response, estimated_tokens)
+                    return response
+            attempt += 1
+            time.sleep(delay)
+
+    def summary(self):
+        with self._stats_lock:
+            summary = dict(self.stats)
+        summary["queue_wait_s"] = round(summary["queue_wait_s"], 3)
+        summary["max_queue_depth"] = max((s.max_queue_depth for s in list(self._schedulers.values())), default=0)
+        return summary
+
+    @staticmethod
+    def combined_summary(managers):
+        """
+        合併多個客戶端管理器的 summary()；計數相加，佇列深度取最大值。
+        """
+        summaries = [manager.summary() for manager in managers]
+        if len(summaries) == 1:
+            return summaries[0]
+        combined = {}
+        for summary in summaries:
+            for key, value in summary.items():
+                combined[key] = max(combined.get(key, 0), value) if key == "max_queue_depth" else combined.get(key, 0) + value
+        combined["queue_wait_s"] = round(combined.get("queue_wait_s", 0.0), 3)
+        return combined
+
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+def get_client_manager(api_key=None, base_url=None, **kwargs):
+    """
+    取得程序共用的客戶端管理器；相同的 (api_key, base_url) 共用同一個連線池與限流額度。
+    """
+    key = (api_key, base_url)
+    with _managers_lock:
+        manager = _managers.get(key)
+        if manager is None:
+            manager = _managers[key] = OpenAIClientManager(api_key=api_key, base_url=base_url, **kwargs)
+        return manager
+
+
+if __name__ == '__main__':
+    # 以本地 stub 伺服器驗證：真實的 AsyncOpenAI 客戶端、連線重用、429 重試與優先級排序
+    from fake_backends import StubOpenAIServer
+
+    async def main():
+        with StubOpenAIServer(latency=0.05, fail_next_with=[429, 429, 503]) as server:
+            manager = OpenAIClientManager(api_key="sk-stub", base_url=server.base_url, requests_per_minute=600,
+                                          max_concurrency=4, base_backoff=0.05)
+            finished = []
+
+            async def call(priority, label):
+                await manager.acreate(priority=priority, model="stub", messages=[{"role": "user", "content": label}])
+                finished.append(label)
+
+            await asyncio.gather(*([call(PRIORITY_GREETING, f"greeting-{i}") for i in range(8)] +
+                                   [call(PRIORITY_EXTRACTION, f"extraction-{i}") for i in range(8)]))
+            print(f"完成順序: {finished}")
+            print(f"管理器統計: {manager.summary()}")
+            print(f"stub 伺服器: {server.request_count} 個請求，{server.connection_count} 條 TCP 連線")
+
+    asyncio.run(main())
@@ -40,7 +40,8 @@ QUESTIONNAIRE_STRUCTURE = [
         "id": "detailed_dissatisfaction_reason", # 條件必填問題
         "question": "很抱歉您對產品不滿意，請問具體原因是什麼？我們希望能改進。",
         "type": "text",
-        "validation_rule": "required_if_triggered", # 修改為條件必填
+        "validation_rule": "required",
+        "show_if": "product_satisfaction in [1, 2]", # 條件必填：滿意度為 1 或 2 時才詢問
         "context": "詢問使用者對產品不滿意的具體原因。",
         "mapping_context": "提取使用者對產品不滿意的具體原因或建議。",
         "priority": 5 
@@ -65,9 +66,27 @@ QUESTIONNAIRE_STRUCTURE = [
 ]
 
 
-# Google Sheet 的列標題，必須與 QUESTIONNAIRE_STRUCTURE 中的 'id' 保持一致且順序正確
-GOOGLE_SHEET_HEADERS = [q["id"] for q in QUESTIONNAIRE_STRUCTURE]
+# 每份提交的識別碼欄位 (互動問卷為 session ID)，放在最後一欄，既有的工作表只需在標題行末端補上此欄
+SUBMISSION_ID_HEADER = "submission_id"
+
+# Google Sheet 的列標題，必須與 QUESTIONNAIRE_STRUCTURE 中的 'id' 保持一致且順序正確，最後是提交識別碼
+GOOGLE_SHEET_HEADERS = [q["id"] for q in QUESTIONNAIRE_STRUCTURE] + [SUBMISSION_ID_HEADER]
 
 # Google Sheet 配置
 GOOGLE_SHEET_ID = "1dloIdYeMpwW7Mqg6LF63MYMbNrl7YSJxFwcYQYB9ryo" # 請替換為你的 Google Sheet ID
 SERVICE_ACCOUNT_FILE = "your_path_to_service_account.json" # 你的服務帳戶金鑰檔案路徑
+
+# 問卷結果儲存後端："sheets" (直接經由背景佇列寫入 Google Sheets)，或本地的 "sqlite" / "csv" / "jsonl"
+RESULT_STORE = "sheets"
+RESULT_STORE_PATH = None # 本地後端的檔案路徑，None 時使用預設檔名 (questionnaire_results.*)
+RESULT_EXPORT_INTERVAL = 300.0 # 本地後端定時批次匯出到 Google Sheets 的間隔 (秒)，None 表示不匯出
+SUBMISSION_INDEX_PATH = "submission_index.db" # 已提交 submission_id 的本地索引 (重試時不重複寫入)，None 表示不去重
+
+# LLM 模型路由：各類呼叫 ("extraction", "greeting", "next_prompt", "clarification", "summary") 使用的模型，
+# 未列出的類型使用 AINLULayer 的預設模型。例如 {"extraction": "gpt-4o-mini", "greeting": "gpt-4o-mini"}
+MODEL_ROUTING = {}
+ESCALATION_MODEL = None # 提取結果 JSON 無效、驗證失敗或信心不足時改用的較強模型，例如 "gpt-4o"；None 表示不升級
+
+# 以嚴格 JSON schema (Structured Outputs) 進行提取：schema 由 QUESTIONNAIRE_STRUCTURE 產生，選項、數字範圍與是/否由 schema 約束。
+# 需要支援 Structured Outputs 的模型 (例如 gpt-4o-mini、gpt-4o)，預設的 gpt-3.5-turbo 不支援
+STRUCTURED_OUTPUT = False
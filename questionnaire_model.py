@@ -0,0 +1,383 @@
+# questionnaire_model.py
+
+"""
+將 questionnaire_data 中的問卷定義在載入時編譯成不可變的索引模型。
+
+- by_id: 問題 id -> 問題 (O(1) 查詢，取代逐一掃描 QUESTIONNAIRE_STRUCTURE)
+- validators: 每一題預先編譯好的驗證函式 (email 正規表達式只編譯一次，選項查詢表只正規化一次)
+- show_if / required_if: 問題定義中的條件運算式，編譯成函式並組成相依 DAG；
+  某題答案變動時只需重新評估 downstream[該題] 中的問題 (已依拓撲順序排列)
+
+條件運算式只允許問題 id、常數、常數列表、比較運算 (==, !=, <, <=, >, >=, in, not in, is, is not)
+以及 and / or / not，例如 "product_satisfaction in [1, 2]"、"age_group == '18-24' and allow_follow_up == '是'"。
+"""
+
+import ast
+import hashlib
+import json
+import operator
+import re
+from types import MappingProxyType
+
+from questionnaire_data import QUESTIONNAIRE_STRUCTURE, SUBMISSION_ID_HEADER
+
+EMAIL_RE = re.compile(r"[^@]+@[^@]+\.[^@]+")
+
+# 數字題的範圍驗證規則：規則名稱 -> (最小值, 最大值)
+RANGE_RULES = {"range_1_5": (1, 5)}
+
+_RANGE_OPTION_RE = re.compile(r"^(\d+)\s*-\s*(\d+)$")
+_OPEN_RANGE_OPTION_RE = re.compile(r"^(\d+)\s*\+$")
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _thaw(value):
+    if isinstance(value, MappingProxyType):
+        return {k: _thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [_thaw(v) for v in value]
+    return value
+
+
+def parse_range_options(options):
+    """
+    將 ["18-24", "55+"] 這類選項解析為 [(18, 24, "18-24"), (55, None, "55+")]；有任一選項不是數字區間時返回空列表。
+    """
+    ranges = []
+    for opt in options:
+        m = _RANGE_OPTION_RE.match(opt.strip())
+        if m:
+            ranges.append((int(m.group(1)), int(m.group(2)), opt))
+            continue
+        m = _OPEN_RANGE_OPTION_RE.match(opt.strip())
+        if m:
+            ranges.append((int(m.group(1)), None, opt))
+            continue
+        return []
+    return ranges
+
+
+_COMPARE_OPS = {
+    ast.Eq: operator.eq, ast.NotEq: operator.ne,
+    ast.Lt: operator.lt, ast.LtE: operator.le, ast.Gt: operator.gt, ast.GtE: operator.ge,
+    ast.In: lambda a, b: a in b, ast.NotIn: lambda a, b: a not in b,
+    ast.Is: operator.is_, ast.IsNot: operator.is_not,
+}
+_ORDERING_OPS = (ast.Lt, ast.LtE, ast.Gt, ast.GtE)
+
+
+class ConditionError(ValueError):
+    pass
+
+
+def _constant_value(node):
+    if isinstance(node, ast.Constant) and isinstance(node.value, (str, int, float, bool, type(None))):
+        return node.value
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub) and isinstance(node.operand, ast.Constant) \
+            and isinstance(node.operand.value, (int, float)):
+        return -node.operand.value
+    raise ConditionError(f"不支援的條件語法: {type(node).__name__}")
+
+
+def _compile_node(node, known_ids, names):
+    if isinstance(node, ast.BoolOp):
+        parts = [_compile_node(v, known_ids, names) for v in node.values]
+        if isinstance(node.op, ast.And):
+            return lambda answers: all(part(answers) for part in parts)
+        return lambda answers: any(part(answers) for part in parts)
+
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        inner = _compile_node(node.operand, known_ids, names)
+        return lambda answers: not inner(answers)
+
+    if isinstance(node, ast.Compare):
+        left = _compile_node(node.left, known_ids, names)
+        comparisons = []
+        for op, comparator in zip(node.ops, node.comparators):
+            if type(op) not in _COMPARE_OPS:
+                raise ConditionError(f"不支援的比較運算: {type(op).__name__}")
+            comparisons.append((_COMPARE_OPS[type(op)], isinstance(op, _ORDERING_OPS), _compile_node(comparator, known_ids, names)))
+
+        def compare(answers):
+            lhs = left(answers)
+            for op_fn, is_ordering, right in comparisons:
+                rhs = right(answers)
+                # 尚未回答 (None) 或型別不符時，大小比較一律視為不成立
+                if is_ordering and (lhs is None or rhs is None):
+                    return False
+                try:
+                    if not op_fn(lhs, rhs):
+                        return False
+                except TypeError:
+                    return False
+                lhs = rhs
+            return True
+        return compare
+
+    if isinstance(node, ast.Name):
+        if node.id not in known_ids:
+            raise ConditionError(f"條件引用了不存在的問題 '{node.id}'。")
+        names.add(node.id)
+        q_id = node.id
+        return lambda answers: answers.get(q_id)
+
+    if isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+        values = frozenset(_constant_value(elt) for elt in node.elts)
+        return lambda answers: values
+
+    value = _constant_value(node)
+    return lambda answers: value
+
+
+class Condition:
+    """
+    編譯後的條件運算式：evaluate(answers) -> bool，depends_on 為運算式引用的問題 id。
+    """
+    __slots__ = ("expression", "evaluate", "depends_on")
+
+    def __init__(self, expression, known_ids):
+        try:
+            tree = ast.parse(expression, mode="eval")
+        except SyntaxError as e:
+            raise ConditionError(f"無法解析條件 '{expression}': {e}") from e
+        names = set()
+        fn = _compile_node(tree.body, known_ids, names)
+        self.expression = expression
+        self.evaluate = lambda answers: bool(fn(answers))
+        self.depends_on = frozenset(names)
+
+    def __repr__(self):
+        return f"Condition({self.expression!r})"
+
+
+def _build_validator(question):
+    """
+    返回 validator(extracted_answer) -> (is_valid, validated_value, error_msg)，只處理非空答案的類型與規則驗證。
+    """
+    q_type = question.get("type")
+    validation_rule = question.get("validation_rule")
+    options = question.get("options", ())
+
+    if q_type == "number":
+        bounds = RANGE_RULES.get(validation_rule)
+
+        def validate_number(extracted_answer):
+            try:
+                num_input = int(extracted_answer)
+                if bounds and not (bounds[0] <= num_input <= bounds[1]):
+                    return False, None, f"您提供的數字不在有效範圍 ({bounds[0]}-{bounds[1]}) 內。"
+                return True, num_input, None
+            except ValueError:
+                return False, None, "無法將您的回答轉換為有效的數字。請確保您的回答包含數字。"
+        return validate_number
+
+    if q_type == "select":
+        option_lookup = {opt.lower(): opt for opt in options}
+        # 嘗試更寬鬆的匹配：如果 extracted_answer 只是數字，且選項是數字區間 (e.g. age_group 37 -> "35-44")
+        bounded_ranges = [(int(m.group(1)), int(m.group(2)), opt) for opt, m in ((opt, _RANGE_OPTION_RE.match(opt.strip())) for opt in options) if m]
+        invalid_msg = f"您選擇的選項不在有效列表中。請從以下選項中選擇一個：{', '.join(options)}。"
+
+        def validate_select(extracted_answer):
+            if isinstance(extracted_answer, str):
+                matched_option = option_lookup.get(extracted_answer.lower())
+                if matched_option:
+                    return True, matched_option, None
+            if isinstance(extracted_answer, (int, str)) and str(extracted_answer).isdigit():
+                number = int(extracted_answer)
+                for low, high, opt in bounded_ranges:
+                    if low <= number <= high:
+                        return True, opt, None
+            return False, None, invalid_msg
+        return validate_select
+
+    if q_type == "boolean":
+        def validate_boolean(extracted_answer):
+            if isinstance(extracted_answer, str):
+                if extracted_answer.lower() in ("是", "yes"):
+                    return True, "是", None
+                elif extracted_answer.lower() in ("否", "no"):
+                    return True, "否", None
+            return False, None, "無法將您的回答解析為 '是' 或 '否'。請嘗試更直接的回答。"
+        return validate_boolean
+
+    if q_type == "text" and validation_rule == "email":
+        def validate_email(extracted_answer):
+            if not EMAIL_RE.match(str(extracted_answer)):
+                return False, None, "您提供的電子郵件格式無效。請輸入一個有效的電子郵件地址。"
+            return True, extracted_answer, None
+        return validate_email
+
+    def validate_any(extracted_answer):
+        return True, extracted_answer, None
+    return validate_any
+
+
+def build_answer_schema(question):
+    """
+    返回該題答案的 JSON schema (供 Structured Outputs 使用)：選項題為選項列舉、是/否題為 '是'/'否' 列舉、
+    數字題為整數 (有範圍規則時加上上下限)，其餘為字串；皆可為 null，表示使用者沒有提及。
+    """
+    q_type = question.get("type")
+    if q_type == "select" and question.get("options"):
+        schema = {"type": ["string", "null"], "enum": list(question["options"]) + [None]}
+    elif q_type == "boolean":
+        schema = {"type": ["string", "null"], "enum": ["是", "否", None]}
+    elif q_type == "number":
+        schema = {"type": ["integer", "null"]}
+        bounds = RANGE_RULES.get(question.get("validation_rule"))
+        if bounds:
+            schema["minimum"], schema["maximum"] = bounds
+    else:
+        schema = {"type": ["string", "null"]}
+    schema["description"] = question.get("mapping_context", question["question"])
+    return schema
+
+
+def structure_version(structure):
+    """
+    問卷結構的內容雜湊 (12 碼)：結構相同的定義得到相同的版本，不必編譯就能比較。
+    """
+    return hashlib.sha1(json.dumps(list(structure), ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+
+
+class CompiledQuestionnaire:
+    """
+    不可變的問卷模型。questions 中的每個問題都是唯讀映射，可當作原本的問題 dict 使用。
+    name 為問卷 id (questionnaire_registry 中的檔名)，result_headers 為結果儲存後端的欄位順序。
+    """
+    __slots__ = ("name", "questions", "by_id", "index", "headers", "result_headers", "version", "validators",
+                 "option_lookup", "range_options", "required_ids", "conditional_ids",
+                 "show_conditions", "required_conditions", "dependents", "downstream",
+                 "initial_hidden", "initial_required", "__weakref__")
+
+    def __init__(self, structure, name="default"):
+        questions = _freeze(list(structure))
+        ids = [q["id"] for q in questions]
+        if len(set(ids)) != len(ids):
+            raise ValueError("問卷定義中有重複的問題 id。")
+
+        self.name = name
+        self.questions = questions
+        self.by_id = MappingProxyType({q["id"]: q for q in questions})
+        self.index = MappingProxyType({q_id: i for i, q_id in enumerate(ids)})
+        self.headers = tuple(ids)
+        self.result_headers = self.headers + (SUBMISSION_ID_HEADER,)
+        self.version = structure_version(structure)
+        self.validators = MappingProxyType({q["id"]: _build_validator(q) for q in questions})
+        self.option_lookup = MappingProxyType({
+            q["id"]: MappingProxyType({opt.lower(): opt for opt in q["options"]})
+            for q in questions if q.get("type") == "select" and q.get("options")
+        })
+        self.range_options = MappingProxyType({
+            q_id: tuple(ranges) for q_id, ranges in (
+                (q["id"], parse_range_options(q["options"])) for q in questions if q.get("type") == "select" and q.get("options"))
+            if ranges
+        })
+        # 無條件必填的問題 (validation_rule == "required" 且沒有 required_if)
+        self.required_ids = frozenset(q["id"] for q in questions if q.get("validation_rule") == "required" and not q.get("required_if"))
+
+        known_ids = frozenset(ids)
+        show_conditions = {}
+        required_conditions = {}
+        for q in questions:
+            if q.get("show_if"):
+                show_conditions[q["id"]] = Condition(q["show_if"], known_ids)
+            if q.get("required_if"):
+                required_conditions[q["id"]] = Condition(q["required_if"], known_ids)
+        self.show_conditions = MappingProxyType(show_conditions)
+        self.required_conditions = MappingProxyType(required_conditions)
+        self.conditional_ids = frozenset(show_conditions) | frozenset(required_conditions)
+
+        # 相依圖：來源問題 -> 條件中引用它的問題
+        dependents = {}
+        for q_id in sorted(self.conditional_ids, key=self.index.get):
+            depends_on = set()
+            for conditions in (show_conditions, required_conditions):
+                if q_id in conditions:
+                    depends_on |= conditions[q_id].depends_on
+            for source_id in depends_on:
+                dependents.setdefault(source_id, []).append(q_id)
+        self.dependents = MappingProxyType({k: tuple(v) for k, v in dependents.items()})
+
+        topo_position = self._topological_positions(ids, dependents)
+        # 某題答案變動時需重新評估的所有下游問題 (遞移閉包)，依拓撲順序排列，
+        # 上游問題被隱藏而清除答案時，其下游會在同一輪中接著被評估
+        downstream = {}
+        for source_id in dependents:
+            reached = set()
+            stack = list(dependents[source_id])
+            while stack:
+                q_id = stack.pop()
+                if q_id not in reached:
+                    reached.add(q_id)
+                    stack.extend(dependents.get(q_id, ()))
+            downstream[source_id] = tuple(sorted(reached, key=topo_position.get))
+        self.downstream = MappingProxyType(downstream)
+
+        # 尚無任何答案時各問題的狀態，只計算一次，每個會話直接複製
+        empty_answers = {q_id: None for q_id in ids}
+        self.initial_hidden = frozenset(q_id for q_id in self.conditional_ids if not self.is_visible(q_id, empty_answers))
+        self.initial_required = frozenset(
+            q_id for q_id in ids if q_id not in self.initial_hidden and self.is_required(q_id, empty_answers))
+
+    @staticmethod
+    def _topological_positions(ids, dependents):
+        in_degree = {q_id: 0 for q_id in ids}
+        for targets in dependents.values():
+            for q_id in targets:
+                in_degree[q_id] += 1
+        ready = [q_id for q_id in ids if in_degree[q_id] == 0]
+        order = []
+        while ready:
+            q_id = ready.pop()
+            order.append(q_id)
+            for target in dependents.get(q_id, ()):
+                in_degree[target] -= 1
+                if in_degree[target] == 0:
+                    ready.append(target)
+        if len(order) != len(ids):
+            cyclic = sorted(q_id for q_id, degree in in_degree.items() if degree > 0)
+            raise ConditionError(f"條件之間存在循環相依: {', '.join(cyclic)}")
+        return {q_id: i for i, q_id in enumerate(order)}
+
+    def __len__(self):
+        return len(self.questions)
+
+    def get(self, q_id):
+        return self.by_id.get(q_id)
+
+    def is_visible(self, q_id, answers):
+        condition = self.show_conditions.get(q_id)
+        return condition is None or condition.evaluate(answers)
+
+    def is_required(self, q_id, answers):
+        """
+        問題在目前答案下是否必填 (不檢查是否顯示)。
+        """
+        if q_id in self.required_ids:
+            return True
+        condition = self.required_conditions.get(q_id)
+        if condition is None:
+            return False
+        return condition.evaluate(answers)
+
+    def to_structure(self):
+        """
+        還原為可修改、可 JSON 序列化的原始問卷結構。
+        """
+        return _thaw(self.questions)
+
+
+def compile_questionnaire(structure, name="default"):
+    return CompiledQuestionnaire(structure, name)
+
+
+# 載入時編譯一次，所有會話共用
+DEFAULT_QUESTIONNAIRE = compile_questionnaire(QUESTIONNAIRE_STRUCTURE)
@@ -0,0 +1,245 @@
+# questionnaire_registry.py
+
+"""
+多份問卷的定義註冊表。
+
+問卷定義放在同一個目錄中，一個檔案一份 (*.json；安裝了 PyYAML 時也可以是 *.yaml / *.yml)，
+檔名 (不含副檔名) 為問卷 id，內容為問題列表，或含 "questions" 列表 (可另外指定 "id") 的物件：
+
+    {"id": "store_survey", "questions": [{"id": "name", "question": "您的姓名是？", "type": "text"}, ...]}
+
+每個定義只編譯一次 (questionnaire_model.CompiledQuestionnaire：驗證函式、條件 DAG、標題順序)，
+以內容雜湊作為版本；SessionEngine 讓同一版本的所有會話共用同一個編譯結果、AINLULayer (預先編譯的 schema 提示)
+與規則提取器，每個會話只保存自己的答案與對話歷史。
+
+熱重載：get() 最多每 check_interval 秒檢查一次定義檔的修改時間，內容變更時編譯新版本，之後開始的會話使用新版本；
+進行中的會話仍持有開始時的版本。每個版本的結構另外存檔在 archive_dir，程序重啟或會話移到其他 worker 後，
+get_version() 仍能取回快照中記錄的舊版本。
+"""
+
+import json
+import os
+import re
+import threading
+import time
+import weakref
+
+from questionnaire_model import DEFAULT_QUESTIONNAIRE, compile_questionnaire, structure_version
+
+DEFINITION_SUFFIXES = (".json", ".yaml", ".yml")
+
+_ID_RE = re.compile(r"^[\w-]+$")
+
+
+class QuestionnaireNotFoundError(ValueError):
+    pass
+
+
+def load_definition(path):
+    """
+    讀取問卷定義檔，返回 (問卷 id, 問題列表)。
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        text = f.read()
+    if path.endswith((".yaml", ".yml")):
+        try:
+            import yaml
+        except ImportError as e:
+            raise ImportError(f"讀取 YAML 問卷定義需要 PyYAML (pip install pyyaml)：{path}") from e
+        data = yaml.safe_load(text)
+    else:
+        data = json.loads(text)
+
+    questionnaire_id = os.path.splitext(os.path.basename(path))[0]
+    if isinstance(data, dict):
+        questionnaire_id = data.get("id", questionnaire_id)
+        data = data.get("questions")
+    if not isinstance(data, list) or not data:
+        raise ValueError(f"問卷定義 '{path}' 必須是問題列表，或含 'questions' 列表的物件。")
+    if not isinstance(questionnaire_id, str) or not _ID_RE.match(questionnaire_id):
+        raise ValueError(f"問卷 id '{questionnaire_id}' 只能包含英數字、底線與連字號。")
+    return questionnaire_id, data
+
+
+class QuestionnaireRegistry:
+    def __init__(self, directory=None, check_interval=2.0, archive_dir=None, include_default=True):
+        """
+        directory: 問卷定義目錄；None 時只有預設問卷。
+        check_interval: 兩次檢查定義檔是否變更的最短間隔 (秒)；0 為每次 get() 都檢查，None 為只在呼叫 reload() 時重新載入。
+        archive_dir: 各版本結構的存檔目錄，預設為 <directory>/.versions。
+        include_default: 以 "default" 註冊 questionnaire_data 中的預設問卷 (目錄中的 default.json 會取代它)。
+        """
+        self.directory = directory
+        self.check_interval = check_interval
+        self.archive_dir = archive_dir or (os.path.join(directory, ".versions") if directory else None)
+        self.include_default = include_default
+        self._lock = threading.RLock()
+        self._current = {} # 問卷 id -> 目前版本
+        self._versions = weakref.WeakValueDictionary() # (問卷 id, version) -> 仍被使用的各版本
+        self._sources = {} # 定義檔路徑 -> ((mtime_ns, size), 問卷 id)
+        self._last_check = 0.0
+        self.compiles = 0
+        self.reloads = 0
+        self.errors = 0
+        if include_default:
+            self._install(DEFAULT_QUESTIONNAIRE)
+        self.reload()
+
+    def get(self, questionnaire_id="default"):
+        """
+        返回問卷目前的版本 (CompiledQuestionnaire)；新會話應使用這個版本。
+        """
+        self._maybe_reload()
+        questionnaire = self._current.get(questionnaire_id)
+        if questionnaire is None:
+            raise QuestionnaireNotFoundError(f"找不到問卷 '{questionnaire_id}'。")
+        return questionnaire
+
+    def get_version(self, questionnaire_id, version):
+        """
+        返回指定版本 (例如會話快照中記錄的版本)；不在記憶體中時從 archive_dir 的存檔重新編譯。
+        """
+        with self._lock:
+            questionnaire = self._versions.get((questionnaire_id, version))
+            if questionnaire is not None:
+                return questionnaire
+            path = self._archive_path(questionnaire_id, version)
+            if path is not None and os.path.exists(path):
+                with open(path, "r", encoding="utf-8") as f:
+                    structure = json.load(f)
+                questionnaire = compile_questionnaire(structure, questionnaire_id)
+                self.compiles += 1
+                if questionnaire.version == version:
+                    self._versions[(questionnaire_id, version)] = questionnaire
+                    return questionnaire
+        raise QuestionnaireNotFoundError(f"找不到問卷 '{questionnaire_id}' 的版本 {version}。")
+
+    def is_current(self, questionnaire):
+        return self._current.get(questionnaire.name) is questionnaire
+
+    def ids(self):
+        self._maybe_reload()
+        return sorted(self._current)
+
+    def _maybe_reload(self):
+        if self.check_interval is not None and time.monotonic() - self._last_check >= self.check_interval:
+            self.reload()
+
+    def reload(self):
+        """
+        重新掃描定義目錄，返回 {問卷 id: 新版本} (只含新增或內容變更的問卷)。
+        無法讀取或編譯的定義檔會被略過，該問卷繼續使用原本的版本。
+        """
+        with self._lock:
+            self._last_check = time.monotonic()
+            if self.directory is None:
+                return {}
+            changed = {}
+            seen = set()
+            for filename in sorted(os.listdir(self.directory)):
+                path = os.path.join(self.directory, filename)
+                if not filename.endswith(DEFINITION_SUFFIXES) or not os.path.isfile(path):
+                    continue
+                seen.add(path)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                file_signature = (stat.st_mtime_ns, stat.st_size)
+                previous = self._sources.get(path)
+                if previous is not None and previous[0] == file_signature:
+                    continue
+                try:
+                    questionnaire_id, structure = load_definition(path)
+                    questionnaire = self._compile(questionnaire_id, structure)
+                except Exception as e:
+                    self.errors += 1
+                    print(f"無法載入問卷定義 '{path}'，繼續使用原本的版本: {e}")
+                    continue
+                if previous is not None and previous[1] != questionnaire_id:
+                    self._current.pop(previous[1], None) # 檔案中的 id 改了
+                self._sources[path] = (file_signature, questionnaire_id)
+                if self._install(questionnaire):
+                    changed[questionnaire_id] = questionnaire.version
+
+            for path in [p for p in self._sources if p not in seen]:
+                _, questionnaire_id = self._sources.pop(path)
+                # 進行中的會話仍持有原本的版本；之後無法再以這個 id 開始新會話
+                self._current.pop(questionnaire_id, None)
+                print(f"問卷定義 '{path}' 已移除，問卷 '{questionnaire_id}' 不再接受新會話。")
+                if questionnaire_id == DEFAULT_QUESTIONNAIRE.name and self.include_default:
+                    self._install(DEFAULT_QUESTIONNAIRE)
+            return changed
+
+    def _compile(self, questionnaire_id, structure):
+        # 內容沒有變 (例如只是重新存檔) 時直接沿用已編譯的版本
+        existing = self._versions.get((questionnaire_id, structure_version(structure)))
+        if existing is not None:
+            return existing
+        questionnaire = compile_questionnaire(structure, questionnaire_id)
+        self.compiles += 1
+        self._archive(questionnaire)
+        return questionnaire
+
+    def _install(self, questionnaire):
+        previous = self._current.get(questionnaire.name)
+        if previous is questionnaire:
+            return False
+        self._current[questionnaire.name] = questionnaire
+        self._versions[(questionnaire.name, questionnaire.version)] = questionnaire
+        if previous is not None:
+            self.reloads += 1
+            print(f"問卷 '{questionnaire.name}' 已更新為版本 {questionnaire.version}；"
+                  f"進行中的會話繼續使用版本 {previous.version}。")
+            if questionnaire.headers != previous.headers:
+                from result_stores import result_store_name
+                print(f"注意：問卷 '{questionnaire.name}' 的題目已變更，新版本的答案會寫入另外的資料表/檔案/工作表 "
+                      f"({result_store_name(questionnaire)})。")
+        return True
+
+    def _archive_path(self, questionnaire_id, version):
+        if self.archive_dir is None:
+            return None
+        return os.path.join(self.archive_dir, f"{questionnaire_id}@{version}.json")
+
+    def _archive(self, questionnaire):
+        path = self._archive_path(questionnaire.name, questionnaire.version)
+        if path is None or os.path.exists(path):
+            return
+        os.makedirs(self.archive_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(questionnaire.to_structure(), f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "questionnaires": {q_id: q.version for q_id, q in sorted(self._current.items())},
+                "live_versions": len(self._versions),
+                "compiles": self.compiles,
+                "reloads": self.reloads,
+                "errors": self.errors,
+            }
+
+
+if __name__ == '__main__':
+    import tempfile
+    from questionnaire_data import QUESTIONNAIRE_STRUCTURE
+
+    tmp_dir = tempfile.mkdtemp()
+    definition_path = os.path.join(tmp_dir, "store_survey.json")
+    with open(definition_path, "w", encoding="utf-8") as f:
+        json.dump({"questions": QUESTIONNAIRE_STRUCTURE[:3]}, f, ensure_ascii=False)
+
+    registry = QuestionnaireRegistry(tmp_dir, check_interval=0)
+    pinned = registry.get("store_survey")
+    print(f"store_survey 版本 {pinned.version}，題目: {list(pinned.headers)}")
+
+    with open(definition_path, "w", encoding="utf-8") as f:
+        json.dump({"questions": QUESTIONNAIRE_STRUCTURE[:4]}, f, ensure_ascii=False)
+    os.utime(definition_path, ns=(time.time_ns(), time.time_ns() + 1_000_000))
+    latest = registry.get("store_survey")
+    print(f"重新載入後版本 {latest.version}，題目: {list(latest.headers)}")
+    print(f"舊版本仍可取得: {registry.get_version('store_survey', pinned.version) is pinned}")
+    print(registry.stats())
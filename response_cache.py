@@ -0,0 +1,162 @@
+# response_cache.py
+
+"""
+生成式提示語 (歡迎語、下一步提示) 的回應快取。
+
+ResponseCache 提供 LRU + TTL 淘汰的記憶體快取，並可選擇以 SQLite 作為磁碟層，讓多個程序或重啟後
+仍能共用已生成的內容。PromptVariantCache 在其上實作「變化策略」：每個鍵先累積數個不同的生成結果，
+之後從中隨機挑選回傳，兼顧回覆的自然變化與零延遲。
+"""
+
+import json
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import METRICS
+
+
+class ResponseCache:
+    def __init__(self, max_entries=1024, ttl=3600.0, sqlite_path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict() # key -> (stored_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self._db = None
+        if sqlite_path:
+            self._db = sqlite3.connect(sqlite_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS response_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, stored_at REAL NOT NULL)")
+            self._db.commit()
+
+    def _expired(self, stored_at):
+        # 以 wall-clock 時間記錄，磁碟層的資料在重啟後仍可判斷是否過期
+        return self.ttl is not None and time.time() - stored_at > self.ttl
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if not self._expired(entry[0]):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+
+            if self._db is not None:
+                row = self._db.execute("SELECT value, stored_at FROM response_cache WHERE key = ?", (key,)).fetchone()
+                if row is not None and not self._expired(row[1]):
+                    value = json.loads(row[0])
+                    self._store_in_memory(key, value, row[1])
+                    self.hits += 1
+                    return value
+
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        stored_at = time.time()
+        with self._lock:
+            self._store_in_memory(key, value, stored_at)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO response_cache (key, value, stored_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(value, ensure_ascii=False), stored_at))
+                self._db.commit()
+
+    def _store_in_memory(self, key, value, stored_at):
+        self._entries[key] = (stored_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def discard_prefix(self, prefix, keep=None):
+        """
+        刪除鍵以 prefix 開頭、但不以 keep 開頭的項目 (記憶體與磁碟層)，返回刪除的筆數。
+        """
+        def stale(key):
+            return key.startswith(prefix) and not (keep and key.startswith(keep))
+
+        with self._lock:
+            keys = [key for key in self._entries if stale(key)]
+            for key in keys:
+                del self._entries[key]
+            removed = len(keys)
+            if self._db is not None:
+                sql = "DELETE FROM response_cache WHERE substr(key, 1, ?) = ?"
+                params = [len(prefix), prefix]
+                if keep:
+                    sql += " AND substr(key, 1, ?) != ?"
+                    params += [len(keep), keep]
+                removed = self._db.execute(sql, params).rowcount # 記憶體中的項目都已寫入磁碟層
+                self._db.commit()
+            return removed
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM response_cache")
+                self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+class PromptVariantCache:
+    """
+    每個鍵最多保存 variants_per_key 個生成結果。未滿時 get() 返回 None，讓呼叫端生成新的變體；
+    已滿時隨機返回其中一個。variants_per_key=1 即固定回覆，0 表示停用快取。
+    """
+    def __init__(self, cache, variants_per_key=3, namespace="prompt"):
+        self.cache = cache
+        self.variants_per_key = variants_per_key
+        self.namespace = namespace
+        self._random = random.Random()
+        self._lock = threading.Lock()
+        self.served = 0 # 直接由快取回覆的次數
+        self.generated = 0 # 新生成並加入快取的變體數
+        self._metric_label = namespace.split(":", 1)[0] # 例如 "greeting"、"next"
+
+    def _key(self, key):
+        return f"{self.namespace}:{key}"
+
+    def variants(self, key):
+        return self.cache.get(self._key(key), [])
+
+    def get(self, key):
+        if self.variants_per_key <= 0:
+            return None
+        variants = self.variants(key)
+        if len(variants) < self.variants_per_key:
+            METRICS.inc("prompt_cache_requests_total", cache=self._metric_label, result="miss")
+            return None
+        self.served += 1
+        METRICS.inc("prompt_cache_requests_total", cache=self._metric_label, result="hit")
+        return self._random.choice(variants)
+
+    def add(self, key, text):
+        if self.variants_per_key <= 0:
+            return
+        with self._lock:
+            variants = list(self.variants(key))
+            if len(variants) >= self.variants_per_key:
+                return
+            variants.append(text)
+            self.generated += 1
+            self.cache.set(self._key(key), variants)
+
+    def stats(self):
+        return {"variants_per_key": self.variants_per_key, "served_from_cache": self.served, "generated": self.generated}
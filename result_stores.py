@@ -0,0 +1,589 @@
+# result_stores.py
+
+"""
+可替換的問卷結果儲存後端。
+
+- SQLiteResultStore: 本地 SQLite (WAL 模式)，寫入快、可查詢，適合作為主要儲存
+- CSVResultStore / JSONLResultStore: 只追加 (append-only) 的本地檔案
+- SheetsResultStore: 原本的 Google Sheets 路徑 (經由 SheetSubmissionQueue 背景批次寫入)
+
+所有後端都以 GOOGLE_SHEET_HEADERS 決定欄位順序；questionnaire_registry 中的其他問卷以 get_result_store_for()
+取得各自的後端，欄位順序為該問卷的 result_headers。本地後端可搭配 SheetsBulkExporter，
+依排程將累積的資料以大批次匯出到 Google Sheets，不需在問卷結束時連網。
+提供 submission_index.SubmissionIndex 時，帶有相同 submission_id 的提交只會寫入一次。
+"""
+
+import csv
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from google_sheets_service import append_rows_to_sheet, build_data_row, is_quota_error
+from metrics import METRICS
+from questionnaire_data import GOOGLE_SHEET_HEADERS, SUBMISSION_ID_HEADER
+
+
+class ResultStore:
+    """
+    儲存後端介面。append / append_many 接收答案字典，依 headers 順序轉為資料行後寫入。
+    支援匯出的後端另外實作 read_since(position, limit) -> (rows, new_position)。
+    index: submission_index.SubmissionIndex；提供時答案中的 submission_id 已提交過的會被略過。
+    index_scope: 在索引中記錄的範圍 (資料最後寫入的工作表名稱)，reconcile_with_sheet 依此只比對該工作表的提交。
+    """
+    name = "base"
+    index_scope = None
+
+    def __init__(self, headers=None, index=None):
+        self.headers = tuple(headers if headers is not None else GOOGLE_SHEET_HEADERS)
+        self.index = index
+
+    def to_row(self, answers):
+        return build_data_row(answers, self.headers)
+
+    def append(self, answers):
+        """
+        返回 True 表示已寫入，False 表示同一個 submission_id 先前已提交過 (視為已成功，不重複寫入)。
+        """
+        return self.append_many([answers]) == 1
+
+    def append_many(self, answers_list):
+        """
+        返回實際寫入的筆數。寫入失敗時撤銷這一批在索引中的保留並拋出例外，重試時不會被當成重複提交。
+        """
+        rows = [self.to_row(answers) for answers in answers_list]
+        accepted = []
+        if self.index is not None:
+            keyed = [(answers.get(SUBMISSION_ID_HEADER), row) for answers, row in zip(answers_list, rows)]
+            unkeyed = [row for submission_id, row in keyed if not submission_id]
+            accepted = self.index.reserve_many([(submission_id, row) for submission_id, row in keyed if submission_id],
+                                               self.index_scope)
+            skipped = len(rows) - len(unkeyed) - len(accepted)
+            if skipped:
+                METRICS.inc("duplicate_submissions_total", skipped)
+                print(f"略過 {skipped} 筆先前已提交過的重複提交。")
+            rows = unkeyed + [row for _, row in accepted]
+        if rows:
+            try:
+                self.append_rows(rows)
+            except Exception:
+                if accepted:
+                    self.index.release([submission_id for submission_id, _ in accepted])
+                raise
+        return len(rows)
+
+    def is_stored(self, answers):
+        """
+        append() 返回 False (重複提交) 時，確認索引中先前保存的資料行是否就是這份答案。
+        """
+        if self.index is None:
+            return False
+        stored = self.index.stored_row(answers.get(SUBMISSION_ID_HEADER))
+        return stored is not None and stored == json.loads(json.dumps(self.to_row(answers), ensure_ascii=False))
+
+    def append_rows(self, rows):
+        """
+        寫入已依 headers 排好順序的資料行。
+        """
+        raise NotImplementedError
+
+    def read_since(self, position, limit=None):
+        raise NotImplementedError(f"{type(self).__name__} 不支援讀取匯出。")
+
+    def count(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class SQLiteResultStore(ResultStore):
+    name = "sqlite"
+
+    def __init__(self, path="questionnaire_results.db", headers=None, table="responses", synchronous="NORMAL", index=None):
+        """
+        synchronous: WAL 模式下 NORMAL 在程序崩潰時不會遺失資料，只有作業系統當機時可能遺失最後幾筆交易。
+        """
+        super().__init__(headers, index)
+        self.path = path
+        self.table = table
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(f"PRAGMA synchronous={synchronous}")
+        columns = ", ".join(f'"{h}"' for h in self.headers)
+        self._db.execute(
+            f'CREATE TABLE IF NOT EXISTS "{table}" (row_id INTEGER PRIMARY KEY AUTOINCREMENT, submitted_at REAL NOT NULL, '
+            + ", ".join(f'"{h}"' for h in self.headers) + ")")
+        self._db.commit()
+        existing = [r[1] for r in self._db.execute(f'PRAGMA table_info("{table}")')][2:]
+        if existing != list(self.headers) and existing == list(self.headers[:len(existing)]):
+            # 問卷標題只在末端新增了欄位 (例如 submission_id)：補上欄位，既有資料的新欄位為 NULL
+            for header in self.headers[len(existing):]:
+                self._db.execute(f'ALTER TABLE "{table}" ADD COLUMN "{header}"')
+            self._db.commit()
+            existing = list(self.headers)
+        if existing != list(self.headers):
+            raise ValueError(f"SQLite 資料表 '{table}' 的欄位 {existing} 與問卷標題 {list(self.headers)} 不一致。")
+        self._insert_sql = f'INSERT INTO "{table}" (submitted_at, {columns}) VALUES (?, {", ".join("?" * len(self.headers))})'
+        self._select_sql = f'SELECT row_id, {columns} FROM "{table}" WHERE row_id > ? ORDER BY row_id'
+
+    def append_rows(self, rows):
+        now = time.time()
+        with self._lock:
+            self._db.executemany(self._insert_sql, [(now, *row) for row in rows])
+            self._db.commit()
+
+    def read_since(self, position, limit=None):
+        """
+        position 為上次讀到的 row_id (從 0 開始)。
+        """
+        sql = self._select_sql + (f" LIMIT {int(limit)}" if limit else "")
+        with self._lock:
+            records = self._db.execute(sql, (position or 0,)).fetchall()
+        if not records:
+            return [], position or 0
+        return [list(r[1:]) for r in records], records[-1][0]
+
+    def count(self):
+        with self._lock:
+            return self._db.execute(f'SELECT COUNT(*) FROM "{self.table}"').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class _AppendOnlyFileStore(ResultStore):
+    """
+    只追加的本地檔案。position 為檔案的位元組位移，只讀取完整寫入的行。
+    """
+    def __init__(self, path, headers=None, fsync=False, index=None):
+        super().__init__(headers, index)
+        self.path = path
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._rows = None # 行數在第一次 count() 時才計算
+        with self._lock:
+            if not os.path.exists(path) or os.path.getsize(path) == 0:
+                self._write_text(self._file_header())
+
+    def _file_header(self):
+        return ""
+
+    def _format_rows(self, rows):
+        raise NotImplementedError
+
+    def _parse(self, lines):
+        raise NotImplementedError
+
+    def _write_text(self, text):
+        if not text:
+            return
+        with open(self.path, "a", encoding="utf-8", newline="") as f:
+            f.write(text)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+
+    def append_rows(self, rows):
+        text = self._format_rows(rows)
+        with self._lock:
+            self._write_text(text)
+            if self._rows is not None:
+                self._rows += len(rows)
+
+    def read_since(self, position, limit=None):
+        position = position or 0
+        consumed = [position]
+
+        def complete_lines(f):
+            # 最後一行若尚未寫完 (沒有換行) 則留待下次讀取
+            for line in iter(f.readline, b""):
+                if not line.endswith(b"\n"):
+                    return
+                consumed[0] += len(line)
+                yield line.decode("utf-8")
+
+        rows = []
+        new_position = position
+        with open(self.path, "rb") as f:
+            f.seek(position)
+            for row in self._parse(complete_lines(f)):
+                rows.append(row)
+                new_position = consumed[0]
+                if limit and len(rows) >= limit:
+                    break
+        return rows, new_position
+
+    def count(self):
+        with self._lock:
+            if self._rows is None:
+                self._rows = len(self.read_since(0)[0])
+            return self._rows
+
+
+class CSVResultStore(_AppendOnlyFileStore):
+    name = "csv"
+
+    def __init__(self, path="questionnaire_results.csv", headers=None, fsync=False, index=None):
+        super().__init__(path, headers, fsync, index)
+
+    def _file_header(self):
+        return self._format_rows([self.headers])
+
+    def _format_rows(self, rows):
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator="\n").writerows(rows)
+        return buffer.getvalue()
+
+    def read_since(self, position, limit=None):
+        rows, new_position = super().read_since(position, limit)
+        if not position and rows and tuple(rows[0]) == self.headers:
+            rows = rows[1:]
+        return rows, new_position
+
+    def _parse(self, lines):
+        # csv.reader 會自行向 lines 多取幾行以處理欄位內的換行
+        return csv.reader(lines)
+
+
+class JSONLResultStore(_AppendOnlyFileStore):
+    name = "jsonl"
+
+    def __init__(self, path="questionnaire_results.jsonl", headers=None, fsync=False, index=None):
+        super().__init__(path, headers, fsync, index)
+
+    def _format_rows(self, rows):
+        return "".join(json.dumps(dict(zip(self.headers, row)), ensure_ascii=False) + "\n" for row in rows)
+
+    def _parse(self, lines):
+        for line in lines:
+            if line.strip():
+                record = json.loads(line)
+                yield [record.get(h, "") for h in self.headers]
+
+
+class SheetsResultStore(ResultStore):
+    """
+    原本的 Google Sheets 路徑：資料放入 SheetSubmissionQueue，由背景執行緒批次寫入。
+    index 預設使用佇列的提交索引，佇列寫入成功後會將 id 記為 committed。
+    """
+    name = "sheets"
+
+    def __init__(self, queue=None, headers=None, index=None):
+        if queue is None:
+            from sheet_submission_queue import get_default_submission_queue
+            queue = get_default_submission_queue()
+        super().__init__(headers if headers is not None else queue.headers, index if index is not None else queue.index)
+        self.queue = queue
+        self.index_scope = queue.worksheet_name
+
+    def append_rows(self, rows):
+        for row in rows:
+            self.queue.enqueue(row)
+
+    def count(self):
+        return self.queue.stats["enqueued"]
+
+    def close(self):
+        self.queue.flush(timeout=10.0)
+
+
+class SheetsBulkExporter:
+    """
+    依排程將本地儲存後端累積的資料以大批次匯出到 Google Sheets。
+    匯出進度 (position) 保存在 state_path，重啟後從上次位置繼續，不會重複匯出已確認寫入的資料。
+    """
+    def __init__(self, store, client_factory, sheet_id, worksheet_name="工作表1", state_path=None,
+                 batch_size=1000, interval=60.0):
+        self.store = store
+        self.client_factory = client_factory
+        self.sheet_id = sheet_id
+        self.worksheet_name = worksheet_name
+        self.state_path = state_path or f"{getattr(store, 'path', 'results')}.export_state.json"
+        self.batch_size = batch_size
+        self.interval = interval
+
+        self._client = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._worker = None
+        self.position = self._load_position()
+        self.stats = {"exported_rows": 0, "batches": 0, "failures": 0, "quota_errors": 0, "skipped_rows": 0}
+
+    def _load_position(self):
+        if not os.path.exists(self.state_path):
+            return 0
+        with open(self.state_path, "r", encoding="utf-8") as f:
+            return json.load(f).get("position", 0)
+
+    def _save_position(self):
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"position": self.position, "updated_at": time.time()}, f)
+        os.replace(tmp_path, self.state_path)
+
+    def export_once(self):
+        """
+        匯出目前累積的所有資料，返回本次匯出的筆數。遇到錯誤時停止，下次從未確認的位置重試。
+        """
+        exported = 0
+        with self._lock:
+            while True:
+                rows, new_position = self.store.read_since(self.position, self.batch_size)
+                if not rows:
+                    break
+                submission_ids = []
+                if self.store.index is not None and SUBMISSION_ID_HEADER in self.store.headers:
+                    # 匯出後、更新進度前崩潰時，重新匯出的行已確認寫入過，不再重複寫入
+                    rows, submission_ids, skipped = self.store.index.filter_uncommitted(
+                        rows, self.store.headers.index(SUBMISSION_ID_HEADER))
+                    self.stats["skipped_rows"] += skipped
+                try:
+                    if rows and self._client is None:
+                        self._client = self.client_factory()
+                        if self._client is None:
+                            print("無法連接 Google Sheets，稍後再匯出。")
+                            self.stats["failures"] += 1
+                            break
+                    if rows:
+                        append_rows_to_sheet(self._client, self.sheet_id, self.worksheet_name, rows, self.store.headers)
+                except Exception as e:
+                    self.stats["failures"] += 1
+                    if is_quota_error(e):
+                        self.stats["quota_errors"] += 1
+                        print(f"Google Sheets API 配額不足，稍後再匯出: {e}")
+                    else:
+                        print(f"匯出到 Google Sheet 時發生錯誤，稍後再匯出: {e}")
+                    break
+                if submission_ids:
+                    self.store.index.mark_committed(submission_ids, self.worksheet_name)
+                self.position = new_position
+                self._save_position()
+                exported += len(rows)
+                self.stats["exported_rows"] += len(rows)
+                self.stats["batches"] += 1 if rows else 0
+        if exported:
+            print(f"已匯出 {exported} 筆數據到 Google Sheet '{self.worksheet_name}'。")
+        return exported
+
+    def start(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._stop.clear()
+            self._worker = threading.Thread(target=self._run, name="SheetsBulkExporter", daemon=True)
+            self._worker.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.export_once()
+
+    def stop(self, final_export=True):
+        self._stop.set()
+        if self._worker is not None:
+            self._worker.join(timeout=5.0)
+        if final_export:
+            self.export_once()
+
+
+STORE_TYPES = {
+    "sqlite": SQLiteResultStore,
+    "csv": CSVResultStore,
+    "jsonl": JSONLResultStore,
+}
+
+
+_DEFAULT_PATHS = {
+    "sqlite": "questionnaire_results.db",
+    "csv": "questionnaire_results.csv",
+    "jsonl": "questionnaire_results.jsonl",
+}
+
+
+def create_result_store(kind, path=None, headers=None, index=None):
+    """
+    kind: "sqlite" / "csv" / "jsonl" / "sheets"。index: submission_index.SubmissionIndex，None 表示不去重。
+    """
+    if kind == "sheets":
+        return SheetsResultStore(headers=headers, index=index)
+    if kind not in STORE_TYPES:
+        raise ValueError(f"未知的儲存後端 '{kind}'，可用: {', '.join(sorted(STORE_TYPES) + ['sheets'])}")
+    return STORE_TYPES[kind](path, headers, index=index) if path else STORE_TYPES[kind](headers=headers, index=index)
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+_exporters = {} # 匯出進度檔路徑 -> 本程序中執行的 SheetsBulkExporter
+_exporters_lock = threading.Lock()
+_export_delegate = None # worker 程序中為通知 supervisor 的函式，見 configure_worker_process()
+
+
+def configure_worker_process(worker_id, notify_export):
+    """
+    worker_pool 的 worker 程序在建立任何儲存後端之前呼叫：
+    - Sheets 寫入佇列使用這個 worker 自己的 spool 檔案 (檔名加上 worker_id)
+    - 本地後端不在 worker 中定時匯出，改以 notify_export(spec) 通知 supervisor，由 supervisor 以 start_bulk_export(spec)
+      為每個後端只執行一個 SheetsBulkExporter；多個程序各自匯出同一個檔案時會重複匯出並互相覆寫匯出進度
+    """
+    global _export_delegate
+    from sheet_submission_queue import set_spool_suffix
+    set_spool_suffix(worker_id)
+    _export_delegate = notify_export
+
+
+def _schedule_export(store, worksheet_name, state_path):
+    spec = {"kind": store.name, "path": store.path, "table": getattr(store, "table", None), "headers": list(store.headers),
+            "worksheet_name": worksheet_name, "state_path": state_path}
+    if _export_delegate is not None:
+        _export_delegate(spec)
+    else:
+        _start_exporter(store, spec)
+
+
+def _start_exporter(store, spec):
+    import atexit
+    from questionnaire_data import RESULT_EXPORT_INTERVAL, GOOGLE_SHEET_ID
+    from google_sheets_service import get_default_sheet_client
+
+    with _exporters_lock:
+        exporter = _exporters.get(spec["state_path"])
+        if exporter is None:
+            exporter = SheetsBulkExporter(store, get_default_sheet_client, GOOGLE_SHEET_ID, worksheet_name=spec["worksheet_name"],
+                                          state_path=spec["state_path"], interval=RESULT_EXPORT_INTERVAL)
+            exporter.start()
+            # atexit 依註冊的相反順序執行：先做最後一次匯出，再關閉儲存後端
+            atexit.register(exporter.stop)
+            _exporters[spec["state_path"]] = exporter
+        return exporter
+
+
+def start_bulk_export(spec):
+    """
+    在本程序中為 spec (由 worker 的 notify_export 傳來) 描述的本地後端啟動定時匯出，同一個後端只啟動一次。
+    """
+    with _exporters_lock:
+        if spec["state_path"] in _exporters:
+            return _exporters[spec["state_path"]]
+    import atexit
+    from submission_index import get_default_submission_index
+
+    index = get_default_submission_index()
+    if spec["kind"] == "sqlite":
+        store = SQLiteResultStore(spec["path"], spec["headers"], table=spec["table"], index=index)
+    else:
+        store = STORE_TYPES[spec["kind"]](spec["path"], spec["headers"], index=index)
+    store.index_scope = spec["worksheet_name"]
+    atexit.register(store.close)
+    return _start_exporter(store, spec)
+
+
+def stop_bulk_exports():
+    """
+    停止本程序中的所有定時匯出，並做最後一次匯出 (worker_pool 在所有 worker 結束後呼叫)。
+    """
+    with _exporters_lock:
+        exporters = list(_exporters.values())
+    for exporter in exporters:
+        exporter.stop()
+
+
+def get_default_result_store():
+    """
+    取得程序共用的儲存後端，依 questionnaire_data 中的 RESULT_STORE 設定建立；
+    本地後端且設定了 RESULT_EXPORT_INTERVAL 時，會一併啟動定時匯出到 Google Sheets。
+    """
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            import atexit
+            from questionnaire_data import RESULT_STORE, RESULT_STORE_PATH, RESULT_EXPORT_INTERVAL
+            from submission_index import get_default_submission_index
+
+            _default_store = create_result_store(RESULT_STORE, RESULT_STORE_PATH, index=get_default_submission_index())
+            atexit.register(_default_store.close)
+            if RESULT_STORE != "sheets":
+                _default_store.index_scope = "工作表1" # 批次匯出的工作表
+            if RESULT_STORE != "sheets" and RESULT_EXPORT_INTERVAL:
+                _schedule_export(_default_store, "工作表1", f"{_default_store.path}.export_state.json")
+        return _default_store
+
+
+_questionnaire_stores = {} # (問卷 id, 結果欄位) -> ResultStore
+
+def result_store_name(questionnaire):
+    """
+    問卷結果的資料表/檔案/工作表名稱：<問卷 id>_<結果欄位的雜湊 (8 碼)>。
+    只由問卷 id 與欄位決定，重啟後或在其他 worker 中，題目相同的版本總是得到同一個名稱，題目不同的版本總是不同。
+    """
+    digest = hashlib.sha1(json.dumps(list(questionnaire.result_headers), ensure_ascii=False).encode("utf-8")).hexdigest()[:8]
+    return f"{questionnaire.name}_{digest}"
+
+
+def get_result_store_for(questionnaire):
+    """
+    取得某份問卷共用的儲存後端。預設問卷使用 get_default_result_store()；其他問卷依同一個 RESULT_STORE 設定各自建立，
+    名稱為 result_store_name()：sqlite 為同一檔案中的 responses_<名稱> 資料表，csv / jsonl 為 <檔名>_<名稱> 檔案，
+    sheets 寫入同名的工作表。題目相同的版本共用同一個後端，題目變更後的版本寫入另一個，不會與舊版本的資料錯欄。
+    """
+    if questionnaire.name == "default" and questionnaire.result_headers == tuple(GOOGLE_SHEET_HEADERS):
+        return get_default_result_store()
+    key = (questionnaire.name, questionnaire.result_headers)
+    with _default_store_lock:
+        store = _questionnaire_stores.get(key)
+        if store is None:
+            store = _questionnaire_stores[key] = _create_questionnaire_store(questionnaire, result_store_name(questionnaire))
+        return store
+
+
+def _create_questionnaire_store(questionnaire, suffix):
+    import atexit
+    from questionnaire_data import RESULT_STORE, RESULT_STORE_PATH, RESULT_EXPORT_INTERVAL, GOOGLE_SHEET_ID
+    from google_sheets_service import get_default_sheet_client
+    from submission_index import get_default_submission_index
+
+    index = get_default_submission_index()
+    headers = questionnaire.result_headers
+    if RESULT_STORE == "sheets":
+        from sheet_submission_queue import SheetSubmissionQueue, spool_path_for
+        queue = SheetSubmissionQueue(get_default_sheet_client, GOOGLE_SHEET_ID, suffix, headers,
+                                     spool_path=spool_path_for(f"sheet_submission_spool_{suffix}.jsonl"), index=index)
+        atexit.register(queue.close)
+        store = SheetsResultStore(queue)
+        atexit.register(store.close)
+        return store
+
+    if RESULT_STORE == "sqlite":
+        path = RESULT_STORE_PATH or _DEFAULT_PATHS["sqlite"]
+        store = SQLiteResultStore(path, headers, table=f"responses_{suffix}", index=index)
+    else:
+        root, ext = os.path.splitext(RESULT_STORE_PATH or _DEFAULT_PATHS.get(RESULT_STORE, "questionnaire_results"))
+        store = create_result_store(RESULT_STORE, f"{root}_{suffix}{ext}", headers, index)
+    store.index_scope = suffix # 批次匯出的工作表與後端同名
+    atexit.register(store.close)
+    if RESULT_EXPORT_INTERVAL:
+        _schedule_export(store, suffix, f"{store.path}.{suffix}.export_state.json")
+    return store
+
+
+if __name__ == '__main__':
+    # 使用暫存目錄與假的 gspread 客戶端示範各後端與批次匯出
+    import tempfile
+    from fake_backends import FakeGspreadClient
+
+    tmp_dir = tempfile.mkdtemp()
+    sample = {"name": "王小明", "email": "wang@example.com", "age_group": "25-34", "product_satisfaction": 4,
+              "feedback_comments": "第一行\n第二行, 含逗號", "allow_follow_up": "是"}
+    for store in (SQLiteResultStore(os.path.join(tmp_dir, "r.db")), CSVResultStore(os.path.join(tmp_dir, "r.csv")),
+                  JSONLResultStore(os.path.join(tmp_dir, "r.jsonl"))):
+        store.append_many([sample] * 3)
+        fake_client = FakeGspreadClient()
+        exporter = SheetsBulkExporter(store, lambda: fake_client, "fake-sheet", state_path=os.path.join(tmp_dir, f"{store.name}.state"), batch_size=2)
+        exporter.export_once()
+        store.append(sample)
+        exporter.export_once()
+        rows = fake_client.open_by_key("fake-sheet").worksheet("工作表1").rows
+        print(f"{store.name:>6} | 本地 {store.count()} 筆 | 匯出後工作表 {len(rows) - 1} 筆 | 第一筆: {rows[1]} | {exporter.stats}")
+        store.close()
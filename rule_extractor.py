@@ -0,0 +1,223 @@
+# rule_extractor.py
+
+"""
+本地規則式快速提取器。
+
+對於「4」、「是」、電子郵件、「我37歲」或結束指令這類簡單回答，直接依照編譯後問卷模型
+(questionnaire_model) 中的 type / options / validation_rule 提取答案，不呼叫 LLM。只有當整段輸入都能被規則完整解析、
+且只對應到唯一一個未回答問題時才算命中；其他情況返回 None，交由 LLM 處理。
+單獨的是/否與分數 (「好」、「不用」、「4」) 本身看不出在回答哪一題，只有當該題是上一輪提示語詢問的問題時才套用。
+"""
+
+import re
+import threading
+import time
+import weakref
+
+from questionnaire_model import DEFAULT_QUESTIONNAIRE
+
+END_COMMANDS = ["結束問卷", "完成問卷", "結束", "完成", "我想結束", "不用了", "quit", "exit", "done"]
+
+YES_WORDS = {"是", "是的", "好", "好的", "可以", "同意", "願意", "要", "yes", "y", "ok", "okay", "sure"}
+NO_WORDS = {"否", "不", "不是", "不要", "不好", "不可以", "不同意", "不願意", "不用", "no", "n", "nope"}
+
+CHINESE_DIGITS = {"一": 1, "二": 2, "兩": 2, "三": 3, "四": 4, "五": 5}
+
+_TRAILING_PUNCTUATION = "。.!！~～,，?？ "
+_EMAIL_RE = re.compile(r"^(?:我的)?(?:電子郵件|電郵|信箱|郵件|email|e-mail)?(?:地址)?\s*(?:是|:|：)?\s*([A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,})$", re.IGNORECASE)
+_SCORE_RE = re.compile(r"^(?:我給|給)?\s*([1-5一二三四五])\s*(?:分)?$")
+_AGE_RE = re.compile(r"^(?:我)?(?:今年)?(?:已經)?(\d{1,3})\s*(?:歲|岁)(?:了)?$")
+
+
+def _strip(text):
+    return text.strip().strip(_TRAILING_PUNCTUATION)
+
+
+class FastPathStats:
+    """
+    快速路徑的命中率與延遲統計 (執行緒安全)。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.rule_time = 0.0
+        self.llm_calls = 0
+        self.llm_time = 0.0
+
+    def record(self, hit, elapsed):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.rule_time += elapsed
+
+    def record_llm_call(self, elapsed):
+        with self._lock:
+            self.llm_calls += 1
+            self.llm_time += elapsed
+
+    @classmethod
+    def combined(cls, stats_list):
+        """
+        合併多個提取器 (預設問卷與各問卷版本各自的提取器) 的統計。
+        """
+        combined = cls()
+        for stats in stats_list:
+            with stats._lock:
+                combined.hits += stats.hits
+                combined.misses += stats.misses
+                combined.rule_time += stats.rule_time
+                combined.llm_calls += stats.llm_calls
+                combined.llm_time += stats.llm_time
+        return combined
+
+    def summary(self):
+        with self._lock:
+            total = self.hits + self.misses
+            avg_llm_ms = (self.llm_time / self.llm_calls * 1000) if self.llm_calls else 0.0
+            return {
+                "rule_calls": total,
+                "hits": self.hits,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "avg_rule_ms": round(self.rule_time / total * 1000, 4) if total else 0.0,
+                "llm_calls": self.llm_calls,
+                "avg_llm_ms": round(avg_llm_ms, 2),
+                "llm_calls_saved": self.hits,
+                "estimated_saved_ms": round(self.hits * avg_llm_ms, 2),
+            }
+
+
+class RuleBasedExtractor:
+    def __init__(self, questionnaire=None, end_commands=None):
+        self.questionnaire = questionnaire if questionnaire is not None else DEFAULT_QUESTIONNAIRE
+        self.end_commands = set(c.lower() for c in (end_commands or END_COMMANDS))
+        self.stats = FastPathStats()
+
+        # 依題目定義預先決定每一題適用的規則
+        self._email_ids = []
+        self._score_ids = []
+        self._yes_no_ids = []
+        # 選項查詢表與數字區間已在問卷編譯時建立
+        self._select_options = self.questionnaire.option_lookup # q_id -> {正規化選項: 原始選項}
+        self._range_options = self.questionnaire.range_options # q_id -> ((low, high, 原始選項), ...)
+        for q in self.questionnaire.questions:
+            q_id = q["id"]
+            q_type = q.get("type")
+            rule = q.get("validation_rule")
+            if q_type == "text" and rule == "email":
+                self._email_ids.append(q_id)
+            elif q_type == "number" and rule == "range_1_5":
+                self._score_ids.append(q_id)
+            elif q_type == "boolean":
+                self._yes_no_ids.append(q_id)
+
+    @staticmethod
+    def _only_candidate(q_ids, unanswered_ids):
+        candidates = [q_id for q_id in q_ids if q_id in unanswered_ids]
+        return candidates[0] if len(candidates) == 1 else None
+
+    def _match(self, raw_text, unanswered_ids, prompted_ids):
+        """
+        返回 (q_id, value)，無法以高置信度對應到唯一問題時返回 None。
+        """
+        m = _EMAIL_RE.match(raw_text) # 電子郵件保留原本的大小寫
+        if m:
+            q_id = self._only_candidate(self._email_ids, unanswered_ids)
+            return (q_id, m.group(1)) if q_id else None
+
+        text = raw_text.lower()
+
+        m = _SCORE_RE.match(text)
+        if m:
+            q_id = self._only_candidate(self._score_ids, unanswered_ids)
+            if q_id not in prompted_ids:
+                return None
+            raw = m.group(1)
+            return q_id, CHINESE_DIGITS.get(raw) or int(raw)
+
+        if text in YES_WORDS or text in NO_WORDS:
+            # 「好」也可能是回應「我們可以開始嗎」這類提問
+            q_id = self._only_candidate(self._yes_no_ids, unanswered_ids)
+            if q_id not in prompted_ids:
+                return None
+            return q_id, "是" if text in YES_WORDS else "否"
+
+        m = _AGE_RE.match(text)
+        if m:
+            q_id = self._only_candidate(self._range_options, unanswered_ids)
+            if not q_id:
+                return None
+            age = int(m.group(1))
+            for low, high, opt in self._range_options[q_id]:
+                if low <= age and (high is None or age <= high):
+                    return q_id, opt
+            return None
+
+        matched = [(q_id, opts[text]) for q_id, opts in self._select_options.items() if text in opts and q_id in unanswered_ids]
+        if len(matched) == 1:
+            return matched[0]
+        return None
+
+    def extract(self, user_input, unanswered_ids, prompted_ids=()):
+        """
+        嘗試以規則提取答案。命中時返回與 AINLULayer.parse_chat_response_to_answers 相同格式的結果，否則返回 None。
+        prompted_ids: 上一輪提示語具體詢問的問題；單獨的是/否與分數只對應到其中的問題。
+        """
+        start = time.perf_counter()
+        result = None
+        text = _strip(user_input)
+        if text:
+            if text.lower() in self.end_commands:
+                result = {"extracted_answers": {}, "action_request": "finish_questionnaire", "reasoning": "rule: end command"}
+            else:
+                match = self._match(text, unanswered_ids, prompted_ids)
+                if match:
+                    q_id, value = match
+                    result = {"extracted_answers": {q_id: value}, "action_request": "continue_questionnaire", "reasoning": f"rule: {q_id}"}
+        self.stats.record(result is not None, time.perf_counter() - start)
+        return result
+
+
+_default_extractor = None
+_shared_extractors = weakref.WeakValueDictionary() # (問卷 id, version) -> 仍有會話使用的提取器
+_shared_extractors_lock = threading.Lock()
+
+def get_default_rule_extractor():
+    global _default_extractor
+    if _default_extractor is None:
+        _default_extractor = RuleBasedExtractor()
+    return _default_extractor
+
+
+def live_rule_extractors():
+    """
+    返回預設提取器與仍有會話使用的各問卷版本提取器。
+    """
+    with _shared_extractors_lock:
+        shared = list(_shared_extractors.values())
+    return [get_default_rule_extractor()] + shared
+
+
+def get_rule_extractor(questionnaire):
+    """
+    同一版本問卷的所有會話共用一個提取器 (選項查詢表、年齡區間等只建立一次)；
+    沒有會話使用的版本會被回收。
+    """
+    if questionnaire is DEFAULT_QUESTIONNAIRE:
+        return get_default_rule_extractor()
+    key = (questionnaire.name, questionnaire.version)
+    with _shared_extractors_lock:
+        extractor = _shared_extractors.get(key)
+        if extractor is None:
+            extractor = _shared_extractors[key] = RuleBasedExtractor(questionnaire)
+        return extractor
+
+
+if __name__ == '__main__':
+    extractor = RuleBasedExtractor()
+    all_ids = set(DEFAULT_QUESTIONNAIRE.headers)
+    for sample in ["4", "是", "test@example.com", "我的email是 a@b.co", "我37歲", "25-34", "結束。", "我叫王小明，今年30歲", "還好吧"]:
+        print(f"{sample!r:>28} -> {extractor.extract(sample, all_ids, all_ids)}")
+    print(extractor.stats.summary())
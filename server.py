@@ -0,0 +1,351 @@
+# server.py
+
+"""
+本地 HTTP 前端 (僅使用標準函式庫)，將 SessionEngine 以 JSON API 提供：
+
+    POST /sessions                  body (可省略): {"questionnaire": 問卷 id} -> {"session_id": ..., "reply": 歡迎語}
+    POST /sessions/<id>/turn        body: {"text": "..."} -> {"reply": ..., "finished": bool}
+    POST /sessions/<id>/turn?stream=1
+                                    -> NDJSON (chunked)：逐行 {"delta": "..."}，最後一行
+                                       {"reply": ..., "finished": bool, "ttft_ms": ...}
+    DELETE /sessions/<id>           -> {"ok": true}
+    GET  /health                    -> {"ok": true, "active_sessions": N}
+    GET  /stats                     -> 規則快速路徑命中率、回應快取等統計
+    GET  /metrics                   -> Prometheus 文字格式的指標 (各階段耗時、token/費用、快取命中率)
+    GET  /metrics?format=json       -> 同上，JSON 格式
+    GET  /analytics[?questionnaire=id]
+                                    -> 已提交答案的彙總統計 (各選項次數、數字題平均/變異數、各題完成率與中斷率)
+
+用法：
+    python server.py --host 127.0.0.1 --port 8080
+    python server.py --workers 4      # 多程序：會話依 ID 固定分配到 4 個 worker 程序 (worker_pool.py)
+    python server.py --questionnaires surveys/   # 從目錄載入多份問卷定義 (questionnaire_registry.py)，修改後自動重新載入
+    python server.py --analytics-state analytics_state.json   # 答案統計定期保存，重啟後接續累計
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+import time
+from urllib.parse import parse_qs
+
+from answer_analytics import ANALYTICS, AnswerAnalytics
+from metrics import METRICS
+from session_engine import SessionEngine, SessionNotFoundError
+
+MAX_BODY_SIZE = 64 * 1024
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class QuestionnaireHTTPServer:
+    def __init__(self, engine, host="127.0.0.1", port=8080, analytics_baseline=None):
+        """
+        analytics_baseline: 使用 WorkerPool 時，先前保存的答案統計狀態 (AnswerAnalytics.export_state())，
+                            查詢時與各 worker 的統計合併。
+        """
+        self.engine = engine
+        self.host = host
+        self.port = port
+        self.analytics_baseline = analytics_baseline
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        print(f"問卷伺服器已啟動：http://{self.host}:{self.port}")
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                except ValueError:
+                    await self._write_response(writer, 400, {"error": "bad request line"}, keep_alive=False)
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get("content-length", "0") or 0)
+                if length > MAX_BODY_SIZE:
+                    await self._write_response(writer, 413, {"error": "body too large"}, keep_alive=False)
+                    break
+                body = await reader.readexactly(length) if length else b""
+                keep_alive = headers.get("connection", "").lower() != "close"
+
+                if self._wants_stream(method.upper(), path):
+                    await self._stream_turn(writer, path, body, keep_alive)
+                    if not keep_alive:
+                        break
+                    continue
+                status, payload = await self._dispatch(method.upper(), path, body)
+                await self._write_response(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method, path, body):
+        parts = [p for p in path.split("?", 1)[0].split("/") if p]
+        try:
+            data = json.loads(body) if body else {}
+        except json.JSONDecodeError:
+            return 400, {"error": "invalid JSON body"}
+
+        try:
+            if parts == ["health"] and method == "GET":
+                return 200, {"ok": True, "active_sessions": self.engine.active_session_count()}
+            if parts == ["stats"] and method == "GET":
+                stats = self.engine.stats()
+                # WorkerPool 的統計需要詢問各 worker 程序
+                return 200, await stats if asyncio.iscoroutine(stats) else stats
+            if parts == ["metrics"] and method == "GET":
+                query = parse_qs(path.partition("?")[2])
+                collect = getattr(self.engine, "collect_metrics", None)
+                metrics = await collect() if collect is not None else METRICS
+                if query.get("format", [""])[-1] == "json":
+                    return 200, metrics.to_dict()
+                return 200, metrics.render_prometheus()
+            if parts == ["analytics"] and method == "GET":
+                query = parse_qs(path.partition("?")[2])
+                analytics = await _collect_analytics(self.engine, self.analytics_baseline)
+                return 200, analytics.snapshot(query.get("questionnaire", [None])[-1])
+            if parts == ["sessions"] and method == "POST":
+                questionnaire_id = data.get("questionnaire")
+                if questionnaire_id is not None and not isinstance(questionnaire_id, str):
+                    return 400, {"error": "'questionnaire' must be a string"}
+                session_id, reply = await self.engine.start_session(data.get("session_id"), questionnaire_id=questionnaire_id)
+                return 200, {"session_id": session_id, "reply": reply}
+            if len(parts) == 3 and parts[0] == "sessions" and parts[2] == "turn" and method == "POST":
+                text = data.get("text")
+                if not isinstance(text, str):
+                    return 400, {"error": "'text' is required"}
+                reply = await self.engine.turn(parts[1], text)
+                return 200, {"reply": reply, "finished": not self.engine.is_active(parts[1])}
+            if len(parts) == 2 and parts[0] == "sessions" and method == "DELETE":
+                self.engine.end_session(parts[1])
+                return 200, {"ok": True}
+        except SessionNotFoundError:
+            return 404, {"error": "session not found"}
+        except ValueError as e:
+            return 400, {"error": str(e)}
+        except Exception as e:
+            print(f"處理請求 {method} {path} 時發生錯誤: {e}")
+            return 500, {"error": "internal error"}
+        return 404, {"error": "not found"}
+
+    @staticmethod
+    def _wants_stream(method, path):
+        route, _, query = path.partition("?")
+        parts = [p for p in route.split("/") if p]
+        return (method == "POST" and len(parts) == 3 and parts[0] == "sessions" and parts[2] == "turn"
+                and parse_qs(query).get("stream", ["0"])[-1] not in ("0", "false", ""))
+
+    async def _stream_turn(self, writer, path, body, keep_alive):
+        """
+        以 chunked transfer 逐行輸出 NDJSON：{"delta": ...} 區塊，最後是與非串流回應相同的結果加上 ttft_ms。
+        回應標頭送出前發生的錯誤 (JSON 格式、會話不存在) 仍以一般 JSON 錯誤回應。
+        """
+        session_id = [p for p in path.split("?", 1)[0].split("/") if p][1]
+        try:
+            data = json.loads(body) if body else {}
+        except json.JSONDecodeError:
+            return await self._write_response(writer, 400, {"error": "invalid JSON body"}, keep_alive)
+        text = data.get("text")
+        if not isinstance(text, str):
+            return await self._write_response(writer, 400, {"error": "'text' is required"}, keep_alive)
+        if not await _session_exists(self.engine, session_id):
+            return await self._write_response(writer, 404, {"error": "session not found"}, keep_alive)
+
+        head = (
+            "HTTP/1.1 200 OK\r\n"
+            "Content-Type: application/x-ndjson; charset=utf-8\r\n"
+            "Transfer-Encoding: chunked\r\n"
+            "Cache-Control: no-cache\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1"))
+
+        async def send_line(payload):
+            line = (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
+            writer.write(f"{len(line):x}\r\n".encode("latin-1") + line + b"\r\n")
+            await writer.drain()
+
+        start = time.perf_counter()
+        ttft = None
+        parts = []
+        try:
+            async for piece in self.engine.turn_stream(session_id, text):
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                parts.append(piece)
+                await send_line({"delta": piece})
+            await send_line({
+                "reply": "".join(parts),
+                "finished": not self.engine.is_active(session_id),
+                "ttft_ms": round(ttft * 1000, 2) if ttft is not None else None,
+            })
+        except SessionNotFoundError:
+            await send_line({"error": "session not found"})
+        except (ConnectionError, asyncio.CancelledError):
+            raise
+        except Exception as e:
+            print(f"處理串流請求 POST {path} 時發生錯誤: {e}")
+            await send_line({"error": "internal error"})
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def _write_response(self, writer, status, payload, keep_alive):
+        # 字串 payload 以純文字送出 (Prometheus 文字格式)，其餘為 JSON
+        if isinstance(payload, str):
+            body = payload.encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            content_type = "application/json; charset=utf-8"
+        head = (
+            f"HTTP/1.1 {status} {_REASONS.get(status, 'OK')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+
+async def _idle_session_reaper(engine, interval=60.0):
+    while True:
+        await asyncio.sleep(interval)
+        evicted = engine.evict_idle_sessions()
+        if evicted:
+            print(f"已移除 {evicted} 個閒置會話。")
+
+
+async def _session_exists(engine, session_id):
+    # WorkerPool 需要詢問負責的 worker (會話可能只存在於快照中)；SessionEngine.is_active 已會查詢快照
+    check = getattr(engine, "check_active", None)
+    if check is None:
+        return engine.is_active(session_id)
+    return await check(session_id)
+
+
+async def _collect_analytics(engine, baseline=None):
+    # 單一程序時直接使用程序內的統計；WorkerPool 需要詢問各 worker 程序並加上先前保存的狀態
+    collect = getattr(engine, "collect_analytics", None)
+    if collect is None:
+        return ANALYTICS
+    analytics = await collect()
+    if baseline:
+        analytics.merge_state(baseline)
+    return analytics
+
+
+async def _analytics_saver(engine, path, baseline=None, interval=60.0):
+    while True:
+        await asyncio.sleep(interval)
+        (await _collect_analytics(engine, baseline)).save(path)
+
+
+def _create_engine(response_cache_path=None, session_store_kind=None, session_store_path=None, questionnaire_dir=None):
+    session_store = None
+    if session_store_kind:
+        from session_store import create_session_store
+        session_store = create_session_store(session_store_kind, session_store_path)
+    registry = None
+    if questionnaire_dir:
+        from questionnaire_registry import QuestionnaireRegistry
+        registry = QuestionnaireRegistry(questionnaire_dir)
+    return SessionEngine(response_cache_path=response_cache_path, session_store=session_store, registry=registry)
+
+
+async def _serve(host, port, response_cache_path=None, session_store_kind=None, session_store_path=None, workers=0,
+                 questionnaire_dir=None, analytics_state_path=None):
+    engine_factory = functools.partial(_create_engine, response_cache_path, session_store_kind, session_store_path,
+                                       questionnaire_dir)
+    baseline = None
+    if workers:
+        # 每個 worker 程序在自己的程序中建立 SessionEngine；閒置會話由各 worker 自行移除
+        from worker_pool import WorkerPool
+        engine = await WorkerPool(workers, engine_factory=engine_factory).start()
+        reaper = None
+        if analytics_state_path:
+            history = AnswerAnalytics()
+            history.load(analytics_state_path)
+            baseline = history.export_state()
+    else:
+        engine = engine_factory()
+        reaper = asyncio.create_task(_idle_session_reaper(engine))
+        if analytics_state_path:
+            ANALYTICS.load(analytics_state_path)
+    saver = asyncio.create_task(_analytics_saver(engine, analytics_state_path, baseline)) if analytics_state_path else None
+    await engine.warm_up()
+    try:
+        await QuestionnaireHTTPServer(engine, host, port, analytics_baseline=baseline).serve_forever()
+    finally:
+        if saver is not None:
+            saver.cancel()
+            try:
+                (await _collect_analytics(engine, baseline)).save(analytics_state_path)
+            except Exception as e:
+                print(f"保存答案統計時發生錯誤: {e}")
+        if reaper is not None:
+            reaper.cancel()
+        # SessionEngine.close() 關閉記憶體中的會話 (快照保留)；WorkerPool.close() 等進行中的回合完成後結束 worker
+        closed = engine.close()
+        if asyncio.iscoroutine(closed):
+            await closed
+        else:
+            # 單一程序時定時匯出在本程序中執行，結束前最後匯出一次 (Sheets 佇列由 atexit 寫完)
+            from result_stores import stop_bulk_exports
+            await asyncio.get_running_loop().run_in_executor(None, stop_bulk_exports)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="問卷 AI Agent HTTP 伺服器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--response-cache", default=None, help="歡迎語/提示語與答案提取快取的 SQLite 檔案路徑 (可選)")
+    parser.add_argument("--session-store", default=None, choices=["sqlite", "log"],
+                        help="每回合寫入會話快照，重啟或換 worker 後可繼續問卷 (可選)")
+    parser.add_argument("--session-store-path", default=None, help="會話快照檔案路徑，預設 questionnaire_sessions.*")
+    parser.add_argument("--workers", type=int, default=0, help="worker 程序數 (0 為單一程序)；會話依 ID 固定分配到各 worker")
+    parser.add_argument("--questionnaires", default=None,
+                        help="問卷定義目錄 (*.json / *.yaml)；建立會話時以 {\"questionnaire\": id} 指定問卷，定義修改後自動重新載入")
+    parser.add_argument("--analytics-state", default=None,
+                        help="答案統計的狀態檔；啟動時載入、每分鐘與結束時保存 (可先以 answer_analytics.py --backfill 由歷史資料建立)")
+    parser.add_argument("--no-metrics", action="store_true", help="停用 /metrics 的指標收集")
+    parser.add_argument("--slow-turn-ms", type=float, default=None, help="回合超過這個毫秒數時印出各階段耗時分解")
+    args = parser.parse_args()
+    if args.workers and args.session_store == "log":
+        # 多個程序寫入同一個日誌時，任一程序自動壓縮都會遺失其他程序的寫入 (見 session_store.LogSessionStore)
+        parser.error("--workers 需搭配 --session-store sqlite；log 只適用於單一程序。")
+    if args.no_metrics:
+        METRICS.enabled = False
+    if args.slow_turn_ms is not None:
+        METRICS.slow_turn_threshold = args.slow_turn_ms / 1000
+    asyncio.run(_serve(args.host, args.port, args.response_cache, args.session_store, args.session_store_path, args.workers,
+                       args.questionnaires, args.analytics_state))
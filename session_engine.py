@@ -0,0 +1,338 @@
+# session_engine.py
+
+"""
+非同步多會話問卷引擎。
+
+每個會話對應一個 QuestionnaireAgent (對話狀態機)，所有會話共用同一個 AINLULayer 與其非同步
+OpenAI 客戶端，因此單一程序即可同時服務大量填答者。前端 (CLI、HTTP 伺服器等) 只需呼叫
+start_session() 與 turn(session_id, text)；需要邊生成邊顯示時傳入 on_chunk 回呼，或使用 turn_stream()。
+
+提供 session_store 時，每回合結束後會寫入會話快照；記憶體中找不到的會話 (程序重啟、由其他 worker
+接手) 會從快照恢復，記憶體中的會話若已被其他 worker 推進也會重新載入。
+
+提供 registry (questionnaire_registry.QuestionnaireRegistry) 時可同時服務多份問卷：start_session() 指定問卷 id，
+會話固定使用開始時的問卷版本 (定義熱重載後也不變)，同一版本的會話共用一個 AINLULayer 與規則提取器。
+"""
+
+import asyncio
+import time
+import uuid
+import weakref
+
+from ai_agents import QuestionnaireAgent, TURN_PIPELINE_STATS
+from ai_nlu_layer import AINLULayer
+from extraction_cache import ExtractionCache
+from metrics import METRICS
+from response_cache import ResponseCache
+
+
+class SessionNotFoundError(KeyError):
+    pass
+
+
+class _Session:
+    __slots__ = ("agent", "lock", "last_active", "turn")
+
+    def __init__(self, agent, turn=0):
+        self.agent = agent
+        self.lock = asyncio.Lock() # 同一會話的輸入依序處理
+        self.last_active = time.monotonic()
+        self.turn = turn # 已完成的回合數 (歡迎語為第 0 回合)，用於判斷快照新舊
+
+
+class SessionEngine:
+    def __init__(self, nlu_agent=None, agent_factory=QuestionnaireAgent, idle_timeout=1800.0, response_cache_path=None,
+                 session_store=None, registry=None):
+        """
+        response_cache_path: 提供時歡迎語/下一步提示與答案提取結果的快取會另外保存在該 SQLite 檔案中。
+        session_store: session_store.SessionStore；提供時每回合寫入會話快照，並可恢復記憶體中沒有的會話。
+        registry: questionnaire_registry.QuestionnaireRegistry；None 時所有會話使用預設問卷。
+        """
+        self.nlu_agent = nlu_agent
+        self.agent_factory = agent_factory
+        self.idle_timeout = idle_timeout
+        self.response_cache_path = response_cache_path
+        self.session_store = session_store
+        self.registry = registry
+        self._nlu_layers = weakref.WeakValueDictionary() # (問卷 id, version) -> 該版本會話共用的 AINLULayer
+        self._sessions = {}
+        self.resumed_sessions = 0
+
+    def _get_nlu_agent(self):
+        if self.nlu_agent is None:
+            self.nlu_agent = AINLULayer(response_cache=ResponseCache(sqlite_path=self.response_cache_path),
+                                        extraction_cache=ExtractionCache(sqlite_path=self.response_cache_path))
+        return self.nlu_agent
+
+    def _nlu_for(self, questionnaire):
+        nlu = self._get_nlu_agent()
+        if questionnaire is nlu.questionnaire:
+            return nlu
+        key = (questionnaire.name, questionnaire.version)
+        layer = self._nlu_layers.get(key)
+        if layer is None:
+            layer = self._nlu_layers[key] = nlu.for_questionnaire(questionnaire)
+        return layer
+
+    def _create_agent(self, questionnaire=None):
+        if questionnaire is None:
+            return self.agent_factory(nlu_agent=self._get_nlu_agent())
+        return self.agent_factory(nlu_agent=self._nlu_for(questionnaire), questionnaire=questionnaire)
+
+    def _questionnaire_for(self, state):
+        # 恢復的會話使用快照中記錄的問卷版本，而不是目前的版本
+        if self.registry is None:
+            return None
+        return self.registry.get_version(state.questionnaire_id, state.questionnaire_version)
+
+    async def warm_up(self):
+        """
+        預先生成歡迎語變體池，讓新會話開始時不必等待 LLM。
+        """
+        pool_size = await self._get_nlu_agent().aprewarm_greeting_pool()
+        print(f"已預先生成 {pool_size} 個歡迎語變體。")
+        return pool_size
+
+    def _get_session(self, session_id):
+        session = self._sessions.get(session_id)
+        if session is None:
+            session = self._resume_session(session_id)
+        if session is None:
+            raise SessionNotFoundError(session_id)
+        return session
+
+    def _resume_session(self, session_id):
+        if self.session_store is None:
+            return None
+        state = self.session_store.load(session_id)
+        if state is None or state.finished:
+            return None
+        agent = self._create_agent(self._questionnaire_for(state))
+        agent.restore(state)
+        session = _Session(agent, state.turn)
+        self._sessions[session_id] = session
+        self.resumed_sessions += 1
+        return session
+
+    def _sync_with_store(self, session_id, session):
+        # 其他 worker 已推進此會話時，以最新快照取代記憶體中的舊狀態
+        if self.session_store is None:
+            return session
+        latest_turn = self.session_store.latest_turn(session_id)
+        if latest_turn is None or latest_turn <= session.turn:
+            return session
+        state = self.session_store.load(session_id)
+        session.agent.close()
+        session.agent = self._create_agent(self._questionnaire_for(state)).restore(state)
+        session.turn = state.turn
+        self.resumed_sessions += 1
+        return session
+
+    def _checkpoint(self, session_id, session):
+        if self.session_store is None:
+            return
+        if session.agent.finished:
+            # 答案已交給結果儲存後端，快照不再需要
+            self.session_store.delete(session_id)
+        else:
+            with METRICS.timer("checkpoint_seconds"):
+                self.session_store.save(session.agent.snapshot(session_id, session.turn))
+
+    async def start_session(self, session_id=None, on_chunk=None, questionnaire_id=None):
+        """
+        建立新會話，返回 (session_id, 歡迎語)。on_chunk 提供時歡迎語會逐塊傳入。
+        questionnaire_id: registry 中的問卷 id，使用該問卷目前的版本；None 為預設問卷。
+        """
+        session_id = session_id or uuid.uuid4().hex
+        if self.is_active(session_id):
+            raise ValueError(f"會話 '{session_id}' 已存在。")
+        if self.registry is not None:
+            questionnaire = self.registry.get(questionnaire_id or "default")
+        elif questionnaire_id not in (None, "default"):
+            raise ValueError(f"沒有設定問卷註冊表，無法使用問卷 '{questionnaire_id}'。")
+        else:
+            questionnaire = None
+        agent = self._create_agent(questionnaire)
+        session = _Session(agent)
+        self._sessions[session_id] = session
+        async with session.lock:
+            greeting = await agent.astart(on_chunk=on_chunk)
+            self._checkpoint(session_id, session)
+        return session_id, greeting
+
+    async def turn(self, session_id, text, on_chunk=None):
+        """
+        處理一次使用者輸入並返回回覆。問卷結束後會話會被移除。on_chunk 提供時回覆會逐塊傳入。
+        """
+        session = self._get_session(session_id)
+        async with session.lock:
+            session = self._sync_with_store(session_id, session)
+            session.last_active = time.monotonic()
+            reply = await session.agent.aturn(text, on_chunk=on_chunk)
+            session.turn += 1
+            self._checkpoint(session_id, session)
+            if session.agent.finished:
+                self._sessions.pop(session_id, None)
+        return reply
+
+    async def turn_stream(self, session_id, text):
+        """
+        turn() 的非同步產生器版本：逐塊 yield 回覆文字。會話不存在時在第一次迭代拋出 SessionNotFoundError。
+        """
+        self._get_session(session_id)
+        queue = asyncio.Queue()
+        task = asyncio.ensure_future(self.turn(session_id, text, on_chunk=queue.put_nowait))
+        task.add_done_callback(lambda _: queue.put_nowait(None))
+        try:
+            while True:
+                piece = await queue.get()
+                if piece is None:
+                    break
+                yield piece
+            await task # 傳遞 turn() 中的例外
+        finally:
+            if not task.done():
+                task.cancel()
+
+    def is_active(self, session_id):
+        # 閒置移除或程序重啟後，仍有快照的會話也可以繼續
+        if session_id in self._sessions:
+            return True
+        return self.session_store is not None and self.session_store.latest_turn(session_id) is not None
+
+    def end_session(self, session_id):
+        session = self._sessions.pop(session_id, None)
+        if session is not None:
+            session.agent.close()
+        if self.session_store is not None:
+            self.session_store.delete(session_id)
+
+    def active_session_count(self):
+        return len(self._sessions)
+
+    def session_ids(self):
+        return list(self._sessions)
+
+    async def detach_session(self, session_id):
+        """
+        等進行中的回合完成後，將會話從此引擎移除並返回其 SessionState (移交給其他引擎用)；
+        會話不存在或已結束時返回 None。快照 (若有) 保留不刪除。
+        """
+        session = self._sessions.get(session_id)
+        if session is None:
+            return None
+        async with session.lock:
+            if self._sessions.get(session_id) is not session:
+                return None
+            del self._sessions[session_id]
+            state = session.agent.snapshot(session_id, session.turn)
+            session.agent.close()
+        return state
+
+    def attach_session(self, state):
+        """
+        接手由 detach_session() 移交的會話。
+        """
+        agent = self._create_agent(self._questionnaire_for(state))
+        agent.restore(state)
+        self._sessions[state.session_id] = _Session(agent, state.turn)
+
+    def close(self):
+        """
+        關閉記憶體中的所有會話；與 end_session() 不同，快照保留，會話之後仍可恢復。
+        """
+        for session in self._sessions.values():
+            session.agent.close()
+        self._sessions.clear()
+
+    def _live_nlu_layers(self):
+        # 預設的 AINLULayer 與仍有會話使用的各問卷版本 AINLULayer
+        layers = [] if self.nlu_agent is None else [self.nlu_agent]
+        layers.extend(self._nlu_layers.values())
+        return layers
+
+    @staticmethod
+    def _distinct(objects):
+        # for_questionnaire() 建立的 AINLULayer 預設共用快取與統計物件，依物件去重，避免重複計算
+        unique = {}
+        for obj in objects:
+            if obj is not None:
+                unique.setdefault(id(obj), obj)
+        return list(unique.values())
+
+    def stats(self):
+        from ai_nlu_layer import StreamingStats
+        from openai_client_manager import OpenAIClientManager
+        from rule_extractor import FastPathStats, live_rule_extractors
+
+        layers = self._live_nlu_layers()
+        extraction_caches = self._distinct(layer.extraction_cache for layer in layers)
+        return {
+            "active_sessions": self.active_session_count(),
+            "rule_fast_path": FastPathStats.combined(self._distinct(e.stats for e in live_rule_extractors())).summary(),
+            "turn_pipeline": TURN_PIPELINE_STATS.summary(),
+            "response_cache": self._response_cache_stats(),
+            "extraction_cache": ExtractionCache.combined_stats(extraction_caches) if extraction_caches else None,
+            "openai_client": OpenAIClientManager.combined_summary(self._distinct(layer.client_manager for layer in layers))
+                             if layers else None,
+            "streaming": StreamingStats.combined(self._distinct(layer.streaming_stats for layer in layers)).summary()
+                         if layers else None,
+            "model_routing": self._model_routing_stats(),
+            "chat_memory": self._chat_memory_stats(),
+            "session_store": dict(self.session_store.stats(), resumed_sessions=self.resumed_sessions)
+                             if self.session_store is not None else None,
+            "questionnaires": self._questionnaire_stats(),
+        }
+
+    def _questionnaire_stats(self):
+        if self.registry is None:
+            return None
+        sessions = {}
+        for session in self._sessions.values():
+            questionnaire = session.agent.questionnaire
+            key = f"{questionnaire.name}@{questionnaire.version}"
+            sessions[key] = sessions.get(key, 0) + 1
+        return dict(self.registry.stats(), sessions_by_version=sessions, shared_nlu_layers=len(self._nlu_layers))
+
+    def _model_routing_stats(self):
+        nlu = self.nlu_agent
+        if nlu is None:
+            return None
+        models = {kind: nlu.model_for(kind) for kind in ("extraction", "greeting", "next_prompt", "clarification", "summary")}
+        return {"models": models, "escalation_model": nlu.escalation_model, **nlu.routing_stats.summary()}
+
+    def _chat_memory_stats(self):
+        # 每個會話對話歷史的記憶體用量與每回合送出的歷史 token 數 (最近 8 則 + 摘要)
+        memories = [s.agent.chat_history for s in self._sessions.values()]
+        if not memories:
+            return {"sessions": 0}
+        sizes = [m.memory_bytes() for m in memories]
+        history_tokens = [m.prompt_tokens(8) for m in memories]
+        return {
+            "sessions": len(memories),
+            "avg_bytes_per_session": round(sum(sizes) / len(sizes)),
+            "max_bytes_per_session": max(sizes),
+            "avg_history_tokens_per_turn": round(sum(history_tokens) / len(history_tokens), 1),
+            "max_history_tokens_per_turn": max(history_tokens),
+            "summaries": sum(m.summaries for m in memories),
+        }
+
+    def _response_cache_stats(self):
+        nlu = self.nlu_agent
+        if nlu is None or nlu.greeting_cache is None:
+            return None
+        return {
+            "cache": nlu.greeting_cache.cache.stats(),
+            "greeting": nlu.greeting_cache.stats(),
+            "next_prompt": nlu.next_prompt_cache.stats(),
+        }
+
+    def evict_idle_sessions(self):
+        """
+        移除超過 idle_timeout 未活動的會話，返回移除數量。
+        """
+        now = time.monotonic()
+        expired = [sid for sid, s in self._sessions.items() if now - s.last_active > self.idle_timeout and not s.lock.locked()]
+        for sid in expired:
+            self._sessions.pop(sid).agent.close()
+        return len(expired)
@@ -0,0 +1,352 @@
+# session_store.py
+
+"""
+會話狀態的快照與恢復。
+
+SessionEngine 在每回合結束後將 QuestionnaireAgent 的狀態 (已收集的答案、未回答/隱藏/必填問題、
+對話歷史與摘要等) 序列化為精簡的 SessionState 並寫入本地儲存；程序重啟或由另一個 worker
+接手時，依 session_id 以 O(1) 查詢取回最新快照繼續問卷，不必重新開始。
+
+- SQLiteSessionStore: 以 session_id 為主鍵的 SQLite (WAL 模式)，多個程序可共用同一個檔案
+- LogSessionStore: 只追加的快照日誌 + 記憶體中的 session_id -> 位移索引，可定期壓縮
+
+兩者都以回合數 (turn) 防止較舊的快照覆蓋較新的快照 (例如兩個 worker 短暫同時持有同一會話)。
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+
+SNAPSHOT_FORMAT = 1
+
+
+class SessionState:
+    """
+    QuestionnaireAgent 可恢復的狀態。集合以排序後的 list 保存，對話訊息以 [role, content] 保存。
+    questionnaire_id 與 questionnaire_version 指出會話開始時使用的問卷版本 (questionnaire_registry)；
+    questionnaire_id 放在最後，沒有這個欄位的舊快照視為預設問卷；submission_id 為這次作答的提交識別碼，
+    沒有這個欄位的舊快照沿用 session_id。
+    """
+    __slots__ = ("session_id", "questionnaire_version", "turn", "collected_answers", "unanswered_ids", "hidden_ids",
+                 "required_ids", "last_prompted_ids", "finished", "awaiting_exit_confirmation", "pending_farewell",
+                 "chat_messages", "chat_summary", "chat_pending", "token_usage", "updated_at", "questionnaire_id",
+                 "submission_id")
+
+    def __init__(self, session_id, questionnaire_version, turn, collected_answers, unanswered_ids, hidden_ids,
+                 required_ids, last_prompted_ids, finished=False, awaiting_exit_confirmation=False, pending_farewell=None,
+                 chat_messages=(), chat_summary="", chat_pending=(), token_usage=None, updated_at=None,
+                 questionnaire_id="default", submission_id=None):
+        self.session_id = session_id
+        self.questionnaire_version = questionnaire_version
+        self.turn = turn
+        self.collected_answers = collected_answers
+        self.unanswered_ids = unanswered_ids
+        self.hidden_ids = hidden_ids
+        self.required_ids = required_ids
+        self.last_prompted_ids = last_prompted_ids
+        self.finished = finished
+        self.awaiting_exit_confirmation = awaiting_exit_confirmation
+        self.pending_farewell = pending_farewell
+        self.chat_messages = chat_messages
+        self.chat_summary = chat_summary
+        self.chat_pending = chat_pending
+        self.token_usage = token_usage or {}
+        self.updated_at = updated_at if updated_at is not None else time.time()
+        self.questionnaire_id = questionnaire_id
+        self.submission_id = submission_id
+
+    def to_bytes(self):
+        # 依 __slots__ 順序的精簡 JSON 陣列，不重複保存欄位名稱
+        values = [SNAPSHOT_FORMAT] + [getattr(self, name) for name in self.__slots__]
+        return json.dumps(values, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    @classmethod
+    def from_bytes(cls, data):
+        values = json.loads(data)
+        if values[0] != SNAPSHOT_FORMAT:
+            raise ValueError(f"不支援的會話快照格式版本: {values[0]}")
+        return cls(*values[1:])
+
+
+class _SaveTimer:
+    """
+    記錄最近的快照寫入耗時。
+    """
+    def __init__(self, max_samples=1000):
+        self.samples = deque(maxlen=max_samples)
+        self.saves = 0
+        self.stale_skips = 0
+
+    def record(self, seconds):
+        self.saves += 1
+        self.samples.append(seconds)
+
+    def summary(self):
+        if not self.samples:
+            return {"saves": self.saves, "stale_skips": self.stale_skips}
+        ordered = sorted(self.samples)
+        return {
+            "saves": self.saves,
+            "stale_skips": self.stale_skips,
+            "save_p50_ms": round(ordered[len(ordered) // 2] * 1000, 3),
+            "save_p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 3),
+        }
+
+
+class SessionStore:
+    """
+    會話快照儲存介面：save(state) 寫入最新快照，load(session_id) 取回 (不存在時為 None)，
+    latest_turn(session_id) 只查詢回合數，供判斷記憶體中的會話是否已被其他 worker 推進。
+    """
+    name = "base"
+
+    def __init__(self):
+        self.timer = _SaveTimer()
+
+    def save(self, state):
+        start = time.perf_counter()
+        saved = self._save(state)
+        if saved:
+            self.timer.record(time.perf_counter() - start)
+        else:
+            self.timer.stale_skips += 1
+        return saved
+
+    def _save(self, state):
+        raise NotImplementedError
+
+    def load(self, session_id):
+        raise NotImplementedError
+
+    def latest_turn(self, session_id):
+        state = self.load(session_id)
+        return state.turn if state is not None else None
+
+    def delete(self, session_id):
+        raise NotImplementedError
+
+    def session_ids(self):
+        raise NotImplementedError
+
+    def stats(self):
+        return {"store": self.name, **self.timer.summary()}
+
+    def close(self):
+        pass
+
+
+class SQLiteSessionStore(SessionStore):
+    name = "sqlite"
+
+    def __init__(self, path="questionnaire_sessions.db", synchronous="NORMAL"):
+        """
+        synchronous: WAL 模式下 NORMAL 在程序崩潰時不會遺失快照，且每次寫入不需 fsync。
+        """
+        super().__init__()
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=10.0)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(f"PRAGMA synchronous={synchronous}")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, turn INTEGER NOT NULL, "
+            "updated_at REAL NOT NULL, state BLOB NOT NULL)")
+        self._db.commit()
+
+    def _save(self, state):
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO sessions (session_id, turn, updated_at, state) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(session_id) DO UPDATE SET turn = excluded.turn, updated_at = excluded.updated_at, "
+                "state = excluded.state WHERE excluded.turn >= sessions.turn",
+                (state.session_id, state.turn, state.updated_at, state.to_bytes()))
+            self._db.commit()
+            return cursor.rowcount > 0
+
+    def load(self, session_id):
+        with self._lock:
+            row = self._db.execute("SELECT state FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return SessionState.from_bytes(row[0]) if row else None
+
+    def latest_turn(self, session_id):
+        with self._lock:
+            row = self._db.execute("SELECT turn FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return row[0] if row else None
+
+    def delete(self, session_id):
+        with self._lock:
+            self._db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            self._db.commit()
+
+    def session_ids(self):
+        with self._lock:
+            return [r[0] for r in self._db.execute("SELECT session_id FROM sessions")]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class LogSessionStore(SessionStore):
+    """
+    只追加的快照日誌：每行為 "session_id\\tturn\\t快照 JSON" (刪除為 "session_id\\t-1\\t")。
+    記憶體中保存每個會話最新快照的 (位移, 長度, 回合數)；其他程序追加的內容在查詢時增量讀入。
+    壓縮會替換檔案，其他程序會在下次查詢時重新開啟；但壓縮期間其他程序的寫入可能遺失，
+    多個 worker 同時寫入時請使用 SQLiteSessionStore，或設定 compact_ratio=None 並在離線時呼叫 compact()。
+    """
+    name = "log"
+
+    def __init__(self, path="questionnaire_sessions.log", fsync=False, compact_ratio=4.0):
+        """
+        compact_ratio: 日誌中的快照數超過存活會話數的這個倍數時自動壓縮；None 表示不自動壓縮。
+        """
+        super().__init__()
+        self.path = path
+        self.fsync = fsync
+        self.compact_ratio = compact_ratio
+        self._lock = threading.Lock()
+        self._index = {} # session_id -> (offset, length, turn)
+        self._scanned = 0 # 已建立索引的位元組位移
+        self._records = 0
+        self._fd = None
+        self._reader = None
+        with self._lock:
+            self._open()
+            self._refresh()
+
+    def _open(self):
+        # 寫入使用 O_APPEND (每筆快照一次 write)，讀取使用另一個檔案物件
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, "O_BINARY", 0), 0o644)
+        self._reader = open(self.path, "rb")
+
+    def _read(self, length, offset):
+        self._reader.seek(offset)
+        return self._reader.read(length)
+
+    def _close_files(self):
+        os.close(self._fd)
+        self._reader.close()
+
+    def _reopen(self):
+        self._close_files()
+        self._open()
+        self._index = {}
+        self._scanned = 0
+        self._records = 0
+
+    def _refresh(self):
+        # 檔案被其他程序壓縮 (替換) 時重新開啟並重建索引
+        try:
+            if os.stat(self.path).st_ino != os.fstat(self._fd).st_ino:
+                self._reopen()
+        except FileNotFoundError:
+            pass
+        # 只讀取上次之後追加的完整行
+        size = os.fstat(self._fd).st_size
+        if size <= self._scanned:
+            return
+        data = self._read(size - self._scanned, self._scanned)
+        end = data.rfind(b"\n") + 1
+        offset = self._scanned
+        for line in data[:end].splitlines(keepends=True):
+            session_id, turn, _ = line.split(b"\t", 2)
+            turn = int(turn)
+            key = session_id.decode("utf-8")
+            if turn < 0:
+                self._index.pop(key, None)
+            else:
+                self._index[key] = (offset, len(line), turn)
+            self._records += 1
+            offset += len(line)
+        self._scanned += end
+
+    def _append(self, line):
+        os.write(self._fd, line)
+        if self.fsync:
+            os.fsync(self._fd)
+
+    def _save(self, state):
+        if "\t" in state.session_id or "\n" in state.session_id:
+            raise ValueError("session_id 不可包含 tab 或換行字元。")
+        payload = state.to_bytes()
+        line = state.session_id.encode("utf-8") + b"\t" + str(state.turn).encode() + b"\t" + payload + b"\n"
+        with self._lock:
+            self._refresh()
+            current = self._index.get(state.session_id)
+            if current is not None and current[2] > state.turn:
+                return False
+            self._append(line)
+            self._refresh()
+            if self.compact_ratio and self._records > 64 and self._records > self.compact_ratio * max(1, len(self._index)):
+                self._compact()
+        return True
+
+    def load(self, session_id):
+        with self._lock:
+            self._refresh()
+            entry = self._index.get(session_id)
+            if entry is None:
+                return None
+            line = self._read(entry[1], entry[0])
+        return SessionState.from_bytes(line.split(b"\t", 2)[2])
+
+    def latest_turn(self, session_id):
+        with self._lock:
+            self._refresh()
+            entry = self._index.get(session_id)
+        return entry[2] if entry else None
+
+    def delete(self, session_id):
+        with self._lock:
+            self._append(session_id.encode("utf-8") + b"\t-1\t\n")
+            self._refresh()
+
+    def session_ids(self):
+        with self._lock:
+            self._refresh()
+            return list(self._index)
+
+    def compact(self):
+        with self._lock:
+            self._refresh()
+            self._compact()
+
+    def _compact(self):
+        # 只保留每個會話的最新快照，寫入暫存檔後原子替換
+        tmp_path = self.path + ".tmp"
+        entries = sorted(self._index.items(), key=lambda item: item[1][0])
+        with open(tmp_path, "wb") as f:
+            for _, (offset, length, _) in entries:
+                f.write(self._read(length, offset))
+            f.flush()
+            os.fsync(f.fileno())
+        # Windows 無法替換仍開啟中的檔案，先關閉再替換
+        self._close_files()
+        os.replace(tmp_path, self.path)
+        self._open()
+        self._index = {}
+        self._scanned = 0
+        self._records = 0
+        self._refresh()
+
+    def close(self):
+        with self._lock:
+            self._close_files()
+
+
+STORE_TYPES = {
+    "sqlite": SQLiteSessionStore,
+    "log": LogSessionStore,
+}
+
+
+def create_session_store(kind="sqlite", path=None):
+    """
+    依名稱建立會話快照儲存；path 為 None 時使用預設檔名。
+    """
+    if kind not in STORE_TYPES:
+        raise ValueError(f"未知的會話儲存類型 '{kind}'，可用: {', '.join(STORE_TYPES)}")
+    return STORE_TYPES[kind](path) if path else STORE_TYPES[kind]()
@@ -0,0 +1,293 @@
+# sheet_submission_queue.py
+
+"""
+Google Sheets 的背景批次寫入佇列 (write-behind)。
+
+問卷結束時只需將答案行放入佇列並立即返回；背景執行緒依「批次大小」或「最舊資料的等待時間」
+觸發，以一次 append_rows 寫入整批資料。尚未寫入成功的資料會保存在本地 spool 檔案中，
+程式重啟後會自動補寫；遇到配額錯誤 (429) 時以指數退避重試。
+設定了提交索引時，寫入前會略過已確認寫入的 submission_id (例如寫入成功後、更新 spool 前崩潰而補寫的資料)。
+"""
+
+import atexit
+import json
+import os
+import random
+import threading
+import time
+
+from google_sheets_service import append_rows_to_sheet, is_quota_error
+from metrics import METRICS
+from questionnaire_data import SUBMISSION_ID_HEADER
+
+
+class SheetSubmissionQueue:
+    def __init__(self, client_factory, sheet_id, worksheet_name, headers,
+                 spool_path="sheet_submission_spool.jsonl", max_batch_size=50, max_batch_age=5.0,
+                 base_backoff=1.0, max_backoff=60.0, fsync=True, autostart=True, index=None):
+        """
+        client_factory: 無參數函式，返回 gspread 客戶端 (或相容的假客戶端)；返回 None 表示暫時無法連線。
+        index: submission_index.SubmissionIndex；寫入成功後將 submission_id 記為 committed。
+        """
+        self.client_factory = client_factory
+        self.sheet_id = sheet_id
+        self.worksheet_name = worksheet_name
+        self.headers = list(headers)
+        self.spool_path = spool_path
+        self.max_batch_size = max_batch_size
+        self.max_batch_age = max_batch_age
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.fsync = fsync
+        self.index = index
+        self._id_column = self.headers.index(SUBMISSION_ID_HEADER) if SUBMISSION_ID_HEADER in self.headers else None
+
+        self._client = None
+        self._pending = [] # [(enqueued_at, data_row)]
+        self._in_flight = 0 # 正在寫入中的筆數，flush() 需等待其完成
+        self._cond = threading.Condition()
+        self._closed = False
+        self._force_flush = False
+        self._retry_attempt = 0
+        self._next_attempt_at = 0.0
+        self._worker = None
+
+        self.stats = {"enqueued": 0, "flushed_rows": 0, "batches": 0, "retries": 0, "quota_errors": 0, "skipped_rows": 0}
+
+        self._load_spool()
+        if autostart:
+            self.start()
+
+    # ---- spool 檔案 ----
+
+    def _load_spool(self):
+        if not os.path.exists(self.spool_path):
+            return
+        now = time.monotonic()
+        with open(self.spool_path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    self._pending.append((now, json.loads(line)))
+                except json.JSONDecodeError:
+                    # 程式在寫入一半時中斷，最後一行可能不完整
+                    print(f"警告：略過 spool 檔案中損壞的一行: {line[:50]}")
+        if self._pending:
+            print(f"從 '{self.spool_path}' 恢復了 {len(self._pending)} 筆尚未寫入 Google Sheet 的資料。")
+
+    def _append_to_spool(self, data_row):
+        with open(self.spool_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(data_row, ensure_ascii=False) + "\n")
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+
+    def _rewrite_spool(self):
+        # 以暫存檔 + os.replace 原子地改寫 spool，只保留尚未寫入的資料
+        if not self._pending:
+            if os.path.exists(self.spool_path):
+                os.remove(self.spool_path)
+            return
+        tmp_path = self.spool_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for _, data_row in self._pending:
+                f.write(json.dumps(data_row, ensure_ascii=False) + "\n")
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(tmp_path, self.spool_path)
+
+    # ---- 公開介面 ----
+
+    def start(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run, name="SheetSubmissionQueue", daemon=True)
+            self._worker.start()
+
+    def enqueue(self, data_row):
+        """
+        放入一行資料並立即返回。資料會先寫入本地 spool 以免程式中斷而遺失。
+        """
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("SheetSubmissionQueue 已關閉，無法再加入資料。")
+            self._append_to_spool(data_row)
+            self._pending.append((time.monotonic(), list(data_row)))
+            self.stats["enqueued"] += 1
+            self._cond.notify_all()
+
+    def pending_count(self):
+        with self._cond:
+            return len(self._pending) + self._in_flight
+
+    def flush(self, timeout=None):
+        """
+        要求立即寫入所有待處理資料，並等待完成。返回 True 表示佇列已清空。
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._next_attempt_at = 0.0
+            self._force_flush = True
+            self._cond.notify_all()
+            while self._pending or self._in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def close(self, timeout=10.0):
+        """
+        停止背景執行緒前盡量寫完剩餘資料；寫不完的資料仍保留在 spool 中，下次啟動時補寫。
+        """
+        flushed = self.flush(timeout=timeout)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._worker is not None:
+            self._worker.join(timeout=1.0)
+        return flushed
+
+    # ---- 背景執行緒 ----
+
+    def _batch_ready(self, now):
+        if not self._pending or now < self._next_attempt_at:
+            return False
+        if self._force_flush or self._closed:
+            return True
+        if len(self._pending) >= self.max_batch_size:
+            return True
+        return now - self._pending[0][0] >= self.max_batch_age
+
+    def _wait_time(self, now):
+        if not self._pending:
+            return None
+        if now < self._next_attempt_at:
+            return self._next_attempt_at - now
+        return max(0.0, self.max_batch_age - (now - self._pending[0][0]))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._batch_ready(time.monotonic()):
+                    if self._closed and not self._pending:
+                        return
+                    if self._closed and time.monotonic() < self._next_attempt_at:
+                        return # 關閉時不再等待退避，剩餘資料留在 spool
+                    self._cond.wait(self._wait_time(time.monotonic()))
+                batch = self._pending[:self.max_batch_size]
+                del self._pending[:len(batch)]
+                self._in_flight = len(batch)
+
+            success = self._write_batch([row for _, row in batch])
+
+            with self._cond:
+                self._in_flight = 0
+                if success:
+                    self._retry_attempt = 0
+                    self._next_attempt_at = 0.0
+                    self.stats["flushed_rows"] += len(batch)
+                    self.stats["batches"] += 1
+                else:
+                    # 放回佇列最前面，保持原本的順序
+                    self._pending[:0] = batch
+                    self._retry_attempt += 1
+                    self.stats["retries"] += 1
+                    delay = min(self.max_backoff, self.base_backoff * (2 ** (self._retry_attempt - 1)))
+                    self._next_attempt_at = time.monotonic() + delay * random.uniform(0.5, 1.0)
+                if not self._pending:
+                    self._force_flush = False
+                try:
+                    self._rewrite_spool()
+                except OSError as e:
+                    print(f"更新 spool 檔案 '{self.spool_path}' 時發生錯誤: {e}")
+                self._cond.notify_all()
+
+    def _write_batch(self, rows):
+        submission_ids = []
+        if self.index is not None and self._id_column is not None:
+            rows, submission_ids, skipped = self.index.filter_uncommitted(rows, self._id_column)
+            if skipped:
+                self.stats["skipped_rows"] += skipped
+                print(f"略過 {skipped} 筆已確認寫入 Google Sheet 的資料。")
+            if not rows:
+                return True
+        try:
+            if self._client is None:
+                self._client = self.client_factory()
+                if self._client is None:
+                    print("無法連接 Google Sheets，資料將保留在本地佇列中稍後重試。")
+                    return False
+            with METRICS.timer("sheets_write_seconds"):
+                append_rows_to_sheet(self._client, self.sheet_id, self.worksheet_name, rows, self.headers)
+            METRICS.inc("sheets_rows_written_total", len(rows))
+            print(f"已批次寫入 {len(rows)} 筆數據到 Google Sheet '{self.worksheet_name}'。")
+            if submission_ids:
+                self.index.mark_committed(submission_ids, self.worksheet_name)
+            return True
+        except Exception as e:
+            METRICS.inc("sheets_write_errors_total", error="quota" if is_quota_error(e) else type(e).__name__)
+            if is_quota_error(e):
+                self.stats["quota_errors"] += 1
+                print(f"Google Sheets API 配額不足，稍後重試: {e}")
+            else:
+                print(f"批次寫入 Google Sheet 時發生錯誤，稍後重試: {e}")
+            return False
+
+
+_spool_suffix = ""
+
+def set_spool_suffix(suffix):
+    """
+    之後建立的佇列的 spool 檔名加上 suffix (例如 sheet_submission_spool.worker-0.jsonl)。
+    worker_pool 的每個 worker 程序使用自己的 spool：多個程序共用同一個 spool 時，
+    各自會恢復其他程序的資料，改寫 spool 時也會覆蓋其他程序剛追加的資料。
+    """
+    global _spool_suffix
+    _spool_suffix = f".{suffix}" if suffix else ""
+
+
+def spool_path_for(path):
+    root, ext = os.path.splitext(path)
+    return f"{root}{_spool_suffix}{ext}"
+
+
+_default_queue = None
+_default_queue_lock = threading.Lock()
+
+def get_default_submission_queue():
+    """
+    取得程序共用的寫入佇列，使用 questionnaire_data 中的 Google Sheet 設定。
+    """
+    global _default_queue
+    with _default_queue_lock:
+        if _default_queue is None:
+            from questionnaire_data import GOOGLE_SHEET_ID, GOOGLE_SHEET_HEADERS
+            from google_sheets_service import get_default_sheet_client
+            from submission_index import get_default_submission_index
+
+            _default_queue = SheetSubmissionQueue(get_default_sheet_client, GOOGLE_SHEET_ID, "工作表1", GOOGLE_SHEET_HEADERS,
+                                                  spool_path=spool_path_for("sheet_submission_spool.jsonl"),
+                                                  index=get_default_submission_index())
+            atexit.register(_default_queue.close)
+        return _default_queue
+
+
+if __name__ == '__main__':
+    # 使用假的 gspread 客戶端驗證批次寫入與配額重試
+    import tempfile
+    from fake_backends import FakeGspreadClient
+
+    fake_client = FakeGspreadClient()
+    spool = os.path.join(tempfile.mkdtemp(), "spool.jsonl")
+    queue = SheetSubmissionQueue(lambda: fake_client, "fake-sheet", "工作表1", ["name", "email"],
+                                 spool_path=spool, max_batch_size=10, max_batch_age=0.2, base_backoff=0.05)
+    fake_client.open_by_key("fake-sheet").worksheet("工作表1").fail_next_with = [429]
+    for i in range(25):
+        queue.enqueue([f"測試{i}", f"user{i}@example.com"])
+    queue.flush(timeout=5)
+    ws = fake_client.open_by_key("fake-sheet").worksheet("工作表1")
+    print(f"寫入行數 (含標題): {len(ws.rows)}，append_rows 呼叫次數: {ws.call_counts.get('append_rows')}，統計: {queue.stats}")
+    queue.close()
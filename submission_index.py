@@ -0,0 +1,334 @@
+# submission_index.py
+
+"""
+問卷提交的冪等索引。
+
+每份提交帶有 submission_id (互動問卷為 session ID)，寫入前先查本地索引，同一份提交重試、
+或使用者重複說「結束」時不會在 Google Sheet 中追加重複的行，也不必下載整張工作表來去重。
+
+- BloomFilter: 記憶體中的位元陣列，可確定「一定沒見過」的 id，大多數新提交不需查詢資料庫
+- SubmissionIndex: Bloom filter + SQLite 精確索引，狀態為 accepted (已交給儲存後端) -> committed (已確認寫入工作表)
+- reconcile_with_sheet: 以一次範圍讀取 (submission_id 欄) 比對本地索引與工作表，補上確認、找出遺失與重複的行
+
+多份問卷的儲存後端共用同一個索引，每筆記錄另外保存範圍 (scope，即寫入的工作表名稱)，對帳時只比對該工作表的記錄。
+"""
+
+import hashlib
+import json
+import math
+import sqlite3
+import threading
+import time
+
+from google_sheets_service import append_rows_to_sheet, get_worksheet_with_headers
+from questionnaire_data import SUBMISSION_ID_HEADER
+
+
+class BloomFilter:
+    def __init__(self, capacity=100000, error_rate=0.001):
+        """
+        capacity: 預期的元素數；超過後誤判率會上升，由 SubmissionIndex 負責以更大的容量重建。
+        """
+        self.capacity = max(1, int(capacity))
+        self.error_rate = error_rate
+        self.size = max(8, int(math.ceil(-self.capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.hash_count = max(1, int(round(self.size / self.capacity * math.log(2))))
+        self._bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        # 以兩個 64 位元雜湊組合出 k 個位置 (double hashing)
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+    def __len__(self):
+        return self.count
+
+
+class SubmissionIndex:
+    """
+    已提交 submission_id 的本地索引。Bloom filter 回答「一定沒見過」時不必先查詢，直接以
+    INSERT ... ON CONFLICT DO NOTHING 寫入 (其他程序已保留的 id 由主鍵擋下，同樣算作重複)；
+    可能見過時才查詢 SQLite 確認，誤判只會多一次查詢，不會誤擋新的提交。
+    """
+    def __init__(self, path="submission_index.db", capacity=100000, error_rate=0.001):
+        self.path = path
+        self.error_rate = error_rate
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS submissions (submission_id TEXT PRIMARY KEY, status TEXT NOT NULL, "
+            "row TEXT, updated_at REAL NOT NULL, scope TEXT)")
+        if "scope" not in [r[1] for r in self._db.execute("PRAGMA table_info(submissions)")]:
+            # 舊版本建立的索引：既有記錄的範圍為 NULL，對帳時在工作表中找到後補上
+            self._db.execute("ALTER TABLE submissions ADD COLUMN scope TEXT")
+        self._db.commit()
+        self.stats = {"checks": 0, "bloom_negatives": 0, "exact_lookups": 0, "false_positives": 0, "duplicates": 0}
+        ids = [r[0] for r in self._db.execute("SELECT submission_id FROM submissions")]
+        self._bloom = self._new_bloom(max(capacity, len(ids) * 2))
+        for submission_id in ids:
+            self._bloom.add(submission_id)
+
+    def _new_bloom(self, capacity):
+        return BloomFilter(capacity, self.error_rate)
+
+    def _remember(self, submission_id):
+        if len(self._bloom) >= self._bloom.capacity:
+            # 超過容量時以兩倍容量重建，維持誤判率
+            ids = [r[0] for r in self._db.execute("SELECT submission_id FROM submissions")]
+            self._bloom = self._new_bloom(self._bloom.capacity * 2)
+            for existing in ids:
+                self._bloom.add(existing)
+        self._bloom.add(submission_id)
+
+    def _status(self, submission_id):
+        # 呼叫端需持有 self._lock
+        self.stats["checks"] += 1
+        if submission_id not in self._bloom:
+            self.stats["bloom_negatives"] += 1
+            return None
+        self.stats["exact_lookups"] += 1
+        record = self._db.execute("SELECT status FROM submissions WHERE submission_id = ?", (submission_id,)).fetchone()
+        if record is None:
+            self.stats["false_positives"] += 1
+            return None
+        return record[0]
+
+    def __contains__(self, submission_id):
+        with self._lock:
+            return self._status(submission_id) is not None
+
+    def is_committed(self, submission_id):
+        with self._lock:
+            return self._status(submission_id) == "committed"
+
+    def stored_row(self, submission_id):
+        """
+        返回 reserve 時保存的資料行；沒有這個 id 或沒有保存資料行 (例如由對帳加入的 id) 時返回 None。
+        """
+        with self._lock:
+            record = self._db.execute("SELECT row FROM submissions WHERE submission_id = ?", (submission_id,)).fetchone()
+        return json.loads(record[0]) if record and record[0] else None
+
+    def reserve_many(self, items, scope=None):
+        """
+        items: [(submission_id, data_row)]。將尚未見過的 id 記為 accepted，返回其中可以寫入的項目；
+        已見過 (包括同一批中重複) 的項目會被略過。scope: 這些提交寫入的工作表名稱。
+        """
+        accepted = []
+        now = time.time()
+        with self._lock:
+            seen = set()
+            candidates = []
+            for submission_id, row in items:
+                if submission_id in seen or self._status(submission_id) is not None:
+                    self.stats["duplicates"] += 1
+                    continue
+                seen.add(submission_id)
+                candidates.append((submission_id, row))
+            if candidates:
+                # Bloom filter 只記得本程序見過的 id；其他程序 (其他 worker、重啟前的程序) 可能已保留同一個 id，
+                # 由資料庫的主鍵做最後判斷，沒有插入的項目視為重複提交
+                for submission_id, row in candidates:
+                    cursor = self._db.execute(
+                        "INSERT INTO submissions (submission_id, status, row, updated_at, scope) VALUES (?, 'accepted', ?, ?, ?) "
+                        "ON CONFLICT(submission_id) DO NOTHING",
+                        (submission_id, json.dumps(row, ensure_ascii=False), now, scope))
+                    if cursor.rowcount == 1:
+                        accepted.append((submission_id, row))
+                    else:
+                        self.stats["duplicates"] += 1
+                self._db.commit()
+                for submission_id, _ in candidates:
+                    if submission_id not in self._bloom:
+                        self._remember(submission_id)
+        return accepted
+
+    def reserve(self, submission_id, row=None, scope=None):
+        """
+        返回 True 表示這是新的提交 (可以寫入)，False 表示先前已提交過。
+        """
+        return bool(self.reserve_many([(submission_id, row)], scope))
+
+    def release(self, submission_ids):
+        """
+        撤銷 reserve_many() 的保留 (寫入儲存後端失敗時)，之後重試不會被當成重複提交。
+        只刪除仍為 accepted 的記錄；Bloom filter 無法刪除元素，之後查詢這些 id 只會多一次 SQLite 查詢。
+        """
+        submission_ids = list(submission_ids)
+        if not submission_ids:
+            return
+        with self._lock:
+            self._db.executemany("DELETE FROM submissions WHERE submission_id = ? AND status = 'accepted'",
+                                 [(submission_id,) for submission_id in submission_ids])
+            self._db.commit()
+
+    def mark_committed(self, submission_ids, scope=None):
+        """
+        記錄這些 id 已確認寫入工作表 scope；索引中沒有的 id (例如工作表中既有的行) 會一併加入。
+        """
+        submission_ids = list(submission_ids)
+        if not submission_ids:
+            return
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                "INSERT INTO submissions (submission_id, status, row, updated_at, scope) VALUES (?, 'committed', NULL, ?, ?) "
+                "ON CONFLICT(submission_id) DO UPDATE SET status = 'committed', updated_at = excluded.updated_at, "
+                "scope = COALESCE(submissions.scope, excluded.scope)",
+                [(submission_id, now, scope) for submission_id in submission_ids])
+            self._db.commit()
+            for submission_id in submission_ids:
+                if submission_id not in self._bloom:
+                    self._remember(submission_id)
+
+    def filter_uncommitted(self, rows, column):
+        """
+        依 rows 中第 column 欄的 submission_id 去掉已確認寫入的行，返回 (待寫入的行, 其中的 id, 略過的行數)。
+        沒有 id 的行一律保留。
+        """
+        pending, ids, skipped = [], [], 0
+        with self._lock:
+            for row in rows:
+                submission_id = row[column] if column < len(row) else ""
+                if submission_id and self._status(submission_id) == "committed":
+                    skipped += 1
+                    continue
+                pending.append(row)
+                if submission_id:
+                    ids.append(submission_id)
+        return pending, ids, skipped
+
+    def entries(self, status=None, scope=None):
+        """
+        返回 [(submission_id, status, data_row 或 None)]；scope 提供時只返回該工作表的記錄。
+        """
+        conditions = [(column, value) for column, value in (("status", status), ("scope", scope)) if value is not None]
+        sql = "SELECT submission_id, status, row FROM submissions"
+        if conditions:
+            sql += " WHERE " + " AND ".join(f"{column} = ?" for column, _ in conditions)
+        with self._lock:
+            records = self._db.execute(sql, [value for _, value in conditions]).fetchall()
+        return [(submission_id, s, json.loads(row) if row else None) for submission_id, s, row in records]
+
+    def count(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM submissions").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def reconcile_with_sheet(index, client, sheet_id, worksheet_name, headers, repair=False):
+    """
+    以一次範圍讀取 (只讀 submission_id 欄) 比對本地索引中寫入這個工作表的記錄與工作表：
+    - confirmed: 本地為 accepted 但已出現在工作表中 (寫入成功但確認遺失)，改記為 committed，之後不會再寫一次
+    - unknown: 工作表中有、索引中沒有的 id (例如本地索引重建)，加入索引
+    - missing: 本地為 committed 但工作表中找不到；repair=True 時以保存的資料行補寫
+    - duplicates: 工作表中出現多次的 id 及其行號 (只回報，不自動刪除)
+    - pending: 本地為 accepted 且尚未出現在工作表中 (仍在佇列中等待寫入)
+    """
+    headers = list(headers)
+    column = headers.index(SUBMISSION_ID_HEADER) + 1
+    worksheet = get_worksheet_with_headers(client, sheet_id, worksheet_name, headers)
+    values = worksheet.col_values(column)[1:] # 第一行為標題
+
+    rows_by_id = {}
+    rows_without_id = 0
+    for row_number, submission_id in enumerate(values, start=2):
+        if submission_id:
+            rows_by_id.setdefault(submission_id, []).append(row_number)
+        else:
+            rows_without_id += 1
+
+    # 共用索引的其他問卷寫入其他工作表，不能拿來比對或補寫到這個工作表
+    local = {submission_id: (status, row) for submission_id, status, row in index.entries(scope=worksheet_name)}
+    confirmed = [sid for sid, (status, _) in local.items() if status == "accepted" and sid in rows_by_id]
+    unknown = [sid for sid in rows_by_id if sid not in local]
+    missing = [sid for sid, (status, _) in local.items() if status == "committed" and sid not in rows_by_id]
+    pending = [sid for sid, (status, _) in local.items() if status == "accepted" and sid not in rows_by_id]
+    index.mark_committed(confirmed + unknown, worksheet_name)
+
+    repaired = 0
+    if repair:
+        rows = [local[sid][1] for sid in missing if local[sid][1] is not None]
+        if rows:
+            append_rows_to_sheet(client, sheet_id, worksheet_name, rows, headers)
+            repaired = len(rows)
+
+    report = {
+        "sheet_rows": len(values),
+        "rows_without_id": rows_without_id,
+        "confirmed": len(confirmed),
+        "unknown": len(unknown),
+        "missing": missing,
+        "repaired": repaired,
+        "pending": len(pending),
+        "duplicates": {sid: numbers for sid, numbers in rows_by_id.items() if len(numbers) > 1},
+    }
+    print(f"對帳完成：工作表 {report['sheet_rows']} 行，確認 {report['confirmed']} 筆，新加入索引 {report['unknown']} 筆，"
+          f"遺失 {len(missing)} 筆 (補寫 {repaired} 筆)，重複 {len(report['duplicates'])} 個 id，佇列中 {report['pending']} 筆。")
+    return report
+
+
+_default_index = None
+_default_index_lock = threading.Lock()
+
+def get_default_submission_index():
+    """
+    取得程序共用的提交索引 (questionnaire_data.SUBMISSION_INDEX_PATH)；設定為 None 時返回 None (不去重)。
+    """
+    global _default_index
+    with _default_index_lock:
+        if _default_index is None:
+            from questionnaire_data import SUBMISSION_INDEX_PATH
+            if SUBMISSION_INDEX_PATH is None:
+                return None
+            import atexit
+            _default_index = SubmissionIndex(SUBMISSION_INDEX_PATH)
+            atexit.register(_default_index.close)
+        return _default_index
+
+
+if __name__ == '__main__':
+    # 以假的 gspread 客戶端示範：重試與重複「結束」不會產生重複行，對帳只讀取一欄
+    import os
+    import tempfile
+    from fake_backends import FakeGspreadClient
+    from questionnaire_data import GOOGLE_SHEET_HEADERS
+    from result_stores import SheetsResultStore
+    from sheet_submission_queue import SheetSubmissionQueue
+
+    tmp_dir = tempfile.mkdtemp()
+    fake_client = FakeGspreadClient()
+    index = SubmissionIndex(os.path.join(tmp_dir, "index.db"))
+    queue = SheetSubmissionQueue(lambda: fake_client, "fake-sheet", "工作表1", GOOGLE_SHEET_HEADERS,
+                                 spool_path=os.path.join(tmp_dir, "spool.jsonl"), max_batch_age=0.1, index=index)
+    store = SheetsResultStore(queue)
+    answers = {"name": "王小明", "email": "wang@example.com", "age_group": "25-34", "product_satisfaction": 4,
+               "feedback_comments": "", "allow_follow_up": "是"}
+    for i in range(5):
+        store.append({**answers, SUBMISSION_ID_HEADER: f"session-{i}"})
+    store.append({**answers, SUBMISSION_ID_HEADER: "session-3"}) # 重試
+    queue.flush(timeout=5)
+
+    worksheet = fake_client.open_by_key("fake-sheet").worksheet("工作表1")
+    worksheet.append_rows([worksheet.rows[2]]) # 模擬寫入逾時後被重送的一行
+    index.reserve("session-9", store.to_row({**answers, SUBMISSION_ID_HEADER: "session-9"}), "工作表1")
+    index.mark_committed(["session-9"], "工作表1") # 模擬已確認、但之後在工作表中被刪除的一行
+    report = reconcile_with_sheet(index, fake_client, "fake-sheet", "工作表1", GOOGLE_SHEET_HEADERS, repair=True)
+    print(f"工作表資料行 {len(worksheet.rows) - 1} | 重複 {report['duplicates']} | 讀取呼叫 {worksheet.call_counts} | 索引 {index.stats}")
+    queue.close()
@@ -0,0 +1,7 @@
+# tests/conftest.py
+
+import os
+import sys
+
+# 模組都放在專案根目錄
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
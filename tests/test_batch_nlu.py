@@ -0,0 +1,51 @@
+# tests/test_batch_nlu.py
+
+import json
+
+import pytest
+
+import batch_nlu
+from batch_nlu import BatchNLURunner
+from fake_backends import make_fake_nlu
+from result_stores import SQLiteResultStore
+from submission_index import SubmissionIndex
+
+
+def test_replayed_batch_after_crash_is_not_counted_twice(tmp_path, monkeypatch):
+    input_path = tmp_path / "transcripts.jsonl"
+    input_path.write_text("".join(json.dumps({"id": f"r{i}", "text": "我叫王小明"}, ensure_ascii=False) + "\n"
+                                  for i in range(10)), encoding="utf-8")
+    store = SQLiteResultStore(str(tmp_path / "results.db"), index=SubmissionIndex(str(tmp_path / "index.db")))
+
+    def runner():
+        return BatchNLURunner(make_fake_nlu({"我叫王小明": {"name": "王小明"}}), store, concurrency=1, write_batch=4,
+                              progress_interval=0)
+
+    # 第二批寫入後、更新檢查點前崩潰：恢復後會重送這一批
+    save = batch_nlu.BatchCheckpoint.save
+    saves = []
+
+    def crashing_save(self, line, offset, stats):
+        saves.append(line)
+        if len(saves) == 2:
+            raise RuntimeError("模擬崩潰")
+        save(self, line, offset, stats)
+
+    monkeypatch.setattr(batch_nlu.BatchCheckpoint, "save", crashing_save)
+    with pytest.raises(RuntimeError):
+        runner().run(str(input_path))
+    assert store.count() == 8
+
+    monkeypatch.setattr(batch_nlu.BatchCheckpoint, "save", save)
+    summary = runner().run(str(input_path))
+    assert store.count() == 10
+    # 重送的一批在崩潰前已寫入，只記為略過的重複；崩潰前的那次計數沒有存進檢查點
+    assert summary["duplicates_skipped"] == 4
+    assert summary["rows_written"] + summary["duplicates_skipped"] == 10
+
+    # 刪除檢查點重跑同一個檔案：所有記錄都已寫入過，不會再算進寫入筆數
+    (tmp_path / "transcripts.jsonl.checkpoint.json").unlink()
+    summary = runner().run(str(input_path))
+    assert store.count() == 10
+    assert summary["rows_written"] == 0
+    assert summary["duplicates_skipped"] == 10
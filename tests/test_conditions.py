@@ -0,0 +1,66 @@
+# tests/test_conditions.py
+
+import pytest
+
+from ai_agents import QuestionnaireAgent
+from questionnaire_model import DEFAULT_QUESTIONNAIRE, compile_questionnaire
+
+
+def _agent(questionnaire=DEFAULT_QUESTIONNAIRE):
+    return QuestionnaireAgent(nlu_agent=object(), rule_extractor=False, questionnaire=questionnaire)
+
+
+def _answer(agent, q_id, value):
+    """
+    回答一題，返回這次條件重新評估的次數。
+    """
+    is_valid, validated, _ = agent._validate_extracted_answer(agent.questionnaire.by_id[q_id], value)
+    assert is_valid
+    before = agent.condition_evaluations
+    agent._update_answers_and_unanswered_status(q_id, validated)
+    return agent.condition_evaluations - before
+
+
+def _branching(blocks):
+    structure = []
+    for i in range(blocks):
+        structure += [
+            {"id": f"score_{i}", "question": f"滿意度 {i}？", "type": "number", "validation_rule": "range_1_5"},
+            {"id": f"reason_{i}", "question": f"原因 {i}？", "type": "text", "validation_rule": "required", "show_if": f"score_{i} <= 2"},
+            {"id": f"detail_{i}", "question": f"追問 {i}？", "type": "text", "show_if": f"reason_{i} is not None and score_{i} == 1"},
+            {"id": f"referral_{i}", "question": f"推薦 {i}？", "type": "boolean", "required_if": f"score_{i} >= 4"},
+        ]
+    return compile_questionnaire(structure)
+
+
+def test_dissatisfaction_reason_follows_product_satisfaction():
+    agent = _agent()
+    downstream = DEFAULT_QUESTIONNAIRE.downstream["product_satisfaction"]
+    reason = "detailed_dissatisfaction_reason"
+    assert reason in downstream
+    assert reason not in agent.unanswered_questions_ids
+
+    for value, shown in ((1, True), (4, False), (2, True), (4, False)):
+        assert _answer(agent, "product_satisfaction", value) == len(downstream)
+        assert (reason in agent.unanswered_questions_ids) is shown
+        assert (reason in agent._pending_required_ids()) is shown
+
+    # 顯示時填了原因，分數改回 4 後原因被清除
+    _answer(agent, "product_satisfaction", 1)
+    _answer(agent, reason, "太貴了")
+    assert _answer(agent, "product_satisfaction", 4) == len(downstream)
+    assert agent.collected_answers[reason] is None
+    assert reason not in agent.unanswered_questions_ids
+
+
+@pytest.mark.parametrize("blocks", [1, 50, 300])
+def test_condition_work_scales_with_changed_answers_not_questionnaire_size(blocks):
+    questionnaire = _branching(blocks)
+    agent = _agent(questionnaire)
+    for i in range(blocks):
+        for q_id, value in ((f"score_{i}", 1), (f"reason_{i}", "太慢"), (f"detail_{i}", "常當機"), (f"score_{i}", 5), (f"referral_{i}", "是")):
+            assert _answer(agent, q_id, value) == len(questionnaire.downstream.get(q_id, ()))
+    # 每題的下游只有同一組的問題，與問卷大小無關
+    assert max(len(v) for v in questionnaire.downstream.values()) <= 3
+    assert agent.unanswered_questions_ids == set() and not agent._pending_required_ids()
+    assert agent.condition_evaluations == blocks * (3 + 1 + 0 + 3 + 0)
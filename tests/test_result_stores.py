@@ -0,0 +1,45 @@
+# tests/test_result_stores.py
+
+import pytest
+
+import questionnaire_data
+import result_stores
+import submission_index
+from questionnaire_data import QUESTIONNAIRE_STRUCTURE
+from questionnaire_model import compile_questionnaire
+from result_stores import get_result_store_for
+
+
+@pytest.mark.parametrize("backend", ["csv", "jsonl", "sqlite"])
+def test_changed_questions_never_share_a_store_across_restarts(tmp_path, monkeypatch, backend):
+    monkeypatch.setattr(questionnaire_data, "RESULT_STORE", backend)
+    monkeypatch.setattr(questionnaire_data, "RESULT_STORE_PATH", str(tmp_path / f"results.{backend}"))
+    monkeypatch.setattr(questionnaire_data, "RESULT_EXPORT_INTERVAL", 0)
+    monkeypatch.setattr(submission_index, "get_default_submission_index", lambda: None)
+
+    def restart():
+        # 重啟後或另一個 worker：本程序沒有開啟過其他版本
+        monkeypatch.setattr(result_stores, "_questionnaire_stores", {})
+
+    original = compile_questionnaire(QUESTIONNAIRE_STRUCTURE[:3], "store_survey")
+    reworded = compile_questionnaire([dict(QUESTIONNAIRE_STRUCTURE[0], question="請問貴姓大名？")] + QUESTIONNAIRE_STRUCTURE[1:3],
+                                     "store_survey")
+    extended = compile_questionnaire(QUESTIONNAIRE_STRUCTURE[:4], "store_survey")
+    assert len({original.version, reworded.version, extended.version}) == 3
+
+    restart()
+    first = get_result_store_for(original)
+    first.append({"name": "王小明", "submission_id": "a"})
+    restart()
+    second = get_result_store_for(extended)
+    second.append({"name": "李小華", "product_satisfaction": 4, "submission_id": "b"})
+    restart()
+    third = get_result_store_for(reworded) # 只改了問題文字，欄位相同
+    third.append({"name": "陳大文", "submission_id": "c"})
+
+    assert result_stores.result_store_name(original) == result_stores.result_store_name(reworded)
+    assert result_stores.result_store_name(original) != result_stores.result_store_name(extended)
+    assert first.count() == 2 and third.count() == 2
+    assert second.count() == 1
+    for store in (first, second, third):
+        store.close()
@@ -0,0 +1,31 @@
+# tests/test_rule_extractor.py
+
+import asyncio
+
+from ai_agents import QuestionnaireAgent
+from fake_backends import make_fake_nlu
+from questionnaire_model import DEFAULT_QUESTIONNAIRE
+from rule_extractor import RuleBasedExtractor
+
+
+def test_bare_yes_to_greeting_is_not_recorded_as_consent():
+    # 歡迎語問「我們可以從您的姓名開始嗎」，回答「好」不是同意後續聯絡
+    async def run():
+        agent = QuestionnaireAgent(nlu_agent=make_fake_nlu(), rule_extractor=RuleBasedExtractor(), speculative_next_prompt=False)
+        await agent.astart()
+        await agent.aturn("好")
+        return agent
+    agent = asyncio.run(run())
+    assert agent.collected_answers["allow_follow_up"] is None
+    assert agent.rule_extractor.stats.hits == 0
+
+
+def test_bare_answers_apply_only_to_prompted_question():
+    extractor = RuleBasedExtractor()
+    unanswered = set(DEFAULT_QUESTIONNAIRE.headers)
+    assert extractor.extract("好", unanswered, {"name"}) is None
+    assert extractor.extract("4", unanswered, {"name"}) is None
+    assert extractor.extract("好", unanswered, {"allow_follow_up"})["extracted_answers"] == {"allow_follow_up": "是"}
+    assert extractor.extract("4", unanswered, {"product_satisfaction"})["extracted_answers"] == {"product_satisfaction": 4}
+    # 明確的格式 (email、年齡) 不需要上一輪的提示
+    assert extractor.extract("wang@example.com", unanswered)["extracted_answers"] == {"email": "wang@example.com"}
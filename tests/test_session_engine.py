@@ -0,0 +1,53 @@
+# tests/test_session_engine.py
+
+import asyncio
+import json
+
+from extraction_cache import ExtractionCache
+from fake_backends import make_fake_nlu
+from questionnaire_data import QUESTIONNAIRE_STRUCTURE
+from questionnaire_registry import QuestionnaireRegistry
+from session_engine import SessionEngine
+
+
+def test_stats_include_registry_questionnaire_sessions(tmp_path):
+    (tmp_path / "store_survey.json").write_text(json.dumps({"questions": QUESTIONNAIRE_STRUCTURE[:4]}, ensure_ascii=False),
+                                                encoding="utf-8")
+    registry = QuestionnaireRegistry(str(tmp_path), check_interval=None)
+    engine = SessionEngine(nlu_agent=make_fake_nlu({"我叫王小明": {"name": "王小明"}}, extraction_cache=ExtractionCache()),
+                           registry=registry)
+
+    async def run():
+        before = engine.stats()
+        session_id, _ = await engine.start_session(questionnaire_id="store_survey")
+        await engine.turn(session_id, "wang@example.com") # 規則快速路徑 (該問卷版本自己的提取器)
+        await engine.turn(session_id, "我叫王小明") # LLM 提取，結果寫入提取快取
+        return before, engine.stats()
+
+    before, after = asyncio.run(run())
+    assert after["rule_fast_path"]["hits"] == before["rule_fast_path"]["hits"] + 1
+    assert after["extraction_cache"]["misses"] == before["extraction_cache"]["misses"] + 1
+    assert after["openai_client"]["requests"] > before["openai_client"]["requests"]
+    assert after["questionnaires"]["sessions_by_version"] == {f"store_survey@{registry.get('store_survey').version}": 1}
+    engine.close()
+
+
+def test_stats_combine_per_version_layers_with_their_own_cache(tmp_path):
+    (tmp_path / "store_survey.json").write_text(json.dumps({"questions": QUESTIONNAIRE_STRUCTURE[:4]}, ensure_ascii=False),
+                                                encoding="utf-8")
+    registry = QuestionnaireRegistry(str(tmp_path), check_interval=None)
+    engine = SessionEngine(nlu_agent=make_fake_nlu({"我叫王小明": {"name": "王小明"}}, extraction_cache=ExtractionCache()),
+                           registry=registry)
+    layer = engine._nlu_for(registry.get("store_survey"))
+    layer.extraction_cache = ExtractionCache() # 例如另外設定的提取快取
+
+    async def run():
+        for questionnaire_id in (None, "store_survey"):
+            session_id, _ = await engine.start_session(questionnaire_id=questionnaire_id)
+            await engine.turn(session_id, "我叫王小明")
+
+    asyncio.run(run())
+    assert engine.nlu_agent.extraction_cache.stats()["misses"] == 1
+    assert layer.extraction_cache.stats()["misses"] == 1
+    assert engine.stats()["extraction_cache"]["misses"] == 2
+    engine.close()
@@ -0,0 +1,94 @@
+# tests/test_submissions.py
+
+import asyncio
+import builtins
+
+import pytest
+
+from ai_agents import QuestionnaireAgent
+from fake_backends import make_fake_nlu
+from main import run_cli
+from result_stores import SQLiteResultStore
+from session_engine import SessionEngine
+from submission_index import SubmissionIndex
+
+
+def _store(tmp_path):
+    return SQLiteResultStore(str(tmp_path / "results.db"), index=SubmissionIndex(str(tmp_path / "index.db")))
+
+
+def test_consecutive_cli_runs_store_separate_rows(tmp_path, monkeypatch):
+    store = _store(tmp_path)
+    nlu = make_fake_nlu()
+    for _ in range(2):
+        # 每次執行都直接結束並確認 (必填問題未回答)
+        inputs = iter(["結束", "是"])
+        monkeypatch.setattr(builtins, "input", lambda prompt="": next(inputs))
+        engine = SessionEngine(nlu_agent=nlu,
+                               agent_factory=lambda nlu_agent, **_: QuestionnaireAgent(nlu_agent=nlu_agent, result_store=store))
+        asyncio.run(run_cli(engine, stream=False))
+    assert store.count() == 2
+    rows, _ = store.read_since(0)
+    assert rows[0][-1] != rows[1][-1]
+
+
+def test_failed_write_can_be_retried(tmp_path):
+    store = _store(tmp_path)
+    write_rows = store.append_rows
+    calls = []
+
+    def flaky_append_rows(rows):
+        calls.append(len(rows))
+        if len(calls) == 1:
+            raise OSError("disk full")
+        write_rows(rows)
+
+    store.append_rows = flaky_append_rows
+    answers = {"name": "王小明", "submission_id": "attempt-1"}
+    with pytest.raises(OSError):
+        store.append(answers)
+    assert store.append(answers) is True
+    assert store.append(answers) is False
+    assert store.count() == 1
+
+
+def test_duplicate_submission_is_reported_truthfully(tmp_path):
+    store = _store(tmp_path)
+
+    def finish(name):
+        agent = QuestionnaireAgent(nlu_agent=make_fake_nlu(), result_store=store, submission_id="attempt-1")
+        agent.collected_answers["name"] = name
+        return agent._finish("好的。")
+
+    assert "已送出，感謝" in finish("王小明")
+    assert "先前已經送出，不會重複記錄" in finish("王小明") # 例如從快照恢復後重送「結束」
+    assert "本次的答案沒有寫入" in finish("李小華")
+    assert store.count() == 1
+
+
+def test_reconcile_only_repairs_rows_of_its_own_worksheet(tmp_path):
+    from fake_backends import FakeGspreadClient
+    from submission_index import reconcile_with_sheet
+
+    index = SubmissionIndex(str(tmp_path / "index.db"))
+    index.reserve("default-1", ["王小明", "default-1"], "工作表1")
+    index.reserve("survey-1", ["李小華", "survey-1"], "store_survey")
+    index.mark_committed(["default-1"], "工作表1")
+    index.mark_committed(["survey-1"], "store_survey")
+
+    client = FakeGspreadClient()
+    report = reconcile_with_sheet(index, client, "fake-sheet", "store_survey", ["name", "submission_id"], repair=True)
+    assert report["missing"] == ["survey-1"]
+    assert client.open_by_key("fake-sheet").worksheet("store_survey").rows[1:] == [["李小華", "survey-1"]]
+
+
+def test_id_reserved_by_another_index_instance_is_a_duplicate(tmp_path):
+    # 例如另一個 worker 或重啟前的程序：這個實例的 Bloom filter 沒見過該 id
+    path = str(tmp_path / "index.db")
+    first = SubmissionIndex(path)
+    second = SubmissionIndex(path)
+    assert first.reserve("s1", ["王小明", "s1"]) is True
+    assert second.reserve("s1", ["王小明", "s1"]) is False
+    assert second.reserve_many([("s1", ["王小明", "s1"]), ("s2", ["李小華", "s2"])]) == [("s2", ["李小華", "s2"])]
+    assert "s1" in second
+    assert second.stats["duplicates"] == 2
@@ -0,0 +1,32 @@
+# tests/test_worker_pool.py
+
+import multiprocessing
+
+from submission_index import SubmissionIndex
+
+
+def _reserve_in_worker(path, submission_id, start, results):
+    # 與 WorkerPool 相同：每個 worker 程序開啟自己的 SubmissionIndex (各自的 Bloom filter)，共用同一個資料庫檔案
+    index = SubmissionIndex(path)
+    start.wait()
+    try:
+        results.put(index.reserve(submission_id, ["王小明", submission_id]))
+    except Exception as e:
+        results.put(repr(e))
+
+
+def test_same_submission_id_from_two_worker_processes_is_stored_once(tmp_path):
+    path = str(tmp_path / "index.db")
+    SubmissionIndex(path) # 先建立資料表
+    ctx = multiprocessing.get_context("spawn")
+    start = ctx.Event()
+    results = ctx.Queue()
+    processes = [ctx.Process(target=_reserve_in_worker, args=(path, "session-1", start, results)) for _ in range(2)]
+    for process in processes:
+        process.start()
+    start.set()
+    outcomes = sorted(results.get(timeout=30) for _ in processes)
+    for process in processes:
+        process.join(timeout=30)
+    assert outcomes == [False, True]
+    assert SubmissionIndex(path).stored_row("session-1") == ["王小明", "session-1"]
@@ -0,0 +1,580 @@
+# worker_pool.py
+
+"""
+多程序 worker 池。
+
+單一程序即使使用非同步 I/O，每回合的 Python 工作 (提示語組裝、JSON 解析、答案驗證、對話歷史處理)
+仍受 GIL 限制只能使用一個核心。WorkerPool 啟動 N 個 worker 程序，每個程序執行自己的 SessionEngine
+(各自的 AINLULayer、OpenAI 客戶端與快取)。程序之間共用的只有結果儲存後端與提交索引 (submission_index.db)：
+每個 worker 的 Bloom filter 只記得自己見過的 submission_id，同一個 id 是否已提交由 SQLite 的主鍵判斷。
+每個 worker 的 Sheets 寫入佇列使用自己的 spool 檔案；本地結果儲存後端的定時匯出只在 supervisor 中執行 (每個後端一個)。
+
+- 會話 ID 以一致性雜湊 (HashRing) 固定對應到某個 worker，同一會話的所有回合都在同一個程序中處理
+- add_worker() / remove_worker() 改變環後，只有歸屬改變的會話 (約 1/N) 以 SessionState 快照搬移到新的 worker；
+  搬移期間該會話的新輸入會等待搬移完成，進行中的回合先處理完才搬移
+- remove_worker() 與 close() 會先等進行中的回合完成 (graceful drain)，worker 結束前寫完結果儲存後端的佇列
+- worker 意外結束時由 supervisor 以同一個 id 重新啟動；設定了 session_store 時，會話會從快照恢復
+
+介面與 SessionEngine 相同 (start_session / turn / turn_stream / end_session / is_active)，
+server.py 以 --workers N 使用。
+"""
+
+import asyncio
+import atexit
+import bisect
+import functools
+import hashlib
+import itertools
+import multiprocessing
+import os
+import signal
+import threading
+import time
+import uuid
+
+from answer_analytics import ANALYTICS, AnswerAnalytics
+from metrics import METRICS, Metrics
+from result_stores import configure_worker_process, start_bulk_export, stop_bulk_exports
+from session_engine import SessionEngine, SessionNotFoundError
+
+
+class HashRing:
+    """
+    一致性雜湊環；每個節點放置 replicas 個虛擬節點，讓會話平均分配，增減節點時只有相鄰區段的鍵改變歸屬。
+    """
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self._points = [] # 排序後的 (雜湊值, 節點)
+        self._hashes = []
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+    def add(self, node):
+        for i in range(self.replicas):
+            self._points.append((self._hash(f"{node}#{i}"), node))
+        self._points.sort()
+        self._hashes = [h for h, _ in self._points]
+
+    def remove(self, node):
+        self._points = [(h, n) for h, n in self._points if n != node]
+        self._hashes = [h for h, _ in self._points]
+
+    def copy(self):
+        ring = HashRing(replicas=self.replicas)
+        ring._points = list(self._points)
+        ring._hashes = list(self._hashes)
+        return ring
+
+    @property
+    def nodes(self):
+        return sorted({n for _, n in self._points})
+
+    def node_for(self, key):
+        if not self._points:
+            raise RuntimeError("沒有可用的 worker。")
+        index = bisect.bisect(self._hashes, self._hash(key)) % len(self._points)
+        return self._points[index][1]
+
+
+# ---- worker 程序 ----
+
+def _worker_main(worker_id, conn, engine_factory):
+    # Ctrl-C 由 supervisor 處理 (先 drain 再結束 worker)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    configure_worker_process(worker_id, functools.partial(_notify_export, conn))
+    try:
+        asyncio.run(_Worker(worker_id, conn, engine_factory).run())
+    finally:
+        # multiprocessing 的子程序不會執行 atexit；在此執行，讓結果儲存後端與 Sheets 佇列寫完
+        atexit._run_exitfuncs()
+
+
+def _notify_export(conn, spec):
+    try:
+        conn.send((None, "export", spec))
+    except (BrokenPipeError, OSError):
+        pass # supervisor 已不存在
+
+
+class _Worker:
+    def __init__(self, worker_id, conn, engine_factory):
+        self.worker_id = worker_id
+        self.conn = conn
+        self.engine_factory = engine_factory
+        self.engine = None
+        self.turns = 0
+        self._inflight = 0
+        self._idle = None
+        self._stopped = None
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.engine = self.engine_factory()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._stopped = asyncio.Event()
+        threading.Thread(target=self._read_requests, name=f"{self.worker_id}-reader", daemon=True).start()
+        self.conn.send((None, "ready", os.getpid()))
+        reaper = asyncio.ensure_future(self._reap_idle_sessions())
+        await self._stopped.wait()
+        reaper.cancel()
+
+    def _read_requests(self):
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                # supervisor 已不存在
+                message = (None, "stop", ())
+            self.loop.call_soon_threadsafe(self._dispatch, message)
+            if message[1] == "stop":
+                return
+
+    def _dispatch(self, message):
+        asyncio.ensure_future(self._handle(*message))
+
+    async def _handle(self, req_id, op, args):
+        if op != "stop":
+            self._inflight += 1
+            self._idle.clear()
+        try:
+            value = await getattr(self, f"_op_{op}")(req_id, *args)
+        except Exception as e:
+            self._reply(req_id, "error", (type(e).__name__, str(e)))
+        else:
+            self._reply(req_id, "ok", value)
+        finally:
+            if op == "stop":
+                self._stopped.set()
+            else:
+                self._inflight -= 1
+                if self._inflight == 0:
+                    self._idle.set()
+
+    def _reply(self, req_id, status, value):
+        if req_id is None:
+            return
+        try:
+            self.conn.send((req_id, status, value))
+        except (BrokenPipeError, OSError):
+            pass
+
+    def _chunk_sender(self, req_id, stream):
+        if not stream:
+            return None
+        return lambda piece: self._reply(req_id, "chunk", piece)
+
+    async def _reap_idle_sessions(self, interval=60.0):
+        while True:
+            await asyncio.sleep(interval)
+            self.engine.evict_idle_sessions()
+
+    async def _op_start(self, req_id, session_id, stream, questionnaire_id=None):
+        _, reply = await self.engine.start_session(session_id, on_chunk=self._chunk_sender(req_id, stream),
+                                                   questionnaire_id=questionnaire_id)
+        return reply
+
+    async def _op_turn(self, req_id, session_id, text, stream):
+        reply = await self.engine.turn(session_id, text, on_chunk=self._chunk_sender(req_id, stream))
+        self.turns += 1
+        return reply, self.engine.is_active(session_id)
+
+    async def _op_is_active(self, req_id, session_id):
+        return self.engine.is_active(session_id)
+
+    async def _op_end(self, req_id, session_id):
+        self.engine.end_session(session_id)
+
+    async def _op_detach(self, req_id, session_ids):
+        states = []
+        for session_id in session_ids:
+            state = await self.engine.detach_session(session_id)
+            if state is not None:
+                states.append(state)
+        return states
+
+    async def _op_attach(self, req_id, states):
+        for state in states:
+            self.engine.attach_session(state)
+        return len(states)
+
+    async def _op_warm_up(self, req_id):
+        return await self.engine.warm_up()
+
+    async def _op_stats(self, req_id):
+        return {"pid": os.getpid(), "cpu_seconds": round(time.process_time(), 3), "turns": self.turns, **self.engine.stats()}
+
+    async def _op_metrics(self, req_id):
+        return METRICS.export_state()
+
+    async def _op_analytics(self, req_id):
+        return ANALYTICS.export_state()
+
+    async def _op_stop(self, req_id):
+        # graceful drain：等進行中的請求完成，再關閉所有會話 (保留快照，可由其他 worker 恢復)
+        await self._idle.wait()
+        self.engine.close()
+        return self.turns
+
+
+# ---- supervisor ----
+
+class _WorkerHandle:
+    __slots__ = ("worker_id", "process", "conn", "ready", "pending", "chunk_callbacks", "requests", "stopping")
+
+    def __init__(self, worker_id, process, conn, loop):
+        self.worker_id = worker_id
+        self.process = process
+        self.conn = conn
+        self.ready = loop.create_future()
+        self.pending = {} # req_id -> Future
+        self.chunk_callbacks = {} # req_id -> on_chunk
+        self.requests = 0
+        self.stopping = False
+
+
+class WorkerPool:
+    def __init__(self, workers=None, engine_factory=SessionEngine, replicas=64, start_method="spawn"):
+        """
+        workers: worker 程序數，預設為 CPU 核心數。
+        engine_factory: 在 worker 程序中建立 SessionEngine 的可呼叫物件 (須可 pickle，例如模組層級函式或 functools.partial)。
+        start_method: multiprocessing 的啟動方式；預設 spawn，避免 fork 複製 supervisor 中的執行緒與連線。
+        """
+        self.initial_workers = workers or os.cpu_count() or 1
+        self.engine_factory = engine_factory
+        self.ring = HashRing(replicas=replicas)
+        self._context = multiprocessing.get_context(start_method)
+        self._loop = None
+        self._workers = {} # worker_id -> _WorkerHandle
+        self._worker_ids = itertools.count()
+        self._request_ids = itertools.count(1)
+        self._owners = {} # session_id -> worker_id (supervisor 已知的進行中會話)
+        self._moving = {} # session_id -> asyncio.Event，搬移完成時設定
+        self._rebalance_lock = None
+        self._inflight = 0
+        self._idle = None
+        self._closing = False
+        self.migrated_sessions = 0
+        self.respawns = 0
+
+    # ---- 生命週期 ----
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._rebalance_lock = asyncio.Lock()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        handles = await asyncio.gather(*[self._spawn(f"worker-{next(self._worker_ids)}") for _ in range(self.initial_workers)])
+        for handle in handles:
+            self.ring.add(handle.worker_id)
+        print(f"已啟動 {len(handles)} 個 worker 程序。")
+        return self
+
+    async def _spawn(self, worker_id):
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(target=_worker_main, args=(worker_id, child_conn, self.engine_factory),
+                                        name=worker_id, daemon=True)
+        process.start()
+        child_conn.close()
+        handle = _WorkerHandle(worker_id, process, parent_conn, self._loop)
+        self._workers[worker_id] = handle
+        threading.Thread(target=self._read_responses, args=(handle,), name=f"{worker_id}-responses", daemon=True).start()
+        await handle.ready
+        return handle
+
+    def _read_responses(self, handle):
+        try:
+            while True:
+                try:
+                    message = handle.conn.recv()
+                except (EOFError, OSError):
+                    self._loop.call_soon_threadsafe(self._worker_lost, handle)
+                    return
+                self._loop.call_soon_threadsafe(self._deliver, handle, *message)
+        except RuntimeError:
+            pass # 事件迴圈已關閉
+
+    def _deliver(self, handle, req_id, status, value):
+        if req_id is None:
+            if status == "ready" and not handle.ready.done():
+                handle.ready.set_result(value)
+            elif status == "export":
+                # worker 建立了本地儲存後端；匯出只在 supervisor 中執行
+                try:
+                    start_bulk_export(value)
+                except Exception as e:
+                    print(f"無法啟動 '{value.get('path')}' 的定時匯出: {e}")
+            return
+        if status == "chunk":
+            callback = handle.chunk_callbacks.get(req_id)
+            if callback is not None:
+                callback(value)
+            return
+        future = handle.pending.pop(req_id, None)
+        if future is not None and not future.done():
+            future.set_result((status, value))
+
+    def _worker_lost(self, handle):
+        for future in handle.pending.values():
+            if not future.done():
+                future.set_exception(RuntimeError(f"worker '{handle.worker_id}' 已結束。"))
+        handle.pending.clear()
+        if not handle.ready.done():
+            handle.ready.set_exception(RuntimeError(f"worker '{handle.worker_id}' 啟動失敗。"))
+        if handle.stopping or self._closing or self._workers.get(handle.worker_id) is not handle:
+            return
+        # 意外結束：以同一個 id 重新啟動，環不變；有快照的會話在新程序中恢復，沒有的在下一次輸入時回報不存在
+        print(f"worker '{handle.worker_id}' 意外結束，重新啟動。")
+        self.respawns += 1
+        asyncio.ensure_future(self._spawn(handle.worker_id))
+
+    async def close(self, timeout=30.0):
+        """
+        停止接受新會話，等進行中的請求完成後結束所有 worker。
+        """
+        self._closing = True
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            print(f"等待進行中的請求逾時 ({timeout} 秒)，直接結束 worker。")
+        await asyncio.gather(*[self._stop_worker(handle, timeout) for handle in list(self._workers.values())])
+        self._workers.clear()
+        # 所有 worker 都已寫完本地儲存後端，最後匯出一次
+        await self._loop.run_in_executor(None, stop_bulk_exports)
+
+    async def _stop_worker(self, handle, timeout):
+        handle.stopping = True
+        try:
+            await asyncio.wait_for(self._call(handle, "stop"), timeout)
+        except (RuntimeError, asyncio.TimeoutError):
+            pass
+        await self._loop.run_in_executor(None, handle.process.join, timeout)
+        if handle.process.is_alive():
+            handle.process.terminate()
+        handle.conn.close()
+
+    # ---- 請求 ----
+
+    async def _call(self, handle, op, *args, on_chunk=None):
+        await handle.ready
+        req_id = next(self._request_ids)
+        future = self._loop.create_future()
+        handle.pending[req_id] = future
+        if on_chunk is not None:
+            handle.chunk_callbacks[req_id] = on_chunk
+        handle.requests += 1
+        try:
+            handle.conn.send((req_id, op, args))
+            status, value = await future
+        finally:
+            handle.pending.pop(req_id, None)
+            handle.chunk_callbacks.pop(req_id, None)
+        if status == "error":
+            error_type, message = value
+            if error_type == "SessionNotFoundError":
+                raise SessionNotFoundError(message)
+            if error_type == "ValueError":
+                raise ValueError(message)
+            raise RuntimeError(f"worker '{handle.worker_id}' 處理 {op} 時發生錯誤: {error_type}: {message}")
+        return value
+
+    async def _route(self, session_id, op, *args, on_chunk=None):
+        # 會話正在搬移時等待；送出後才發現會話已被搬走 (歸屬改變) 時改送到新的 worker
+        self._inflight += 1
+        self._idle.clear()
+        try:
+            while True:
+                while session_id in self._moving:
+                    await self._moving[session_id].wait()
+                worker_id = self.ring.node_for(session_id)
+                if op == "start":
+                    # 送出前登記歸屬，歡迎語生成期間發生的搬移也會包含這個會話
+                    self._owners[session_id] = worker_id
+                try:
+                    return worker_id, await self._call(self._workers[worker_id], op, *args, on_chunk=on_chunk)
+                except SessionNotFoundError:
+                    if session_id not in self._moving and self.ring.node_for(session_id) == worker_id:
+                        self._owners.pop(session_id, None)
+                        raise
+        finally:
+            self._inflight -= 1
+            if self._inflight == 0:
+                self._idle.set()
+
+    async def start_session(self, session_id=None, on_chunk=None, questionnaire_id=None):
+        """
+        建立新會話，返回 (session_id, 歡迎語)。questionnaire_id 由 worker 各自的問卷註冊表解析。
+        """
+        if self._closing:
+            raise RuntimeError("worker 池正在關閉，不再接受新會話。")
+        session_id = session_id or uuid.uuid4().hex
+        if session_id in self._owners:
+            raise ValueError(f"會話 '{session_id}' 已存在。")
+        try:
+            _, reply = await self._route(session_id, "start", session_id, on_chunk is not None, questionnaire_id,
+                                         on_chunk=on_chunk)
+        except Exception:
+            self._owners.pop(session_id, None)
+            raise
+        return session_id, reply
+
+    async def turn(self, session_id, text, on_chunk=None):
+        worker_id, (reply, active) = await self._route(session_id, "turn", session_id, text, on_chunk is not None,
+                                                      on_chunk=on_chunk)
+        if not active:
+            self._owners.pop(session_id, None)
+        elif session_id not in self._owners:
+            # 由快照恢復的會話 (supervisor 重啟或 worker 重新啟動後)
+            self._owners[session_id] = worker_id
+        return reply
+
+    async def turn_stream(self, session_id, text):
+        """
+        turn() 的非同步產生器版本：逐塊 yield 回覆文字。
+        """
+        queue = asyncio.Queue()
+        task = asyncio.ensure_future(self.turn(session_id, text, on_chunk=queue.put_nowait))
+        task.add_done_callback(lambda _: queue.put_nowait(None))
+        try:
+            while True:
+                piece = await queue.get()
+                if piece is None:
+                    break
+                yield piece
+            await task
+        finally:
+            if not task.done():
+                task.cancel()
+
+    def is_active(self, session_id):
+        """
+        只檢查 supervisor 已知的會話 (回合結束後判斷問卷是否完成用)；
+        supervisor 重啟後或只存在於會話快照中的會話請用 check_active()。
+        """
+        return session_id in self._owners
+
+    async def check_active(self, session_id):
+        """
+        supervisor 不知道的會話交給負責的 worker 判斷 (其 SessionEngine 會查詢會話快照)。
+        """
+        if session_id in self._owners:
+            return True
+        _, active = await self._route(session_id, "is_active", session_id)
+        return active
+
+    def end_session(self, session_id):
+        self._owners.pop(session_id, None)
+        handle = self._workers.get(self.ring.node_for(session_id))
+        if handle is not None and handle.ready.done():
+            handle.conn.send((None, "end", (session_id,)))
+
+    def active_session_count(self):
+        return len(self._owners)
+
+    async def warm_up(self):
+        sizes = await asyncio.gather(*[self._call(handle, "warm_up") for handle in self._workers.values()])
+        return sum(sizes)
+
+    # ---- 增減 worker ----
+
+    async def add_worker(self):
+        """
+        啟動一個新的 worker 並重新分配會話，返回新 worker 的 id。
+        """
+        async with self._rebalance_lock:
+            handle = await self._spawn(f"worker-{next(self._worker_ids)}")
+            ring = self.ring.copy()
+            ring.add(handle.worker_id)
+            moved = await self._rebalance(ring)
+        print(f"已加入 {handle.worker_id}，搬移 {moved} 個會話。")
+        return handle.worker_id
+
+    async def remove_worker(self, worker_id=None, timeout=30.0):
+        """
+        將 worker 的會話搬移到其他 worker，等進行中的回合完成後結束它。worker_id 預設為最後加入的 worker。
+        """
+        async with self._rebalance_lock:
+            if len(self._workers) <= 1:
+                raise ValueError("至少需要保留一個 worker。")
+            worker_id = worker_id or list(self._workers)[-1]
+            handle = self._workers[worker_id]
+            ring = self.ring.copy()
+            ring.remove(worker_id)
+            moved = await self._rebalance(ring)
+            del self._workers[worker_id]
+            await self._stop_worker(handle, timeout)
+        print(f"已移除 {worker_id}，搬移 {moved} 個會話。")
+        return moved
+
+    async def _rebalance(self, ring):
+        # 先標記要搬移的會話再切換到新的環，之後到達的輸入會等待搬移完成
+        moves = {}
+        for session_id, owner in self._owners.items():
+            target = ring.node_for(session_id)
+            if target != owner:
+                moves.setdefault((owner, target), []).append(session_id)
+        done = asyncio.Event()
+        for session_ids in moves.values():
+            for session_id in session_ids:
+                self._moving[session_id] = done
+        self.ring = ring
+        moved = 0
+        try:
+            for (source, target), session_ids in moves.items():
+                # detach 會等該會話進行中的回合完成；期間結束的會話不會被返回
+                states = await self._call(self._workers[source], "detach", session_ids)
+                if states:
+                    await self._call(self._workers[target], "attach", states)
+                detached = {state.session_id for state in states}
+                for session_id in session_ids:
+                    if session_id in detached:
+                        self._owners[session_id] = target
+                    else:
+                        self._owners.pop(session_id, None)
+                moved += len(states)
+        finally:
+            for session_ids in moves.values():
+                for session_id in session_ids:
+                    self._moving.pop(session_id, None)
+            done.set()
+        self.migrated_sessions += moved
+        return moved
+
+    # ---- 統計 ----
+
+    async def stats(self):
+        workers = dict(zip(self._workers, await asyncio.gather(*[self._call(h, "stats") for h in self._workers.values()])))
+        sessions = {worker_id: 0 for worker_id in self._workers}
+        for worker_id in self._owners.values():
+            sessions[worker_id] = sessions.get(worker_id, 0) + 1
+        return {
+            "workers": len(self._workers),
+            "active_sessions": self.active_session_count(),
+            "sessions_per_worker": sessions,
+            "requests_per_worker": {worker_id: h.requests for worker_id, h in self._workers.items()},
+            "migrated_sessions": self.migrated_sessions,
+            "respawns": self.respawns,
+            "worker_stats": workers,
+        }
+
+    async def collect_metrics(self):
+        """
+        彙總所有 worker 的指標，返回一個 Metrics (與單一程序時的輸出格式相同)。
+        """
+        merged = Metrics(buckets=METRICS.buckets)
+        for state in await asyncio.gather(*[self._call(h, "metrics") for h in self._workers.values()]):
+            merged.merge_state(state)
+        return merged
+
+    async def collect_analytics(self):
+        """
+        彙總所有 worker 的答案統計，返回一個 AnswerAnalytics。
+        """
+        merged = AnswerAnalytics()
+        for states in await asyncio.gather(*[self._call(h, "analytics") for h in self._workers.values()]):
+            merged.merge_state(states)
+        return merged